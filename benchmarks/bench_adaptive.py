@@ -0,0 +1,143 @@
+'''
+Benchmark of adaptive uploads against a server whose load swings.
+
+A local stub server takes a fixed time per request plus a time per
+reading, both multiplied by a load factor that goes from light to heavy
+and back, and turns requests away with HTTP 429 once too many are
+waiting. Readings are submitted at a steady rate to an Uploader with
+fixed settings and then to one with adaptive settings, and for each the
+readings delivered and rejected, the requests sent and the delivery
+latency percentiles are reported, along with the adaptive settings
+over time.
+
+Usage: python benchmarks/bench_adaptive.py [--rate N] [--phase S]
+Run it from the project root with the client installed, or with
+PYTHONPATH=. set.
+'''
+import argparse, json, multiprocessing, time, urllib.request
+
+from sensclient.engine import Engine
+from sensclient.uploader import Uploader
+
+
+# The load factor of the server in each phase
+PHASES = (1.0, 4.0, 1.0)
+
+
+def stub_server(port, phase, per_request, per_reading, capacity):
+    '''
+    Runs a stub Senslify server whose response times follow PHASES.
+    '''
+    import asyncio
+    from aiohttp import web
+
+    start = time.monotonic()
+    latencies = []
+    counts = {'accepted': 0, 'rejected': 0}
+    busy = asyncio.Semaphore(capacity)
+    waiting = [0]
+
+    def load():
+        return PHASES[min(int((time.monotonic() - start) / phase), len(PHASES) - 1)]
+
+    async def upload(request):
+        if waiting[0] >= capacity * 2:
+            counts['rejected'] += 1
+            return web.Response(status=429, headers={'Retry-After': '1'})
+        waiting[0] += 1
+        try:
+            body = await request.json()
+            async with busy:
+                await asyncio.sleep(load() * (per_request + per_reading * len(body['readings'])))
+        finally:
+            waiting[0] -= 1
+        now = time.time()
+        latencies.extend(now - reading['ts'] for reading in body['readings'])
+        counts['accepted'] += 1
+        return web.Response(text='ok')
+
+    async def stats(request):
+        ordered = sorted(latencies)
+        def pct(q):
+            return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else None
+        return web.json_response(dict(counts, count=len(ordered), p50=pct(0.5), p99=pct(0.99)))
+
+    async def reset(request):
+        nonlocal start
+        start = time.monotonic()
+        latencies.clear()
+        counts.update(accepted=0, rejected=0)
+        return web.Response(text='ok')
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post('/upload', upload)
+    app.router.add_get('/stats', stats)
+    app.router.add_post('/reset', reset)
+    web.run_app(app, host='127.0.0.1', port=port, print=None)
+
+
+def server_stats(port, path='/stats', data=None):
+    url = 'http://127.0.0.1:{}{}'.format(port, path)
+    with urllib.request.urlopen(url, data=data) as resp:
+        return json.loads(resp.read().decode('utf-8')) if data is None else None
+
+
+def run(port, rate, duration, settings):
+    '''
+    Submits readings at a steady rate for the duration and reports what
+    the server received.
+    '''
+    server_stats(port, '/reset', b'')
+    uploader = Uploader('127.0.0.1:{}'.format(port), Engine(), timeout=5.0, **settings)
+    uploader.start()
+    timeline = []
+    start = time.monotonic()
+    sent = 0
+    while time.monotonic() - start < duration:
+        due = int((time.monotonic() - start) * rate)
+        while sent < due:
+            uploader.submit({'device': 'bench', 'ts': time.time(), 'id': sent % 8, 'count': sent,
+                'readings': [sent & 0xfff] * 10})
+            sent += 1
+        stats = uploader.stats()
+        if not timeline or time.monotonic() - timeline[-1][0] >= 1.0:
+            timeline.append((time.monotonic(), stats['batch_size'], stats['flush_interval'],
+                stats['inflight_limit'], stats['latency']))
+        time.sleep(0.005)
+    uploader.close(timeout=30)
+    return sent, uploader.stats(), server_stats(port), [(t - start,) + tuple(rest) for t, *rest in timeline]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rate', type=float, default=2000.0, help='readings/s submitted')
+    parser.add_argument('--phase', type=float, default=5.0, help='seconds per load phase')
+    parser.add_argument('--port', type=int, default=18767)
+    parser.add_argument('--capacity', type=int, default=2, help='requests the server handles at once')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('fork')
+    server = context.Process(target=stub_server,
+        args=(args.port, args.phase, 0.02, 0.0002, args.capacity), daemon=True)
+    server.start()
+    time.sleep(1.0)
+    duration = args.phase * len(PHASES)
+
+    fixed = {'batch_size': 50, 'flush_interval': 0.1, 'connections': 8}
+    print('{:<10} {:>9} {:>10} {:>9} {:>9} {:>10} {:>10}'.format(
+        'MODE', 'SENT', 'DELIVERED', 'REJECTED', 'REQUESTS', 'p50 (ms)', 'p99 (ms)'))
+    for mode, settings in (('fixed', fixed), ('adaptive', dict(fixed, adaptive={'target_latency': 0.25}))):
+        sent, stats, received, timeline = run(args.port, args.rate, duration, settings)
+        print('{:<10} {:>9} {:>10} {:>9} {:>9} {:>10.0f} {:>10.0f}'.format(
+            mode, sent, received['count'], received['rejected'], stats['requests'],
+            (received['p50'] or 0) * 1e3, (received['p99'] or 0) * 1e3))
+        if mode == 'adaptive':
+            print('\n{:>6} {:>8} {:>9} {:>9} {:>12}'.format('TIME', 'BATCH', 'INTERVAL', 'INFLIGHT', 'LATENCY'))
+            for t, batch, interval, inflight, latency in timeline:
+                print('{:>6.0f} {:>8} {:>9.2f} {:>9} {:>12}'.format(t, batch, interval, inflight,
+                    '{:.0f}ms'.format(latency * 1e3) if latency is not None else '-'))
+    server.terminate()
+
+
+if __name__ == '__main__':
+    main()
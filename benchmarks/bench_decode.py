@@ -0,0 +1,77 @@
+'''
+Microbenchmark comparing the generic tos.Packet decoding of oscilloscope
+messages against the struct based decoders in sensclient.decoding.
+
+Usage: python benchmarks/bench_decode.py [--packets N] [--readings N]
+Run it from the project root with the client installed, or with
+PYTHONPATH=. set.
+'''
+import argparse, random, struct, timeit
+
+from sensclient import decoding
+from sensclient.listener import OscilloscopeMsg
+
+
+def make_payloads(packets, nreadings):
+    '''
+    Builds synthetic oscilloscope messages.
+    Arguments:
+        packets: The number of messages to build.
+        nreadings: The number of readings per message.
+    '''
+    layout = struct.Struct('>HHHH{}H'.format(nreadings))
+    return [
+        layout.pack(1, 256, i % 32, i & 0xffff,
+            *(random.randrange(0, 4096) for _ in range(nreadings)))
+        for i in range(packets)
+    ]
+
+
+def tos_packet(payloads):
+    for payload in payloads:
+        msg = OscilloscopeMsg(list(payload))
+        raw = msg.readings
+        [(raw[i] << 8) | raw[i+1] for i in range(0, len(raw) - 1, 2)]
+
+
+def fast_message(payloads):
+    for payload in payloads:
+        decoding.decode_message(payload)
+
+
+def registry_dispatch(payloads):
+    table = decoding.DECODERS.table([0x93])
+    for payload in payloads:
+        table[0x93](payload)
+
+
+def fast_batch(payloads):
+    decoding.decode_batch(payloads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--packets', type=int, default=10000)
+    parser.add_argument('--readings', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    payloads = make_payloads(args.packets, args.readings)
+    print('{} packets of {} readings, NumPy {}'.format(
+        args.packets, args.readings,
+        'available' if decoding.load_numpy() is not None else 'not available'))
+    print('{:<24} {:>12} {:>12}'.format('DECODER', 'US/PACKET', 'PACKETS/S'))
+    baseline = None
+    for name, func in (('tos.Packet', tos_packet),
+                       ('decode_message', fast_message),
+                       ('registry dispatch', registry_dispatch),
+                       ('decode_batch', fast_batch)):
+        best = min(timeit.repeat(lambda: func(payloads), number=1, repeat=args.repeat))
+        per_packet = best / args.packets
+        baseline = baseline or per_packet
+        print('{:<24} {:>12.3f} {:>12.0f}  ({:.1f}x)'.format(
+            name, per_packet * 1e6, 1 / per_packet, baseline / per_packet))
+
+
+if __name__ == '__main__':
+    main()
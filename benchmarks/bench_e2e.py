@@ -0,0 +1,159 @@
+'''
+End-to-end benchmark of the client's ingest path: fake motes on
+pseudo-terminals feed real Listeners, whose events go through the event
+queue and the Uploader to a local stub Senslify server.
+
+Reports the end-to-end throughput, the ingest-to-upload latency
+percentiles, the CPU used per device and the peak RSS of the client.
+The fake motes and the stub server run in their own processes, so only
+the client's own work is measured.
+
+Usage: python benchmarks/bench_e2e.py [--devices N] [--rate N] [--duration S]
+Run it from the project root with the client installed, or with
+PYTHONPATH=. set. Linux only.
+'''
+import argparse, json, multiprocessing, os, resource, sys, threading, time, urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakemote import FakeMote
+from sensclient.engine import Engine
+from sensclient.eventqueue import EventQueue
+from sensclient.listener import Listener
+from sensclient.uploader import Uploader, make_reading
+
+
+def stub_server(port):
+    '''
+    Runs a stub Senslify server that accepts uploads and records, for
+    every reading, the time between its ingestion by the client and its
+    arrival at the server.
+    '''
+    from aiohttp import web
+
+    latencies = []
+
+    async def upload(request):
+        now = time.time()
+        body = await request.json()
+        latencies.extend(now - reading['ts'] for reading in body['readings'])
+        return web.Response(text='ok')
+
+    async def stats(request):
+        ordered = sorted(latencies)
+        def pct(q):
+            return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else None
+        return web.json_response({'count': len(ordered), 'p50': pct(0.5), 'p99': pct(0.99)})
+
+    app = web.Application()
+    app.router.add_post('/upload', upload)
+    app.router.add_get('/stats', stats)
+    web.run_app(app, host='127.0.0.1', port=port, print=None)
+
+
+def run_motes(motes, duration, tick=0.005):
+    '''
+    Drives every fake mote from one process until the duration passes.
+    '''
+    start = time.monotonic()
+    while time.monotonic() - start < duration:
+        elapsed = time.monotonic() - start
+        for mote in motes:
+            due = int(elapsed * mote.rate)
+            if due > mote.sent:
+                os.write(mote.master, b''.join(mote.message(i) for i in range(mote.sent, due)))
+                mote.sent = due
+        time.sleep(tick)
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--devices', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=200.0, help='messages/s per device')
+    parser.add_argument('--motes', type=int, default=8, help='motes per device')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--flush-interval', type=float, default=0.25)
+    parser.add_argument('--port', type=int, default=18765)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('fork')
+    server = context.Process(target=stub_server, args=(args.port,), daemon=True)
+    server.start()
+    time.sleep(1.0)
+
+    motes = [FakeMote(args.rate, args.motes) for _ in range(args.devices)]
+
+    engine = Engine.default()
+    queue = EventQueue(maxsize=100000)
+    uploader = Uploader('127.0.0.1:{}'.format(args.port), batch_size=args.batch_size,
+        flush_interval=args.flush_interval)
+    uploader.start()
+
+    def consume():
+        while True:
+            events = queue.get(max_items=256)
+            if not events:
+                break
+            for device, event, _ in events:
+                uploader.submit(make_reading(device, event))
+
+    consumer = threading.Thread(target=consume, daemon=True)
+    consumer.start()
+
+    listeners = []
+    for mote in motes:
+        listener = Listener(queue.put, mote.device, 115200)
+        listener.start()
+        listener.resume()
+        listeners.append(listener)
+
+    cpu_start = cpu_seconds()
+    wall_start = time.monotonic()
+    writer = context.Process(target=run_motes, args=(motes, args.duration), daemon=True)
+    writer.start()
+    writer.join()
+
+    # give the pipeline time to drain
+    deadline = time.monotonic() + 5.0
+    while queue.depth() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    uploader.flush()
+    time.sleep(args.flush_interval + 0.5)
+    wall = time.monotonic() - wall_start
+    cpu = cpu_seconds() - cpu_start
+
+    for listener in listeners:
+        listener.stop()
+    queue.close()
+    uploader.close(timeout=10)
+    engine.close()
+
+    with urllib.request.urlopen('http://127.0.0.1:{}/stats'.format(args.port)) as resp:
+        stats = json.loads(resp.read().decode('utf-8'))
+    server.terminate()
+    for mote in motes:
+        mote.close()
+
+    offered = int(args.devices * args.rate * args.duration)
+    received = stats['count']
+    print('{} devices x {:.0f} messages/s for {:.0f}s ({} offered)'.format(
+        args.devices, args.rate, args.duration, offered))
+    print('{:<28} {}'.format('uploaded', '{} ({:.2%} lost)'.format(
+        received, 1 - received / offered if offered else 0)))
+    print('{:<28} {:.0f}'.format('throughput (packets/s)', received / args.duration))
+    if received:
+        print('{:<28} {:.1f} / {:.1f}'.format('latency p50 / p99 (ms)',
+            stats['p50'] * 1e3, stats['p99'] * 1e3))
+    print('{:<28} {:.1f}% total, {:.2f}% per device'.format('CPU',
+        100 * cpu / wall, 100 * cpu / wall / args.devices))
+    print('{:<28} {:.1f}'.format('peak RSS (MB)', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+if __name__ == '__main__':
+    main()
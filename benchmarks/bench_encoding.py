@@ -0,0 +1,94 @@
+'''
+Benchmark of the upload encodings: compares the bytes sent per reading
+and the CPU spent encoding a batch in plain JSON and in the columnar
+encoding, each with and without gzip.
+
+The readings mimic a gateway forwarding the oscilloscope messages of a
+few motes, whose readings drift slowly around a level of their own.
+
+Usage: python benchmarks/bench_encoding.py [--batch N] [--motes N] [--readings N]
+Run it from the project root with the client installed, or with
+PYTHONPATH=. set.
+'''
+import argparse, gzip, json, random, timeit
+
+import simplejson
+
+from sensclient import columnar
+
+
+def make_readings(batch, motes, nreadings, rate=10.0):
+    '''
+    Builds a batch of synthetic readings.
+    Arguments:
+        batch: The number of readings.
+        motes: The number of distinct motes they come from.
+        nreadings: The number of readings per message.
+        rate: The number of messages per second.
+    '''
+    levels = [random.randrange(500, 3500) for _ in range(motes)]
+    start = 1.7e9
+    readings = []
+    for i in range(batch):
+        mote = i % motes
+        values = []
+        for _ in range(nreadings):
+            levels[mote] = max(0, min(4095, levels[mote] + random.randint(-3, 3)))
+            values.append(levels[mote])
+        readings.append({
+            'device': '/dev/ttyUSB0',
+            'ts': start + i / rate + random.random() * 1e-3,
+            'version': 1,
+            'interval': 256,
+            'id': mote + 1,
+            'count': i // motes,
+            'readings': values
+        })
+    return readings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--batch', type=int, default=500)
+    parser.add_argument('--motes', type=int, default=8)
+    parser.add_argument('--readings', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    readings = make_readings(args.batch, args.motes, args.readings)
+    # the Uploader serializes every reading as it is submitted and joins
+    #   the results when a batch is sent, columnar batches are encoded
+    #   from those records
+    records = [simplejson.dumps(reading).encode('utf-8') for reading in readings]
+
+    def json_body():
+        return b'{"readings":[' + b','.join(
+            simplejson.dumps(reading).encode('utf-8') for reading in readings) + b']}'
+
+    def columnar_body():
+        return columnar.encode(readings)
+
+    def columnar_from_records():
+        return columnar.encode(json.loads(b'[' + b','.join(records) + b']'))
+
+    assert len(columnar.decode(columnar_body())) == len(readings)
+
+    print('{} readings from {} motes, {} values each'.format(args.batch, args.motes, args.readings))
+    print('{:<30} {:>14} {:>14}'.format('ENCODING', 'BYTES/READING', 'US/READING'))
+    # JSON timings include serializing every reading, columnar timings
+    #   start from the readings or, as in the Uploader, from the records
+    for name, func, compress in (
+            ('json', json_body, False),
+            ('json + gzip', json_body, True),
+            ('columnar', columnar_body, False),
+            ('columnar + gzip', columnar_body, True),
+            ('columnar (from records)', columnar_from_records, False)):
+        encode = (lambda: gzip.compress(func(), compresslevel=5)) if compress else func
+        size = len(encode())
+        best = min(timeit.repeat(encode, number=10, repeat=args.repeat)) / 10
+        print('{:<30} {:>14.1f} {:>14.2f}'.format(
+            name, size / args.batch, best / args.batch * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+'''
+Startup benchmark of the headless client ('sdcp daemon').
+
+Measures the time taken to import the client, then runs the daemon
+against a fake mote and a local stub Senslify server and measures the
+time from launching the process to its readiness notification (sent
+over a NOTIFY_SOCKET, as systemd would receive it), to the first
+reading arriving at the server, and to a clean exit on SIGTERM.
+
+Usage: python benchmarks/bench_startup.py [--runs N]
+Run it from the project root with the client installed, or with
+PYTHONPATH=. set. Linux only.
+'''
+import argparse, json, multiprocessing, os, signal, socket, statistics, subprocess, sys, \
+    tempfile, threading, time, urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_e2e import stub_server
+from fakemote import FakeMote
+
+
+# The modules the client defers until they are first used
+DEFERRED = ('aiohttp', 'numpy', 'click_shell', 'tinyos3.tos', 'http.server', 'multiprocessing')
+
+_IMPORT = '''
+import sys, time
+start = time.perf_counter()
+import sensclient.client
+{extra}
+print(time.perf_counter() - start)
+print(','.join(m for m in {deferred!r} if m in sys.modules))
+'''
+
+
+def import_time(eager=False):
+    '''
+    Imports the client in a fresh interpreter.
+    Arguments:
+        eager: Also import every deferred module, as the client used to.
+    Returns the import time in seconds and the deferred modules that
+    were imported anyway.
+    '''
+    extra = 'import ' + ', '.join(DEFERRED) if eager else ''
+    out = subprocess.check_output([sys.executable, '-c',
+        _IMPORT.format(extra=extra, deferred=DEFERRED)], env=os.environ)
+    seconds, loaded = out.decode('utf-8').splitlines()
+    return float(seconds), loaded
+
+
+def uploaded(port):
+    with urllib.request.urlopen('http://127.0.0.1:{}/stats'.format(port)) as resp:
+        return json.loads(resp.read().decode('utf-8'))['count']
+
+
+def run_daemon(config, port, notify_path):
+    '''
+    Launches the daemon once and times its startup and shutdown.
+    '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(notify_path)
+    sock.settimeout(30)
+    env = dict(os.environ, NOTIFY_SOCKET=notify_path)
+    before = uploaded(port)
+    start = time.monotonic()
+    process = subprocess.Popen([sys.executable, '-m', 'sensclient', 'daemon', '--config', config],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while b'READY=1' not in sock.recv(4096):
+            pass
+        ready = time.monotonic() - start
+        while uploaded(port) == before:
+            time.sleep(0.002)
+        first = time.monotonic() - start
+        stopping = time.monotonic()
+        process.send_signal(signal.SIGTERM)
+        process.wait(30)
+        stop = time.monotonic() - stopping
+    finally:
+        if process.poll() is None:
+            process.kill()
+        sock.close()
+        os.unlink(notify_path)
+    return ready, first, stop, process.returncode
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--rate', type=float, default=100.0, help='messages/s sent by the fake mote')
+    parser.add_argument('--port', type=int, default=18766)
+    args = parser.parse_args()
+
+    lazy = [import_time() for _ in range(args.runs)]
+    eager = [import_time(eager=True) for _ in range(args.runs)]
+    print('{:<36} {:>10.1f}'.format('import, deferred (ms)', statistics.median(t for t, _ in lazy) * 1e3))
+    print('{:<36} {:>10.1f}'.format('import, everything (ms)', statistics.median(t for t, _ in eager) * 1e3))
+    if lazy[0][1]:
+        print('{:<36} {:>10}'.format('imported anyway', lazy[0][1]))
+
+    context = multiprocessing.get_context('fork')
+    server = context.Process(target=stub_server, args=(args.port,), daemon=True)
+    server.start()
+    time.sleep(1.0)
+    mote = FakeMote(args.rate, 4)
+    threading.Thread(target=mote.run, args=(None,), daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config = os.path.join(tmp, 'sensclient.json')
+        with open(config, 'w') as fp:
+            json.dump({
+                'servers': {'primary': '127.0.0.1:{}'.format(args.port), 'secondary': []},
+                'devices': [{'device': mote.device, 'baudrate': 115200, 'amrate': 'OSCILLOSCOPE'}],
+                'spool': {'enabled': False},
+                'uploader': {'flush_interval': 0.01}
+            }, fp)
+        runs = [run_daemon(config, args.port, os.path.join(tmp, 'notify')) for _ in range(args.runs)]
+
+    server.terminate()
+    print('{:<36} {:>10.1f}'.format('launch to READY=1 (ms)', statistics.median(r[0] for r in runs) * 1e3))
+    print('{:<36} {:>10.1f}'.format('launch to first upload (ms)', statistics.median(r[1] for r in runs) * 1e3))
+    print('{:<36} {:>10.1f}'.format('SIGTERM to exit (ms)', statistics.median(r[2] for r in runs) * 1e3))
+    print('{:<36} {:>10}'.format('exit codes', ','.join(str(r[3]) for r in runs)))
+
+
+if __name__ == '__main__':
+    main()
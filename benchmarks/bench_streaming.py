@@ -0,0 +1,135 @@
+'''
+Benchmark of streaming uploads over a WebSocket against HTTP batches.
+
+A local stub server accepts both HTTP batches at /upload and streams at
+/stream, acknowledging every frame, and records for every reading the
+time between its submission and its arrival. Readings are submitted at
+a steady rate to an Uploader sending HTTP batches, to one streaming,
+and to one streaming to a server that drops the connection every few
+frames, and for each the readings delivered (and how many of them
+arrived more than once), the requests or frames sent, the client CPU
+and the delivery latency percentiles are reported.
+
+Usage: python benchmarks/bench_streaming.py [--rate N] [--duration S]
+Run it from the project root with the client installed, or with
+PYTHONPATH=. set.
+'''
+import argparse, json, multiprocessing, time, urllib.request
+
+from sensclient.engine import Engine
+from sensclient.streaming import decode_frame
+from sensclient.uploader import Uploader
+
+
+def stub_server(port, drop_every):
+    '''
+    Runs a stub Senslify server taking both HTTP batches and streams.
+    Streams are dropped after every drop_every frames if it is set.
+    '''
+    from aiohttp import web, WSMsgType
+
+    latencies = []
+    seen = set()
+    counts = {'duplicates': 0, 'frames': 0}
+    acked = dict()
+
+    def record(readings):
+        now = time.time()
+        for reading in readings:
+            if reading['count'] in seen:
+                counts['duplicates'] += 1
+                continue
+            seen.add(reading['count'])
+            latencies.append(now - reading['ts'])
+
+    async def upload(request):
+        record((await request.json())['readings'])
+        return web.Response(text='ok')
+
+    async def stream(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        hello = json.loads((await ws.receive()).data)
+        await ws.send_str(json.dumps({'acked': acked.get(hello['stream'], 0)}))
+        async for msg in ws:
+            if msg.type != WSMsgType.BINARY:
+                continue
+            counts['frames'] += 1
+            if drop_every and counts['frames'] % drop_every == 0:
+                await ws.close()
+                break
+            seq, readings = decode_frame(msg.data)
+            record(readings)
+            acked[hello['stream']] = seq
+            await ws.send_str(json.dumps({'ack': seq}))
+        return ws
+
+    async def stats(request):
+        ordered = sorted(latencies)
+        def pct(q):
+            return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else None
+        return web.json_response(dict(counts, count=len(ordered), p50=pct(0.5), p99=pct(0.99)))
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post('/upload', upload)
+    app.router.add_get('/stream', stream)
+    app.router.add_get('/stats', stats)
+    web.run_app(app, host='127.0.0.1', port=port, print=None)
+
+
+def run(server, rate, duration, settings):
+    '''
+    Submits readings at a steady rate for the duration and returns the
+    readings sent, the Uploader's stats and the CPU it took.
+    '''
+    uploader = Uploader(server, Engine(), **settings)
+    uploader.start()
+    cpu = time.process_time()
+    start = time.monotonic()
+    sent = 0
+    while time.monotonic() - start < duration:
+        due = int((time.monotonic() - start) * rate)
+        while sent < due:
+            uploader.submit({'device': 'bench', 'ts': time.time(), 'id': sent % 8, 'count': sent,
+                'readings': [sent & 0xfff] * 10})
+            sent += 1
+        time.sleep(0.002)
+    uploader.close(timeout=30)
+    return sent, uploader.stats(), time.process_time() - cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rate', type=float, default=5000.0, help='readings/s submitted')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per run')
+    parser.add_argument('--batch', type=int, default=50, help='readings per batch')
+    parser.add_argument('--interval', type=float, default=0.02, help='flush interval in seconds')
+    parser.add_argument('--drop-every', type=int, default=25, help='frames between dropped streams')
+    parser.add_argument('--port', type=int, default=18768)
+    args = parser.parse_args()
+
+    settings = {'batch_size': args.batch, 'flush_interval': args.interval, 'timeout': 5.0}
+    runs = (
+        ('http', '127.0.0.1:{}', 0),
+        ('websocket', 'ws://127.0.0.1:{}/stream', 0),
+        ('ws+drops', 'ws://127.0.0.1:{}/stream', args.drop_every)
+    )
+    context = multiprocessing.get_context('fork')
+    print('{:<10} {:>9} {:>10} {:>6} {:>9} {:>8} {:>10} {:>10}'.format(
+        'MODE', 'SENT', 'DELIVERED', 'DUPS', 'REQUESTS', 'CPU (s)', 'p50 (ms)', 'p99 (ms)'))
+    for num, (mode, server, drop_every) in enumerate(runs):
+        port = args.port + num
+        stub = context.Process(target=stub_server, args=(port, drop_every), daemon=True)
+        stub.start()
+        time.sleep(1.0)
+        sent, stats, cpu = run(server.format(port), args.rate, args.duration, settings)
+        with urllib.request.urlopen('http://127.0.0.1:{}/stats'.format(port)) as resp:
+            received = json.loads(resp.read().decode('utf-8'))
+        stub.terminate()
+        print('{:<10} {:>9} {:>10} {:>6} {:>9} {:>8.2f} {:>10.1f} {:>10.1f}'.format(
+            mode, sent, received['count'], received['duplicates'], stats['requests'], cpu,
+            (received['p50'] or 0) * 1e3, (received['p99'] or 0) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
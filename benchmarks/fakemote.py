@@ -0,0 +1,108 @@
+'''
+A fake TinyOS basestation backed by a pseudo-terminal. It emits
+correctly framed oscilloscope messages at a configurable rate, so real
+Listeners can be pointed at it without any hardware.
+
+Usage: python benchmarks/fakemote.py [--rate N] [--motes N] [--duration S]
+Prints the pseudo-terminal to point the client at, e.g.
+'devices add /dev/pts/3 115200 OSCILLOSCOPE'.
+'''
+import argparse, os, pty, struct, time, tty
+
+from sensclient.framing import frame, PROTO_PACKET_NOACK, DISPATCH_AM
+from sensclient.listener import AM_HEADER, Listener
+
+
+class FakeMote:
+    '''
+    Defines a pseudo-terminal that behaves like a basestation mote
+    forwarding oscilloscope messages from a number of motes.
+    '''
+
+    def __init__(self, rate=100.0, motes=1, nreadings=10, amtype=Listener.AM_RATES['OSCILLOSCOPE'],
+            interval=256, corrupt=0.0):
+        '''
+        Opens a new pseudo-terminal.
+        Arguments:
+            rate: The number of messages sent per second.
+            motes: The number of distinct motes the messages come from.
+            nreadings: The number of readings per message.
+            amtype: The AM type of the messages.
+            interval: The sampling interval reported in the messages.
+            corrupt: The fraction of frames sent with a bad CRC.
+        '''
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.device = os.ttyname(self.slave)
+        self.rate = float(rate)
+        self.motes = max(1, int(motes))
+        self.amtype = amtype
+        self.interval = interval
+        self.corrupt = float(corrupt)
+        self.sent = 0
+        self._layout = struct.Struct('>HHHH{}H'.format(nreadings))
+        self._nreadings = nreadings
+        self._counts = [0] * self.motes
+
+
+    def message(self, i):
+        '''
+        Builds the i-th framed message.
+        Arguments:
+            i: The index of the message.
+        '''
+        mote = i % self.motes
+        count = self._counts[mote]
+        self._counts[mote] = (count + 1) & 0xffff
+        payload = self._layout.pack(1, self.interval, mote + 1, count,
+            *(((i + j) * 37) & 0x0fff for j in range(self._nreadings)))
+        am = AM_HEADER.pack(0xffff, mote + 1, len(payload), 0x22, self.amtype)
+        data = frame(bytes((PROTO_PACKET_NOACK, DISPATCH_AM)) + am + payload)
+        if self.corrupt and (i * 7919) % 1000 < self.corrupt * 1000:
+            data = data[:-2] + bytes((data[-2] ^ 0xff,)) + data[-1:]
+        return data
+
+
+    def run(self, duration, tick=0.01):
+        '''
+        Sends messages at the configured rate.
+        Arguments:
+            duration: The time in seconds to send for, None sends
+            forever.
+            tick: The time in seconds between writes.
+        '''
+        start = time.monotonic()
+        while duration is None or time.monotonic() - start < duration:
+            due = int((time.monotonic() - start) * self.rate)
+            if due > self.sent:
+                os.write(self.master, b''.join(self.message(i) for i in range(self.sent, due)))
+                self.sent = due
+            time.sleep(tick)
+
+
+    def close(self):
+        '''
+        Closes the pseudo-terminal.
+        '''
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rate', type=float, default=10.0)
+    parser.add_argument('--motes', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=None)
+    args = parser.parse_args()
+
+    mote = FakeMote(args.rate, args.motes)
+    print('Fake mote sending {} messages/s on {}'.format(args.rate, mote.device), flush=True)
+    try:
+        mote.run(args.duration)
+    except KeyboardInterrupt:
+        pass
+    mote.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,18 @@
-from sensclient.client import init
 import os, sys
 
 
+def __getattr__(name):
+    # The client imports nearly everything, so it is only imported when
+    #   needed; importing one of the package's modules (as the sharding
+    #   workers do) stays cheap
+    if name == 'init':
+        from sensclient.client import init
+        return init
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
 def main():
+    from sensclient.client import init
     init()
 
 
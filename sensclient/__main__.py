@@ -0,0 +1,4 @@
+from sensclient import main
+
+
+main()
@@ -0,0 +1,226 @@
+import asyncio, time
+
+
+class InflightLimit:
+    '''
+    Defines a limit on the number of requests in flight at once, like
+    an asyncio.Semaphore whose limit can be changed while requests are
+    waiting on it. Must be used on one event loop.
+    '''
+
+    def __init__(self, limit):
+        self._limit = max(1, int(limit))
+        self._active = 0
+        self._changed = asyncio.Condition()
+
+
+    def limit(self):
+        '''
+        Gets the maximum number of requests in flight.
+        '''
+        return self._limit
+
+
+    def set_limit(self, limit):
+        '''
+        Changes the maximum number of requests in flight. Lowering it
+        does not interrupt requests already in flight.
+        Arguments:
+            limit: The new limit, at least 1.
+        '''
+        limit = max(1, int(limit))
+        if limit > self._limit:
+            self._limit = limit
+            asyncio.get_running_loop().create_task(self._notify())
+        else:
+            self._limit = limit
+
+
+    async def _notify(self):
+        async with self._changed:
+            self._changed.notify_all()
+
+
+    async def __aenter__(self):
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._active < self._limit)
+            self._active += 1
+
+
+    async def __aexit__(self, *exc):
+        async with self._changed:
+            self._active -= 1
+            self._changed.notify()
+
+
+class AdaptiveController:
+    '''
+    Defines the controller that tunes the upload path to how quickly
+    the server is answering.
+
+    The controller runs AIMD (additive increase, multiplicative
+    decrease) against a latency target, the way TCP finds the capacity
+    of a link. The number of requests in flight grows by one per round
+    of responses that come back in time, going by a moving average of
+    the latency, and the flush interval shrinks by the recovery factor,
+    so readings wait as little as possible. A sign of congestion (an
+    HTTP 429 or 5xx, or the average latency going over the target)
+    cuts the requests in flight by the decrease factor and stretches
+    the flush interval by as much, so the same readings go out in
+    fewer, larger requests; this happens at most once per round trip,
+    so that one burst of errors counts once. A 429 or 503 with a
+    Retry-After header also holds back every request for as long as
+    the server asked.
+
+    The batch size only grows, by batch_step, when full batches come
+    back in time, and is cut when a request fails outright (a timeout
+    or a lost connection) or is refused as too large (HTTP 413), which
+    is when batches have grown past what the server takes.
+    '''
+
+    def __init__(self, batch_size, flush_interval, inflight, target_latency=0.5,
+            min_batch=10, max_batch=5000, batch_step=50, min_interval=0.05,
+            max_interval=2.0, recovery=0.9, max_inflight=None, decrease=0.5,
+            alpha=0.3):
+        '''
+        Returns a new AdaptiveController.
+        Arguments:
+            batch_size: The initial number of readings per request.
+            flush_interval: The initial flush interval in seconds.
+            inflight: The initial number of requests in flight.
+            target_latency: The latency in seconds past which the
+            server is considered congested.
+            min_batch: The smallest batch size.
+            max_batch: The largest batch size.
+            batch_step: How much the batch size grows per response.
+            min_interval: The shortest flush interval.
+            max_interval: The longest flush interval.
+            recovery: The factor the flush interval shrinks by per
+            response.
+            max_inflight: The most requests in flight, defaults to
+            the initial number.
+            decrease: The factor applied on congestion.
+            alpha: The weight of new samples in the latency average.
+        Raises a ValueError if the bounds are inconsistent.
+        '''
+        max_inflight = inflight if max_inflight is None else max_inflight
+        if not (0 < min_batch <= max_batch and 0 < min_interval <= max_interval
+                and max_inflight >= 1 and 0 < decrease < 1 and 0 < recovery <= 1
+                and target_latency > 0):
+            raise ValueError('Invalid adaptive upload settings!')
+        self._target = float(target_latency)
+        self._min_batch, self._max_batch = int(min_batch), int(max_batch)
+        self._batch_step = int(batch_step)
+        self._min_interval, self._max_interval = float(min_interval), float(max_interval)
+        self._recovery = float(recovery)
+        self._max_inflight = int(max_inflight)
+        self._decrease = float(decrease)
+        self._alpha = float(alpha)
+
+        self._batch = float(min(max(batch_size, self._min_batch), self._max_batch))
+        self._interval = min(max(float(flush_interval), self._min_interval), self._max_interval)
+        self._window = float(min(max(inflight, 1), self._max_inflight))
+        self._latency = None
+        self._decreased = 0.0
+        self._hold_until = 0.0
+        self._decreases = 0
+
+
+    #
+    # ACCESSOR METHODS
+    #
+
+    def batch_size(self):
+        '''
+        Gets the number of readings to send per request.
+        '''
+        return int(self._batch)
+
+
+    def flush_interval(self):
+        '''
+        Gets the time in seconds a reading may wait before its batch
+        is sent.
+        '''
+        return self._interval
+
+
+    def inflight(self):
+        '''
+        Gets the number of requests that may be in flight at once.
+        '''
+        return int(self._window)
+
+
+    def latency(self):
+        '''
+        Gets the moving average of the response latency, or None
+        before the first response.
+        '''
+        return self._latency
+
+
+    def target(self):
+        '''
+        Gets the latency target in seconds.
+        '''
+        return self._target
+
+
+    def decreases(self):
+        '''
+        Gets the number of times congestion cut the settings.
+        '''
+        return self._decreases
+
+
+    def delay(self):
+        '''
+        Gets the time in seconds to hold back requests for, as asked
+        by the server.
+        '''
+        return max(0.0, self._hold_until - time.monotonic())
+
+
+    #
+    # CONTROL METHODS
+    #
+
+    def observe(self, latency, status, retry_after=None, size=None):
+        '''
+        Folds the outcome of one request into the settings.
+        Arguments:
+            latency: The time in seconds the request took.
+            status: The HTTP status of the response, None if the
+            request failed.
+            retry_after: The value of the response's Retry-After
+            header, if any.
+            size: The number of readings in the request.
+        '''
+        now = time.monotonic()
+        if status is not None and status < 300:
+            self._latency = latency if self._latency is None else \
+                self._latency + self._alpha * (latency - self._latency)
+        if retry_after is not None and status in (429, 503):
+            try:
+                self._hold_until = max(self._hold_until, now + min(float(retry_after), 300.0))
+            except ValueError:
+                pass
+        failed = status is None or status == 413
+        congested = failed or status == 429 or status >= 500 or \
+            (self._latency is not None and self._latency > self._target)
+        if congested:
+            # react once per round trip
+            if now - self._decreased < max(self._latency or 0.0, self._min_interval):
+                return
+            self._decreased = now
+            self._decreases += 1
+            self._window = max(1.0, self._window * self._decrease)
+            self._interval = min(self._max_interval, self._interval / self._decrease)
+            if failed:
+                self._batch = max(self._min_batch, self._batch * self._decrease)
+        elif status < 300:
+            self._window = min(self._max_inflight, self._window + 1.0 / self._window)
+            self._interval = max(self._min_interval, self._interval * self._recovery)
+            if size is not None and size >= int(self._batch):
+                self._batch = min(self._max_batch, self._batch + self._batch_step)
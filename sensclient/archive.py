@@ -0,0 +1,584 @@
+import bisect, itertools, mmap, os, queue, struct, sys, threading, time, zlib
+from array import array
+
+import click
+import simplejson
+
+from sensclient.configuration import DEFAULT_ARCHIVE_PATH
+
+
+# The columns of the archive in the order they are stored, with the
+#   array typecode of each
+COLUMNS = (('ts', 'd'), ('device', 'H'), ('mote', 'I'), ('count', 'I'), ('reading', 'I'))
+
+# The typecode of the timestamps of sealed blocks, in microseconds and
+#   stored as differences from the previous one
+_SEALED_TS = 'q'
+
+# Every block starts with a magic, its number of rows, whether it is
+#   compressed and the stored size of each column
+_BLOCK = struct.Struct('<4sIB' + 'I' * len(COLUMNS))
+_BLOCK_MAGIC = b'SCAB'
+
+# The sparse index holds one entry per block: its first and last
+#   timestamps, its offset and size in the segment, its number of rows
+#   and a mask of the motes in it, bit id % 64
+_ENTRY = struct.Struct('<ddQIIQ')
+
+# Sealed segments hold their index after the blocks, and end with its
+#   offset and number of entries
+_FOOTER = struct.Struct('<QI4s')
+_FOOTER_MAGIC = b'SCAI'
+
+# Wakes the sealing thread up to flush the rows held in memory in time
+_WAKE = object()
+
+_OPEN_SUFFIX = '.seg'
+_INDEX_SUFFIX = '.idx'
+_SEALED_SUFFIX = '.arc'
+_DEVICES_SUFFIX = '.dev'
+
+
+def _day(ts):
+    return time.strftime('%Y%m%d', time.gmtime(ts))
+
+
+def _pack(column):
+    if sys.byteorder != 'little':
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def _unpack(typecode, data):
+    column = array(typecode)
+    column.frombytes(data)
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column
+
+
+def _encode_block(columns, level=None):
+    '''
+    Builds a block from its columns, compressed with zlib at the given
+    level if one is given.
+    '''
+    if level is None:
+        parts = [_pack(column) for column in columns]
+    else:
+        micros = array(_SEALED_TS, (round(ts * 1e6) for ts in columns[0]))
+        deltas = array(_SEALED_TS, itertools.starmap(int.__sub__, zip(micros, [0] + micros[:-1].tolist())))
+        parts = [zlib.compress(_pack(column), level) for column in [deltas] + list(columns[1:])]
+    header = _BLOCK.pack(_BLOCK_MAGIC, len(columns[0]), level is not None, *(len(part) for part in parts))
+    return header + b''.join(parts)
+
+
+def _decode_block(data):
+    '''
+    Reads the columns of a block out of a bytes-like object.
+    '''
+    magic, rows, compressed, *sizes = _BLOCK.unpack_from(data, 0)
+    if magic != _BLOCK_MAGIC:
+        raise ValueError('Corrupt archive block!')
+    columns = []
+    pos = _BLOCK.size
+    for (_, typecode), size in zip(COLUMNS, sizes):
+        part = data[pos:pos+size]
+        pos += size
+        if compressed:
+            part = zlib.decompress(part)
+            if not columns:
+                deltas = _unpack(_SEALED_TS, part)
+                columns.append(array('d', (micros / 1e6 for micros in itertools.accumulate(deltas))))
+                continue
+        columns.append(_unpack(typecode, part))
+    return columns
+
+
+class Archive:
+    '''
+    Defines the local archive of every reading received, kept on disk
+    for offline analysis and retention, independently of the server.
+
+    The archive holds one segment per day (UTC), each made of blocks
+    of up to block_rows rows with fixed-width columns: the time, the
+    device (as a number into the day's list of devices), the mote id,
+    the message count and one reading. A message with ten readings is
+    ten rows. Rows are gathered into typed arrays in memory and written
+    as one block once block_rows have been gathered or flush_interval
+    seconds have passed, by the background thread if no more rows come,
+    so appending costs no Python object per reading and no write per
+    message; rows still in memory are lost on a crash.
+
+    Each segment comes with a sparse index of one entry per block,
+    holding the block's time range and a mask of the motes in it.
+    Times are kept in order within a day, a message received before the
+    previous one is archived at the previous one's time, so a query
+    reads the index, seeks to the blocks that can hold matching rows
+    and looks for the first row within a block by bisection, without
+    scanning the rest. Segments are read through mmap.
+
+    Once a day is over its segment is sealed on a background thread:
+    the blocks are rewritten with their columns compressed, times as
+    differences in microseconds, and the index is appended to the file.
+    Segments of days older than retention_days are then deleted.
+    '''
+
+    def __init__(self, path=DEFAULT_ARCHIVE_PATH, block_rows=4096, flush_interval=5.0,
+            retention_days=None, compress_level=6):
+        '''
+        Opens (creating if needed) the archive in the given directory.
+        Segments of earlier days that were not sealed yet are sealed.
+        Arguments:
+            path: The directory holding the archive's files.
+            block_rows: The number of rows per block.
+            flush_interval: The longest time in seconds rows are held
+            in memory.
+            retention_days: The number of days kept, None keeps every
+            day.
+            compress_level: The zlib level sealed blocks are
+            compressed at.
+        Raises a ValueError if a setting is not positive, or an
+        OSError if the directory cannot be used.
+        '''
+        if block_rows <= 0 or flush_interval <= 0 or (retention_days is not None and retention_days <= 0):
+            raise ValueError('The archive block size, flush interval and retention must be positive!')
+        self._path = path
+        self._block_rows = int(block_rows)
+        self._flush_interval = float(flush_interval)
+        self._retention_days = int(retention_days) if retention_days is not None else None
+        self._compress_level = int(compress_level)
+
+        self._lock = threading.Lock()
+        # held while segments are swapped for their sealed versions
+        self._files_lock = threading.Lock()
+        self._columns = [array(typecode) for _, typecode in COLUMNS]
+        self._motes = 0
+        self._started = None
+        self._held = None
+        # the time.monotonic() the rows in memory started being held
+        self._held = None
+        self._last_ts = 0.0
+        self._day = None
+        self._writer = None
+        self._index = None
+        self._devices = []
+        self._device_ids = dict()
+        self._rows = 0
+
+        os.makedirs(path, exist_ok=True)
+        self._sealing = queue.Queue()
+        self._sealer = threading.Thread(target=self._run_sealer, name='sensclient-archive', daemon=True)
+        self._sealer.start()
+        today = _day(time.time())
+        for day in self.days():
+            if day != today and os.path.exists(self._file(day, _OPEN_SUFFIX)):
+                self._sealing.put(day)
+
+
+    #
+    # ACCESSOR METHODS
+    #
+
+    def path(self):
+        '''
+        Gets the directory holding the archive.
+        '''
+        return self._path
+
+
+    def days(self):
+        '''
+        Gets the days held by the archive, as YYYYMMDD strings, oldest
+        first.
+        '''
+        return sorted({name[:8] for name in os.listdir(self._path)
+            if name.endswith((_OPEN_SUFFIX, _SEALED_SUFFIX)) and name[:8].isdigit()})
+
+
+    def day_stats(self, day):
+        '''
+        Gets the size on disk of a day's segment and whether it is
+        sealed.
+        Arguments:
+            day: The day, as a YYYYMMDD string.
+        '''
+        sealed = os.path.exists(self._file(day, _SEALED_SUFFIX))
+        segment = self._file(day, _SEALED_SUFFIX if sealed else _OPEN_SUFFIX)
+        try:
+            size = os.path.getsize(segment)
+        except OSError:
+            size = 0
+        return {'sealed': sealed, 'bytes': size}
+
+
+    def rows(self):
+        '''
+        Gets the number of rows archived since the archive was opened.
+        '''
+        return self._rows
+
+
+    #
+    # WRITING METHODS
+    #
+
+    def _file(self, day, suffix):
+        return os.path.join(self._path, day + suffix)
+
+
+    def _load_devices(self, day):
+        try:
+            with open(self._file(day, _DEVICES_SUFFIX), 'r') as f:
+                return simplejson.load(f)
+        except (OSError, ValueError):
+            return []
+
+
+    def _device_id(self, device):
+        num = self._device_ids.get(device)
+        if num is None:
+            num = self._device_ids[device] = len(self._devices)
+            self._devices.append(device)
+            filename = self._file(self._day, _DEVICES_SUFFIX)
+            with open(filename + '.tmp', 'w') as f:
+                simplejson.dump(self._devices, f)
+            os.replace(filename + '.tmp', filename)
+        return num
+
+
+    def _open_day(self, day):
+        '''
+        Starts appending to a day's segment, dropping any block left
+        half written by a crash.
+        '''
+        self._day = day
+        self._devices = self._load_devices(day)
+        self._device_ids = {device: num for num, device in enumerate(self._devices)}
+        segment, index = self._file(day, _OPEN_SUFFIX), self._file(day, _INDEX_SUFFIX)
+        entries = self._read_index(index)
+        end = entries[-1][2] + entries[-1][3] if entries else 0
+        self._writer = open(segment, 'ab')
+        self._writer.truncate(end)
+        # appending does not move the position truncate() left behind,
+        #   and blocks are indexed at the position
+        self._writer.seek(end)
+        self._index = open(index, 'ab')
+        self._index.truncate(len(entries) * _ENTRY.size)
+
+
+    def _close_day(self):
+        self._flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._index.close()
+            self._writer = self._index = None
+            self._sealing.put(self._day)
+
+
+    def _flush(self):
+        '''
+        Writes the rows held in memory as a block and indexes it.
+        '''
+        columns = self._columns
+        if not columns[0]:
+            return
+        block = _encode_block(columns)
+        offset = self._writer.tell()
+        self._writer.write(block)
+        self._writer.flush()
+        self._index.write(_ENTRY.pack(columns[0][0], columns[0][-1], offset, len(block),
+            len(columns[0]), self._motes))
+        self._index.flush()
+        self._columns = [array(typecode) for _, typecode in COLUMNS]
+        self._motes = 0
+        self._started = None
+
+
+    def add(self, device, event, ts=None):
+        '''
+        Archives the readings of a message. Messages without an id and
+        readings, or with values that do not fit the columns, are
+        ignored.
+        Arguments:
+            device: The device the message came in on.
+            event: The decoded message.
+            ts: The time the message was received, defaults to now.
+        '''
+        try:
+            mote, count, readings = event.id, getattr(event, 'count', 0), event.readings
+            if hasattr(readings, 'tolist'):
+                readings = readings.tolist()
+            readings = array('I', readings)
+        except (AttributeError, OverflowError, TypeError):
+            return
+        n = len(readings)
+        if n == 0:
+            return
+        ts = ts if ts is not None else time.time()
+        with self._lock:
+            ts = max(ts, self._last_ts)
+            day = _day(ts)
+            if day != self._day:
+                self._close_day()
+                self._open_day(day)
+            try:
+                device_id = self._device_id(device)
+                ids, counts = array('I', (mote,)) * n, array('I', (count,)) * n
+            except (OverflowError, TypeError):
+                return
+            columns = self._columns
+            columns[0].extend(array('d', (ts,)) * n)
+            columns[1].extend(array('H', (device_id,)) * n)
+            columns[2].extend(ids)
+            columns[3].extend(counts)
+            columns[4].extend(readings)
+            self._motes |= 1 << (mote % 64)
+            self._last_ts = ts
+            self._rows += n
+            if self._started is None:
+                self._started = ts
+                self._held = time.monotonic()
+                # have the sealing thread flush the rows if no more come
+                self._sealing.put(_WAKE)
+            if len(columns[0]) >= self._block_rows or ts - self._started >= self._flush_interval:
+                self._flush()
+
+
+    def close(self):
+        '''
+        Writes the rows held in memory and closes the archive. The
+        current day's segment is left open, to be appended to when the
+        archive is opened again.
+        '''
+        with self._lock:
+            self._flush()
+            if self._writer is not None:
+                self._writer.close()
+                self._index.close()
+                self._writer = self._index = None
+        self._sealing.put(None)
+        self._sealer.join()
+
+
+    #
+    # SEALING METHODS
+    #
+
+    @staticmethod
+    def _read_index(filename):
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return []
+        usable = len(data) - len(data) % _ENTRY.size
+        return [entry for entry in _ENTRY.iter_unpack(data[:usable])]
+
+
+    def _seal(self, day):
+        segment, index = self._file(day, _OPEN_SUFFIX), self._file(day, _INDEX_SUFFIX)
+        sealed = self._file(day, _SEALED_SUFFIX)
+        if os.path.exists(sealed):
+            # sealed before, the open segment was left over
+            with self._files_lock:
+                for filename in (segment, index):
+                    if os.path.exists(filename):
+                        os.remove(filename)
+            return
+        entries = self._read_index(index)
+        with open(segment, 'rb') as src, open(sealed + '.tmp', 'wb') as dst:
+            sealed_entries = []
+            for first, last, offset, size, rows, motes in entries:
+                src.seek(offset)
+                block = _encode_block(_decode_block(src.read(size)), self._compress_level)
+                sealed_entries.append(_ENTRY.pack(first, last, dst.tell(), len(block), rows, motes))
+                dst.write(block)
+            footer = _FOOTER.pack(dst.tell(), len(sealed_entries), _FOOTER_MAGIC)
+            dst.write(b''.join(sealed_entries) + footer)
+            dst.flush()
+            os.fsync(dst.fileno())
+        with self._files_lock:
+            os.replace(sealed + '.tmp', sealed)
+            os.remove(segment)
+            os.remove(index)
+
+
+    def _expire(self):
+        if self._retention_days is None:
+            return
+        days = self.days()
+        for day in days[:max(0, len(days) - self._retention_days)]:
+            if day == self._day:
+                continue
+            with self._files_lock:
+                for suffix in (_SEALED_SUFFIX, _OPEN_SUFFIX, _INDEX_SUFFIX, _DEVICES_SUFFIX):
+                    if os.path.exists(self._file(day, suffix)):
+                        os.remove(self._file(day, suffix))
+
+
+    def _flush_wait(self):
+        held = self._held
+        if held is None:
+            return None
+        return max(0.0, held + self._flush_interval - time.monotonic())
+
+
+    def _flush_idle(self):
+        with self._lock:
+            if self._held is not None and time.monotonic() - self._held >= self._flush_interval:
+                self._flush()
+
+
+    def _run_sealer(self):
+        while True:
+            try:
+                day = self._sealing.get(timeout=self._flush_wait())
+            except queue.Empty:
+                day = _WAKE
+            if day is None:
+                break
+            try:
+                if day is _WAKE:
+                    self._flush_idle()
+                else:
+                    self._seal(day)
+                    self._expire()
+            except (OSError, ValueError, zlib.error) as e:
+                click.secho('Cannot {} the archive of {}: {}'.format(
+                    'flush' if day is _WAKE else 'seal', self._day if day is _WAKE else day, e),
+                    fg='red', err=True)
+
+
+    #
+    # QUERY METHODS
+    #
+
+    def _blocks(self, day):
+        '''
+        Maps a day's segment and gets its index entries.
+        Returns the mmap, None for an empty segment, and the entries.
+        '''
+        with self._files_lock:
+            sealed = self._file(day, _SEALED_SUFFIX)
+            if os.path.exists(sealed):
+                filename, entries = sealed, None
+            else:
+                filename = self._file(day, _OPEN_SUFFIX)
+                entries = self._read_index(self._file(day, _INDEX_SUFFIX))
+            try:
+                with open(filename, 'rb') as f:
+                    if os.fstat(f.fileno()).st_size == 0:
+                        return None, []
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except FileNotFoundError:
+                return None, []
+        if entries is None:
+            start, count, magic = _FOOTER.unpack_from(data, len(data) - _FOOTER.size)
+            if magic != _FOOTER_MAGIC:
+                raise ValueError('Corrupt archive segment {}!'.format(filename))
+            entries = list(_ENTRY.iter_unpack(data[start:start + count * _ENTRY.size]))
+        return data, entries
+
+
+    @staticmethod
+    def _rows_of(columns, devices, start, end, device, mote):
+        times = columns[0]
+        lo = bisect.bisect_left(times, start) if start is not None else 0
+        hi = bisect.bisect_right(times, end) if end is not None else len(times)
+        for i in range(lo, hi):
+            if (device is None or columns[1][i] == device) and (mote is None or columns[2][i] == mote):
+                yield times[i], devices[columns[1][i]], columns[2][i], columns[3][i], columns[4][i]
+
+
+    def _days_between(self, start, end):
+        first = _day(start) if start is not None else None
+        last = _day(end) if end is not None else None
+        return [day for day in self.days() if (first is None or day >= first) and (last is None or day <= last)]
+
+
+    def blocks(self, start=None, end=None):
+        '''
+        Gets the blocks written so far that may hold readings in a time
+        range, oldest first, without reading them.
+        Arguments:
+            start: Only the blocks with readings at or after this time.
+            end: Only the blocks with readings at or before this time.
+        Returns a list of (day, number) pairs, the number being the
+        position of the block in the day's segment.
+        '''
+        blocks = []
+        for day in self._days_between(start, end):
+            data, entries = self._blocks(day)
+            if data is not None:
+                data.close()
+            blocks.extend((day, num) for num, (first_ts, last_ts, *_) in enumerate(entries)
+                if (start is None or last_ts >= start) and (end is None or first_ts <= end))
+        return blocks
+
+
+    def read_block(self, day, number, start=None, end=None, device=None, mote=None):
+        '''
+        Gets the readings of one block that match.
+        Arguments:
+            day: The day of the block, as a YYYYMMDD string.
+            number: The position of the block in the day's segment.
+            start, end, device, mote: As for query().
+        Returns a list of query() tuples, in time order.
+        '''
+        devices = self._load_devices(day)
+        if device is not None and device not in devices:
+            return []
+        data, entries = self._blocks(day)
+        if data is None:
+            return []
+        try:
+            if number >= len(entries):
+                return []
+            offset, size = entries[number][2:4]
+            # a copy, as a view left behind by a corrupt block would keep
+            #   the mmap from closing
+            columns = _decode_block(data[offset:offset+size])
+        finally:
+            data.close()
+        return list(self._rows_of(columns, devices, start, end,
+            devices.index(device) if device is not None else None, mote))
+
+
+    def query(self, start=None, end=None, device=None, mote=None):
+        '''
+        Gets the archived readings that match, in time order.
+        Arguments:
+            start: Only the readings at or after this time.
+            end: Only the readings at or before this time.
+            device: Only the readings received on this device.
+            mote: Only the readings of the mote with this id.
+        Yields (ts, device, mote, count, reading) tuples. Only the
+        blocks whose index entries can match are read.
+        '''
+        with self._lock:
+            # the rows still in memory, as of now
+            current = self._day, list(self._devices), [array(c.typecode, c) for c in self._columns]
+        days = self._days_between(start, end)
+        if current[0] is not None and current[0] not in days and current[2][0] and \
+                (start is None or current[0] >= _day(start)) and (end is None or current[0] <= _day(end)):
+            days.append(current[0])
+        for day in days:
+            devices = self._load_devices(day) if day != current[0] else current[1]
+            if device is not None and device not in devices:
+                continue
+            device_id = devices.index(device) if device is not None else None
+            data, entries = self._blocks(day)
+            try:
+                for first_ts, last_ts, offset, size, rows, motes in entries:
+                    if (start is not None and last_ts < start) or (end is not None and first_ts > end):
+                        continue
+                    if mote is not None and not motes & (1 << (mote % 64)):
+                        continue
+                    columns = _decode_block(data[offset:offset+size])
+                    yield from self._rows_of(columns, devices, start, end, device_id, mote)
+            finally:
+                if data is not None:
+                    data.close()
+            if day == current[0]:
+                yield from self._rows_of(current[2], devices, start, end, device_id, mote)
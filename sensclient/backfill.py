@@ -0,0 +1,367 @@
+import asyncio, os, threading, time
+
+import click
+import simplejson
+
+from sensclient.engine import Engine
+
+
+class ArchiveSource:
+    '''
+    Offers the readings of an Archive for a backfill, one chunk per
+    block of the archive. The rows of a block are grouped back into
+    one reading per message.
+
+    Progress is checkpointed to a JSON file, rewritten atomically after
+    every chunk delivered: for each day, the number of blocks below
+    which every block was delivered, and the blocks above it that were
+    too. The checkpoint is only used by a backfill of the same time
+    range and filters to the same server, any other starts over.
+    '''
+
+    def __init__(self, archive, checkpoint, server, start=None, end=None, device=None, mote=None):
+        '''
+        Returns a new ArchiveSource.
+        Arguments:
+            archive: The Archive to read.
+            checkpoint: The path of the checkpoint file.
+            server: The server the readings go to.
+            start, end, device, mote: Only the readings that match,
+            as for Archive.query().
+        '''
+        self._archive = archive
+        self._filename = checkpoint
+        self._filters = (start, end, device, mote)
+        self._source = {'archive': archive.path(), 'server': server, 'start': start, 'end': end,
+            'device': device, 'mote': mote}
+        self._lock = threading.Lock()
+        self._done = dict()
+        try:
+            with open(checkpoint, 'r') as f:
+                saved = simplejson.load(f)
+            if saved.get('source') == self._source:
+                self._done = {day: (below, set(also)) for day, (below, also) in saved['done'].items()}
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        self._blocks = [block for block in archive.blocks(start, end) if not self._is_done(*block)]
+        self._total = len(self._blocks)
+
+
+    def _is_done(self, day, number):
+        below, also = self._done.get(day, (0, set()))
+        return number < below or number in also
+
+
+    def total(self):
+        '''
+        Gets the number of chunks left when the backfill started.
+        '''
+        return self._total
+
+
+    def chunks(self):
+        '''
+        Yields every chunk not delivered yet, as a key to pass to
+        complete() and a list of JSON encoded readings.
+        '''
+        for day, number in self._blocks:
+            records = []
+            last = None
+            for ts, device, mote, count, reading in self._archive.read_block(day, number, *self._filters):
+                if (ts, device, mote, count) != last:
+                    last = (ts, device, mote, count)
+                    records.append({'device': device, 'ts': ts, 'id': mote, 'count': count, 'readings': []})
+                records[-1]['readings'].append(reading)
+            yield (day, number), [simplejson.dumps(record).encode('utf-8') for record in records]
+
+
+    def complete(self, key):
+        '''
+        Checkpoints a delivered chunk.
+        Arguments:
+            key: The key the chunk was yielded with.
+        '''
+        day, number = key
+        with self._lock:
+            below, also = self._done.get(day, (0, set()))
+            also.add(number)
+            while below in also:
+                also.discard(below)
+                below += 1
+            self._done[day] = (below, also)
+            saved = {'source': self._source,
+                'done': {day: [below, sorted(also)] for day, (below, also) in self._done.items()}}
+            with open(self._filename + '.tmp', 'w') as f:
+                simplejson.dump(saved, f)
+            os.replace(self._filename + '.tmp', self._filename)
+
+
+    def close(self):
+        pass
+
+
+class SpoolSource:
+    '''
+    Offers the records of a Spool for a backfill, in chunks of up to
+    chunk_size records. The spool's own cursor is the checkpoint:
+    chunks are committed in order as they are delivered, so a backfill
+    that is interrupted starts again after the last chunk delivered
+    before every earlier one was.
+    '''
+
+    def __init__(self, spool, chunk_size=500):
+        '''
+        Returns a new SpoolSource.
+        Arguments:
+            spool: The Spool to read, which nothing else may commit.
+            chunk_size: The number of records per chunk.
+        '''
+        self._spool = spool
+        self._chunk_size = int(chunk_size)
+        self._lock = threading.Lock()
+        # the end offset, record count and delivery of every chunk
+        #   offered and not committed yet, in order
+        self._pending = []
+        self._total = -(-spool.backlog() // self._chunk_size)
+
+
+    def total(self):
+        '''
+        Gets the number of chunks left when the backfill started.
+        '''
+        return self._total
+
+
+    def chunks(self):
+        '''
+        Yields every chunk not delivered yet, as a key to pass to
+        complete() and a list of JSON encoded readings.
+        '''
+        offset = None
+        while True:
+            records, end = self._spool.read(self._chunk_size, offset=offset)
+            if not records:
+                return
+            with self._lock:
+                self._pending.append([end, len(records), False])
+            yield end, records
+            offset = end
+
+
+    def complete(self, key):
+        '''
+        Marks a chunk delivered, and commits every chunk before which
+        all were.
+        Arguments:
+            key: The key the chunk was yielded with.
+        '''
+        with self._lock:
+            for chunk in self._pending:
+                if chunk[0] == key:
+                    chunk[2] = True
+            while self._pending and self._pending[0][2]:
+                end, count, _ = self._pending.pop(0)
+                self._spool.commit(end, count)
+
+
+    def close(self):
+        self._spool.close()
+
+
+class Backfill:
+    '''
+    Defines a bulk upload of stored readings, from an ArchiveSource or
+    a SpoolSource, to a server.
+
+    Chunks are uploaded with up to concurrency of them in flight at
+    once, through an Uploader of their own with its own pool of
+    connections. A chunk that fails is retried, backing off, until it
+    is delivered or the backfill is stopped, and each chunk delivered is
+    checkpointed by its source, so that a backfill that is stopped or
+    interrupted resumes where it left off. Delivery is at-least-once,
+    and a backfill whose progress cannot be checkpointed stops.
+
+    Live readings keep priority: no new chunk is started while the
+    busy function says the live uploads are behind, and the rate, if
+    given, caps the readings backfilled per second.
+
+    Backfills run on the client's Engine.
+    '''
+
+    # The time in seconds to wait while the live uploads are busy
+    BUSY_WAIT = 0.5
+
+    # The bounds in seconds on the delay before retrying a chunk
+    RETRY_MIN = 1.0
+    RETRY_MAX = 60.0
+
+
+    def __init__(self, source, uploader, concurrency=2, rate=None, busy=None, engine=None):
+        '''
+        Returns a new Backfill. Call start() to start it.
+        Arguments:
+            source: The ArchiveSource or SpoolSource to read.
+            uploader: The Uploader to send chunks through, which is
+            started and closed by the backfill.
+            concurrency: The most chunks in flight at once.
+            rate: The most readings sent per second, None for no cap.
+            busy: An optional function returning whether the live
+            uploads are behind.
+            engine: The Engine to run on, defaults to the process-wide
+            Engine.
+        Raises a ValueError if the concurrency or the rate is not
+        positive.
+        '''
+        if concurrency <= 0 or (rate is not None and rate <= 0):
+            raise ValueError('The backfill concurrency and rate must be positive!')
+        self._source = source
+        self._uploader = uploader
+        self._concurrency = int(concurrency)
+        self._rate = float(rate) if rate is not None else None
+        self._busy = busy
+        self._engine = engine if engine else Engine.default()
+
+        self._task = None
+        self._stopping = False
+        self._stopped = None
+        self._started = None
+        self._finished = None
+        self._chunks = 0
+        self._sent = 0
+        self._retries = 0
+        self._waits = 0.0
+
+
+    def stats(self):
+        '''
+        Gets a dict describing the backfill's progress.
+        '''
+        end = self._finished if self._finished is not None else time.monotonic()
+        return {
+            'running': self.running(),
+            'total': self._source.total(),
+            'chunks': self._chunks,
+            'sent': self._sent,
+            'retries': self._retries,
+            'yielded': self._waits,
+            'elapsed': end - self._started if self._started is not None else 0.0
+        }
+
+
+    def running(self):
+        '''
+        Gets whether the backfill is still going.
+        '''
+        return self._task is not None and not self._task.done()
+
+
+    async def _upload(self, slots, key, records):
+        loop = asyncio.get_running_loop()
+        delay = Backfill.RETRY_MIN
+        try:
+            while True:
+                try:
+                    if await self._uploader.send(records):
+                        break
+                except Exception as e:
+                    click.secho('Backfilling a chunk failed, retrying: {}'.format(e), fg='red', err=True)
+                if self._stopping:
+                    return
+                self._retries += 1
+                try:
+                    await asyncio.wait_for(self._stopped.wait(), delay)
+                    return
+                except asyncio.TimeoutError:
+                    pass
+                delay = min(delay * 2, Backfill.RETRY_MAX)
+            try:
+                await loop.run_in_executor(None, self._source.complete, key)
+            except Exception as e:
+                # without a checkpoint every chunk from here on would be
+                #   sent again by the next backfill
+                click.secho('Cannot checkpoint the backfill, stopping: {}'.format(e), fg='red', err=True)
+                self._stopping = True
+                self._stopped.set()
+                return
+            self._chunks += 1
+            self._sent += len(records)
+        finally:
+            slots.release()
+
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self._concurrency)
+        tasks = set()
+        chunks = self._source.chunks()
+        allowance = 0.0
+        refilled = time.monotonic()
+        try:
+            while not self._stopping:
+                # live readings go first
+                while self._busy is not None and self._busy() and not self._stopping:
+                    self._waits += Backfill.BUSY_WAIT
+                    await asyncio.sleep(Backfill.BUSY_WAIT)
+                await slots.acquire()
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None or self._stopping:
+                    slots.release()
+                    break
+                key, records = chunk
+                if self._rate is not None:
+                    now = time.monotonic()
+                    allowance = min(self._rate, allowance + (now - refilled) * self._rate) - len(records)
+                    refilled = now
+                    if allowance < 0:
+                        await asyncio.sleep(-allowance / self._rate)
+                task = loop.create_task(self._upload(slots, key, records))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except (OSError, ValueError) as e:
+            click.secho('Backfill failed: {}'.format(e), fg='red', err=True)
+        finally:
+            self._finished = time.monotonic()
+            await self._uploader._close()
+            await loop.run_in_executor(None, self._source.close)
+
+
+    def start(self):
+        '''
+        Starts the backfill in the background.
+        '''
+        self._uploader.start()
+        self._started = time.monotonic()
+
+        async def _start():
+            self._stopped = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        self._engine.call(_start())
+
+
+    def stop(self, timeout=None):
+        '''
+        Stops the backfill once the chunks in flight are delivered or
+        fail. Whatever was not delivered is sent by the next backfill.
+        Arguments:
+            timeout: The maximum time in seconds to wait.
+        '''
+        self._stopping = True
+        if self._task is not None and not self._engine.closed():
+            self._engine.call_soon(self._stopped.set)
+            async def _wait():
+                await asyncio.gather(self._task, return_exceptions=True)
+            self._engine.call(_wait(), timeout)
+
+
+    def wait(self, timeout=None):
+        '''
+        Waits for the backfill to finish.
+        Arguments:
+            timeout: The maximum time in seconds to wait.
+        '''
+        if self._task is not None:
+            async def _wait():
+                await asyncio.gather(self._task, return_exceptions=True)
+            self._engine.call(_wait(), timeout)
@@ -0,0 +1,379 @@
+import asyncio, bisect, mmap, os, struct, time
+
+from sensclient.listener import Listener
+
+
+# Every capture file starts with a magic number, a format version and
+#   the wall-clock time (ns since the epoch) the capture started at
+MAGIC = b'SCAP'
+VERSION = 1
+FILE_HEADER = struct.Struct('<4sHHQ')
+
+# Every chunk of raw bytes is prefixed by its time (ns since the start
+#   of the capture, monotonic) and its length
+RECORD = struct.Struct('<QI')
+
+# The sparse index maps a record's time to its offset in the file
+INDEX_ENTRY = struct.Struct('<QQ')
+
+# A finished capture ends with the offset and size of its index
+TRAILER = struct.Struct('<QQ4s')
+TRAILER_MAGIC = b'SIDX'
+
+
+class CaptureWriter:
+    '''
+    Defines a writer for raw serial capture files.
+
+    A capture is the sequence of chunks of bytes exactly as they were
+    read from a serial port, each stamped with a monotonic timestamp.
+    Every index_interval bytes, the time and offset of the next record
+    are added to a sparse index which, ending with the time and offset
+    of the last record, is appended to the file, with a trailer
+    pointing at it, when the writer is closed. A capture that was never
+    closed (say, after a crash) is still readable; its index is rebuilt
+    by scanning.
+    '''
+
+    def __init__(self, path, index_interval=1024*1024):
+        '''
+        Creates a new capture file, replacing any existing file.
+        Arguments:
+            path: The path of the capture file.
+            index_interval: The number of bytes between index entries.
+        '''
+        self._path = path
+        self._fp = open(path, 'wb', buffering=256*1024)
+        self._start = time.monotonic_ns()
+        self._fp.write(FILE_HEADER.pack(MAGIC, VERSION, 0, time.time_ns()))
+        self._offset = FILE_HEADER.size
+        self._index_interval = int(index_interval)
+        self._next_index = self._offset
+        self._index = []
+        self._last = None
+        self._records = 0
+
+
+    def path(self):
+        '''
+        Gets the path of the capture file.
+        '''
+        return self._path
+
+
+    def records(self):
+        '''
+        Gets the number of records written so far.
+        '''
+        return self._records
+
+
+    def size(self):
+        '''
+        Gets the number of bytes written so far.
+        '''
+        return self._offset
+
+
+    def write(self, data, ts=None):
+        '''
+        Appends a chunk of raw bytes to the capture.
+        Arguments:
+            data: The bytes, any bytes-like object.
+            ts: The time.monotonic_ns() the bytes were read at,
+            defaults to now.
+        '''
+        ts = (ts if ts is not None else time.monotonic_ns()) - self._start
+        if self._offset >= self._next_index:
+            self._index.append((ts, self._offset))
+            self._next_index = self._offset + self._index_interval
+        self._last = (ts, self._offset)
+        self._fp.write(RECORD.pack(ts, len(data)))
+        self._fp.write(data)
+        self._offset += RECORD.size + len(data)
+        self._records += 1
+
+
+    def close(self):
+        '''
+        Writes the index and closes the capture file.
+        '''
+        if self._fp is None:
+            return
+        index_offset = self._offset
+        if self._last is not None and self._index[-1] != self._last:
+            # readers take the length of the capture from the last entry
+            self._index.append(self._last)
+        for ts, offset in self._index:
+            self._fp.write(INDEX_ENTRY.pack(ts, offset))
+        self._fp.write(TRAILER.pack(index_offset, len(self._index), TRAILER_MAGIC))
+        self._fp.close()
+        self._fp = None
+
+
+class CaptureReader:
+    '''
+    Defines a reader for raw serial capture files. The file is memory
+    mapped, so records are handed out as memoryviews onto the mapping
+    and captures of any size can be read without loading them into
+    memory.
+    '''
+
+    def __init__(self, path):
+        '''
+        Opens a capture file.
+        Arguments:
+            path: The path of the capture file.
+        Raises a ValueError if the file is not a capture.
+        '''
+        self._path = path
+        self._fp = open(path, 'rb')
+        size = os.fstat(self._fp.fileno()).st_size
+        if size < FILE_HEADER.size:
+            self._fp.close()
+            raise ValueError('{} is not a capture file!'.format(path))
+        self._mmap = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self._started = FILE_HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError('{} is not a capture file!'.format(path))
+        self._view = memoryview(self._mmap)
+        self._end = size
+        self._index = None
+        self._last = 0
+        if size >= FILE_HEADER.size + TRAILER.size:
+            index_offset, entries, trailer = TRAILER.unpack_from(self._mmap, size - TRAILER.size)
+            if trailer == TRAILER_MAGIC and \
+                    index_offset + entries * INDEX_ENTRY.size + TRAILER.size == size:
+                self._end = index_offset
+                self._index = [INDEX_ENTRY.unpack_from(self._mmap, index_offset + i * INDEX_ENTRY.size)
+                    for i in range(entries)]
+                if self._index:
+                    self._last = self._index[-1][0]
+        if self._index is None:
+            self._index = self._rebuild_index()
+        self._times = [ts for ts, _ in self._index]
+
+
+    def _rebuild_index(self, interval=1024*1024):
+        index = []
+        offset = FILE_HEADER.size
+        next_index = offset
+        while offset + RECORD.size <= self._end:
+            ts, length = RECORD.unpack_from(self._mmap, offset)
+            if offset + RECORD.size + length > self._end:
+                break
+            if offset >= next_index:
+                index.append((ts, offset))
+                next_index = offset + interval
+            self._last = ts
+            offset += RECORD.size + length
+        # ignore a torn record at the end of an unfinished capture
+        self._end = offset
+        return index
+
+
+    #
+    # ACCESSOR METHODS
+    #
+
+    def started(self):
+        '''
+        Gets the wall-clock time (s since the epoch) the capture
+        started at.
+        '''
+        return self._started / 1e9
+
+
+    def duration(self):
+        '''
+        Gets the time in seconds from the start of the capture to its
+        last record.
+        '''
+        return self._last / 1e9
+
+
+    def size(self):
+        '''
+        Gets the number of bytes of raw records in the capture.
+        '''
+        return self._end - FILE_HEADER.size
+
+
+    #
+    # READ METHODS
+    #
+
+    def seek(self, seconds):
+        '''
+        Finds where to start reading to replay from a point in the
+        capture, using the sparse index.
+        Arguments:
+            seconds: The time from the start of the capture.
+        Returns the offset of the record to start from.
+        '''
+        i = bisect.bisect_right(self._times, int(seconds * 1e9)) - 1
+        return self._index[i][1] if i >= 0 else FILE_HEADER.size
+
+
+    def records(self, offset=None, start=0.0):
+        '''
+        Yields the records of the capture as (ts, data, next offset)
+        tuples, where ts is in ns since the start of the capture and
+        data is a memoryview onto the mapped file.
+        Arguments:
+            offset: The offset to start at, defaults to the beginning
+            or to the indexed record nearest to start.
+            start: Skip records older than this many seconds into the
+            capture.
+        '''
+        if offset is None:
+            offset = self.seek(start)
+        skip = int(start * 1e9)
+        while offset + RECORD.size <= self._end:
+            ts, length = RECORD.unpack_from(self._mmap, offset)
+            data_start = offset + RECORD.size
+            offset = data_start + length
+            if offset > self._end:
+                break
+            if ts >= skip:
+                yield ts, self._view[data_start:offset], offset
+
+
+    def close(self):
+        '''
+        Unmaps and closes the capture file.
+        '''
+        try:
+            if getattr(self, '_view', None) is not None:
+                self._view.release()
+                self._view = None
+            self._mmap.close()
+        except BufferError:
+            # a record is still referenced, leave the mapping to the GC
+            pass
+        self._fp.close()
+
+
+class ReplayListener(Listener):
+    '''
+    Defines a Listener that reads from a capture file instead of a
+    serial port. The captured bytes go through the same framing,
+    decoding and callback as live traffic, so a replay exercises the
+    rest of the client exactly like the device it was recorded from.
+
+    Captures replay at their recorded pace scaled by the speed: 1 is
+    real time, N is N times faster and 0 is as fast as the client can
+    take them. Pausing a replay holds its position; once the end of
+    the capture is reached, the Listener stops.
+    '''
+
+    # The number of records replayed between yields to the event loop
+    #   when replaying as fast as possible
+    BURST = 64
+
+
+    def __init__(self, callback, path, speed=1.0, start=0.0, amrate='OSCILLOSCOPE', engine=None,
+            decoder=None, registry=None):
+        '''
+        Returns a new instance of a ReplayListener.
+        Arguments:
+            callback: See Listener, the device is the path of the
+            capture.
+            path: The path of the capture file.
+            speed: The replay speed, 0 replays as fast as possible.
+            start: The time in seconds into the capture to start at.
+            amrate: See Listener.
+            engine: See Listener.
+            decoder: See Listener.
+            registry: See Listener.
+        '''
+        Listener.__init__(self, callback, path, None, amrate, engine, decoder, registry)
+        if speed < 0:
+            raise ValueError('The replay speed cannot be negative!')
+        self._speed = float(speed)
+        self._start = float(start)
+        self._reader = None
+        self._offset = None
+        self._replayer = None
+
+
+    def baudrate(self):
+        '''
+        Gets the replay speed, in place of the device's baudrate.
+        '''
+        return '{:g}x'.format(self._speed) if self._speed else 'max'
+
+
+    def position(self):
+        '''
+        Gets the offset in the capture file of the next record.
+        '''
+        return self._offset
+
+
+    def record(self, writer):
+        raise ValueError('A replay cannot be recorded!')
+
+
+    #
+    # EVENT LOOP METHODS
+    #
+
+    def _is_open(self):
+        return self._reader is not None
+
+
+    def _open(self):
+        self._reader = CaptureReader(self._device)
+
+
+    def _close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+
+    def _watch(self):
+        self._replayer = asyncio.get_running_loop().create_task(self._replay())
+
+
+    def _unwatch(self):
+        if self._replayer is not None:
+            if self._replayer is not asyncio.current_task():
+                self._replayer.cancel()
+            self._replayer = None
+
+
+    async def _replay(self):
+        records = self._reader.records(self._offset, self._start)
+        first = began = None
+        count = 0
+        try:
+            for ts, data, offset in records:
+                if self._speed:
+                    if first is None:
+                        first, began = ts, time.monotonic()
+                    delay = (ts - first) / 1e9 / self._speed - (time.monotonic() - began)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                else:
+                    count += 1
+                    if count % ReplayListener.BURST == 0:
+                        await asyncio.sleep(0)
+                self._feed(data)
+                self._offset = offset
+                data = None
+        finally:
+            records.close()
+        await self.transition(Listener.STOPPED)
+
+
+    def _feed(self, data):
+        while data:
+            n = self._parser.feed(data)
+            data = data[n:]
+            for frame in self._parser.frames():
+                self._dispatch(frame)
+            if n == 0:
+                break
@@ -1,14 +1,35 @@
 import click
-from click_shell import shell
 
-import atexit, os, threading
+import atexit, os, threading, time
+from concurrent.futures import ThreadPoolExecutor
 
-from sensclient.configuration import read_config, write_config
+from sensclient.archive import Archive
+from sensclient.backfill import ArchiveSource, Backfill, SpoolSource
+from sensclient.capture import CaptureWriter, ReplayListener
+from sensclient.configuration import (DEFAULT_CONFIG_PATH, DEFAULT_SPOOL_PATH, ConfigWatcher, load_config,
+    read_config, validate_config, write_config)
+from sensclient.console import Sampler, Summary, render
+from sensclient.decoding import DECODERS
+from sensclient.dedup import DuplicateFilter
+from sensclient.engine import Engine
+from sensclient.eventqueue import EventQueue
+from sensclient.failover import FailoverMonitor
 from sensclient.listener import Listener
+from sensclient.metrics import (REGISTRY, DECODE_SECONDS, QUEUE_WAIT_SECONDS,
+    UPLOAD_SECONDS, UPLOAD_ERRORS, MetricsServer, quantile, render_samples,
+    render_histogram)
+from sensclient.profiling import PROFILER, STAGES, Profiler
+from sensclient.recent import RecentReadings, RecentServer
+from sensclient.sequence import SequenceTracker, loss_rate
+from sensclient.spool import Spool
+from sensclient.uploader import Uploader, make_reading
 
 
-# Used to make the event callback function thread-safe
-_event_lock = threading.Lock()
+# Buffers events between the Listeners and the event consumer
+_queue = None
+
+# The thread that drains the event queue
+_consumer = None
 
 # Stores active device listeners
 _listeners = dict()
@@ -17,19 +38,82 @@ _listeners = dict()
 _config = None
 _config_file = None
 
+# Serializes changes to the configuration, from the shell and the watcher
+_config_lock = threading.RLock()
+
+# Watches the configuration file and applies its changes
+_watcher = None
+
+# The configuration sections that only take effect on restart
+RESTART_SECTIONS = ('uploader', 'spool', 'queue', 'sharding', 'failover', 'metrics', 'reload', 'sequence',
+    'dedup', 'recent', 'archive')
+
 # Constant for the primary server
 PRIMARY = -1
 
+# The baudrate that asks for the rate of a device to be detected
+AUTO = 'AUTO'
+
+# The most devices opened at once when the client starts
+BRING_UP_THREADS = 32
+
 # The currently selected server
 _server = PRIMARY
 
+# Uploads readings to the currently selected server
+_uploader = None
+
+# Worker processes running the Listeners, when sharding is enabled
+_pool = None
+
+# Tracks server health and drives automatic failover
+_failover = None
+
+# Serves the client's metrics to Prometheus, when enabled
+_metrics_server = None
+
+# The counters seen by the last 'devices stats', used to compute rates
+_last_stats = dict()
+
+# Whether the client runs as a daemon, without a terminal
+_headless = False
+
+# Tracks the sequence numbers of every mote, per device
+_sequences = dict()
+
+# The options of new sequence trackers, None when tracking is disabled
+_sequence_options = None
+
+# Suppresses copies of messages heard by several devices, when enabled
+_dedup = None
+
+# Caches the recent readings of every mote, and answers local queries on them
+_recent = None
+_recent_server = None
+
+# Summarizes the event stream for the live console, when interactive
+_summary = None
+
+# Samples raw events for the tail command while it runs
+_tail = None
+
+# Keeps every reading on disk for offline analysis, when enabled
+_archive = None
+
+# Uploads archived or spooled readings in bulk while it runs
+_backfill = None
+
+# How often in seconds the idle event consumer checks whether to join
+#   or leave a profile
+CONSUMER_POLL = 0.5
+
 
 def get_baudrate(baudrate):
     '''
     Attempts to mask the baudrate to a known value.
     
     If masking fails, the method will simply return the passed in
-    baudrate as an int.
+    baudrate as an int. AUTO is not masked, see detect_baudrate().
     Arguments:
         baudrate: A baudrate provided by the user.
     '''
@@ -41,23 +125,260 @@ def get_baudrate(baudrate):
         return int(br)
 
 
-def process_event(event):
+def get_server(num):
+    '''
+    Gets the address of a configured server by its number.
+    Arguments:
+        num: PRIMARY for the primary server, otherwise the index of a
+        secondary server.
+    '''
+    if num == PRIMARY:
+        return _config['servers']['primary']
+    return _config['servers']['secondary'][num]
+
+
+def get_servers():
+    '''
+    Gets every configured server as a dict mapping its number to its
+    address.
+    '''
+    servers = {PRIMARY: _config['servers']['primary']}
+    for i, address in enumerate(_config['servers']['secondary']):
+        servers[i] = address
+    return servers
+
+
+def switch_server(num):
     '''
-    Defines a thread-safe method for handling events from 
-    Listeners.
+    Defines the callback the failover monitor uses to move uploads to
+    another server.
     Arguments:
+        num: The number of the server to switch to.
+    '''
+    global _server
+
+    _server = num
+    _uploader.set_server(get_server(num))
+    click.secho('Failing over to server ({}) {}...'.format(num, get_server(num)), fg='yellow', err=True)
+
+
+def is_auto(baudrate):
+    '''
+    Gets whether a baudrate asks for the rate to be detected.
+    Arguments:
+        baudrate: A baudrate provided by the user.
+    '''
+    return str(baudrate).upper() == AUTO
+
+
+def detect_baudrate(device):
+    '''
+    Finds the baudrate of a device by listening to it at each rate in
+    Listener.RATES.
+    Arguments:
+        device: The physical address of the device.
+    Raises a RuntimeError if no TinyOS frames were heard at any rate.
+    '''
+    from sensclient.probe import probe_device
+
+    result = Engine.default().call(probe_device(device))
+    if result.baudrate is None:
+        raise RuntimeError('Cannot detect the baudrate of device {}, no TinyOS frames heard at {} baud!'.format(
+            device, ', '.join(str(rate) for rate in result.rates)))
+    click.echo('Detected {} baud on device {}.'.format(result.baudrate, device))
+    return result.baudrate
+
+
+def create_listener(device, baudrate, amrate):
+    '''
+    Creates and starts the Listener for a device, either in this
+    process or in one of the worker processes when sharding is
+    enabled.
+    Arguments:
+        device: The physical address of the device.
+        baudrate: The baudrate, as a name from Listener.RATES, a
+        number or AUTO to detect it.
+        amrate: The AM rate of the messages to report.
+    '''
+    if is_auto(baudrate):
+        baudrate = str(detect_baudrate(device))
+    if _pool is not None:
+        listener = _pool.listener(device, get_baudrate(baudrate), amrate)
+    else:
+        listener = Listener(queue_event, device, get_baudrate(baudrate), amrate)
+    listener.start()
+    return listener
+
+
+def queue_event(device, event):
+    '''
+    Defines the callback given to Listeners. Hands the event to the
+    event queue so that reading from devices never waits on whatever
+    consumes the events.
+    Arguments:
+        device: The device the event came in on.
+        event: The event to queue.
+    '''
+    if _sequence_options is not None:
+        track_sequence(device, event)
+    if _recent is not None:
+        _recent.add(device, event)
+    _queue.put(device, event)
+
+
+def track_sequence(device, event):
+    '''
+    Records the sequence number of a message, before it can be dropped
+    by the event queue, so that gaps only count what was lost before
+    reaching the client. Messages without an id and a count are
+    ignored.
+    Arguments:
+        device: The device the message came in on.
+        event: The decoded message.
+    '''
+    try:
+        mote, count = event.id, event.count
+    except AttributeError:
+        return
+    tracker = _sequences.get(device)
+    if tracker is None:
+        tracker = _sequences[device] = SequenceTracker(**_sequence_options)
+    tracker.observe(mote, count)
+
+
+def process_event(device, event, now=None):
+    '''
+    Defines a method for handling events from Listeners. Only ever
+    called from the event consumer thread.
+    Arguments:
+        device: The device the event came in on.
         event: The event to handle.
+        now: The time.monotonic() the event is handled at.
     '''
-    global _event_lock
-    
-    _event_lock.acquire()
-    click.echo(event)
-    _event_lock.release()
+    began = STAGES.begin('consumer') if STAGES.active else None
+    if _dedup is not None and not _dedup.admit(device, event, now):
+        return
+    if began is not None:
+        began = STAGES.lap(began, ('consumer', device, 'dedup'))
+    if _uploader is not None:
+        _uploader.submit(make_reading(device, event))
+    if began is not None:
+        began = STAGES.lap(began, ('consumer', device, 'upload'))
+    if _archive is not None:
+        _archive.add(device, event)
+    if began is not None:
+        began = STAGES.lap(began, ('consumer', device, 'archive'))
+    if _summary is not None:
+        _summary.add(device, event)
+    tail = _tail
+    if tail is not None:
+        tail.offer(device, event, now)
+    if began is not None:
+        STAGES.lap(began, ('consumer', device, 'console'))
 
 
-@shell(prompt='\nSDCP: ')
-def run():
-    pass
+def consume_events():
+    '''
+    Defines the body of the event consumer thread. Drains the event
+    queue until it is closed.
+    '''
+    generation = 0
+    while True:
+        events = _queue.get(max_items=256, timeout=CONSUMER_POLL)
+        if PROFILER.generation != generation:
+            generation = PROFILER.attach()
+        if not events:
+            if _queue.closed():
+                break
+            continue
+        now = time.monotonic()
+        for device, event, queued in events:
+            QUEUE_WAIT_SECONDS.observe(now - queued, (device,))
+            process_event(device, event, now)
+
+
+def observe_upload(server, latency, ok):
+    '''
+    Defines the observer given to the Uploader. Records the outcome of
+    every upload request in the metrics and hands it on to the failover
+    monitor.
+    Arguments:
+        server: The server the request went to.
+        latency: The time in seconds the request took.
+        ok: Whether the server accepted the request.
+    '''
+    UPLOAD_SECONDS.observe(latency, (server,))
+    if not ok:
+        UPLOAD_ERRORS.inc((server,))
+    if _failover is not None:
+        _failover.observe(server, latency, ok)
+
+
+def collect_metrics(prefix):
+    '''
+    Defines the metrics collector that reports the Listeners' and the
+    event queue's counters at scrape time.
+    Arguments:
+        prefix: The prefix of every metric name.
+    '''
+    listeners = list(_listeners.values())
+    stats = []
+    for listener in listeners:
+        try:
+            stats.append(({'device': listener.device()}, listener.stats()))
+        except RuntimeError:
+            pass
+    parts = []
+    for key, help in (('packets', 'Messages reported by the Listener.'),
+                      ('bytes', 'Bytes read from the serial port.'),
+                      ('frames', 'Serial frames with a valid CRC.'),
+                      ('unhandled', 'Messages of AM types without a decoder.'),
+                      ('decode_errors', 'Messages that could not be decoded.'),
+                      ('crc_errors', 'Serial frames with a bad CRC.'),
+                      ('framing_errors', 'Malformed serial frames.')):
+        parts.append(render_samples(prefix + key + '_total', 'counter', help,
+            [(labels, values[key]) for labels, values in stats]))
+    parts.append(render_histogram(DECODE_SECONDS.name, DECODE_SECONDS.help,
+        [(labels, values['decode']) for labels, values in stats]))
+    motes = []
+    for device, tracker in list(_sequences.items()):
+        for mote in tracker.motes():
+            motes.append(({'device': device, 'mote': mote}, tracker.mote(mote)))
+    for key, help in (('received', 'Messages received from the mote.'),
+                      ('lost', 'Messages of the mote skipped in its sequence.'),
+                      ('duplicates', 'Duplicate messages received from the mote.'),
+                      ('reordered', 'Messages of the mote received out of order.'),
+                      ('resets', 'Restarts of the mote\'s sequence.')):
+        parts.append(render_samples(prefix + 'mote_' + key + '_total', 'counter', help,
+            [(labels, values[key]) for labels, values in motes]))
+    if _dedup is not None:
+        parts.append(render_samples(prefix + 'duplicates_suppressed_total', 'counter',
+            'Copies of messages already received from another device.',
+            [({'device': device}, count) for device, count in _dedup.stats()['suppressed'].items()]))
+    if _queue is not None:
+        parts.append(render_samples(prefix + 'dropped_total', 'counter',
+            'Events dropped by the event queue.',
+            [({'device': device}, count) for device, count in _queue.stats()['dropped'].items()]))
+        parts.append(render_samples(prefix + 'queue_depth', 'gauge',
+            'Events waiting in the event queue.', [({}, _queue.depth())]))
+    return ''.join(parts)
+
+
+@click.group(invoke_without_command=True)
+@click.pass_context
+def run(ctx):
+    '''
+    Defines the client's commands. Without a command, starts the
+    client and its interactive shell.
+    '''
+    if ctx.invoked_subcommand == 'daemon':
+        return
+    if _config is None:
+        start()
+    if ctx.invoked_subcommand is None:
+        # the shell is only needed, and so only imported, when interactive
+        from click_shell import make_click_shell
+        make_click_shell(ctx, prompt='\nSDCP: ').cmdloop()
     
     
 #
@@ -87,6 +408,22 @@ def server():
     Defines commands for managing the servers in use by the client.
     '''
     pass
+
+
+@run.group()
+def archive():
+    '''
+    Defines commands for querying the local archive.
+    '''
+    pass
+
+
+@run.group()
+def profile():
+    '''
+    Defines commands for profiling the client.
+    '''
+    pass
     
 
 #
@@ -98,44 +435,120 @@ def server():
 @click.argument('device')
 @click.argument('baudrate')
 @click.argument('amrate')
-def config_add_server_command(device, baudrate, amrate):
-    pass
+def config_add_device_command(device, baudrate, amrate):
+    '''
+    Adds a device to the configuration and starts listening on it.
+    '''
+    if any(entry['device'] == device for entry in _config['devices']):
+        click.secho('Cannot add device {}, it is already configured!'.format(device), fg='red', err=True)
+        return
+    config = dict(_config)
+    config['devices'] = _config['devices'] + [{'device': device, 'baudrate': baudrate, 'amrate': amrate}]
+    update_config(config)
 
 
 @config.command('remove-device')
 @click.argument('device')
-def config_remove_device(device):
-    pass
+def config_remove_device_command(device):
+    '''
+    Removes a device from the configuration and stops listening on it.
+    '''
+    devices = [entry for entry in _config['devices'] if entry['device'] != device]
+    if len(devices) == len(_config['devices']):
+        click.secho('Cannot remove device {}, it is not configured!'.format(device), fg='red', err=True)
+        return
+    config = dict(_config)
+    config['devices'] = devices
+    update_config(config)
 
     
 @config.command('add-server')
 @click.argument('server')
 def config_add_server_command(server):
-    pass
+    '''
+    Adds a secondary server to the configuration.
+    '''
+    if server in get_servers().values():
+        click.secho('Cannot add server {}, it is already configured!'.format(server), fg='red', err=True)
+        return
+    config = dict(_config)
+    config['servers'] = {
+        'primary': _config['servers']['primary'],
+        'secondary': _config['servers']['secondary'] + [server]
+    }
+    update_config(config)
 
 
 @config.command('remove-server')  
 @click.argument('server')  
 def config_remove_server_command(server):
-    pass
+    '''
+    Removes a secondary server from the configuration.
+    '''
+    if server == _config['servers']['primary']:
+        click.secho('Cannot remove server {}, it is the primary server!'.format(server), fg='red', err=True)
+        return
+    if server not in _config['servers']['secondary']:
+        click.secho('Cannot remove server {}, it is not configured!'.format(server), fg='red', err=True)
+        return
+    config = dict(_config)
+    config['servers'] = {
+        'primary': _config['servers']['primary'],
+        'secondary': [address for address in _config['servers']['secondary'] if address != server]
+    }
+    update_config(config)
 
 
 @config.command('set-primary-server')
 @click.argument('server')
 def config_set_primary_server_command(server):
-    pass
+    '''
+    Makes a server the primary server. The previous primary server
+    becomes a secondary server.
+    '''
+    primary = _config['servers']['primary']
+    if server == primary:
+        click.secho('Cannot set primary server, {} is already the primary server!'.format(server), fg='red', err=True)
+        return
+    secondary = list(_config['servers']['secondary'])
+    if server in secondary:
+        secondary[secondary.index(server)] = primary
+    else:
+        secondary.append(primary)
+    config = dict(_config)
+    config['servers'] = {'primary': server, 'secondary': secondary}
+    update_config(config)
     
     
 @config.command('create')
 @click.argument('filename')
 def config_create_command(filename):
-    pass
+    '''
+    Creates a new configuration file, asking for its servers and
+    devices.
+    '''
+    if os.path.exists(filename):
+        click.secho('Cannot create configuration file {}, it already exists!'.format(filename), fg='red', err=True)
+        return
+    read_config(filename)
+    if os.path.isfile(filename):
+        click.echo("Created configuration file {}, use 'config load {}' to switch to it.".format(filename, filename))
 
 
 @config.command('load')
 @click.argument('filename')
 def config_load_command(filename):
-    pass
+    '''
+    Switches to another configuration file. Only the devices and
+    servers that differ from the current configuration are changed.
+    '''
+    try:
+        config = load_config(filename)
+    except (OSError, ValueError) as e:
+        click.secho('Cannot load configuration file {}: {}'.format(filename, e), fg='red', err=True)
+        return
+    apply_config(config, filename)
+    click.echo('Loaded configuration file {}.'.format(filename))
 
 
 #
@@ -145,9 +558,10 @@ def config_load_command(filename):
 
 @devices.command('add')
 @click.argument('device')
-@click.argument('baudrate')
-@click.argument('amrate')
-def devices_add_command(device, baudrate, amrate):
+@click.argument('baudrate', required=False)
+@click.argument('amrate', required=False)
+@click.option('--auto', is_flag=True, help='Detect the baudrate, which is then left out.')
+def devices_add_command(device, baudrate, amrate, auto):
     '''
     Adds a device and starts listening on it.
     Arguments:
@@ -156,23 +570,57 @@ def devices_add_command(device, baudrate, amrate):
     '''
     global _listeners
     
+    if auto:
+        baudrate, amrate = AUTO, amrate or baudrate
+    if baudrate is None or amrate is None:
+        click.secho('Cannot add device {}, expected a baudrate and an amrate, or --auto and an amrate!'.format(device), fg='red', err=True)
+        return
     if device not in _listeners:
         try:
-            _listeners[device] = Listener(
-                process_event, 
-                device, 
-                get_baudrate(baudrate), 
-                int(amrate)
-            )
-            _listeners[device].start()
-        except RuntimeError as e:
-            click.secho(e, fg='red', err=True)
+            _listeners[device] = create_listener(device, baudrate, amrate)
+        except (OSError, RuntimeError) as e:
+            click.secho(str(e), fg='red', err=True)
         except ValueError:
             click.secho('Cannot add listener for device {}, invalid baudrate or sample rate entered!'.format(device), fg='red', err=True)
     else:
         click.secho('Cannot start Listener for device {}, there is already an active Listener for the device!'.format(device), fg='red', err=True)
 
 
+@devices.command('probe')
+@click.argument('devices', nargs=-1)
+@click.option('--window', type=float, default=1.0, help='Seconds to listen at each rate.')
+def devices_probe_command(devices, window):
+    '''
+    Detects the baudrate of devices by listening to them at each rate
+    in Listener.RATES, all devices at once. Probes every serial port
+    not already listened to if no device is given.
+    '''
+    from sensclient.probe import probe
+
+    if not devices:
+        from serial.tools import list_ports
+        devices = [port.device for port in list_ports.comports() if port.device not in _listeners]
+    busy = [device for device in devices if device in _listeners]
+    for device in busy:
+        click.secho('Cannot probe device {}, it has an active Listener!'.format(device), fg='red', err=True)
+    devices = [device for device in devices if device not in _listeners]
+    if not devices:
+        click.secho('Cannot probe, no devices to probe!', fg='red', err=True)
+        return
+    click.echo('Probing {} device(s)...'.format(len(devices)))
+    results = probe(devices, window=window)
+    click.echo('-'*80)
+    click.echo('{:>20} {:>10}   {}'.format('DEVICE', 'BAUDRATE', 'FRAMES/CRC ERRORS PER RATE'))
+    click.echo('-'*80)
+    for device, result in results.items():
+        if isinstance(result, Exception):
+            click.echo('{:>20} {:>10}   {}'.format(device, '-', result))
+            continue
+        click.echo('{:>20} {:>10}   {}'.format(device, result.baudrate or '-', ', '.join(
+            '{}: {}/{}'.format(rate, frames, errors) for rate, (frames, errors) in result.rates.items())))
+    click.echo('-'*80)
+
+
 @devices.command('pause')
 @click.argument('device')
 def devices_pause_command(device):
@@ -185,13 +633,85 @@ def devices_pause_command(device):
     global _listeners
     
     if device in _listeners:
-        if _listeners[device] == Listener.RUNNING:
+        if _listeners[device].state() == Listener.RUNNING:
             click.echo('Pausing Listener for device {}...'.format(device))
             _listeners[device].pause()
+        else:
+            click.secho('Cannot pause Listener for device {}, Listener is not running!'.format(device), fg='red', err=True)
     else:
         click.secho('Cannot pause Listener for device {}, no Listener registered for device!'.format(device), fg='red', err=True)
 
 
+@devices.command('record')
+@click.argument('device')
+@click.argument('filename', required=False)
+@click.option('--stop', is_flag=True, help='Stop recording the device.')
+def devices_record_command(device, filename, stop):
+    '''
+    Records the raw bytes read from a device to a capture file, which
+    can be replayed later with 'devices replay'.
+    Arguments:
+        device: The physical address of the device to record.
+        filename: The capture file to write, replaced if it exists.
+    '''
+    if device not in _listeners or not _listeners[device].is_alive():
+        click.secho('Cannot record device {}, no Listener registered for device!'.format(device), fg='red', err=True)
+        return
+    listener = _listeners[device]
+    if not hasattr(listener, 'record') or isinstance(listener, ReplayListener):
+        click.secho('Cannot record device {}, only devices read by this process can be recorded!'.format(device), fg='red', err=True)
+        return
+    if stop:
+        writer = listener.record(None)
+        if writer is None:
+            click.secho('Cannot stop recording device {}, device is not being recorded!'.format(device), fg='red', err=True)
+            return
+        writer.close()
+        click.echo('Recorded {} bytes from device {} to {}.'.format(writer.size(), device, writer.path()))
+        return
+    if filename is None:
+        click.secho('Cannot record device {}, no capture file given!'.format(device), fg='red', err=True)
+        return
+    try:
+        writer = CaptureWriter(filename)
+    except OSError as e:
+        click.secho('Cannot record device {}: {}'.format(device, e), fg='red', err=True)
+        return
+    previous = listener.record(writer)
+    if previous is not None:
+        previous.close()
+    click.echo('Recording device {} to {}...'.format(device, filename))
+
+
+@devices.command('replay')
+@click.argument('filename')
+@click.option('--speed', type=float, default=1.0,
+    help='Replay speed, 1 is real time and 0 is as fast as possible.')
+@click.option('--start', type=float, default=0.0,
+    help='Time in seconds into the capture to start at.')
+@click.option('--amrate', default='OSCILLOSCOPE', help='AM rate of the messages to report.')
+def devices_replay_command(filename, speed, start, amrate):
+    '''
+    Adds a capture file as a device. The capture is replayed through
+    the same pipeline as a live device once resumed.
+    Arguments:
+        filename: The capture file to replay.
+    '''
+    global _listeners
+
+    if filename in _listeners:
+        click.secho('Cannot replay {}, it is already being replayed!'.format(filename), fg='red', err=True)
+        return
+    try:
+        listener = ReplayListener(queue_event, filename, speed, start, amrate)
+        listener.start()
+    except (OSError, ValueError) as e:
+        click.secho('Cannot replay {}: {}'.format(filename, e), fg='red', err=True)
+        return
+    _listeners[filename] = listener
+    click.echo("Added replay of {}, use 'devices resume {}' to start it.".format(filename, filename))
+
+
 @devices.command('resume')
 @click.argument('device')
 def devices_resume_command(device):
@@ -219,21 +739,181 @@ def devices_show_command():
     
     if len(_listeners) > 0:
         click.echo('-'*80)
-        click.echo('{:>15} {:>15} {:>15} {:>10}'.format('DEVICE', 'BAUDRATE', 'AMRATE', 'STATE'))
+        click.echo('{:>15} {:>15} {:>15} {:>10} {:>10}'.format('DEVICE', 'BAUDRATE', 'AMRATE', 'STATE', 'DROPS'))
         click.echo('-'*80)
-        # for some reason this is giving an error?
         for _, listener in _listeners.items():
-            click.echo('{:>15} {:>15} {:>15} {:>10}'.format(
+            click.echo('{:>15} {:>15} {:>15} {:>10} {:>10}'.format(
                 listener.device(), 
                 listener.baudrate(), 
                 listener.amrate(), 
-                listener.state_as_str()
+                listener.state_as_str(),
+                _queue.dropped(listener.device())
                 )
             )
+        click.echo('-'*80)
+        click.echo('Event queue: {}/{} events ({} policy), {} dropped'.format(
+            _queue.depth(), _queue.maxsize(), _queue.policy(), _queue.dropped()))
     else:
         click.secho('Cannot show Listener status for connected devices, no devices registered!', fg='red', err=True)
 
 
+@devices.command('stats')
+def devices_stats_command():
+    '''
+    Shows throughput, error and latency statistics for every device.
+    Rates are measured since the previous call.
+    '''
+    global _last_stats
+
+    if len(_listeners) == 0:
+        click.secho('Cannot show statistics for connected devices, no devices registered!', fg='red', err=True)
+        return
+    now = time.monotonic()
+    click.echo('-'*80)
+    click.echo('{:>15} {:>9} {:>10} {:>6} {:>6} {:>7} {:>9} {:>9}'.format(
+        'DEVICE', 'PKT/S', 'BYTES/S', 'CRC', 'FRAME', 'DROPS', 'DEC p50', 'WAIT p99'))
+    click.echo('-'*80)
+    for device, listener in _listeners.items():
+        try:
+            stats = listener.stats()
+        except RuntimeError as e:
+            click.secho('{:>15} {}'.format(device, e), fg='red', err=True)
+            continue
+        last = _last_stats.get(device)
+        if last is not None and now > last[0]:
+            elapsed = now - last[0]
+            pps = '{:.1f}'.format((stats['packets'] - last[1]) / elapsed)
+            bps = '{:.0f}'.format((stats['bytes'] - last[2]) / elapsed)
+        else:
+            pps = bps = '-'
+        _last_stats[device] = (now, stats['packets'], stats['bytes'])
+        decode = quantile(stats['decode'], 0.5)
+        wait = quantile(QUEUE_WAIT_SECONDS.snapshot((device,)), 0.99)
+        click.echo('{:>15} {:>9} {:>10} {:>6} {:>6} {:>7} {:>9} {:>9}'.format(
+            device, pps, bps, stats['crc_errors'], stats['framing_errors'],
+            _queue.dropped(device),
+            '{:.0f}us'.format(decode * 1e6) if decode is not None else '-',
+            '{:.1f}ms'.format(wait * 1e3) if wait is not None else '-'))
+    click.echo('-'*80)
+    for (server,), snapshot in sorted(UPLOAD_SECONDS.snapshots().items()):
+        p50, p99 = quantile(snapshot, 0.5), quantile(snapshot, 0.99)
+        click.echo('Uploads to {}: {} requests, {} errors, p50 {:.0f}ms, p99 {:.0f}ms'.format(
+            server, snapshot['count'], UPLOAD_ERRORS.value((server,)), p50 * 1e3, p99 * 1e3))
+    if _metrics_server is not None:
+        click.echo('Prometheus metrics served at http://{}:{}/metrics'.format(*_metrics_server.address()))
+
+
+@devices.command('loss')
+@click.argument('device', required=False)
+def devices_loss_command(device):
+    '''
+    Shows the messages lost by every device, or by every mote of a
+    device, as seen from the gaps in their sequence numbers. Messages
+    dropped by the client itself are shown apart.
+    Arguments:
+        device: The physical address of the device to show the motes
+        of.
+    '''
+    if _sequence_options is None:
+        click.secho('Cannot show losses, sequence tracking is disabled!', fg='red', err=True)
+        return
+    if device is not None:
+        tracker = _sequences.get(device)
+        if tracker is None:
+            click.secho('Cannot show losses for device {}, no messages received from it!'.format(device), fg='red', err=True)
+            return
+        click.echo('-'*80)
+        click.echo('{:>8} {:>10} {:>8} {:>7} {:>7} {:>8} {:>7} {:>8}'.format(
+            'MOTE', 'RECEIVED', 'LOST', 'LOSS', 'DUPS', 'REORDER', 'RESETS', 'LAST'))
+        click.echo('-'*80)
+        for mote in sorted(tracker.motes()):
+            stats = tracker.mote(mote)
+            click.echo('{:>8} {:>10} {:>8} {:>7} {:>7} {:>8} {:>7} {:>8}'.format(
+                mote, stats['received'], stats['lost'], format_rate(loss_rate(stats)),
+                stats['duplicates'], stats['reordered'], stats['resets'], stats['last']))
+        click.echo('-'*80)
+        return
+    if len(_sequences) == 0:
+        click.secho('Cannot show losses, no messages received yet!', fg='red', err=True)
+        return
+    click.echo('-'*80)
+    click.echo('{:>15} {:>6} {:>10} {:>8} {:>7} {:>7} {:>8} {:>7}'.format(
+        'DEVICE', 'MOTES', 'RECEIVED', 'LOST', 'LOSS', 'DUPS', 'RESETS', 'DROPS'))
+    click.echo('-'*80)
+    for name, tracker in sorted(_sequences.items()):
+        stats = tracker.totals()
+        click.echo('{:>15} {:>6} {:>10} {:>8} {:>7} {:>7} {:>8} {:>7}'.format(
+            name, stats['motes'], stats['received'], stats['lost'], format_rate(loss_rate(stats)),
+            stats['duplicates'], stats['resets'], _queue.dropped(name)))
+    click.echo('-'*80)
+    click.echo('LOST counts messages that never reached the client, DROPS those the client dropped.')
+
+
+@devices.command('duplicates')
+def devices_duplicates_command():
+    '''
+    Shows the copies of messages suppressed for every device because
+    another device had already received them.
+    '''
+    if _dedup is None:
+        click.secho('Cannot show duplicates, duplicate suppression is disabled!', fg='red', err=True)
+        return
+    stats = _dedup.stats()
+    devices = sorted(set(stats['admitted']) | set(stats['suppressed']))
+    if len(devices) == 0:
+        click.secho('Cannot show duplicates, no messages received yet!', fg='red', err=True)
+        return
+    click.echo('-'*80)
+    click.echo('{:>15} {:>12} {:>12} {:>10}'.format('DEVICE', 'KEPT', 'SUPPRESSED', 'RATE'))
+    click.echo('-'*80)
+    for device in devices:
+        kept, suppressed = stats['admitted'].get(device, 0), stats['suppressed'].get(device, 0)
+        click.echo('{:>15} {:>12} {:>12} {:>10}'.format(device, kept, suppressed,
+            format_rate(suppressed / (kept + suppressed))))
+    click.echo('-'*80)
+    click.echo('Suppressing copies within {:g}s, {} messages remembered.'.format(_dedup.window(), _dedup.size()))
+
+
+@devices.command('recent')
+@click.option('--device', help='Only the readings of this device.')
+@click.option('--mote', type=int, help='Only the readings of the mote with this id.')
+@click.option('--last', type=int, default=10, help='The number of newest messages to show.')
+@click.option('--since', type=float, help='Only the readings of the last SINCE seconds.')
+def devices_recent_command(device, mote, last, since):
+    '''
+    Shows the most recent readings held by the client, without asking
+    the server.
+    '''
+    if _recent is None:
+        click.secho('Cannot show recent readings, the recent readings cache is disabled!', fg='red', err=True)
+        return
+    readings = _recent.query(device, mote, last, since)
+    if len(readings) == 0:
+        click.secho('Cannot show recent readings, no readings match!', fg='red', err=True)
+        return
+    click.echo('-'*80)
+    click.echo('{:>12} {:>15} {:>6} {:>6}  {}'.format('TIME', 'DEVICE', 'MOTE', 'COUNT', 'READINGS'))
+    click.echo('-'*80)
+    for reading in readings:
+        values = ' '.join(str(value) for value in reading['readings'])
+        click.echo('{:>12} {:>15} {:>6} {:>6}  {}'.format(
+            time.strftime('%H:%M:%S', time.localtime(reading['ts'])) + '{:.3f}'.format(reading['ts'] % 1)[1:],
+            reading['device'], reading['id'], reading['count'],
+            values if len(values) <= 36 else values[:33] + '...'))
+    click.echo('-'*80)
+    if _recent_server is not None:
+        click.echo('Recent readings served at {}/recent'.format(_recent_server.address()))
+
+
+def format_rate(rate):
+    '''
+    Formats a loss rate for display.
+    Arguments:
+        rate: The rate, or None if there is none yet.
+    '''
+    return '{:.2%}'.format(rate) if rate is not None else '-'
+
+
 @devices.command('stop')
 @click.argument('device')
 def devices_stop_command(device):
@@ -259,32 +939,331 @@ def devices_stop_command(device):
 
 
 @server.command('set')
-@click.argument('num')
+@click.argument('num', type=int)
 def server_set_command(num):
     global _config
+    global _server
 
-    if (num == -1 or 
+    if (num == PRIMARY or 
             (0 <= num < len(_config['servers']['secondary']))):
         click.echo('Setting server to server number: {}...'.format(num))
+        _server = num
+        if _failover is not None:
+            if _failover.enabled():
+                click.echo('Automatic failover disabled, use \'server auto\' to turn it back on.')
+            _failover.disable(num)
+        if _uploader is not None:
+            _uploader.set_server(get_server(num))
     else:
         click.echo('Cannot set server, {} is not a valid server number!'.format(num))
 
 
+@server.command('auto')
+def server_auto_command():
+    '''
+    Turns on automatic failover to the healthiest server.
+    '''
+    if _failover is not None:
+        click.echo('Automatic failover enabled...')
+        _failover.enable()
+    else:
+        click.secho('Cannot enable automatic failover, the failover monitor is not running!', fg='red', err=True)
+
+
+def format_health(num):
+    '''
+    Formats the live health statistics of a server for display.
+    Arguments:
+        num: The number of the server.
+    '''
+    health = _failover.health(num) if _failover is not None else None
+    if health is None or health.samples == 0:
+        return ''
+    latency = '{:.1f}ms'.format(health.latency * 1000) if health.latency is not None else 'down'
+    return '  [latency {}, errors {:.0%}, {} samples]'.format(latency, health.error_rate, health.samples)
+
+
 @server.command('show')
 def server_show_handler():
     global _config
     
     click.echo('Displaying all configured servers...')
+    if _failover is not None and _failover.enabled():
+        click.echo('Automatic failover is enabled.')
     if _server == PRIMARY:
-        click.echo('* (-1) {}'.format(_config['servers']['primary']))
+        click.echo('* (-1) {}{}'.format(_config['servers']['primary'], format_health(PRIMARY)))
     else:
-        click.echo('(-1) {}'.format(_config['servers']['primary']))
+        click.echo('(-1) {}{}'.format(_config['servers']['primary'], format_health(PRIMARY)))
         
     for i in range(len(_config['servers']['secondary'])):
         if i != _server:
-            click.echo('({}) {}'.format(i, _config['servers']['secondary'][i]))
+            click.echo('({}) {}{}'.format(i, _config['servers']['secondary'][i], format_health(i)))
         else:
-            click.echo('* ({}) {}'.format(i, _config['servers']['secondary'][i]))
+            click.echo('* ({}) {}{}'.format(i, _config['servers']['secondary'][i], format_health(i)))
+    if _uploader is not None:
+        stats = _uploader.stats()
+        if stats['transport'] == 'websocket':
+            click.echo('Streaming readings to the current server over a WebSocket.')
+        else:
+            click.echo('Uploading {} batches to the current server.'.format(stats['format'].upper()))
+        click.echo('{}atches of up to {} readings, flushed every {:.2f}s, {} requests in flight.'.format(
+            'Adaptive b' if stats['adaptive'] else 'B', stats['batch_size'], stats['flush_interval'],
+            stats['inflight_limit']))
+        if stats['adaptive'] and stats['latency'] is not None:
+            click.echo('Server latency {:.0f}ms, target {:.0f}ms.'.format(
+                stats['latency'] * 1e3, stats['target_latency'] * 1e3))
+
+
+def uploads_busy():
+    '''
+    Gets whether the live uploads are behind, in which case backfills
+    hold off.
+    '''
+    if _uploader is None:
+        return False
+    stats = _uploader.stats()
+    return stats['pending'] >= stats['batch_size'] or stats['inflight'] >= stats['inflight_limit']
+
+
+def show_backfill():
+    '''
+    Shows the progress of the current backfill, if there is one.
+    '''
+    if _backfill is None:
+        click.echo('No backfill has been started.')
+        return
+    stats = _backfill.stats()
+    rate = stats['sent'] / stats['elapsed'] if stats['elapsed'] > 0 else 0.0
+    click.echo('Backfill {}: {} of {} chunks, {} readings sent ({:.0f}/s), {} retries, '
+        'held off {:.1f}s for live uploads.'.format('running' if stats['running'] else 'finished',
+            stats['chunks'], stats['total'], stats['sent'], rate, stats['retries'], stats['yielded']))
+
+
+@server.command('backfill')
+@click.option('--spool', 'spool_path', default=None, help='Upload the records of the spool in this directory instead of the archive.')
+@click.option('--start', default=None, help='Only archived readings from this time, epoch seconds or ISO 8601.')
+@click.option('--end', default=None, help='Only archived readings up to this time, epoch seconds or ISO 8601.')
+@click.option('--device', default=None, help='Only archived readings received on this device.')
+@click.option('--mote', type=int, default=None, help='Only archived readings of this mote.')
+@click.option('--concurrency', type=int, default=2, help='The most chunks in flight at once.')
+@click.option('--rate', type=float, default=None, help='The most readings sent per second.')
+@click.option('--chunk', type=int, default=500, help='The records per chunk of a spool.')
+@click.option('--status', is_flag=True, help='Show the progress of the current backfill.')
+@click.option('--stop', is_flag=True, help='Stop the current backfill, it resumes when run again.')
+def server_backfill_command(spool_path, start, end, device, mote, concurrency, rate, chunk, status, stop):
+    '''
+    Uploads the archived readings, or the records of a spool, to the
+    current server in the background, resuming where the last backfill
+    left off.
+    '''
+    global _backfill
+
+    if status:
+        show_backfill()
+        return
+    if stop:
+        if _backfill is None or not _backfill.running():
+            click.secho('Cannot stop the backfill, none is running!', fg='red', err=True)
+            return
+        click.echo('Stopping the backfill once the chunks in flight are delivered...')
+        _backfill.stop()
+        show_backfill()
+        return
+    if _backfill is not None and _backfill.running():
+        click.secho('Cannot start a backfill, one is already running!', fg='red', err=True)
+        return
+    server = get_server(_server)
+    if spool_path is not None:
+        live = _config.get('spool', dict())
+        if live.get('enabled', True) and \
+                os.path.abspath(spool_path) == os.path.abspath(live.get('path', DEFAULT_SPOOL_PATH)):
+            click.secho('Cannot backfill from the live spool, the uploader is already replaying it!',
+                fg='red', err=True)
+            return
+        try:
+            source = SpoolSource(Spool(spool_path), chunk)
+        except (OSError, ValueError) as e:
+            click.secho('Cannot open the spool {}: {}'.format(spool_path, e), fg='red', err=True)
+            return
+    else:
+        if _archive is None:
+            click.secho('Cannot backfill from the archive, archiving is disabled!', fg='red', err=True)
+            return
+        try:
+            start = parse_time(start) if start is not None else None
+            end = parse_time(end) if end is not None else None
+        except ValueError:
+            click.secho('Cannot backfill, expected times in epoch seconds or ISO 8601!', fg='red', err=True)
+            return
+        source = ArchiveSource(_archive, os.path.join(_archive.path(), 'backfill.json'), server,
+            start, end, device, mote)
+    # a separate uploader, so the live uploads keep their own connections
+    options = {key: value for key, value in _config.get('uploader', dict()).items()
+        if key in ('path', 'compress', 'format', 'timeout')}
+    try:
+        _backfill = Backfill(source, Uploader(server, connections=max(concurrency, 1), **options),
+            concurrency, rate, uploads_busy)
+    except ValueError as e:
+        source.close()
+        click.secho('Cannot start the backfill: {}'.format(e), fg='red', err=True)
+        return
+    click.echo('Backfilling {} chunks to {}...'.format(source.total(), server))
+    _backfill.start()
+
+
+#
+# DEFINE ARCHIVE COMMANDS
+#
+
+
+def parse_time(value):
+    '''
+    Parses a time given on the command line, either in seconds since
+    the epoch or as an ISO 8601 date and time (local time unless it
+    names a timezone).
+    Arguments:
+        value: The time as given.
+    Raises a ValueError if the time is in neither form.
+    '''
+    import datetime
+
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+@archive.command('query')
+@click.option('--start', default=None, help='Only readings from this time, epoch seconds or ISO 8601.')
+@click.option('--end', default=None, help='Only readings up to this time, epoch seconds or ISO 8601.')
+@click.option('--since', type=float, default=None, help='Only readings from the last N seconds.')
+@click.option('--device', default=None, help='Only readings received on this device.')
+@click.option('--mote', type=int, default=None, help='Only readings of this mote.')
+@click.option('--limit', type=int, default=100, help='The most readings to show.')
+def archive_query_command(start, end, since, device, mote, limit):
+    '''
+    Shows the archived readings in a time range, oldest first.
+    '''
+    if _archive is None:
+        click.secho('Cannot query the archive, archiving is disabled!', fg='red', err=True)
+        return
+    try:
+        start = parse_time(start) if start is not None else None
+        end = parse_time(end) if end is not None else None
+    except ValueError:
+        click.secho('Cannot query the archive, expected times in epoch seconds or ISO 8601!', fg='red', err=True)
+        return
+    if since is not None:
+        start = max(start or 0.0, time.time() - since)
+    rows = 0
+    click.echo('-'*80)
+    click.echo('{:>26} {:>15} {:>6} {:>7} {:>8}'.format('TIME', 'DEVICE', 'MOTE', 'COUNT', 'READING'))
+    click.echo('-'*80)
+    for ts, name, ident, count, reading in _archive.query(start, end, device, mote):
+        if rows >= limit:
+            click.echo('... stopped after {} readings, see --limit.'.format(limit))
+            break
+        click.echo('{:>26} {:>15} {:>6} {:>7} {:>8}'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts)) + '{:.3f}'.format(ts % 1)[1:],
+            name, ident, count, reading))
+        rows += 1
+    click.echo('-'*80)
+
+
+@archive.command('show')
+def archive_show_command():
+    '''
+    Shows the days held by the archive.
+    '''
+    if _archive is None:
+        click.secho('Cannot show the archive, archiving is disabled!', fg='red', err=True)
+        return
+    click.echo('Archiving to {}, {} readings archived since the client started.'.format(
+        _archive.path(), _archive.rows()))
+    for day in _archive.days():
+        stats = _archive.day_stats(day)
+        click.echo('{}  {:>12} bytes  {}'.format(day, stats['bytes'], 'sealed' if stats['sealed'] else 'open'))
+
+
+#
+# DEFINE PROFILE COMMANDS
+#
+
+
+@profile.command('start')
+@click.option('--mode', type=click.Choice(Profiler.MODES), default=Profiler.STAGES,
+    help='Time the pipeline stages, run cProfile, or trace memory allocations.')
+@click.option('--every', type=int, default=100, help='Time one in every N passes through each stage.')
+def profile_start_command(mode, every):
+    '''
+    Starts profiling the client, until 'profile stop'.
+    '''
+    try:
+        PROFILER.start(mode, every)
+    except (RuntimeError, ValueError) as e:
+        click.secho('Cannot start profiling: {}'.format(e), fg='red', err=True)
+        return
+    click.echo('Profiling the client ({})...'.format(mode))
+    if _pool is not None:
+        click.secho('Devices running in worker processes are not profiled.', fg='yellow', err=True)
+
+
+@profile.command('stop')
+def profile_stop_command():
+    '''
+    Stops profiling the client, keeping the results for 'profile dump'.
+    '''
+    if not PROFILER.running():
+        click.secho('Cannot stop profiling, no profile is running!', fg='red', err=True)
+        return
+    PROFILER.stop()
+    click.echo('Stopped profiling after {:.1f}s, see \'profile dump\'.'.format(PROFILER.elapsed()))
+
+
+@profile.command('show')
+def profile_show_command():
+    '''
+    Shows the stage timings taken so far, or the state of the profile.
+    '''
+    if PROFILER.mode() is None:
+        click.echo('The client has not been profiled.')
+        return
+    click.echo('{} profile {} for {:.1f}s.'.format(PROFILER.mode().capitalize(),
+        'running' if PROFILER.running() else 'taken', PROFILER.elapsed()))
+    if PROFILER.mode() != Profiler.STAGES:
+        return
+    timings = STAGES.timings()
+    click.echo('-'*80)
+    click.echo('{:>20} {:>18} {:>9} {:>12} {:>12}'.format('DEVICE', 'STAGE', 'SAMPLES', 'WALL (us)', 'CPU (us)'))
+    click.echo('-'*80)
+    for part, device, stage in sorted(timings):
+        samples, wall, cpu = timings[(part, device, stage)]
+        click.echo('{:>20} {:>18} {:>9} {:>12.1f} {:>12.1f}'.format(device, '{}.{}'.format(part, stage),
+            samples, wall / samples * 1e6, cpu / samples * 1e6))
+    click.echo('-'*80)
+    click.echo('Mean time per pass, one in every {} passes timed.'.format(STAGES.every()))
+
+
+@profile.command('dump')
+@click.argument('filename')
+@click.option('--cpu-time', is_flag=True, help='Weigh the stages by CPU time instead of wall time.')
+def profile_dump_command(filename, cpu_time):
+    '''
+    Writes the profile to a collapsed stack file, for flamegraph.pl or
+    speedscope.
+    '''
+    if PROFILER.mode() is None:
+        click.secho('Cannot dump the profile, the client has not been profiled!', fg='red', err=True)
+        return
+    if PROFILER.running() and PROFILER.mode() != Profiler.STAGES:
+        click.secho('Cannot dump the profile until it is stopped!', fg='red', err=True)
+        return
+    try:
+        count = PROFILER.dump(filename, cpu_time)
+    except OSError as e:
+        click.secho('Cannot write the profile to {}: {}'.format(filename, e), fg='red', err=True)
+        return
+    click.echo('Wrote {} stacks to {}.'.format(count, filename))
 
 
 #
@@ -292,6 +1271,36 @@ def server_show_handler():
 #
 
 
+@run.command('daemon')
+@click.option('--config', 'filename', default=DEFAULT_CONFIG_PATH, help='Path of the configuration file.')
+def daemon_command(filename):
+    '''
+    Runs the client as a service, without a shell. Every device in the
+    configuration is started right away and readiness is reported to
+    the service manager (systemd's sd_notify) once they are listening.
+    Stops on SIGTERM or SIGINT, SIGHUP reloads the configuration.
+    '''
+    global _headless
+
+    from sensclient import daemon
+
+    if _config is not None:
+        click.secho('Cannot start the daemon, the client is already running!', fg='red', err=True)
+        return
+    if not os.path.isfile(filename):
+        click.secho('Cannot start the daemon, no configuration file at {}!'.format(filename), fg='red', err=True)
+        raise SystemExit(1)
+    _headless = True
+    configure(filename)
+    start_devices(resume=True)
+    running = sum(1 for listener in _listeners.values() if listener.state() == Listener.RUNNING)
+    daemon.notify('READY=1', 'STATUS=Listening on {} of {} devices'.format(running, len(_config['devices'])))
+    start_services()
+    click.echo('Listening on {} devices, uploading to {}.'.format(running, _uploader.server()), err=True)
+    signum = daemon.wait_for_signal(on_reload=reload_config)
+    daemon.notify('STOPPING=1', 'STATUS=Stopping on signal {}'.format(signum))
+
+
 @run.command('cls')
 def clear_command():
     '''
@@ -300,6 +1309,80 @@ def clear_command():
     click.clear()
 
 
+def summary_loss(device, mote):
+    '''
+    Gets the loss rate of a mote, or of a whole device if the mote is
+    None, for the live console.
+    Arguments:
+        device: The device the mote is heard on.
+        mote: The id of the mote.
+    '''
+    tracker = _sequences.get(device)
+    if tracker is None:
+        return None
+    stats = tracker.totals() if mote is None else tracker.mote(mote)
+    return loss_rate(stats) if stats else None
+
+
+@run.command('console')
+@click.option('--refresh', type=float, default=1.0, help='Seconds between redraws.')
+def console_command(refresh):
+    '''
+    Shows a live summary of every device and mote: the messages per
+    second, the last reading and the lowest, highest and mean readings
+    since the last redraw, and the loss rate. Redrawn every refresh
+    seconds until Ctrl-C.
+    '''
+    if _summary is None:
+        click.secho('Cannot show the console, there is no summary of the events!', fg='red', err=True)
+        return
+    if refresh <= 0:
+        click.secho('Cannot show the console, the refresh must be positive!', fg='red', err=True)
+        return
+    # start from a fresh window
+    _summary.snapshot()
+    try:
+        while True:
+            time.sleep(refresh)
+            lines = render(_summary.snapshot(), summary_loss)
+            click.clear()
+            click.echo('Live summary every {:g}s, Ctrl-C to stop. Queue {}/{}, {} dropped.\n{}'.format(
+                refresh, _queue.depth(), _queue.maxsize(), _queue.dropped(), '\n'.join(lines)))
+    except KeyboardInterrupt:
+        click.echo()
+
+
+@run.command('tail')
+@click.option('--device', default=None, help='Only show the events of this device.')
+@click.option('--mote', type=int, default=None, help='Only show the events of this mote.')
+@click.option('--rate', type=float, default=10.0, help='The most events shown per second.')
+@click.option('--every', type=int, default=1, help='Only consider every Nth event.')
+def tail_command(device, mote, rate, every):
+    '''
+    Prints the raw events as they come in, sampled so that the terminal
+    keeps up, until Ctrl-C.
+    '''
+    global _tail
+
+    try:
+        sampler = Sampler(rate, every, device, mote)
+    except ValueError as e:
+        click.secho(str(e), fg='red', err=True)
+        return
+    _tail = sampler
+    try:
+        while True:
+            time.sleep(0.1)
+            for source, event in sampler.drain():
+                click.echo('{}: {}'.format(source, event))
+    except KeyboardInterrupt:
+        click.echo()
+    finally:
+        _tail = None
+    if sampler.skipped():
+        click.echo('{} sampled events were not shown, over the rate limit.'.format(sampler.skipped()))
+
+
 #
 # CLIENT FUNCTIONS
 #
@@ -312,38 +1395,401 @@ def cleanup():
     '''
     global _listeners
     
+    if _watcher is not None:
+        _watcher.stop()
     for _, listener in _listeners.items():
         listener.stop()
+    if _failover is not None:
+        _failover.stop()
+    if _metrics_server is not None:
+        _metrics_server.close()
+    if _recent_server is not None:
+        _recent_server.close()
+    if _pool is not None:
+        _pool.close()
+    if _queue is not None:
+        _queue.close()
+        _consumer.join(10)
+    if _backfill is not None:
+        _backfill.stop(timeout=10)
+    if _archive is not None:
+        _archive.close()
+    if _uploader is not None:
+        _uploader.close(timeout=10)
+    Engine.default().close()
 
 
-def init():
+def configure(filename=DEFAULT_CONFIG_PATH):
     '''
-    Defines the entry point of the client.
+    Loads the configuration and sets up everything the devices feed
+    into: the event queue and its consumer, the spool, the uploader
+    and the failover monitor. Nothing is sent to a server until
+    start_services() is called.
+    Arguments:
+        filename: The path of the configuration file.
     '''
     global _config
-    global _listeners
+    global _config_file
+    global _uploader
+    global _queue
+    global _consumer
+    global _pool
+    global _failover
+    global _sequence_options
+    global _dedup
+    global _recent
+    global _summary
+    global _archive
     
     # load in the configuration file
-    _config = read_config()
-    # TODO: This needs refactored so it calls the device add 
-    #   command directly
+    _config = read_config(filename)
+    _config_file = filename
+    # register the decoders of any other applications on the devices
+    register_decoders(_config.get('decoders', dict()))
+    # track the sequence numbers of every mote unless disabled
+    sequence = dict(_config.get('sequence', dict()))
+    if sequence.pop('enabled', True):
+        try:
+            SequenceTracker(**sequence)
+            _sequence_options = sequence
+        except (TypeError, ValueError) as e:
+            click.secho('{} Falling back to the default sequence tracking.'.format(e), fg='red', err=True)
+            _sequence_options = dict()
+    # suppress the copies of messages heard by several devices if asked to
+    dedup = dict(_config.get('dedup', dict()))
+    if dedup.pop('enabled', False):
+        try:
+            _dedup = DuplicateFilter(**dedup)
+        except (TypeError, ValueError) as e:
+            click.secho('{} Falling back to the default duplicate filter.'.format(e), fg='red', err=True)
+            _dedup = DuplicateFilter()
+    # keep the recent readings of every mote at hand unless disabled
+    recent = dict(_config.get('recent', dict()))
+    for option in ('host', 'port', 'socket'):
+        recent.pop(option, None)
+    if recent.pop('enabled', True):
+        try:
+            _recent = RecentReadings(**recent)
+        except (TypeError, ValueError) as e:
+            click.secho('{} Falling back to the default recent readings cache.'.format(e), fg='red', err=True)
+            _recent = RecentReadings()
+    # keep every reading on disk if asked to
+    archive = dict(_config.get('archive', dict()))
+    if archive.pop('enabled', False):
+        try:
+            _archive = Archive(**archive)
+        except (TypeError, ValueError) as e:
+            click.secho('{} Readings will not be archived.'.format(e), fg='red', err=True)
+        except OSError as e:
+            click.secho('Cannot open the archive, readings will not be archived: {}'.format(e), fg='red', err=True)
+    # summarize the events for the live console, there is none headless
+    if not _headless:
+        _summary = Summary()
+    # start consuming events
     try:
-        for device in _config['devices']:
-            _listeners[device] = Listener(
-                process_event, 
-                device.device, 
-                get_baudrate(device.baudrate), 
-                int(device.amrate)
-            )
-            _listeners[device].start()
-    except RuntimeError as e:
-        click.secho(e, fg='red', err=True)
-    except ValueError:
-        click.secho('Cannot add listener for device {}, invalid baudrate or sample rate entered!'.format(device), fg='red', err=True)
+        _queue = EventQueue(**_config.get('queue', dict()))
+    except (TypeError, ValueError) as e:
+        click.secho('{} Falling back to the default queue.'.format(e), fg='red', err=True)
+        _queue = EventQueue()
+    _consumer = threading.Thread(target=consume_events, name='sensclient-consumer', daemon=True)
+    _consumer.start()
+    # open the store-and-forward spool unless it has been disabled
+    spool = None
+    spool_config = dict(_config.get('spool', dict()))
+    if spool_config.pop('enabled', True):
+        try:
+            spool = Spool(**spool_config)
+        except (TypeError, ValueError) as e:
+            click.secho('{} Readings will not survive outages.'.format(e), fg='red', err=True)
+        except OSError as e:
+            click.secho('Cannot open the spool, readings will not survive outages: {}'.format(e), fg='red', err=True)
+    # watch the health of every server
+    failover = dict(_config.get('failover', dict()))
+    auto = failover.pop('enabled', False)
+    failover.pop('engine', None)
+    try:
+        _failover = FailoverMonitor(get_servers(), switch_server, _server, **failover)
+    except (TypeError, ValueError) as e:
+        click.secho('{} Falling back to the default failover monitor.'.format(e), fg='red', err=True)
+        _failover = FailoverMonitor(get_servers(), switch_server, _server)
+    if auto:
+        _failover.enable()
+    # prepare the uploader for the primary server
+    uploader = dict(_config.get('uploader', dict()))
+    for option in ('server', 'engine', 'spool', 'observer'):
+        uploader.pop(option, None)
+    try:
+        _uploader = Uploader(get_server(_server), spool=spool, observer=observe_upload, **uploader)
+    except (TypeError, ValueError) as e:
+        click.secho('{} Falling back to the default uploader.'.format(e), fg='red', err=True)
+        _uploader = Uploader(get_server(_server), spool=spool, observer=observe_upload)
+    # spread the Listeners over worker processes if asked to
+    sharding = dict(_config.get('sharding', dict()))
+    sharding.pop('registry', None)
+    try:
+        if int(sharding.get('workers', 0)) > 0:
+            from sensclient.sharding import ShardPool
+            _pool = ShardPool(queue_event, **sharding)
+    except (TypeError, ValueError) as e:
+        click.secho('{} Running all devices in this process.'.format(e), fg='red', err=True)
     # register the cleanup function
     atexit.register(cleanup)
-    
-    # start the shell
+
+
+def register_decoders(decoders):
+    '''
+    Registers the decoders declared in the configuration.
+    Arguments:
+        decoders: A dict mapping each message name to its AM type and
+        fields.
+    '''
+    for name, decoder in decoders.items():
+        try:
+            DECODERS.register_layout(decoder['amtype'], name, decoder['fields'])
+        except (KeyError, TypeError, ValueError) as e:
+            click.secho('Cannot register the decoder for {}: {}'.format(name, e), fg='red', err=True)
+
+
+def start_devices(resume=False):
+    '''
+    Creates the Listeners of the devices listed in the configuration.
+    The devices are opened, and their baudrates detected, in parallel,
+    so bringing them up takes as long as the slowest of them.
+    Arguments:
+        resume: Whether to resume the Listeners, otherwise they are
+        left PAUSED.
+    '''
+    global _listeners
+
+    def bring_up(device):
+        listener = create_listener(
+            device['device'], 
+            str(device['baudrate']), 
+            device['amrate']
+        )
+        if resume:
+            listener.resume()
+        return listener
+
+    if not _config['devices']:
+        return
+    with ThreadPoolExecutor(min(len(_config['devices']), BRING_UP_THREADS)) as pool:
+        futures = [(device['device'], pool.submit(bring_up, device)) for device in _config['devices']]
+    for device, future in futures:
+        try:
+            _listeners[device] = future.result()
+        except (OSError, RuntimeError) as e:
+            click.secho(str(e), fg='red', err=True)
+        except ValueError:
+            click.secho('Cannot add listener for device {}, invalid baudrate or sample rate entered!'.format(device), fg='red', err=True)
+
+
+def start_services():
+    '''
+    Starts uploading, probing the servers, watching the configuration
+    file and, if configured, serving metrics.
+    '''
+    global _metrics_server
+    global _recent_server
+    global _watcher
+
+    _uploader.start()
+    _failover.start()
+    # export metrics to Prometheus if asked to
+    REGISTRY.add_collector(collect_metrics)
+    metrics = _config.get('metrics', dict())
+    if metrics.get('enabled', True) and metrics.get('port'):
+        try:
+            _metrics_server = MetricsServer(host=metrics.get('host', '127.0.0.1'), port=metrics['port'])
+        except (TypeError, ValueError, OverflowError) as e:
+            click.secho('{} Metrics will not be served.'.format(e), fg='red', err=True)
+        except OSError as e:
+            click.secho('Cannot serve metrics: {}'.format(e), fg='red', err=True)
+    # answer queries on the recent readings if asked to
+    recent = _config.get('recent', dict())
+    if _recent is not None and (recent.get('port') or recent.get('socket')):
+        try:
+            _recent_server = RecentServer(_recent, recent.get('host', '127.0.0.1'),
+                recent.get('port'), recent.get('socket'))
+        except OSError as e:
+            click.secho('Cannot serve recent readings: {}'.format(e), fg='red', err=True)
+    # apply changes to the configuration file as they are made
+    reload = dict(_config.get('reload', dict()))
+    if reload.pop('enabled', True) and os.path.isfile(_config_file):
+        try:
+            _watcher = ConfigWatcher(_config_file, reload_config, report_config_error, **reload)
+            _watcher.start()
+        except (TypeError, ValueError) as e:
+            click.secho('Cannot watch the configuration file: {}'.format(e), fg='red', err=True)
+
+
+def update_config(config):
+    '''
+    Writes a changed configuration to the configuration file and
+    applies it.
+    Arguments:
+        config: The new configuration.
+    '''
+    with _config_lock:
+        try:
+            validate_config(config)
+        except ValueError as e:
+            click.secho('Cannot change the configuration: {}'.format(e), fg='red', err=True)
+            return
+        if not write_config(config, _config_file, confirm=False):
+            return
+        if _watcher is not None:
+            # the change is applied right here, not when the watcher
+            #   notices the file changed
+            _watcher.watch(_config_file)
+        apply_config(config)
+
+
+def reload_config(config=None):
+    '''
+    Defines the callback of the configuration watcher, also used on
+    SIGHUP. Applies the configuration file as it is now.
+    Arguments:
+        config: The configuration read from the file, it is read
+        again if not given.
+    '''
+    if config is None:
+        try:
+            config = load_config(_config_file)
+        except (OSError, ValueError) as e:
+            report_config_error(e)
+            return
+    click.secho('Reloading the configuration from {}...'.format(_config_file), fg='yellow', err=True)
+    apply_config(config)
+
+
+def report_config_error(error):
+    '''
+    Defines the callback the configuration watcher reports a file it
+    cannot load to. The running configuration is kept.
+    Arguments:
+        error: The exception raised loading the file.
+    '''
+    click.secho('Ignoring the changed configuration file: {}'.format(error), fg='red', err=True)
+
+
+def apply_config(config, filename=None):
+    '''
+    Moves the running client to a new configuration. Only what differs
+    from the running configuration is touched: the Listeners of
+    devices that were added, removed or changed are started or
+    stopped, and uploads move to another server only if the current
+    one is no longer configured. Readings already queued or spooled
+    are kept.
+    Arguments:
+        config: The new, already validated, configuration.
+        filename: The configuration file it came from, if it replaces
+        the current file.
+    '''
+    global _config
+    global _config_file
+
+    with _config_lock:
+        old = _config
+        _config = config
+        if filename is not None and filename != _config_file:
+            _config_file = filename
+            if _watcher is not None:
+                _watcher.watch(filename)
+        # register new and changed decoders before any Listener needs them
+        decoders = old.get('decoders', dict())
+        register_decoders({name: decoder for name, decoder in config.get('decoders', dict()).items()
+            if decoders.get(name) != decoder})
+        reconcile_devices(old['devices'], config.get('devices', []))
+        if old['servers'] != config['servers']:
+            reconcile_servers(old['servers'])
+        for section in RESTART_SECTIONS:
+            if old.get(section) != config.get(section):
+                click.secho('Changes to the {} section take effect when the client restarts.'.format(section),
+                    fg='yellow', err=True)
+
+
+def reconcile_devices(old, new):
+    '''
+    Starts and stops Listeners to match a new list of devices.
+    Arguments:
+        old: The devices of the running configuration.
+        new: The devices of the new configuration.
+    '''
+    old = {entry['device']: entry for entry in old}
+    new = {entry['device']: entry for entry in new}
+    for device in old:
+        if device not in new and device in _listeners:
+            click.echo('Removing device {}...'.format(device))
+            _listeners.pop(device).stop()
+    for device, entry in new.items():
+        if old.get(device) == entry:
+            continue
+        listener = _listeners.get(device)
+        try:
+            baudrate = None if is_auto(entry['baudrate']) else get_baudrate(str(entry['baudrate']))
+        except ValueError:
+            click.secho('Cannot add listener for device {}, invalid baudrate or sample rate entered!'.format(device), fg='red', err=True)
+            continue
+        if listener is not None and listener.is_alive():
+            # a detected baudrate is kept
+            if baudrate in (None, listener.baudrate()) and listener.amrate() == entry['amrate']:
+                continue
+            click.echo('Restarting device {}...'.format(device))
+            resume = listener.state() == Listener.RUNNING
+            _listeners.pop(device).stop()
+        else:
+            click.echo('Adding device {}...'.format(device))
+            _listeners.pop(device, None)
+            resume = _headless
+        try:
+            listener = create_listener(device, str(entry['baudrate']), entry['amrate'])
+            _listeners[device] = listener
+            if resume:
+                listener.resume()
+        except (OSError, RuntimeError) as e:
+            click.secho(str(e), fg='red', err=True)
+        except ValueError:
+            click.secho('Cannot add listener for device {}, invalid baudrate or sample rate entered!'.format(device), fg='red', err=True)
+
+
+def reconcile_servers(old):
+    '''
+    Renumbers the servers after the configured servers changed. Uploads
+    stay on the current server if it is still configured, otherwise
+    they move to the primary server.
+    Arguments:
+        old: The servers of the previous configuration.
+    '''
+    global _server
+
+    current = old['primary'] if _server == PRIMARY else old['secondary'][_server]
+    numbers = {address: num for num, address in get_servers().items()}
+    num = numbers.get(current, PRIMARY)
+    if current not in numbers:
+        click.secho('Server {} was removed, uploading to server ({}) {}...'.format(
+            current, num, get_server(num)), fg='yellow', err=True)
+    _server = num
+    if _uploader is not None and _uploader.server() != get_server(num):
+        _uploader.set_server(get_server(num))
+    if _failover is not None:
+        _failover.set_servers(get_servers(), num)
+
+
+def start():
+    '''
+    Starts the client for interactive use: devices from the
+    configuration are added PAUSED.
+    '''
+    configure()
+    start_devices()
+    start_services()
+
+
+def init():
+    '''
+    Defines the entry point of the client.
+    '''
     run()
     
 
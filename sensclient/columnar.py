@@ -0,0 +1,175 @@
+# Identifies a columnar body and the version of its layout
+MAGIC = b'SLC\x01'
+
+# The media type of a columnar body
+MEDIA_TYPE = 'application/x-senslify-columnar'
+
+# The keys of a reading that can be encoded
+FIELDS = frozenset(('device', 'ts', 'version', 'interval', 'id', 'count', 'readings'))
+
+
+def _put(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _zigzag(value):
+    return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+
+def _unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def encode(readings):
+    '''
+    Encodes a batch of readings in columns.
+
+    A batch of oscilloscope readings is grouped into series, one per
+    device, mote id, version and interval, which are sent column by column:
+    first the timestamps of every message of the series, then their
+    counts, then the number of readings of each message and finally all of
+    their readings. Timestamps (in microseconds), counts and readings are
+    each sent as the difference from the previous value of their column,
+    which for slowly changing sensor data is a small number, and every
+    number is packed as a varint: 7 bits per byte, low bits first, with the
+    top bit set on every byte but the last. Signed differences are
+    zigzag-mapped to unsigned numbers first (0, -1, 1, -2... become 0, 1,
+    2, 3...), and count differences are taken modulo 2^16 to follow the
+    counter's wraparound.
+
+    A body is laid out as:
+        MAGIC
+        varint number of devices, then for each its UTF-8 name as a varint
+            length followed by the bytes
+        varint number of series, then for each:
+            varint device index, id, version, interval and message count n
+            n zigzag varint timestamp deltas
+            n varint count deltas
+            n varint reading counts
+            zigzag varint reading deltas, for every reading of the series
+    Delta chains restart with every series, from 0.
+    Arguments:
+        readings: The readings, as built by make_reading() from
+        oscilloscope messages.
+    Returns the body as bytes. Raises a ValueError if one of the
+    readings cannot be encoded, in which case the batch should be sent
+    as JSON.
+    '''
+    devices = dict()
+    series = dict()
+    for reading in readings:
+        if reading.keys() != FIELDS:
+            raise ValueError('Only oscilloscope readings can be encoded in columns!')
+        device = devices.setdefault(reading['device'], len(devices))
+        key = (device, reading['id'], reading['version'], reading['interval'])
+        rows = series.get(key)
+        if rows is None:
+            rows = series[key] = []
+        rows.append(reading)
+
+    out = bytearray(MAGIC)
+    put = _put
+    put(out, len(devices))
+    for device in devices:
+        name = device.encode('utf-8')
+        put(out, len(name))
+        out += name
+    put(out, len(series))
+    for key, rows in series.items():
+        for value in key:
+            put(out, value)
+        put(out, len(rows))
+        previous = 0
+        for reading in rows:
+            ts = round(reading['ts'] * 1e6)
+            put(out, _zigzag(ts - previous))
+            previous = ts
+        previous = 0
+        for reading in rows:
+            put(out, (reading['count'] - previous) & 0xffff)
+            previous = reading['count']
+        for reading in rows:
+            put(out, len(reading['readings']))
+        previous = 0
+        for reading in rows:
+            for value in reading['readings']:
+                # the bulk of the data, small rising deltas are inlined
+                delta = value - previous
+                if 0 <= delta < 64:
+                    out.append(delta << 1)
+                else:
+                    put(out, delta << 1 if delta >= 0 else ((-delta) << 1) - 1)
+                previous = value
+    return bytes(out)
+
+
+def decode(body):
+    '''
+    The reference decoder of the columnar encoding.
+    Arguments:
+        body: An encoded batch, any bytes-like object.
+    Returns the list of readings, grouped by series and in the order
+    they were sent within each series. Raises a ValueError if the body
+    is not a valid columnar batch.
+    '''
+    body = bytes(body)
+    if body[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a columnar batch!')
+    pos = len(MAGIC)
+
+    def take():
+        nonlocal pos
+        value = shift = 0
+        while True:
+            try:
+                byte = body[pos]
+            except IndexError:
+                raise ValueError('Truncated columnar batch!') from None
+            pos += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    devices = []
+    for _ in range(take()):
+        size = take()
+        devices.append(body[pos:pos+size].decode('utf-8'))
+        pos += size
+    readings = []
+    for _ in range(take()):
+        device, ident, version, interval, count = (take() for _ in range(5))
+        timestamps, counts, sizes = [], [], []
+        previous = 0
+        for _ in range(count):
+            previous += _unzigzag(take())
+            timestamps.append(previous / 1e6)
+        previous = 0
+        for _ in range(count):
+            previous = (previous + take()) & 0xffff
+            counts.append(previous)
+        for _ in range(count):
+            sizes.append(take())
+        previous = 0
+        for ts, seq, size in zip(timestamps, counts, sizes):
+            values = []
+            for _ in range(size):
+                previous += _unzigzag(take())
+                values.append(previous)
+            try:
+                name = devices[device]
+            except IndexError:
+                raise ValueError('Unknown device {} in columnar batch!'.format(device)) from None
+            readings.append({
+                'device': name,
+                'ts': ts,
+                'version': version,
+                'interval': interval,
+                'id': ident,
+                'count': seq,
+                'readings': values
+            })
+    return readings
@@ -6,7 +6,7 @@
 #   file.
 
 
-import os
+import os, threading
 import click
 import simplejson
 
@@ -14,6 +14,12 @@ import simplejson
 # The default path and name for the configration file
 DEFAULT_CONFIG_PATH = os.path.dirname(os.path.abspath(__file__)) + '/sensclient.json'
 
+# The default directory for the store-and-forward spool
+DEFAULT_SPOOL_PATH = os.path.dirname(DEFAULT_CONFIG_PATH) + '/spool'
+
+# The default directory for the local archive
+DEFAULT_ARCHIVE_PATH = os.path.dirname(DEFAULT_CONFIG_PATH) + '/archive'
+
 
 def _prompt_servers():
     '''
@@ -89,22 +95,186 @@ def read_config(filename=DEFAULT_CONFIG_PATH):
         except OSError:
             pass
     if not config:
-        return prompt_config()
+        return _prompt_config()
+    return config
+
+
+def load_config(filename):
+    '''
+    Reads and validates a configuration file without prompting for a
+    missing one.
+    Arguments:
+        filename: The path and filename of the configuration file.
+    Raises an OSError if the file cannot be read and a ValueError if it
+    is not a valid configuration.
+    '''
+    with open(filename, 'r') as fp:
+        try:
+            config = simplejson.load(fp)
+        except simplejson.JSONDecodeError as e:
+            raise ValueError('{} is not valid JSON: {}'.format(filename, e)) from None
+    validate_config(config)
     return config
 
 
-def write_config(config, filename=DEFAULT_CONFIG_PATH):
+def validate_config(config):
     '''
-    Writes the configuration to file.
+    Checks that a configuration has the shape the client expects.
+    Arguments:
+        config: The raw configuration.
+    Raises a ValueError describing the first problem found.
+    '''
+    if not isinstance(config, dict):
+        raise ValueError('The configuration must be a JSON object!')
+    servers = config.get('servers')
+    if not isinstance(servers, dict) or not isinstance(servers.get('primary'), str):
+        raise ValueError('The configuration must name a primary server!')
+    if not isinstance(servers.get('secondary', []), list) or \
+            not all(isinstance(server, str) for server in servers.get('secondary', [])):
+        raise ValueError('The secondary servers must be a list of addresses!')
+    devices = config.get('devices', [])
+    if not isinstance(devices, list):
+        raise ValueError('The devices must be a list!')
+    seen = set()
+    for device in devices:
+        if not isinstance(device, dict) or not all(key in device for key in ('device', 'baudrate', 'amrate')):
+            raise ValueError('Every device needs a device, a baudrate and an amrate!')
+        if device['device'] in seen:
+            raise ValueError('Device {} is listed more than once!'.format(device['device']))
+        seen.add(device['device'])
+    for section in ('uploader', 'spool', 'queue', 'sharding', 'failover', 'metrics', 'decoders',
+            'reload', 'sequence', 'dedup', 'recent', 'archive'):
+        if not isinstance(config.get(section, dict()), dict):
+            raise ValueError('The {} section must be a JSON object!'.format(section))
+
+
+def write_config(config, filename=DEFAULT_CONFIG_PATH, confirm=True):
+    '''
+    Writes the configuration to file. The file is replaced atomically,
+    so that a client watching it never reads half of it.
     Arguments:
         config: The raw configuration, usually a Python dict.
         filename: The path + filename to write the configuration to.
+        confirm: Whether to ask before overwriting an existing file.
+    Returns whether the configuration was written.
     '''
-    if os.path.isfile(filename):
-        if not click.prompt('Are you sure you want to overwrite the configuration file?'):
-            return
+    if confirm and os.path.isfile(filename):
+        if not click.confirm('Are you sure you want to overwrite the configuration file?'):
+            return False
     try:
-        with open(filename, 'w') as fp:
-            fp.write(simplejson.dumps(config, fp))
+        with open(filename + '.tmp', 'w') as fp:
+            simplejson.dump(config, fp, indent=4)
+        os.replace(filename + '.tmp', filename)
     except OSError:
         click.secho('There was an error writing the configuration file.\nConfiguration file not written.', fg='red')
+        return False
+    return True
+
+
+class ConfigWatcher:
+    '''
+    Defines a watcher that reports changes to the configuration file.
+
+    The file is polled with stat() from a thread of its own, which
+    works on every platform and filesystem, and reloaded when its
+    modification time, size or inode changes. A change is only
+    reported once the file reads back as a valid configuration; an
+    invalid one is reported to on_error and ignored until it changes
+    again.
+    '''
+
+    def __init__(self, filename, on_change, on_error=None, interval=1.0):
+        '''
+        Returns a new ConfigWatcher. Call start() to begin watching.
+        Arguments:
+            filename: The path of the configuration file.
+            on_change: The function called with the new configuration.
+            Called on the watcher's thread.
+            on_error: The function called with the exception when the
+            file cannot be loaded.
+            interval: The time in seconds between polls.
+        '''
+        self._filename = filename
+        self._on_change = on_change
+        self._on_error = on_error
+        self._interval = float(interval)
+        if self._interval <= 0:
+            raise ValueError('The reload interval must be positive!')
+        self._stamp = self._stat()
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def _stat(self):
+        try:
+            st = os.stat(self._filename)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+    def filename(self):
+        '''
+        Gets the path of the watched file.
+        '''
+        return self._filename
+
+
+    def watch(self, filename):
+        '''
+        Moves the watcher to another file, which is taken as already
+        loaded.
+        Arguments:
+            filename: The path of the configuration file.
+        '''
+        self._filename = filename
+        self._stamp = self._stat()
+
+
+    def poll(self):
+        '''
+        Checks the file once, reporting a change if there is one.
+        Returns whether a new configuration was loaded.
+        '''
+        stamp = self._stat()
+        if stamp is None or stamp == self._stamp:
+            return False
+        self._stamp = stamp
+        try:
+            config = load_config(self._filename)
+        except (OSError, ValueError) as e:
+            if self._on_error is not None:
+                self._on_error(e)
+            return False
+        self._on_change(config)
+        return True
+
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self.poll()
+            except Exception as e:
+                if self._on_error is not None:
+                    self._on_error(e)
+
+
+    def start(self):
+        '''
+        Starts watching the file in the background.
+        '''
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='sensclient-config', daemon=True)
+            self._thread.start()
+
+
+    def stop(self):
+        '''
+        Stops watching the file.
+        '''
+        if self._thread is not None:
+            self._stop.set()
+            if self._thread is not threading.current_thread():
+                self._thread.join()
+            self._thread = None
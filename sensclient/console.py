@@ -0,0 +1,217 @@
+import collections, threading, time
+
+
+class _Window:
+    '''
+    Holds what one mote sent during the current window.
+    '''
+
+    __slots__ = ('messages', 'values', 'total', 'low', 'high', 'last')
+
+    def __init__(self):
+        self.messages = 0
+        self.values = 0
+        self.total = 0
+        self.low = None
+        self.high = None
+        self.last = None
+
+
+# One row of the live summary, for a mote or, with a mote of None, for
+#   a whole device. The rate is in messages per second over the window,
+#   and the low, high and mean are None if no reading came in during it
+SummaryRow = collections.namedtuple('SummaryRow',
+    ('device', 'mote', 'rate', 'last', 'low', 'high', 'mean'))
+
+
+class Summary:
+    '''
+    Defines the running summary of the event stream shown by the live
+    console, in place of echoing every event.
+
+    add() folds an event into the current window of its mote with a
+    handful of additions and comparisons, and formats nothing. The
+    window is swapped for an empty one by snapshot(), which the console
+    calls once per refresh, so the rates, minimums, maximums and means
+    shown cover the time since the previous refresh. The last value of
+    a mote is kept across windows.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._window = dict()
+        self._started = time.monotonic()
+        self._last = dict()
+
+
+    def add(self, device, event):
+        '''
+        Counts an event. Safe to call from any thread.
+        Arguments:
+            device: The device the event came in on.
+            event: The decoded message. Only its id and readings, if it
+            has them, are looked at.
+        '''
+        mote = getattr(event, 'id', None)
+        readings = getattr(event, 'readings', None)
+        if readings is not None and len(readings):
+            if hasattr(readings, 'min'):
+                # typed arrays reduce faster on their own
+                low, high, total = readings.min(), readings.max(), int(readings.sum())
+            else:
+                low, high, total = min(readings), max(readings), sum(readings)
+        else:
+            readings = None
+        with self._lock:
+            window = self._window.get((device, mote))
+            if window is None:
+                window = self._window[(device, mote)] = _Window()
+            window.messages += 1
+            if readings is not None:
+                window.values += len(readings)
+                window.total += total
+                window.low = low if window.low is None or low < window.low else window.low
+                window.high = high if window.high is None or high > window.high else window.high
+                window.last = readings[-1]
+
+
+    def snapshot(self):
+        '''
+        Closes the current window and starts a new one.
+        Returns the rows of the closed window as SummaryRows, each
+        device followed by its motes. Motes that were heard from before
+        but not during the window are listed with a rate of 0.
+        '''
+        now = time.monotonic()
+        with self._lock:
+            window, self._window = self._window, dict()
+            elapsed, self._started = max(now - self._started, 1e-9), now
+        for key, stats in window.items():
+            if stats.last is not None:
+                self._last[key] = stats.last
+        devices = collections.defaultdict(list)
+        for key in set(window) | set(self._last):
+            devices[key[0]].append(key)
+        rows = []
+        for device in sorted(devices):
+            motes = sorted(devices[device], key=lambda key: (key[1] is None, key[1]))
+            windows = [window[key] for key in motes if key in window]
+            rows.append(self._row(device, None, windows, elapsed, None))
+            for key in motes:
+                rows.append(self._row(device, key[1], [window[key]] if key in window else [],
+                    elapsed, self._last.get(key)))
+        return rows
+
+
+    @staticmethod
+    def _row(device, mote, windows, elapsed, last):
+        messages = sum(stats.messages for stats in windows)
+        values = sum(stats.values for stats in windows)
+        lows = [stats.low for stats in windows if stats.low is not None]
+        highs = [stats.high for stats in windows if stats.high is not None]
+        return SummaryRow(device, mote, messages / elapsed, last,
+            min(lows) if lows else None, max(highs) if highs else None,
+            sum(stats.total for stats in windows) / values if values else None)
+
+
+def render(rows, loss=None):
+    '''
+    Formats the rows of a snapshot as the lines of a table.
+    Arguments:
+        rows: The SummaryRows to show.
+        loss: An optional function of a device and a mote id (None for
+        the whole device) giving its loss rate, or None if unknown.
+    '''
+    def value(number, spec='{:.0f}'):
+        return spec.format(number) if number is not None else '-'
+
+    lines = ['{:>15} {:>6} {:>9} {:>8} {:>8} {:>8} {:>9} {:>7}'.format(
+        'DEVICE', 'MOTE', 'MSG/S', 'LAST', 'MIN', 'MAX', 'MEAN', 'LOSS')]
+    for row in rows:
+        rate = loss(row.device, row.mote) if loss is not None else None
+        lines.append('{:>15} {:>6} {:>9.1f} {:>8} {:>8} {:>8} {:>9} {:>7}'.format(
+            row.device if row.mote is None else '',
+            'all' if row.mote is None else row.mote,
+            row.rate, value(row.last), value(row.low), value(row.high),
+            value(row.mean, '{:.1f}'), value(rate, '{:.2%}')))
+    return lines
+
+
+class Sampler:
+    '''
+    Defines a sampled tap on the event stream for the tail command, so
+    that raw events can be watched at any packet rate without flooding
+    the terminal.
+
+    Of the events that match the device and mote filters, only every
+    every-th one is kept, and then at most rate per second by a token
+    bucket; what gets through is queued for the terminal to print at
+    its own pace, and the oldest events are dropped if it falls behind.
+    Only the thread that consumes events may call offer().
+    '''
+
+    def __init__(self, rate=10.0, every=1, device=None, mote=None, maxlen=1000):
+        '''
+        Returns a new Sampler.
+        Arguments:
+            rate: The most events let through per second.
+            every: Only one in every this many matching events is
+            considered.
+            device: Only the events of this device.
+            mote: Only the events of the mote with this id.
+            maxlen: The most events queued for printing.
+        Raises a ValueError if the rate or every is not positive.
+        '''
+        if rate <= 0 or every <= 0:
+            raise ValueError('The tail rate and sampling must be positive!')
+        self._rate = float(rate)
+        self._every = int(every)
+        self._device = device
+        self._mote = mote
+        self._events = collections.deque(maxlen=int(maxlen))
+        self._tokens = self._rate
+        self._refilled = time.monotonic()
+        self._matched = 0
+        self._skipped = 0
+
+
+    def offer(self, device, event, now=None):
+        '''
+        Offers an event to the sampler.
+        Arguments:
+            device: The device the event came in on.
+            event: The decoded message.
+            now: The time.monotonic() of the event, defaults to now.
+        '''
+        if (self._device is not None and device != self._device) or \
+                (self._mote is not None and getattr(event, 'id', None) != self._mote):
+            return
+        self._matched += 1
+        if self._matched % self._every:
+            return
+        now = now if now is not None else time.monotonic()
+        self._tokens = min(self._rate, self._tokens + (now - self._refilled) * self._rate)
+        self._refilled = now
+        if self._tokens < 1.0:
+            self._skipped += 1
+            return
+        self._tokens -= 1.0
+        self._events.append((device, event))
+
+
+    def drain(self):
+        '''
+        Takes every event queued for printing, as (device, event)
+        tuples.
+        '''
+        events = []
+        while self._events:
+            events.append(self._events.popleft())
+        return events
+
+
+    def skipped(self):
+        '''
+        Gets the number of sampled events dropped by the rate limit.
+        '''
+        return self._skipped
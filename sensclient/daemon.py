@@ -0,0 +1,86 @@
+import os, signal, socket, threading
+
+
+def notify(*states):
+    '''
+    Reports the client's state to the service manager, following the
+    sd_notify protocol of systemd: the states are sent as one datagram
+    to the Unix socket named by $NOTIFY_SOCKET.
+    Arguments:
+        states: The states to report, such as 'READY=1' or
+        'STATUS=...'.
+    Returns False if the client was not started by a service manager
+    that listens for notifications.
+    '''
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address[0] == '@':
+        # an abstract socket
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall('\n'.join(states).encode('utf-8'))
+    except OSError:
+        return False
+    return True
+
+
+def watchdog_interval():
+    '''
+    Gets how often the service manager's watchdog must be pinged, as
+    half of the timeout it announced in $WATCHDOG_USEC.
+    Returns None if the watchdog is not enabled for this process.
+    '''
+    usec = os.environ.get('WATCHDOG_USEC')
+    pid = os.environ.get('WATCHDOG_PID')
+    if not usec or (pid and pid != str(os.getpid())):
+        return None
+    try:
+        return int(usec) / 2e6
+    except ValueError:
+        return None
+
+
+def wait_for_signal(signals=(signal.SIGTERM, signal.SIGINT, signal.SIGHUP), on_reload=None):
+    '''
+    Blocks until the process is asked to stop, pinging the service
+    manager's watchdog in the meantime. Must be called from the main
+    thread.
+    Arguments:
+        signals: The signals that stop the client.
+        on_reload: If given, SIGHUP no longer stops the client but
+        calls this function instead, with the service manager told
+        that the client is reloading until it returns.
+    Returns the signal that was received.
+    '''
+    received = []
+    stop = threading.Event()
+
+    def handler(signum, frame):
+        received.append(signum)
+        stop.set()
+
+    if on_reload is not None:
+        signals = tuple(signum for signum in signals if signum != signal.SIGHUP) + (signal.SIGHUP,)
+    previous = {signum: signal.signal(signum, handler) for signum in signals}
+    interval = watchdog_interval()
+    try:
+        while True:
+            while not received:
+                if stop.wait(interval or 1.0):
+                    stop.clear()
+                elif interval:
+                    notify('WATCHDOG=1')
+            signum = received.pop(0)
+            if on_reload is None or signum != signal.SIGHUP:
+                return signum
+            notify('RELOADING=1')
+            try:
+                on_reload()
+            finally:
+                notify('READY=1')
+    finally:
+        for signum, old in previous.items():
+            signal.signal(signum, old)
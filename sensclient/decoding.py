@@ -0,0 +1,543 @@
+import struct, sys
+from array import array
+from collections import namedtuple
+
+# NumPy is optional, without it readings are decoded into arrays. It
+#   is slow to import, so it is only looked for when first needed, see
+#   load_numpy()
+numpy = None
+_numpy_loaded = False
+
+
+# The fixed part of an oscilloscope message, every field is a
+#   big-endian (network order) unsigned 16-bit integer
+HEADER = struct.Struct('>HHHH')
+
+# Readings follow the header as big-endian unsigned 16-bit integers
+READING_SIZE = 2
+
+# The NumPy dtype of a single reading, set once NumPy is loaded
+READING_DTYPE = None
+
+
+def load_numpy():
+    '''
+    Imports NumPy, unless that was already attempted.
+    Returns the numpy module, or None if NumPy is not installed.
+    '''
+    global numpy, READING_DTYPE, _numpy_loaded
+    if not _numpy_loaded:
+        try:
+            import numpy as module
+            READING_DTYPE = module.dtype('>u2')
+        except ImportError:
+            module = None
+        numpy = module
+        _numpy_loaded = True
+    return numpy
+
+
+class Oscilloscope(namedtuple('Oscilloscope', 'version interval id count readings')):
+    '''
+    Defines a decoded oscilloscope message. Holds the same fields as
+    OscilloscopeMsg, but readings is a typed sequence of integers
+    rather than the raw blob.
+    '''
+    __slots__ = ()
+
+
+def decode_header(payload, offset=0):
+    '''
+    Decodes the fixed header of an oscilloscope message.
+    Arguments:
+        payload: The message, any bytes-like object.
+        offset: Where the message starts in payload.
+    Returns the (version, interval, id, count) tuple.
+    '''
+    return HEADER.unpack_from(payload, offset)
+
+
+def _array_typecode(size):
+    for typecode in 'BHILQ':
+        if array(typecode).itemsize == size:
+            return typecode
+    raise ValueError('No array type holds {}-byte integers!'.format(size))
+
+
+def integers_view(payload, offset, size):
+    '''
+    Gets the rest of a message, from an offset on, as typed big-endian
+    unsigned integers.
+
+    With NumPy installed the result is a view onto payload itself, no
+    bytes are copied. Without it the integers are unpacked into an
+    array in one call (plus an in-place byteswap on little-endian
+    hosts).
+    Arguments:
+        payload: The message, any bytes-like object.
+        offset: Where the integers start in payload.
+        size: The size of each integer in bytes.
+    '''
+    count = (len(payload) - offset) // size
+    np = numpy if _numpy_loaded else load_numpy()
+    if np is not None:
+        dtype = READING_DTYPE if size == READING_SIZE else np.dtype('>u{}'.format(size))
+        return np.frombuffer(payload, dtype=dtype, count=count, offset=offset)
+    values = array(_array_typecode(size))
+    values.frombytes(memoryview(payload)[offset:offset + count * size])
+    if sys.byteorder == 'little' and size > 1:
+        values.byteswap()
+    return values
+
+
+def readings_view(payload, offset=HEADER.size):
+    '''
+    Gets the readings of an oscilloscope message as typed integers,
+    see integers_view().
+    Arguments:
+        payload: The message, any bytes-like object.
+        offset: Where the readings start in payload.
+    '''
+    return integers_view(payload, offset, READING_SIZE)
+
+
+def decode_message(payload):
+    '''
+    Decodes a whole oscilloscope message.
+    Arguments:
+        payload: The message, any bytes-like object.
+    Returns an Oscilloscope.
+    '''
+    version, interval, ident, count = HEADER.unpack_from(payload, 0)
+    return Oscilloscope(version, interval, ident, count, readings_view(payload))
+
+
+def batch_dtype(nreadings):
+    '''
+    Gets the NumPy structured dtype of an oscilloscope message that
+    carries a given number of readings.
+    Arguments:
+        nreadings: The number of readings per message.
+    '''
+    return load_numpy().dtype([
+        ('version', '>u2'),
+        ('interval', '>u2'),
+        ('id', '>u2'),
+        ('count', '>u2'),
+        ('readings', '>u2', (nreadings,))
+    ])
+
+
+def decode_batch(payloads):
+    '''
+    Decodes many oscilloscope messages at once into structure-of-arrays
+    columns.
+
+    Messages are expected to carry the same number of readings, as
+    they do when they come from one build of the oscilloscope
+    application. The messages are joined into one buffer and decoded in
+    a single pass: with NumPy through a structured dtype, otherwise
+    through a precompiled struct.Struct covering a whole message.
+    Arguments:
+        payloads: A sequence of messages, each a bytes-like object.
+    Returns a dict with the columns 'version', 'interval', 'id' and
+    'count' (one value per message) and 'readings' (one row of
+    readings per message). Raises a ValueError if the messages are not
+    all the same size.
+    '''
+    if not payloads:
+        return {'version': [], 'interval': [], 'id': [], 'count': [], 'readings': []}
+    size = len(payloads[0])
+    if size < HEADER.size or (size - HEADER.size) % READING_SIZE:
+        raise ValueError('Invalid oscilloscope message size {}!'.format(size))
+    buf = b''.join(payloads)
+    if len(buf) != size * len(payloads):
+        raise ValueError('Oscilloscope messages in a batch must all be the same size!')
+    nreadings = (size - HEADER.size) // READING_SIZE
+
+    if load_numpy() is not None:
+        records = numpy.frombuffer(buf, dtype=batch_dtype(nreadings))
+        return {name: records[name] for name in records.dtype.names}
+
+    layout = struct.Struct('>HHHH{}H'.format(nreadings))
+    rows = list(layout.iter_unpack(buf))
+    version, interval, ident, count = zip(*(row[:4] for row in rows))
+    return {
+        'version': array('H', version),
+        'interval': array('H', interval),
+        'id': array('H', ident),
+        'count': array('H', count),
+        'readings': [array('H', row[4:]) for row in rows]
+    }
+
+
+#
+# DECODER REGISTRY
+#
+
+# The struct formats of big-endian integer fields, by size and
+#   signedness
+_INT_FORMATS = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+_SINT_FORMATS = {1: 'b', 2: 'h', 4: 'i', 8: 'q'}
+
+# The number of messages at the start of a block of packed columns
+_COLUMNS_HEADER = struct.Struct('=I')
+
+
+def _wire_bytes(values):
+    # integers_view() arrays are in native order, NumPy views are
+    #   still big-endian
+    if isinstance(values, array) and sys.byteorder == 'little' and values.itemsize > 1:
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+class ColumnWriter:
+    '''
+    Packs decoded messages of one MessageLayout into columns, so that a
+    batch of them can cross a process boundary as a few flat buffers
+    rather than one pickled object per message. Every fixed field
+    becomes a packed array in native order, and a tail that takes the
+    rest of the message is kept as its lengths followed by the raw
+    big-endian tails back to back. See MessageLayout.writer() and
+    MessageLayout.read_columns().
+    '''
+
+    def __init__(self, layout):
+        self._layout = layout
+        self._columns = [array(code) if code is not None else bytearray()
+            for code, _ in layout._columns]
+        self._lengths = array('I')
+        self._tails = bytearray()
+        self._count = 0
+
+
+    def __len__(self):
+        return self._count
+
+
+    def append(self, msg):
+        '''
+        Adds a message.
+        Arguments:
+            msg: A message decoded by the writer's layout.
+        Returns the number of bytes the message adds to pack().
+        '''
+        added = self._layout.size()
+        for column, value in zip(self._columns, msg):
+            if isinstance(column, bytearray):
+                column += value
+            else:
+                column.append(value)
+        if self._layout._tail is not None:
+            tail = msg[-1]
+            tail = bytes(tail) if self._layout._tail == self._layout._blob_tail else _wire_bytes(tail)
+            self._lengths.append(len(tail))
+            self._tails += tail
+            added += self._lengths.itemsize + len(tail)
+        self._count += 1
+        return added
+
+
+    def pack(self):
+        '''
+        Gets the messages added so far as one buffer.
+        '''
+        parts = [_COLUMNS_HEADER.pack(self._count)]
+        parts.extend(bytes(column) if isinstance(column, bytearray) else column.tobytes()
+            for column in self._columns)
+        if self._layout._tail is not None:
+            parts.append(self._lengths.tobytes())
+            parts.append(bytes(self._tails))
+        return b''.join(parts)
+
+
+class MessageLayout:
+    '''
+    Defines the layout of a TinyOS message, declared once and compiled
+    into a decoder.
+
+    Fields are declared like those of a tos.Packet, as (name, type,
+    size) triples, where type is one of:
+        int: A big-endian unsigned integer of 1, 2, 4 or 8 bytes.
+        sint: A big-endian signed integer of 1, 2, 4 or 8 bytes.
+        blob: Raw bytes; a size of None takes the rest of the message.
+        array: Big-endian unsigned integers of the given size taking
+        the rest of the message, see integers_view().
+    Only the last field may take the rest of the message. All fixed
+    fields are compiled into a single struct.Struct, so decoding a
+    message is one unpack_from() call plus, at most, one view of its
+    tail. Messages are decoded into namedtuples.
+    '''
+
+    def __init__(self, name, fields, cls=None):
+        '''
+        Compiles a message layout.
+        Arguments:
+            name: The name of the message.
+            fields: The list of (name, type, size) field declarations.
+            cls: The namedtuple class to decode into, defaults to a
+            new namedtuple named after the message.
+        Raises a ValueError if the layout is not valid.
+        '''
+        self.name = name
+        self.fields = [tuple(field) for field in fields]
+        formats = []
+        self._tail = None
+        for i, (field, kind, size) in enumerate(self.fields):
+            last = i == len(self.fields) - 1
+            if kind in ('int', 'sint') and size in _INT_FORMATS:
+                formats.append((_INT_FORMATS if kind == 'int' else _SINT_FORMATS)[size])
+            elif kind == 'blob' and size is not None:
+                formats.append('{}s'.format(int(size)))
+            elif kind == 'blob' and last:
+                self._tail = self._blob_tail
+            elif kind == 'array' and last and size in _INT_FORMATS:
+                self._tail = self._array_tail
+                self._tail_size = size
+            else:
+                raise ValueError('Invalid field {} in message {}!'.format(field, name))
+        self._struct = struct.Struct('>' + ''.join(formats))
+        # the array typecode and size of every fixed field once packed
+        #   into columns, blobs have no typecode
+        self._columns = [(None if kind == 'blob' else
+            (_array_typecode(size) if kind == 'int' else _array_typecode(size).lower()), size)
+            for field, kind, size in self.fields[:len(formats)]]
+        self._cls = cls if cls is not None else namedtuple(name, [f[0] for f in self.fields])
+        if list(self._cls._fields) != [f[0] for f in self.fields]:
+            raise ValueError('The fields of {} do not match its layout!'.format(self._cls.__name__))
+
+
+    def size(self):
+        '''
+        Gets the size in bytes of the fixed part of the message.
+        '''
+        return self._struct.size
+
+
+    def _blob_tail(self, payload, offset):
+        return bytes(payload[offset:])
+
+
+    def _array_tail(self, payload, offset):
+        return integers_view(payload, offset, self._tail_size)
+
+
+    def decode(self, payload):
+        '''
+        Decodes a message.
+        Arguments:
+            payload: The message, any bytes-like object.
+        Returns a namedtuple of the message's fields. Raises a
+        struct.error if the message is too short.
+        '''
+        if self._tail is None:
+            return self._cls._make(self._struct.unpack_from(payload, 0))
+        return self._cls(*self._struct.unpack_from(payload, 0), self._tail(payload, self._struct.size))
+
+
+    def writer(self):
+        '''
+        Gets a new ColumnWriter for messages of this layout.
+        '''
+        return ColumnWriter(self)
+
+
+    def read_columns(self, buf):
+        '''
+        Rebuilds the messages packed by a ColumnWriter of this layout.
+        The columns are unpacked in one call each, and the tails of the
+        messages are views onto one integers_view() of all of them, so
+        nothing is decoded again.
+        Arguments:
+            buf: The packed columns, any bytes-like object.
+        Returns the list of messages, in the order they were added.
+        '''
+        view = memoryview(buf)
+        count, = _COLUMNS_HEADER.unpack_from(view, 0)
+        pos = _COLUMNS_HEADER.size
+        columns = []
+        for code, size in self._columns:
+            if code is None:
+                data = bytes(view[pos:pos + count * size])
+                columns.append([data[i:i + size] for i in range(0, count * size, size)])
+            else:
+                column = array(code)
+                column.frombytes(view[pos:pos + count * size])
+                columns.append(column)
+            pos += count * size
+        rows = zip(*columns) if columns else [()] * count
+        if self._tail is None:
+            return [self._cls._make(row) for row in rows]
+        lengths = array('I')
+        lengths.frombytes(view[pos:pos + count * lengths.itemsize])
+        pos += count * lengths.itemsize
+        messages = []
+        start = 0
+        if self._tail == self._blob_tail:
+            tails = view[pos:]
+            for row, length in zip(rows, lengths):
+                messages.append(self._cls(*row, bytes(tails[start:start + length])))
+                start += length
+        else:
+            tails = integers_view(view, pos, self._tail_size)
+            for row, length in zip(rows, lengths):
+                end = start + length // self._tail_size
+                messages.append(self._cls(*row, tails[start:end]))
+                start = end
+        return messages
+
+
+# The oscilloscope message, as sent by the TinyOS oscilloscope
+#   application
+OSCILLOSCOPE = MessageLayout('Oscilloscope',
+    [('version',  'int', 2),
+     ('interval', 'int', 2),
+     ('id',       'int', 2),
+     ('count',    'int', 2),
+     ('readings', 'array', READING_SIZE)],
+    Oscilloscope)
+
+
+class DecoderRegistry:
+    '''
+    Defines the table of message decoders, keyed by AM type.
+
+    AM types are a single byte, so the registry keeps a flat table with
+    one slot per type and finding the decoder of a message is a single
+    list index. Every decoder also has a name, which is what devices
+    are usually configured with.
+    '''
+
+    # Selects every registered AM type
+    ALL = 'ALL'
+
+
+    def __init__(self):
+        self._table = [None] * 256
+        self._names = dict()
+
+
+    def register(self, amtype, name, decoder):
+        '''
+        Registers the decoder of an AM type, replacing any decoder
+        already registered for it.
+        Arguments:
+            amtype: The AM type, between 0 and 255, as an int or a
+            string.
+            name: The name the AM type can be referred to by.
+            decoder: A MessageLayout, or a function taking a message
+            payload (as bytes) and returning the decoded message.
+        Raises a ValueError if the AM type is out of range.
+        '''
+        amtype = int(amtype, 0) if isinstance(amtype, str) else int(amtype)
+        if not 0 <= amtype <= 0xff:
+            raise ValueError('Invalid AM type {}, expected 0-255!'.format(amtype))
+        if isinstance(decoder, MessageLayout):
+            decoder = decoder.decode
+        self.unregister(amtype)
+        self._names[name.upper()] = amtype
+        self._table[amtype] = decoder
+
+
+    def register_layout(self, amtype, name, fields):
+        '''
+        Compiles and registers a message layout.
+        Arguments:
+            amtype: The AM type, between 0 and 255.
+            name: The name of the message.
+            fields: The list of (name, type, size) field declarations,
+            see MessageLayout.
+        '''
+        self.register(amtype, name, MessageLayout(name, fields))
+
+
+    def unregister(self, amtype):
+        '''
+        Removes the decoder of an AM type, if any.
+        Arguments:
+            amtype: The AM type.
+        '''
+        self._table[amtype] = None
+        for name in [n for n, t in self._names.items() if t == amtype]:
+            del self._names[name]
+
+
+    def lookup(self, amtype):
+        '''
+        Gets the decoder of an AM type, None if there is none.
+        Arguments:
+            amtype: The AM type.
+        '''
+        return self._table[amtype]
+
+
+    def names(self):
+        '''
+        Gets a dict mapping the name of every registered AM type to
+        the type.
+        '''
+        return dict(self._names)
+
+
+    def resolve(self, amrate):
+        '''
+        Maps an AM rate to the AM type it refers to.
+        Arguments:
+            amrate: Either a registered name or an AM type, as an int
+            or a string.
+        Raises a ValueError if the AM rate is not known.
+        '''
+        if isinstance(amrate, str):
+            if amrate.upper() in self._names:
+                return self._names[amrate.upper()]
+            try:
+                amrate = int(amrate, 0)
+            except ValueError:
+                raise ValueError('Unknown AM rate {}!'.format(amrate)) from None
+        amrate = int(amrate)
+        if not 0 <= amrate <= 0xff:
+            raise ValueError('Invalid AM type {}, expected 0-255!'.format(amrate))
+        return amrate
+
+
+    def select(self, amrates):
+        '''
+        Maps one or several AM rates to the AM types they refer to.
+        Arguments:
+            amrates: An AM rate, a comma separated string or a list of
+            AM rates, or ALL for every registered AM type.
+        Returns a sorted list of AM types.
+        '''
+        if isinstance(amrates, str):
+            if amrates.upper() == DecoderRegistry.ALL:
+                return [t for t, decoder in enumerate(self._table) if decoder is not None]
+            amrates = amrates.split(',')
+        elif not isinstance(amrates, (list, tuple)):
+            amrates = [amrates]
+        return sorted(set(self.resolve(a.strip() if isinstance(a, str) else a) for a in amrates))
+
+
+    def table(self, amtypes, decoder=None):
+        '''
+        Builds a dispatch table for a set of AM types.
+        Arguments:
+            amtypes: The AM types to dispatch.
+            decoder: The decoder used for every type, defaults to each
+            type's registered decoder.
+        Returns a list with one slot per AM type holding its decoder,
+        or None for types that are not dispatched. Raises a ValueError
+        if one of the types has no decoder.
+        '''
+        table = [None] * 256
+        for amtype in amtypes:
+            table[amtype] = decoder if decoder is not None else self._table[amtype]
+            if table[amtype] is None:
+                raise ValueError('No decoder registered for AM type {:#04x}!'.format(amtype))
+        return table
+
+
+# The decoders known to the client
+DECODERS = DecoderRegistry()
+DECODERS.register(0x93, 'OSCILLOSCOPE', OSCILLOSCOPE)
@@ -0,0 +1,97 @@
+import collections, time
+
+
+class DuplicateFilter:
+    '''
+    Defines a filter that suppresses copies of the same message heard
+    by several basestations.
+
+    A message is identified by its type and its id, count and version
+    fields, and is let through only the first time it is seen within
+    the window. Keys are kept in two generations of sets: new keys go
+    into the current generation, and once it is window seconds old, or
+    holds maxsize keys, it replaces the previous generation, whose keys
+    are forgotten. A key is so remembered for at least window seconds
+    (unless the filter fills up faster) and at most twice that, lookups
+    and inserts are O(1), and the memory used never exceeds two
+    generations of maxsize keys.
+    '''
+
+    # The fields identifying a message
+    FIELDS = ('id', 'count', 'version')
+
+
+    def __init__(self, window=2.0, maxsize=65536):
+        '''
+        Returns a new DuplicateFilter.
+        Arguments:
+            window: The time in seconds copies of a message are
+            expected to arrive within.
+            maxsize: The maximum number of keys per generation.
+        Raises a ValueError if the window or the size is not positive.
+        '''
+        if window <= 0 or maxsize <= 0:
+            raise ValueError('The duplicate window and size must be positive!')
+        self._window = float(window)
+        self._maxsize = int(maxsize)
+        self._current = set()
+        self._previous = set()
+        self._rotated = time.monotonic()
+        self._admitted = collections.Counter()
+        self._suppressed = collections.Counter()
+
+
+    def admit(self, device, event, now=None):
+        '''
+        Checks whether a message is the first copy seen.
+        Arguments:
+            device: The device the message came in on.
+            event: The decoded message. Messages without the FIELDS
+            are always let through.
+            now: The time.monotonic() the message is checked at,
+            defaults to now.
+        Returns whether the message should be kept.
+        '''
+        try:
+            key = (type(event), event.id, event.count, event.version)
+        except AttributeError:
+            return True
+        if now is None:
+            now = time.monotonic()
+        if now - self._rotated >= self._window or len(self._current) >= self._maxsize:
+            self._previous = self._current
+            self._current = set()
+            self._rotated = now
+        if key in self._current or key in self._previous:
+            self._suppressed[device] += 1
+            return False
+        self._current.add(key)
+        self._admitted[device] += 1
+        return True
+
+
+    #
+    # ACCESSOR METHODS
+    #
+
+    def window(self):
+        '''
+        Gets the time in seconds copies of a message are suppressed
+        within.
+        '''
+        return self._window
+
+
+    def size(self):
+        '''
+        Gets the number of keys currently remembered.
+        '''
+        return len(self._current) + len(self._previous)
+
+
+    def stats(self):
+        '''
+        Gets the messages let through and suppressed, as dicts mapping
+        each device to its count.
+        '''
+        return {'admitted': dict(self._admitted), 'suppressed': dict(self._suppressed)}
@@ -0,0 +1,140 @@
+import asyncio, threading
+
+
+class Engine:
+    '''
+    Defines the single asyncio event loop that drives every Listener
+    (and anything else in the client that needs to do I/O).
+
+    The loop runs in one daemon thread. The shell and other threads
+    hand work to it through call() and submit(), which are safe to use
+    from any thread. Coroutines that must run on the loop itself should
+    be scheduled through these methods rather than awaited directly
+    from a foreign thread.
+    '''
+
+    # The process-wide default engine, created on first use
+    _default = None
+    _default_lock = threading.Lock()
+
+
+    def __init__(self, name='sensclient-engine'):
+        '''
+        Returns a new Engine with its event loop already running.
+        Arguments:
+            name: The name given to the thread backing the loop.
+        '''
+        self._loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        self._started.wait()
+
+
+    @classmethod
+    def default(cls):
+        '''
+        Gets the process-wide Engine, creating it if needed.
+        '''
+        with cls._default_lock:
+            if cls._default is None or cls._default.closed():
+                cls._default = cls()
+            return cls._default
+
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.call_soon(self._started.set)
+        try:
+            self._loop.run_forever()
+        finally:
+            self._loop.close()
+
+
+    #
+    # ACCESSOR METHODS
+    #
+
+    def loop(self):
+        '''
+        Gets the event loop owned by the engine.
+        '''
+        return self._loop
+
+
+    def closed(self):
+        '''
+        Gets whether the engine has been shut down.
+        '''
+        return not self._thread.is_alive()
+
+
+    def in_loop(self):
+        '''
+        Gets whether the caller is running on the engine's thread.
+        '''
+        return threading.current_thread() is self._thread
+
+
+    #
+    # CONTROL METHODS
+    #
+
+    def submit(self, coro):
+        '''
+        Schedules a coroutine on the engine's loop without waiting on
+        it.
+        Arguments:
+            coro: The coroutine to schedule.
+        Returns a concurrent.futures.Future for the result.
+        '''
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+
+    def call(self, coro, timeout=None):
+        '''
+        Runs a coroutine on the engine's loop and waits for its result.
+        Must not be used from the engine's own thread.
+        Arguments:
+            coro: The coroutine to run.
+            timeout: The maximum time to wait in seconds, None waits
+            forever.
+        '''
+        if self.in_loop():
+            coro.close()
+            raise RuntimeError('Engine.call() cannot be used from the engine thread!')
+        return self.submit(coro).result(timeout)
+
+
+    def call_soon(self, func, *args):
+        '''
+        Schedules a plain function on the engine's loop. Safe to call
+        from any thread.
+        Arguments:
+            func: The function to call.
+            args: The positional arguments to call it with.
+        '''
+        self._loop.call_soon_threadsafe(func, *args)
+
+
+    def close(self, timeout=5):
+        '''
+        Cancels any outstanding tasks and stops the loop.
+        Arguments:
+            timeout: The maximum time to wait for the loop to wind down.
+        '''
+        if self.closed():
+            return
+
+        async def _shutdown():
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        try:
+            self.call(_shutdown(), timeout)
+        except Exception:
+            pass
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
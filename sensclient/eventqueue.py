@@ -0,0 +1,192 @@
+import collections, threading, time
+
+
+class EventQueue:
+    '''
+    Defines a bounded multi-producer queue that decouples the Listeners
+    from whatever consumes their events.
+
+    When the queue is full, what happens to a new event depends on the
+    queue's policy:
+        block: The producer waits until there is room (or until
+        block_timeout passes, after which the event is dropped). Since
+        Listeners run on the engine's event loop, this stalls reading
+        from every device and leaves the kernel's serial buffers to
+        absorb the backlog.
+        drop-oldest: The oldest queued event is dropped to make room.
+        drop-newest: The new event is dropped.
+        sample: Only every Nth event of each device is admitted,
+        displacing the oldest queued event; the rest are dropped.
+    Drops are counted per device, always against the device of the
+    event that was actually lost.
+    '''
+
+    # Define the queue policies
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop-oldest'
+    DROP_NEWEST = 'drop-newest'
+    SAMPLE = 'sample'
+
+    POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, SAMPLE)
+
+
+    def __init__(self, maxsize=10000, policy=DROP_OLDEST, sample_every=10, block_timeout=None):
+        '''
+        Returns a new EventQueue.
+        Arguments:
+            maxsize: The maximum number of queued events.
+            policy: One of POLICIES, what to do when the queue is full.
+            sample_every: For the sample policy, admit one in this many
+            events per device while the queue is full.
+            block_timeout: For the block policy, the maximum time in
+            seconds to wait for room, None waits forever.
+        Raises a ValueError if the policy is not known.
+        '''
+        if policy not in EventQueue.POLICIES:
+            raise ValueError('Unknown queue policy {}, expected one of {}!'.format(
+                policy, ', '.join(EventQueue.POLICIES)))
+        self._maxsize = max(1, int(maxsize))
+        self._policy = policy
+        self._sample_every = max(1, int(sample_every))
+        self._block_timeout = block_timeout
+
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._closed = False
+
+        self._accepted = 0
+        self._dropped = collections.Counter()
+        self._sampled = collections.Counter()
+
+
+    #
+    # ACCESSOR METHODS
+    #
+
+    def depth(self):
+        '''
+        Gets the number of events waiting in the queue.
+        '''
+        return len(self._queue)
+
+
+    def maxsize(self):
+        '''
+        Gets the capacity of the queue.
+        '''
+        return self._maxsize
+
+
+    def policy(self):
+        '''
+        Gets the policy applied when the queue is full.
+        '''
+        return self._policy
+
+
+    def dropped(self, device=None):
+        '''
+        Gets the number of events dropped.
+        Arguments:
+            device: The device to count drops for, None counts drops
+            for all devices.
+        '''
+        if device is None:
+            return sum(self._dropped.values())
+        return self._dropped[device]
+
+
+    def stats(self):
+        '''
+        Gets a dict describing the queue.
+        '''
+        with self._lock:
+            return {
+                'depth': len(self._queue),
+                'maxsize': self._maxsize,
+                'policy': self._policy,
+                'accepted': self._accepted,
+                'dropped': dict(self._dropped)
+            }
+
+
+    def closed(self):
+        '''
+        Gets whether the queue has been closed.
+        '''
+        return self._closed
+
+
+    #
+    # CONTROL METHODS
+    #
+
+    def put(self, device, event):
+        '''
+        Queues an event, applying the queue's policy if it is full.
+        Arguments:
+            device: The device the event came in on.
+            event: The event.
+        Returns True if the event was queued.
+        '''
+        with self._lock:
+            if self._closed:
+                return False
+            if len(self._queue) >= self._maxsize:
+                if self._policy == EventQueue.BLOCK:
+                    if not self._not_full.wait_for(
+                            lambda: len(self._queue) < self._maxsize or self._closed,
+                            self._block_timeout) or self._closed:
+                        self._dropped[device] += 1
+                        return False
+                elif self._policy == EventQueue.DROP_NEWEST:
+                    self._dropped[device] += 1
+                    return False
+                else:
+                    if self._policy == EventQueue.SAMPLE:
+                        self._sampled[device] += 1
+                        if self._sampled[device] % self._sample_every:
+                            self._dropped[device] += 1
+                            return False
+                    lost, _, _ = self._queue.popleft()
+                    self._dropped[lost] += 1
+            elif self._sampled:
+                self._sampled.clear()
+            self._queue.append((device, event, time.monotonic()))
+            self._accepted += 1
+            self._not_empty.notify()
+            return True
+
+
+    def get(self, max_items=1, timeout=None):
+        '''
+        Takes events off of the queue, waiting for at least one.
+        Arguments:
+            max_items: The maximum number of events to take at once.
+            timeout: The maximum time in seconds to wait, None waits
+            forever.
+        Returns a list of (device, event, queued) tuples, where queued
+        is the time.monotonic() at which the event was queued. The list
+        is empty if the wait timed out or the queue was closed.
+        '''
+        with self._lock:
+            if not self._not_empty.wait_for(lambda: self._queue or self._closed, timeout):
+                return []
+            count = min(max_items, len(self._queue))
+            items = [self._queue.popleft() for _ in range(count)]
+            if count:
+                self._not_full.notify(count)
+            return items
+
+
+    def close(self):
+        '''
+        Closes the queue, waking any waiting producers and consumers.
+        Events still queued can be drained with get().
+        '''
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
@@ -0,0 +1,289 @@
+import asyncio, time
+
+from sensclient.engine import Engine
+from sensclient.uploader import server_url
+
+
+class ServerHealth:
+    '''
+    Defines the running health statistics kept for one server. Latency
+    and error rate are exponentially weighted moving averages, so
+    recent samples count the most and nothing has to be stored.
+    '''
+
+    def __init__(self, address, alpha):
+        self.address = address
+        self.alpha = alpha
+        self.latency = None
+        self.error_rate = 0.0
+        self.samples = 0
+        self.errors = 0
+        self.last_seen = None
+
+
+    def record(self, latency, ok):
+        '''
+        Folds one observation into the averages.
+        Arguments:
+            latency: The time in seconds the request took.
+            ok: Whether the request succeeded.
+        '''
+        self.samples += 1
+        if ok:
+            self.latency = latency if self.latency is None else \
+                self.latency + self.alpha * (latency - self.latency)
+            self.last_seen = time.time()
+        else:
+            self.errors += 1
+        self.error_rate += self.alpha * ((0.0 if ok else 1.0) - self.error_rate)
+
+
+    def score(self, penalty):
+        '''
+        Gets the score of the server, lower is healthier. Servers that
+        never answered score infinitely badly.
+        Arguments:
+            penalty: How many times its latency an error costs.
+        '''
+        if self.latency is None:
+            return float('inf')
+        return self.latency * (1.0 + penalty * self.error_rate)
+
+
+class FailoverMonitor:
+    '''
+    Defines the automatic failover mode of the client.
+
+    Every configured server is probed in the background with a
+    lightweight GET, and the Uploader reports the outcome of each of
+    its requests too. From these the monitor keeps a moving-average
+    latency and error rate per server.
+
+    While enabled, the monitor moves uploads to the healthiest server,
+    with hysteresis so that it does not flap between servers of similar
+    health: a server only takes over once its score has beaten the
+    current server's by the switch margin for switch_after consecutive
+    evaluations and the current server has been in use for at least
+    min_dwell seconds. If the current server becomes unhealthy (its
+    error rate passes max_error_rate), the monitor fails over at once.
+    '''
+
+    def __init__(self, servers, on_switch, current, engine=None, probe_interval=5.0,
+            probe_timeout=2.0, probe_path='/', alpha=0.3, penalty=10.0,
+            margin=0.25, switch_after=3, min_dwell=30.0, max_error_rate=0.5):
+        '''
+        Returns a new FailoverMonitor. Call start() to begin probing.
+        Arguments:
+            servers: A dict mapping each server number to its address.
+            on_switch: The function called with the number of the
+            server to switch to. Called on the engine's event loop.
+            current: The number of the server currently in use.
+            engine: The Engine to run on, defaults to the process-wide
+            Engine.
+            probe_interval: The time in seconds between probes.
+            probe_timeout: The time in seconds before a probe fails.
+            probe_path: The path requested by probes.
+            alpha: The weight of new samples in the moving averages.
+            penalty: How many times its latency an error costs a
+            server's score.
+            margin: The fraction by which a server must beat the
+            current server's score to take over.
+            switch_after: The number of consecutive evaluations a
+            server must win before taking over.
+            min_dwell: The minimum time in seconds between switches.
+            max_error_rate: The error rate past which the current
+            server is abandoned immediately.
+        '''
+        self._engine = engine if engine else Engine.default()
+        self._on_switch = on_switch
+        self._current = current
+        self._enabled = False
+        self._probe_interval = float(probe_interval)
+        self._probe_timeout = float(probe_timeout)
+        self._probe_path = probe_path
+        self._penalty = float(penalty)
+        self._margin = float(margin)
+        self._switch_after = int(switch_after)
+        self._min_dwell = float(min_dwell)
+        self._max_error_rate = float(max_error_rate)
+        self._alpha = float(alpha)
+
+        self._health = {num: ServerHealth(address, self._alpha) for num, address in servers.items()}
+        self._by_address = {address: num for num, address in servers.items()}
+        self._candidate = None
+        self._wins = 0
+        self._switched = time.monotonic()
+        self._session = None
+        self._task = None
+
+
+    #
+    # ACCESSOR METHODS
+    #
+
+    def enabled(self):
+        '''
+        Gets whether automatic failover is on.
+        '''
+        return self._enabled
+
+
+    def current(self):
+        '''
+        Gets the number of the server currently in use.
+        '''
+        return self._current
+
+
+    def health(self, num):
+        '''
+        Gets the ServerHealth of a server, or None if it is unknown.
+        Arguments:
+            num: The number of the server.
+        '''
+        return self._health.get(num)
+
+
+    #
+    # EVENT LOOP METHODS
+    #
+
+    async def _probe(self, num, health):
+        import aiohttp
+
+        url = server_url(health.address, self._probe_path)
+        start = time.monotonic()
+        try:
+            async with self._session.get(url) as resp:
+                await resp.read()
+                ok = resp.status < 500
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            ok = False
+        health.record(time.monotonic() - start, ok)
+
+
+    async def _run(self):
+        import aiohttp
+
+        self._session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self._probe_timeout))
+        try:
+            while True:
+                await asyncio.gather(*(self._probe(num, health)
+                    for num, health in self._health.items()))
+                if self._enabled:
+                    self._evaluate()
+                await asyncio.sleep(self._probe_interval)
+        finally:
+            await self._session.close()
+
+
+    def _evaluate(self):
+        current = self._health[self._current]
+        best_num = min(self._health, key=lambda num: self._health[num].score(self._penalty))
+        best = self._health[best_num]
+        if best_num == self._current or best.latency is None:
+            self._candidate, self._wins = None, 0
+            return
+        if current.error_rate > self._max_error_rate or current.latency is None:
+            # the current server is failing, do not wait it out
+            self._switch(best_num)
+            return
+        if best.score(self._penalty) > current.score(self._penalty) * (1.0 - self._margin):
+            self._candidate, self._wins = None, 0
+            return
+        if best_num != self._candidate:
+            self._candidate, self._wins = best_num, 0
+        self._wins += 1
+        if self._wins >= self._switch_after and \
+                time.monotonic() - self._switched >= self._min_dwell:
+            self._switch(best_num)
+
+
+    def _switch(self, num):
+        self._current = num
+        self._candidate, self._wins = None, 0
+        self._switched = time.monotonic()
+        self._on_switch(num)
+
+
+    #
+    # CONTROL METHODS
+    #
+
+    def start(self):
+        '''
+        Starts probing the servers in the background.
+        '''
+        if self._task is None:
+            # aiohttp is slow to import, keep that off of the event loop
+            import aiohttp
+
+            self._task = self._engine.submit(self._run())
+
+
+    def stop(self):
+        '''
+        Stops probing the servers.
+        '''
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+    def enable(self):
+        '''
+        Turns automatic failover on.
+        '''
+        self._enabled = True
+
+
+    def disable(self, current=None):
+        '''
+        Turns automatic failover off, for instance because a server was
+        picked by hand.
+        Arguments:
+            current: The number of the server now in use.
+        '''
+        self._enabled = False
+        if current is not None:
+            self._current = current
+            self._switched = time.monotonic()
+
+
+    def set_servers(self, servers, current):
+        '''
+        Replaces the servers being monitored, for instance after the
+        configuration was reloaded. Servers that are still configured
+        keep their health, whatever their new number.
+        Arguments:
+            servers: A dict mapping each server number to its address.
+            current: The number of the server now in use.
+        '''
+        def _replace():
+            health = {h.address: h for h in self._health.values()}
+            self._health = {num: health.get(address) or ServerHealth(address, self._alpha)
+                for num, address in servers.items()}
+            self._by_address = {address: num for num, address in servers.items()}
+            if current != self._current:
+                self._current = current
+                self._switched = time.monotonic()
+            self._candidate, self._wins = None, 0
+        if self._engine.in_loop():
+            _replace()
+        else:
+            self._engine.call_soon(_replace)
+
+
+    def observe(self, address, latency, ok):
+        '''
+        Records the outcome of an upload request. Meant to be given to
+        the Uploader as its observer.
+        Arguments:
+            address: The server the request went to.
+            latency: The time in seconds the request took.
+            ok: Whether the server accepted the request.
+        '''
+        num = self._by_address.get(address)
+        if num is not None:
+            self._health[num].record(latency, ok)
@@ -0,0 +1,239 @@
+import binascii
+
+
+# The byte that opens and closes every serial frame
+FLAG_BYTE = 0x7e
+
+# The byte that escapes a flag or escape byte inside a frame
+ESCAPE_BYTE = 0x7d
+
+# An escaped byte is sent XORed with this value
+ESCAPE_XOR = 0x20
+
+# Every frame ends with a little-endian CRC-16 (CCITT, initial value 0)
+CRC_SIZE = 2
+
+# The protocol bytes of a packet that asks for an ack (and is followed
+#   by a sequence number) and of one that does not, as in the TinyOS
+#   tools
+PROTO_PACKET_ACK = 0x44
+PROTO_PACKET_NOACK = 0x45
+
+# The dispatch byte of an active message
+DISPATCH_AM = 0x00
+
+
+def crc16(data):
+    '''
+    Computes the CRC TinyOS uses for serial frames.
+    Arguments:
+        data: Any bytes-like object.
+    '''
+    return binascii.crc_hqx(data, 0)
+
+
+def escape(data):
+    '''
+    Escapes the flag and escape bytes in a frame body.
+    Arguments:
+        data: The bytes to escape.
+    '''
+    return bytes(data).replace(b'\x7d', b'\x7d\x5d').replace(b'\x7e', b'\x7d\x5e')
+
+
+def frame(body):
+    '''
+    Builds a complete serial frame around a body: appends the CRC,
+    escapes the result and wraps it in flag bytes.
+    Arguments:
+        body: The frame body, starting with the protocol byte.
+    '''
+    crc = crc16(body)
+    return b'\x7e' + escape(bytes(body) + bytes((crc & 0xff, crc >> 8))) + b'\x7e'
+
+
+class FrameParser:
+    '''
+    Defines a parser for the HDLC-like framing TinyOS uses on serial
+    links.
+
+    Bytes are read straight into a fixed-size bytearray ring with
+    readinto(), so reading allocates nothing. Frame boundaries are
+    located with bytearray.find() and frames are handed out as
+    memoryview slices of the ring. Only frames that actually contain an
+    escape sequence are copied, once, to undo the escaping. CRCs are
+    checked with binascii.crc_hqx() over the same views. Nothing in the
+    parser loops in Python per byte.
+
+    The views returned by frames() are only valid until the next call
+    to fill() or feed(); callers that keep a frame must copy it.
+
+    The parser keeps counters of the frames it accepted and of the
+    framing and CRC errors it saw, see stats().
+    '''
+
+    def __init__(self, capacity=64*1024, max_frame=1024):
+        '''
+        Returns a new FrameParser.
+        Arguments:
+            capacity: The size of the ring in bytes.
+            max_frame: The largest escaped frame accepted; longer runs
+            without a closing flag are discarded as framing errors.
+        '''
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self._max_frame = min(int(max_frame), capacity // 2)
+        self._start = 0
+        self._end = 0
+
+        self._bytes = 0
+        self._frames = 0
+        self._crc_errors = 0
+        self._framing_errors = 0
+        self._discarded = 0
+
+
+    #
+    # ACCESSOR METHODS
+    #
+
+    def stats(self):
+        '''
+        Gets a dict of the parser's counters.
+        '''
+        return {
+            'bytes': self._bytes,
+            'frames': self._frames,
+            'crc_errors': self._crc_errors,
+            'framing_errors': self._framing_errors,
+            'discarded': self._discarded
+        }
+
+
+    def buffered(self):
+        '''
+        Gets the number of bytes waiting in the ring.
+        '''
+        return self._end - self._start
+
+
+    #
+    # PARSING METHODS
+    #
+
+    def _make_room(self, size):
+        free = len(self._buffer) - self._end
+        if free >= size or self._start == 0:
+            return
+        # move the unparsed tail (at most one partial frame) to the front
+        pending = self._end - self._start
+        self._view[:pending] = self._view[self._start:self._end]
+        self._start = 0
+        self._end = pending
+
+
+    def fill(self, readinto, size):
+        '''
+        Reads from a source straight into the ring.
+        Arguments:
+            readinto: A function that reads into the writable buffer it
+            is given and returns the number of bytes read, such as the
+            readinto() method of a file.
+            size: The number of bytes to ask for, usually what the
+            serial port reports as waiting.
+        Returns the number of bytes read.
+        '''
+        size = max(1, size)
+        self._make_room(size)
+        count = min(size, len(self._buffer) - self._end)
+        if count == 0:
+            return 0
+        n = readinto(self._view[self._end:self._end + count]) or 0
+        self._end += n
+        self._bytes += n
+        return n
+
+
+    def feed(self, data):
+        '''
+        Copies bytes that were already read into the ring. Frames must
+        be collected with frames() before feeding more than the ring
+        can hold.
+        Arguments:
+            data: Any bytes-like object.
+        Returns the number of bytes accepted.
+        '''
+        data = memoryview(data)
+        self._make_room(len(data))
+        count = min(len(data), len(self._buffer) - self._end)
+        self._view[self._end:self._end + count] = data[:count]
+        self._end += count
+        self._bytes += count
+        return count
+
+
+    def frames(self):
+        '''
+        Yields every complete frame in the ring whose CRC checks out.
+        Each frame is unescaped and stripped of its CRC, and starts
+        with the protocol byte.
+        '''
+        buf = self._buffer
+        while self._start < self._end:
+            start = buf.find(FLAG_BYTE, self._start, self._end)
+            if start == -1:
+                # no frame in sight, the bytes cannot be used
+                self._discard(self._end - self._start)
+                self._start = self._end
+                break
+            if start > self._start:
+                self._discard(start - self._start)
+                self._start = start
+            end = buf.find(FLAG_BYTE, start + 1, self._end)
+            if end == -1:
+                if self._end - start > self._max_frame:
+                    self._discard(self._end - start)
+                    self._start = self._end
+                break
+            # the closing flag may also open the next frame
+            self._start = end
+            if end == start + 1:
+                continue
+            body = self._decode(start + 1, end)
+            if body is not None:
+                yield body
+        if self._start == self._end:
+            self._start = self._end = 0
+
+
+    def _discard(self, count):
+        self._framing_errors += 1
+        self._discarded += count
+
+
+    def _decode(self, start, end):
+        buf = self._buffer
+        esc = buf.find(ESCAPE_BYTE, start, end)
+        if esc == -1:
+            data = self._view[start:end]
+        else:
+            out = bytearray()
+            while esc != -1:
+                if esc + 1 >= end:
+                    self._framing_errors += 1
+                    return None
+                out += self._view[start:esc]
+                out.append(buf[esc+1] ^ ESCAPE_XOR)
+                start = esc + 2
+                esc = buf.find(ESCAPE_BYTE, start, end)
+            out += self._view[start:end]
+            data = memoryview(out)
+        if len(data) <= CRC_SIZE:
+            self._framing_errors += 1
+            return None
+        body = data[:-CRC_SIZE]
+        if crc16(body) != data[-2] | (data[-1] << 8):
+            self._crc_errors += 1
+            return None
+        self._frames += 1
+        return body
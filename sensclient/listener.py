@@ -1,44 +1,72 @@
-import threading, time, sys
-from tinyos3 import tos
+import asyncio, io, struct, time
+import click
+import serial
 
+from sensclient.decoding import DECODERS
+from sensclient.engine import Engine
+from sensclient.framing import FrameParser, PROTO_PACKET_ACK, PROTO_PACKET_NOACK, DISPATCH_AM
+from sensclient.metrics import DECODE_SECONDS
+from sensclient.profiling import STAGES
 
-# This code comes from the TinyOS oscilloscope application
-class OscilloscopeMsg (tos.Packet):
-    '''
-    Defines a message that is read from the official TinyOS oscilloscope
-    application.
-    '''
-    def __init__(self, packet=None):
-        tinyos3.tos.Packet.__init__(self,
-            [('version',  'int', 2),
-             ('interval', 'int', 2),
-             ('id',       'int', 2),
-             ('count',    'int', 2),
-             ('readings', 'blob', None)],
-            packet)
+
+# The header of an active message: destination, source, length, group
+#   and type
+AM_HEADER = struct.Struct('>HHBBB')
+
+
+def __getattr__(name):
+    # The TinyOS tools are slow to import and only needed for
+    #   OscilloscopeMsg, so the class is built when first used
+    if name == 'OscilloscopeMsg':
+        globals()[name] = _oscilloscope_msg()
+        return globals()[name]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def _oscilloscope_msg():
+    from tinyos3 import tos
+
+    # This code comes from the TinyOS oscilloscope application
+    class OscilloscopeMsg (tos.Packet):
+        '''
+        Defines a message that is read from the official TinyOS oscilloscope
+        application.
+        '''
+        def __init__(self, packet=None):
+            tos.Packet.__init__(self,
+                [('version',  'int', 2),
+                 ('interval', 'int', 2),
+                 ('id',       'int', 2),
+                 ('count',    'int', 2),
+                 ('readings', 'blob', None)],
+                packet)
+
+    OscilloscopeMsg.__qualname__ = 'OscilloscopeMsg'
+    return OscilloscopeMsg
 
 
-class Listener(threading.Thread):
+class Listener:
     '''
     Defines a class for listening for events on connected serial
     devices compatible with TinyOS. A single Listener is always
     bound to a single physical device.
 
-    This class functions as state machine that runs as a daemon
-    (background) thread.
+    This class functions as a state machine driven by the client's
+    shared Engine. Every Listener lives on the same asyncio event loop;
+    none of them owns a thread.
 
     The state machine defines the following three states:
-        PAUSED: Daemon alive, not reporting data.
-        RUNNING: Daemon alive, reporting data.
-        STOPPED: Daemon soon to be officially dead.
-    In PAUSED mode, the state machine functions effectively as a
-    spin lock. It will not collect data from the connected serial
-    port and will not relay said data through the Listeners callback
-    function.
+        PAUSED: Port open, not reporting data.
+        RUNNING: Port open, reporting data.
+        STOPPED: Port closed, the Listener is finished.
+    In RUNNING mode, the Listener registers its serial port with the
+    event loop and is only woken up when the port has bytes waiting.
+    In PAUSED mode, the port is unregistered from the loop, so a paused
+    Listener costs no CPU at all. Any bytes that arrive while paused
+    are discarded on resume.
 
     When created, a Listener will always intialize to the PAUSED
-    state. Once stopped, the daemon thread backing the Listener
-    cannot be restarted.
+    state. Once stopped, a Listener cannot be restarted.
     '''
 
     # Define the states for the state machine
@@ -47,11 +75,11 @@ class Listener(threading.Thread):
     STOPPED = 2
 
 
-    # The rate at which the AM module is configured to send
-    #   messages. This is application specific so only
-    #   the rate for the Oscilloscope application is defined
+    # The AM type the application on the device sends its messages
+    #   as. Kept for compatibility, AM rates are resolved through the
+    #   decoder registry, see sensclient.decoding.DECODERS
     AM_RATES = {
-        'OSCIILLOSCOPE': 0x93
+        'OSCILLOSCOPE': 0x93
     }
 
 
@@ -69,38 +97,80 @@ class Listener(threading.Thread):
     }
 
 
-    def __init__(self, callback, device, baudrate, amrate='OSCILLOSCOPE'):
+    # How often to poll the port on platforms where the event loop
+    #   cannot watch a serial port's file descriptor (Windows)
+    POLL_INTERVAL = 0.01
+
+
+    def __init__(self, callback, device, baudrate, amrate='OSCILLOSCOPE', engine=None,
+            decoder=None, registry=None):
         '''
         Returns a new instance of a Listener.
         Arguments:
             callback: The callback to execute when an event is
-            received. The callback function should be thread-safe.
+            received, called with the device and the message. The
+            callback is run on the engine's event loop and must not
+            block.
             device: The physical address of the device.
             baudrate: The sampling rate of the physical device.
-            amrate: The rate of transfer for the Active Messaging
-            module on the connected device.
+            amrate: The AM rate of the messages to report: a name or a
+            numeric AM type from the registry, several of them
+            separated by commas, or ALL for every registered type.
+            engine: The Engine to run on, defaults to the process-wide
+            Engine.
+            decoder: The function that turns a message payload (as
+            bytes) into the message handed to the callback, defaults
+            to the decoder registered for the message's AM type.
+            registry: The DecoderRegistry to look AM types up in,
+            defaults to DECODERS.
+        Raises a ValueError if an AM rate is not known.
         '''
-        threading.Thread.__init__(self, daemon=True)
-        self._callback = threading.local()
+        registry = registry if registry is not None else DECODERS
         self._callback = callback
-
-        self._device = threading.local()
         self._device = device
-
-        self._baudrate = threading.local()
         self._baudrate = baudrate
-
-        self._amrate = threading.local()
         self._amrate = amrate
+        self._decoders = registry.table(registry.select(amrate), decoder)
+        self._engine = engine if engine else Engine.default()
 
-        self._state = threading.local()
         self._state = Listener.PAUSED
+        self._serial = None
+        self._poller = None
+        self._watching = False
+        self._readinto = None
+        self._parser = FrameParser()
+        self._labels = (device,)
+        self._packets = 0
+        self._unhandled = 0
+        self._decode_errors = 0
+        # the AM types that failed to decode, each is only reported once
+        self._undecodable = set()
+        self._recorder = None
+
+
+    @staticmethod
+    def resolve_amrate(amrate):
+        '''
+        Maps an AM rate to the AM type it refers to.
+        Arguments:
+            amrate: Either a name registered in DECODERS or an integer
+            AM type.
+        Raises a ValueError if the AM rate is not known.
+        '''
+        return DECODERS.resolve(amrate)
 
 
     #
     # ACCESSOR METHODS
     #
 
+    def amrate(self):
+        '''
+        Gets the AM rate the Listener reports messages for.
+        '''
+        return self._amrate
+
+
     def baudrate(self):
         '''
         Gets the physical sampling rate of the device.
@@ -117,9 +187,10 @@ class Listener(threading.Thread):
 
     def samplerate(self):
         '''
-        Gets the software sampling rate of the device in ms.
+        Gets the software sampling rate of the device. Kept for
+        compatibility, this is the same as the AM rate.
         '''
-        return self._samplerate
+        return self._amrate
 
 
     def state(self):
@@ -140,29 +211,220 @@ class Listener(threading.Thread):
             return 'NULL'
 
 
+    def stats(self):
+        '''
+        Gets the Listener's counters: the framing counters of its
+        serial link, the number of messages reported ('packets'), the
+        number of messages dropped because no decoder was selected for
+        their AM type ('unhandled'), the number of messages their
+        decoder failed on ('decode_errors') and a histogram snapshot of
+        decode times ('decode').
+        '''
+        stats = self._parser.stats()
+        stats['packets'] = self._packets
+        stats['unhandled'] = self._unhandled
+        stats['decode_errors'] = self._decode_errors
+        stats['decode'] = DECODE_SECONDS.snapshot(self._labels)
+        return stats
+
+
+    def is_alive(self):
+        '''
+        Gets whether the Listener has not yet been stopped.
+        '''
+        return self._state != Listener.STOPPED
+
+
+    #
+    # EVENT LOOP METHODS
+    #
+
+    def _is_open(self):
+        return self._serial is not None
+
+
+    def _open(self):
+        self._serial = serial.Serial(self._device, self._baudrate, rtscts=0, timeout=0)
+        self._serial.reset_input_buffer()
+        try:
+            # read straight from the descriptor, skipping pyserial's copies
+            self._readinto = io.FileIO(self._serial.fileno(), 'rb', closefd=False).readinto
+        except (AttributeError, OSError):
+            self._readinto = self._serial.readinto
+
+
+    def _close(self):
+        if self._recorder is not None:
+            self._recorder.close()
+            self._recorder = None
+        if self._serial is not None:
+            try:
+                self._serial.close()
+            except (OSError, serial.SerialException):
+                pass
+            self._serial = None
+
+
+    def _watch(self):
+        loop = asyncio.get_running_loop()
+        self._serial.reset_input_buffer()
+        try:
+            loop.add_reader(self._serial.fileno(), self._on_readable)
+            self._watching = True
+        except (NotImplementedError, AttributeError):
+            self._poller = loop.create_task(self._poll())
+
+
+    def _unwatch(self):
+        if self._watching:
+            asyncio.get_running_loop().remove_reader(self._serial.fileno())
+            self._watching = False
+        if self._poller is not None:
+            self._poller.cancel()
+            self._poller = None
+
+
+    async def _poll(self):
+        while True:
+            self._on_readable()
+            await asyncio.sleep(Listener.POLL_INTERVAL)
+
+
+    def _on_readable(self):
+        '''
+        Called by the event loop whenever the serial port has data.
+        Reads everything that is waiting in one call and reports each
+        complete message through the callback.
+        '''
+        began = STAGES.begin('read') if STAGES.active else None
+        try:
+            waiting = self._serial.in_waiting
+            if waiting == 0 and not self._watching:
+                return
+            readinto = self._readinto if self._recorder is None else self._record_into
+            if self._parser.fill(readinto, waiting) == 0 and waiting == 0:
+                raise serial.SerialException('device is readable but returned no data')
+        except (OSError, serial.SerialException) as e:
+            click.secho('Listener for device {} failed: {}'.format(self._device, e), fg='red', err=True)
+            self._unwatch()
+            self._close()
+            self._state = Listener.STOPPED
+            return
+        if began is not None:
+            STAGES.lap(began, ('listener', self._device, 'read'))
+        for frame in self._parser.frames():
+            self._dispatch(frame)
+
+
+    def _record_into(self, buffer):
+        n = self._readinto(buffer)
+        if n:
+            self._recorder.write(buffer[:n], time.monotonic_ns())
+        return n
+
+
+    def _dispatch(self, frame):
+        '''
+        Decodes a frame and reports it if it carries a message of one
+        of the Listener's AM types. The decoder is found by indexing the
+        dispatch table with the AM type; messages of other types are
+        counted and dropped before any decoding. The frame is a view
+        into the parser's ring, only the message payload is copied out
+        of it.
+        '''
+        protocol = frame[0]
+        if protocol == PROTO_PACKET_NOACK:
+            body = frame[1:]
+        elif protocol == PROTO_PACKET_ACK:
+            body = frame[2:]
+        else:
+            return
+        if len(body) < AM_HEADER.size + 1 or body[0] != DISPATCH_AM:
+            return
+        # the AM type is the last byte of the header, after the dispatch byte
+        amtype = body[AM_HEADER.size]
+        decoder = self._decoders[amtype]
+        if decoder is None:
+            self._unhandled += 1
+            return
+        began = STAGES.begin('dispatch') if STAGES.active else None
+        start = time.perf_counter()
+        try:
+            msg = decoder(bytes(body[1+AM_HEADER.size:]))
+        except Exception as e:
+            # a bad message, or a bad decoder, must not stop the Listener
+            self._decode_errors += 1
+            if amtype not in self._undecodable:
+                self._undecodable.add(amtype)
+                click.secho('Cannot decode messages of AM type {} from device {}: {}'.format(
+                    amtype, self._device, e), fg='red', err=True)
+            return
+        DECODE_SECONDS.observe(time.perf_counter() - start, self._labels)
+        self._packets += 1
+        if began is not None:
+            began = STAGES.lap(began, ('listener', self._device, 'decode'))
+        self._callback(self._device, msg)
+        if began is not None:
+            STAGES.lap(began, ('listener', self._device, 'queue'))
+
+
+    async def transition(self, state):
+        '''
+        Moves the state machine into a new state. This is a coroutine
+        that must run on the engine's loop, it completes once the
+        transition has taken effect.
+        Arguments:
+            state: One of PAUSED, RUNNING or STOPPED.
+        Returns the state the Listener ended up in.
+        '''
+        if self._state == Listener.STOPPED or state == self._state:
+            return self._state
+        if state == Listener.RUNNING:
+            if not self._is_open():
+                self._open()
+            self._watch()
+        elif state == Listener.PAUSED:
+            self._unwatch()
+        elif state == Listener.STOPPED:
+            self._unwatch()
+            self._close()
+        else:
+            raise ValueError('Unknown Listener state {}!'.format(state))
+        self._state = state
+        return self._state
+
+
     #
     # CONTROL METHODS
     #
 
-    def run(self):
+    def start(self):
         '''
-        Overridden from the Thread superclass. This function defines
-        the logic of the Listeners state machine.
+        Opens the serial port for the device. The Listener remains
+        PAUSED until resumed. The port is opened off of the event loop,
+        so that several devices can be opened at once.
         '''
-        # Note that the tinyos specific code comes from the
-        #   oscilloscope python application that ships with tos
-        am = tos.AM()
+        async def _start():
+            if not self._is_open() and self._state != Listener.STOPPED:
+                await asyncio.get_running_loop().run_in_executor(None, self._open)
+        self._engine.call(_start())
 
-        while self._state != Listener.STOPPED:
-            if self._state != Listener.PAUSED:
-                # read in the packet
-                p = am.read()
-                # check if there was a packet and we have an AM rate for it
-                if p and p.type == LISTENER.AM_RATES[self._amrate]:
-                    msg = OscilloscodeMsg(p.data)
-                    callback(msg)
-            elif self._state == Listener.PAUSED:
-                time.sleep(0)
+
+    def record(self, writer):
+        '''
+        Starts or stops recording the raw bytes read from the device.
+        Recording only adds work for the Listener while it is on, and
+        it stops when the Listener does.
+        Arguments:
+            writer: A CaptureWriter to record into, or None to stop
+            recording.
+        Returns the CaptureWriter that was recording before, which the
+        caller is responsible for closing.
+        '''
+        async def _record():
+            previous, self._recorder = self._recorder, writer
+            return previous
+        return self._engine.call(_record())
 
 
     def resume(self):
@@ -170,8 +432,8 @@ class Listener(threading.Thread):
         Provides a method for resuming the listener, thereby
         continuing data collection.
         '''
-        if self.is_alive() and self._state == Listener.PAUSED:
-            self._state = Listener.RUNNING
+        if self._state == Listener.PAUSED:
+            self._engine.call(self.transition(Listener.RUNNING))
 
 
     def pause(self):
@@ -179,14 +441,14 @@ class Listener(threading.Thread):
         Provides a method for pausing the Listener, thereby halting
         data collection.
         '''
-        if self.is_alive() and self._state == Listener.RUNNING:
-            self._state = Listener.PAUSED
+        if self._state == Listener.RUNNING:
+            self._engine.call(self.transition(Listener.PAUSED))
 
 
     def stop(self):
         '''
-        Provides a method for stopping the Listener, thereby ending
-        the backing daemon thread.
+        Provides a method for stopping the Listener, thereby closing
+        the serial port.
         '''
-        if self.is_alive() and self._state != Listener.STOPPED:
-            self._state = Listener.STOPPED
+        if self._state != Listener.STOPPED and not self._engine.closed():
+            self._engine.call(self.transition(Listener.STOPPED))
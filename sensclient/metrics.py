@@ -0,0 +1,352 @@
+import bisect, threading
+
+
+# The default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005,
+    0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+
+class _Slotted:
+    '''
+    Defines the per-thread storage shared by Counter and Histogram.
+    Every thread that records a value gets its own slot, which only it
+    ever writes to, so recording takes no lock. Slots are merged when
+    the metric is read.
+    '''
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._local = threading.local()
+        self._slots = []
+        self._lock = threading.Lock()
+
+
+    def _slot(self):
+        try:
+            return self._local.slot
+        except AttributeError:
+            slot = dict()
+            with self._lock:
+                self._slots.append(slot)
+            self._local.slot = slot
+            return slot
+
+
+    def _items(self):
+        with self._lock:
+            slots = list(self._slots)
+        for slot in slots:
+            # copying a dict's items is atomic under the GIL
+            yield from list(slot.items())
+
+
+class Counter(_Slotted):
+    '''
+    Defines a monotonically increasing counter, optionally split by a
+    tuple of label values.
+    '''
+
+    def inc(self, labels=(), amount=1):
+        '''
+        Adds to the counter.
+        Arguments:
+            labels: The tuple of label values to count against.
+            amount: The amount to add.
+        '''
+        slot = self._slot()
+        slot[labels] = slot.get(labels, 0) + amount
+
+
+    def values(self):
+        '''
+        Gets the merged value of the counter for every set of labels.
+        '''
+        merged = dict()
+        for labels, value in self._items():
+            merged[labels] = merged.get(labels, 0) + value
+        return merged
+
+
+    def value(self, labels=()):
+        '''
+        Gets the merged value of the counter for one set of labels.
+        Arguments:
+            labels: The tuple of label values.
+        '''
+        return self.values().get(labels, 0)
+
+
+class Histogram(_Slotted):
+    '''
+    Defines a histogram of observed values over fixed buckets,
+    optionally split by a tuple of label values.
+    '''
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        _Slotted.__init__(self, name, help)
+        self.buckets = tuple(sorted(buckets))
+
+
+    def observe(self, value, labels=()):
+        '''
+        Records a value.
+        Arguments:
+            value: The value to record.
+            labels: The tuple of label values to record it against.
+        '''
+        slot = self._slot()
+        counts = slot.get(labels)
+        if counts is None:
+            # one count per bucket, one for +Inf, then the sum
+            counts = slot[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+
+    def snapshots(self):
+        '''
+        Gets the merged histogram for every set of labels, see
+        snapshot().
+        '''
+        merged = dict()
+        for labels, counts in self._items():
+            total = merged.setdefault(labels, [0] * len(counts))
+            for i, count in enumerate(list(counts)):
+                total[i] += count
+        return {labels: self._snapshot(counts) for labels, counts in merged.items()}
+
+
+    def snapshot(self, labels=()):
+        '''
+        Gets the merged histogram for one set of labels.
+        Arguments:
+            labels: The tuple of label values.
+        Returns a dict with the cumulative 'buckets' (as (bound, count)
+        pairs, ending with +Inf), the 'sum' and the 'count'.
+        '''
+        snapshot = self.snapshots().get(labels)
+        return snapshot if snapshot else self._snapshot([0] * (len(self.buckets) + 2))
+
+
+    def _snapshot(self, counts):
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts[:-1]):
+            running += count
+            cumulative.append((bound, running))
+        return {'buckets': cumulative, 'sum': counts[-1], 'count': running}
+
+
+def quantile(snapshot, q):
+    '''
+    Estimates a quantile from a histogram snapshot, as the upper bound
+    of the bucket it falls in.
+    Arguments:
+        snapshot: A histogram snapshot.
+        q: The quantile, between 0 and 1.
+    Returns None if the histogram is empty.
+    '''
+    if not snapshot['count']:
+        return None
+    rank = q * snapshot['count']
+    for bound, count in snapshot['buckets']:
+        if count >= rank:
+            return bound
+    return float('inf')
+
+
+#
+# PROMETHEUS TEXT FORMAT
+#
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in labels.items()) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_samples(name, kind, help, samples):
+    '''
+    Renders a counter or gauge in the Prometheus text format.
+    Arguments:
+        name: The metric's name.
+        kind: Either 'counter' or 'gauge'.
+        help: The metric's description.
+        samples: A list of (labels dict, value) pairs.
+    '''
+    lines = ['# HELP {} {}'.format(name, help), '# TYPE {} {}'.format(name, kind)]
+    for labels, value in samples:
+        lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def render_histogram(name, help, snapshots):
+    '''
+    Renders a histogram in the Prometheus text format.
+    Arguments:
+        name: The metric's name.
+        help: The metric's description.
+        snapshots: A list of (labels dict, snapshot) pairs.
+    '''
+    lines = ['# HELP {} {}'.format(name, help), '# TYPE {} histogram'.format(name)]
+    for labels, snapshot in snapshots:
+        for bound, count in snapshot['buckets']:
+            bucket = dict(labels)
+            bucket['le'] = _format_value(bound)
+            lines.append('{}_bucket{} {}'.format(name, _format_labels(bucket), count))
+        lines.append('{}_sum{} {}'.format(name, _format_labels(labels), _format_value(snapshot['sum'])))
+        lines.append('{}_count{} {}'.format(name, _format_labels(labels), snapshot['count']))
+    return '\n'.join(lines) + '\n'
+
+
+class Registry:
+    '''
+    Defines the set of metrics exported by the client. Besides its own
+    counters and histograms, the registry runs collectors at render
+    time: functions that read values kept elsewhere (such as a
+    Listener's framing counters) and render them.
+    '''
+
+    def __init__(self, prefix='sensclient_'):
+        self._prefix = prefix
+        self._metrics = []
+        self._labelnames = dict()
+        self._collectors = []
+
+
+    def counter(self, name, help, labelnames=()):
+        '''
+        Creates and registers a Counter.
+        Arguments:
+            name: The name of the counter, without the prefix.
+            help: The description of the counter.
+            labelnames: The names of the counter's labels.
+        '''
+        metric = Counter(self._prefix + name, help)
+        self._metrics.append(metric)
+        self._labelnames[metric.name] = tuple(labelnames)
+        return metric
+
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        '''
+        Creates and registers a Histogram.
+        Arguments:
+            name: The name of the histogram, without the prefix.
+            help: The description of the histogram.
+            labelnames: The names of the histogram's labels.
+            buckets: The upper bounds of the histogram's buckets.
+        '''
+        metric = Histogram(self._prefix + name, help, buckets)
+        self._metrics.append(metric)
+        self._labelnames[metric.name] = tuple(labelnames)
+        return metric
+
+
+    def add_collector(self, collector):
+        '''
+        Registers a function returning extra metrics, already rendered
+        in the Prometheus text format, to include in every render.
+        Arguments:
+            collector: A function taking the prefix and returning text.
+        '''
+        self._collectors.append(collector)
+
+
+    def render(self):
+        '''
+        Renders every metric in the Prometheus text format.
+        '''
+        parts = []
+        for metric in self._metrics:
+            names = self._labelnames[metric.name]
+            if isinstance(metric, Histogram):
+                parts.append(render_histogram(metric.name, metric.help,
+                    [(dict(zip(names, labels)), snapshot)
+                        for labels, snapshot in sorted(metric.snapshots().items())]))
+            else:
+                parts.append(render_samples(metric.name, 'counter', metric.help,
+                    [(dict(zip(names, labels)), value)
+                        for labels, value in sorted(metric.values().items())]))
+        for collector in self._collectors:
+            parts.append(collector(self._prefix))
+        return ''.join(parts)
+
+
+# The registry used throughout the client
+REGISTRY = Registry()
+
+# Define the metrics recorded on the client's hot paths. Decode times
+#   are kept per Listener and reported through Listener.stats(), as
+#   Listeners may run in worker processes with registries of their own
+DECODE_SECONDS = Histogram('sensclient_decode_seconds',
+    'Time spent decoding a message.',
+    (0.000001, 0.000002, 0.000005, 0.00001, 0.00002, 0.00005, 0.0001, 0.0005, 0.001))
+QUEUE_WAIT_SECONDS = REGISTRY.histogram('queue_wait_seconds',
+    'Time events spend in the event queue.', ('device',))
+UPLOAD_SECONDS = REGISTRY.histogram('upload_seconds',
+    'Latency of upload requests.', ('server',))
+UPLOAD_ERRORS = REGISTRY.counter('upload_errors_total',
+    'Upload requests that failed or were rejected.', ('server',))
+
+
+class MetricsServer:
+    '''
+    Defines a small HTTP server exposing the registry in the Prometheus
+    text format at /metrics. It runs in its own thread, so scrapes are
+    served without touching the engine's event loop.
+    '''
+
+    def __init__(self, registry=REGISTRY, host='127.0.0.1', port=9464):
+        '''
+        Starts serving the registry.
+        Arguments:
+            registry: The Registry to serve.
+            host: The address to bind to.
+            port: The port to listen on.
+        '''
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, int(port)), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever,
+            name='sensclient-metrics', daemon=True)
+        self._thread.start()
+
+
+    def address(self):
+        '''
+        Gets the (host, port) the server listens on.
+        '''
+        return self._server.server_address
+
+
+    def close(self):
+        '''
+        Stops the server.
+        '''
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,101 @@
+import asyncio, collections, time
+import serial
+
+from sensclient.engine import Engine
+from sensclient.framing import FrameParser
+from sensclient.listener import Listener
+
+
+# The result of probing one device: the baudrate picked, None if no
+#   rate worked, and the (frames, crc_errors) heard at each rate tried
+ProbeResult = collections.namedtuple('ProbeResult', ('device', 'baudrate', 'rates'))
+
+
+# How often to read the port while probing it
+POLL_INTERVAL = 0.01
+
+
+def candidate_rates():
+    '''
+    Gets the distinct baudrates of Listener.RATES, fastest first.
+    '''
+    return sorted(set(Listener.RATES.values()), reverse=True)
+
+
+async def probe_rate(device, baudrate, window=1.0, frames=2):
+    '''
+    Listens to a device at one baudrate and counts the TinyOS frames
+    with a correct CRC heard. At the wrong rate the bytes read are
+    garbage and no frame checks out.
+    Arguments:
+        device: The physical address of the device.
+        baudrate: The baudrate to try.
+        window: The maximum time in seconds to listen for.
+        frames: The number of valid frames after which to stop early.
+    Returns the number of valid frames and of CRC errors. Raises an
+    OSError or a serial.SerialException if the port cannot be opened.
+    '''
+    loop = asyncio.get_running_loop()
+    port = await loop.run_in_executor(None,
+        lambda: serial.Serial(device, baudrate, rtscts=0, timeout=0))
+    try:
+        port.reset_input_buffer()
+        parser = FrameParser()
+        valid = 0
+        deadline = time.monotonic() + window
+        while valid < frames and time.monotonic() < deadline:
+            await asyncio.sleep(POLL_INTERVAL)
+            waiting = port.in_waiting
+            if waiting:
+                parser.fill(port.readinto, waiting)
+                valid += sum(1 for _ in parser.frames())
+        return valid, parser.stats()['crc_errors']
+    finally:
+        port.close()
+
+
+async def probe_device(device, rates=None, window=1.0, frames=2):
+    '''
+    Finds the baudrate of a device by trying each candidate rate in
+    turn, stopping at the first one that yields enough valid frames.
+    Arguments:
+        device: The physical address of the device.
+        rates: The baudrates to try, defaults to candidate_rates().
+        window: The maximum time in seconds to listen at each rate.
+        frames: The number of valid frames that settles the rate.
+    Returns a ProbeResult. If no rate yields enough frames, the one
+    that yielded the most is picked, if any did.
+    '''
+    results = dict()
+    for baudrate in rates if rates is not None else candidate_rates():
+        results[baudrate] = await probe_rate(device, baudrate, window, frames)
+        if results[baudrate][0] >= frames:
+            return ProbeResult(device, baudrate, results)
+    best = max(results, key=lambda rate: results[rate][0], default=None)
+    if best is None or results[best][0] == 0:
+        return ProbeResult(device, None, results)
+    return ProbeResult(device, best, results)
+
+
+def probe(devices, rates=None, window=1.0, frames=2, engine=None):
+    '''
+    Finds the baudrates of several devices, probing them all at once
+    so that it takes as long as the slowest of them.
+    Arguments:
+        devices: The physical addresses of the devices.
+        rates: The baudrates to try, defaults to candidate_rates().
+        window: The maximum time in seconds to listen at each rate.
+        frames: The number of valid frames that settles the rate.
+        engine: The Engine to run on, defaults to the process-wide
+        Engine.
+    Returns a dict mapping each device to its ProbeResult, or to the
+    exception raised if it could not be opened.
+    '''
+    engine = engine if engine else Engine.default()
+
+    async def _probe():
+        results = await asyncio.gather(
+            *(probe_device(device, rates, window, frames) for device in devices),
+            return_exceptions=True)
+        return dict(zip(devices, results))
+    return engine.call(_probe())
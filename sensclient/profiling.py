@@ -0,0 +1,431 @@
+import os, threading, time
+
+from sensclient.engine import Engine
+
+
+class StageTimer:
+    '''
+    Defines the sampled timings of the stages of the client's pipeline:
+    reading from the serial ports, decoding, handing events to the
+    queue, and each output of the event consumer.
+
+    The stages are instrumented in place and checked with a single
+    attribute read while the timer is off:
+
+        began = STAGES.begin('consumer') if STAGES.active else None
+        ...
+        if began is not None:
+            began = STAGES.lap(began, ('consumer', 'upload'))
+
+    While it is on, only one in every every calls to begin() with the
+    same key on a thread is timed, and its stages record their wall and CPU time
+    into storage that only that thread writes to, so timing takes no
+    lock.
+    '''
+
+    def __init__(self):
+        self.active = False
+        self._every = 100
+        self._local = threading.local()
+        self._slots = []
+        self._lock = threading.Lock()
+
+
+    def _slot(self):
+        try:
+            return self._local.slot
+        except AttributeError:
+            slot = dict()
+            with self._lock:
+                self._slots.append(slot)
+            self._local.slot = slot
+            self._local.countdowns = dict()
+            return slot
+
+
+    def every(self):
+        '''
+        Gets the sampling interval, one in every this many passes
+        through the pipeline is timed.
+        '''
+        return self._every
+
+
+    def start(self, every=100):
+        '''
+        Clears the timings and starts taking new ones.
+        Arguments:
+            every: Only one in every this many passes is timed.
+        Raises a ValueError if every is not positive.
+        '''
+        if every <= 0:
+            raise ValueError('The profile sampling must be positive!')
+        self._every = int(every)
+        with self._lock:
+            for slot in self._slots:
+                slot.clear()
+        self.active = True
+
+
+    def stop(self):
+        '''
+        Stops taking timings, keeping those taken.
+        '''
+        self.active = False
+
+
+    def begin(self, key):
+        '''
+        Starts a pass through the stages of the calling thread.
+        Arguments:
+            key: The name of the pass, passes are sampled separately
+            for every key.
+        Returns the mark to pass to lap(), or None if this pass is not
+        sampled.
+        '''
+        try:
+            countdowns = self._local.countdowns
+        except AttributeError:
+            self._slot()
+            countdowns = self._local.countdowns
+        countdown = countdowns.get(key, 1) - 1
+        if countdown > 0:
+            countdowns[key] = countdown
+            return None
+        countdowns[key] = self._every
+        return time.perf_counter(), time.thread_time()
+
+
+    def lap(self, began, stage):
+        '''
+        Records the time since a mark against a stage.
+        Arguments:
+            began: The mark returned by begin() or by the previous lap().
+            stage: The tuple naming the stage, outermost first.
+        Returns the mark to time the next stage from.
+        '''
+        now = time.perf_counter(), time.thread_time()
+        slot = self._slot()
+        totals = slot.get(stage)
+        if totals is None:
+            totals = slot[stage] = [0, 0.0, 0.0]
+        totals[0] += 1
+        totals[1] += now[0] - began[0]
+        totals[2] += now[1] - began[1]
+        return now
+
+
+    def timings(self):
+        '''
+        Gets the merged timings, as a dict mapping each stage to its
+        number of samples and its total sampled wall and CPU time in
+        seconds.
+        '''
+        with self._lock:
+            slots = list(self._slots)
+        merged = dict()
+        for slot in slots:
+            # copying a dict's items is atomic under the GIL
+            for stage, totals in list(slot.items()):
+                total = merged.setdefault(stage, [0, 0.0, 0.0])
+                for i, value in enumerate(list(totals)):
+                    total[i] += value
+        return {stage: tuple(totals) for stage, totals in merged.items()}
+
+
+# The stage timings of this process
+STAGES = StageTimer()
+
+
+def _frame(filename, lineno, name=None):
+    # collapsed stacks separate frames with ';'
+    if filename == '~':
+        # cProfile's name for built-in functions
+        label = name
+    elif name is None:
+        label = '{}:{}'.format(filename, lineno)
+    else:
+        label = '{} ({}:{})'.format(name, filename, lineno)
+    return label.replace(';', ':')
+
+
+def collapse_profile(stats, root=None, threshold=1e-6, depth=64):
+    '''
+    Turns the statistics of a cProfile run into collapsed stacks.
+    cProfile only records who called whom, so the time of a function
+    is split over the stacks leading to it in proportion to the time
+    spent under each of its callers.
+    Arguments:
+        stats: A pstats.Stats.
+        root: An optional frame to put at the bottom of every stack,
+        such as the name of the thread profiled.
+        threshold: The time in seconds below which a stack is left out.
+        depth: The deepest stack followed.
+    Returns a dict mapping each stack, as a tuple of frames outermost
+    first, to its time in seconds.
+    '''
+    callees = dict()
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, (_, _, _, ct) in callers.items():
+            callees.setdefault(caller, []).append((func, ct))
+    stacks = dict()
+
+    def visit(func, path, wall):
+        _, _, tt, ct, _ = stats.stats[func]
+        path = path + (_frame(*func),)
+        share = wall / ct if ct > 0 else 0.0
+        if tt * share >= threshold:
+            stacks[path] = stacks.get(path, 0.0) + tt * share
+        if len(path) >= depth:
+            return
+        for callee, edge in callees.get(func, ()):
+            if callee in seen:
+                continue
+            below = edge * share
+            if below >= threshold:
+                seen.add(callee)
+                visit(callee, path, below)
+                seen.discard(callee)
+
+    for func, (_, _, _, ct, callers) in stats.stats.items():
+        if not callers:
+            seen = {func}
+            visit(func, (root,) if root is not None else (), ct)
+    return stacks
+
+
+def collapse_snapshot(snapshot, root=None):
+    '''
+    Turns a tracemalloc snapshot into collapsed stacks.
+    Arguments:
+        snapshot: A tracemalloc.Snapshot.
+        root: An optional frame to put at the bottom of every stack.
+    Returns a dict mapping each stack, as a tuple of frames outermost
+    first, to the bytes allocated from it and still live.
+    '''
+    stacks = dict()
+    for stat in snapshot.statistics('traceback'):
+        # tracemalloc orders frames from the oldest to the newest
+        path = ((root,) if root is not None else ()) + tuple(
+            _frame(frame.filename, frame.lineno) for frame in stat.traceback)
+        stacks[path] = stacks.get(path, 0) + stat.size
+    return stacks
+
+
+class Profiler:
+    '''
+    Defines the on-demand profiling of the client, in one of MODES:
+
+        stages: the sampled wall and CPU time of each stage of the
+        pipeline, see StageTimer.
+        cpu: a cProfile run of every thread of the pipeline.
+        memory: a tracemalloc trace of the live allocations.
+
+    cProfile only profiles the thread it is enabled on, so the threads
+    of the pipeline join the run by calling attach() whenever the
+    generation has changed: the Engine's thread, where every Listener
+    runs, is attached by start() and stop() themselves, and the event
+    consumer checks the generation once per batch of events.
+
+    The results are written as collapsed stacks, one stack per line
+    with its frames separated by ';' followed by a space and its
+    weight, which flamegraph.pl, speedscope and most other flame graph
+    tools read.
+    '''
+
+    # Define the profiling modes
+    STAGES = 'stages'
+    CPU = 'cpu'
+    MEMORY = 'memory'
+
+    MODES = (STAGES, CPU, MEMORY)
+
+
+    # The number of frames tracemalloc keeps of every allocation
+    TRACE_FRAMES = 32
+
+
+    def __init__(self, timer=None):
+        '''
+        Returns a new Profiler.
+        Arguments:
+            timer: The StageTimer to use, defaults to the one of the
+            process.
+        '''
+        self.generation = 0
+        self._stages = timer if timer is not None else STAGES
+        self._engine = None
+        self._lock = threading.Condition()
+        self._mode = None
+        self._running = False
+        self._started = None
+        self._elapsed = 0.0
+        self._profiles = dict()
+        self._results = dict()
+        self._snapshot = None
+
+
+    def mode(self):
+        '''
+        Gets the mode of the current or last run, None if there was none.
+        '''
+        return self._mode
+
+
+    def running(self):
+        '''
+        Gets whether a run is in progress.
+        '''
+        return self._running
+
+
+    def elapsed(self):
+        '''
+        Gets the length in seconds of the current or last run.
+        '''
+        if self._running:
+            return time.monotonic() - self._started
+        return self._elapsed
+
+
+    def attach(self):
+        '''
+        Enables or disables the cProfile run on the calling thread, as
+        the current run requires. Called by the threads of the pipeline.
+        Returns the generation the thread is now up to date with.
+        '''
+        import cProfile
+
+        with self._lock:
+            thread = threading.current_thread().name
+            profile = self._profiles.get(thread)
+            if self._running and self._mode == Profiler.CPU:
+                if profile is None:
+                    profile = self._profiles[thread] = cProfile.Profile()
+                    profile.enable()
+            elif profile is not None:
+                profile.disable()
+                self._results[thread] = self._profiles.pop(thread)
+                self._lock.notify_all()
+            return self.generation
+
+
+    def _attach_engine(self, engine):
+        if engine is not None and not engine.closed():
+            async def _attach():
+                self.attach()
+            engine.call(_attach())
+
+
+    def start(self, mode=STAGES, every=100, engine=None):
+        '''
+        Starts a run, discarding the results of the last one.
+        Arguments:
+            mode: One of MODES.
+            every: For the stages mode, only one in every this many
+            passes through the pipeline is timed.
+            engine: The Engine the Listeners run on, defaults to the
+            process-wide Engine.
+        Raises a ValueError if the mode is unknown or every is not
+        positive, and a RuntimeError if a run is in progress.
+        '''
+        if mode not in Profiler.MODES:
+            raise ValueError('Unknown profiling mode {}, expected one of {}!'.format(
+                mode, ', '.join(Profiler.MODES)))
+        if self._running:
+            raise RuntimeError('A {} profile is already running!'.format(self._mode))
+        self._engine = engine if engine else Engine.default()
+        if mode == Profiler.STAGES:
+            self._stages.start(every)
+        elif mode == Profiler.MEMORY:
+            import tracemalloc
+            tracemalloc.start(Profiler.TRACE_FRAMES)
+        with self._lock:
+            self._mode = mode
+            self._running = True
+            self._started = time.monotonic()
+            self._results = dict()
+            self._snapshot = None
+            self.generation += 1
+        if mode == Profiler.CPU:
+            self._attach_engine(self._engine)
+
+
+    def stop(self, timeout=2.0):
+        '''
+        Ends the current run, keeping its results.
+        Arguments:
+            timeout: The maximum time in seconds to wait for the
+            threads of a cProfile run to detach. Threads that do not
+            are left out of the results.
+        '''
+        if not self._running:
+            return
+        if self._mode == Profiler.STAGES:
+            self._stages.stop()
+        elif self._mode == Profiler.MEMORY:
+            import tracemalloc
+            self._snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        with self._lock:
+            self._running = False
+            self._elapsed = time.monotonic() - self._started
+            self.generation += 1
+        if self._mode == Profiler.CPU:
+            self._attach_engine(self._engine)
+            with self._lock:
+                self._lock.wait_for(lambda: not self._profiles, timeout)
+                # a thread that missed the run keeps its profile enabled
+                #   but is never read from again
+                self._profiles.clear()
+
+
+    def stacks(self, cpu_time=False):
+        '''
+        Gets the results of the last run, or so far of the current one
+        in the stages mode, as collapsed stacks.
+        Arguments:
+            cpu_time: For the stages mode, weigh the stages by their
+            CPU time rather than their wall time.
+        Returns a dict mapping each stack, as a tuple of frames
+        outermost first, to its weight: microseconds in the stages and
+        cpu modes (sampled stage times scaled up by the sampling), live
+        bytes in the memory mode.
+        '''
+        import pstats
+
+        if self._mode == Profiler.STAGES:
+            every = self._stages.every()
+            return {tuple(str(part).replace(';', ':') for part in stage):
+                (cpu if cpu_time else wall) * every * 1e6
+                for stage, (_, wall, cpu) in self._stages.timings().items()}
+        stacks = dict()
+        if self._mode == Profiler.CPU:
+            for thread, profile in self._results.items():
+                for stack, seconds in collapse_profile(pstats.Stats(profile), thread).items():
+                    stacks[stack] = seconds * 1e6
+        elif self._mode == Profiler.MEMORY and self._snapshot is not None:
+            stacks = collapse_snapshot(self._snapshot)
+        return stacks
+
+
+    def dump(self, filename, cpu_time=False):
+        '''
+        Writes the results of the last run to a collapsed stack file.
+        Arguments:
+            filename: The path of the file to write.
+            cpu_time: See stacks().
+        Returns the number of stacks written. Raises an OSError if the
+        file cannot be written.
+        '''
+        stacks = self.stacks(cpu_time)
+        lines = ['{} {}\n'.format(';'.join(stack), int(round(weight)))
+            for stack, weight in sorted(stacks.items()) if round(weight) > 0]
+        with open(filename + '.tmp', 'w') as f:
+            f.writelines(lines)
+        os.replace(filename + '.tmp', filename)
+        return len(lines)
+
+
+# The profiler of this process
+PROFILER = Profiler()
@@ -0,0 +1,301 @@
+import collections, os, socketserver, threading, time
+from array import array
+from urllib.parse import parse_qs, urlsplit
+
+import simplejson
+
+from sensclient.decoding import load_numpy
+
+
+# The typecodes of the arrays of unsigned integers that fit in a ring
+NARROW_TYPECODES = tuple(typecode for typecode in 'BHIL' if array(typecode).itemsize <= 4)
+
+
+class _Ring:
+    '''
+    Holds the recent messages of one mote in fixed-size arrays: one set
+    of arrays indexed by message and one ring of all their readings,
+    kept as unsigned 32-bit integers. Messages and readings are
+    numbered from the first ever written, a message is still held if
+    neither its slot nor any of its readings have been overwritten
+    since.
+    '''
+
+    __slots__ = ('ts', 'counts', 'starts', 'lengths', 'values', 'view', 'messages', 'written', 'last')
+
+    def __init__(self, messages, values):
+        self.ts = array('d', bytes(8 * messages))
+        self.counts = array('I', bytes(4 * messages))
+        self.starts = array('Q', bytes(8 * messages))
+        self.lengths = array('I', bytes(4 * messages))
+        self.values = array('I', bytes(4 * values))
+        # a NumPy view onto values, which widens and byteswaps readings
+        #   as they are copied in
+        np = load_numpy()
+        self.view = np.frombuffer(self.values, dtype=np.dtype('=u{}'.format(self.values.itemsize))) \
+            if np is not None else None
+        self.messages = 0
+        self.written = 0
+        self.last = 0.0
+
+
+    def _copyable(self, readings):
+        '''
+        Gets whether readings can be copied into the ring as they are:
+        arrays of the ring's own type, and with NumPy any array of
+        unsigned integers that fit, which the view widens and
+        byteswaps. Anything else is converted first.
+        '''
+        typecode = getattr(readings, 'typecode', None)
+        if typecode == self.values.typecode:
+            return True
+        if self.view is None:
+            return False
+        dtype = getattr(readings, 'dtype', None)
+        return typecode in NARROW_TYPECODES or \
+            (dtype is not None and dtype.kind == 'u' and dtype.itemsize <= self.values.itemsize)
+
+
+    def append(self, ts, count, readings):
+        capacity = len(self.values)
+        if not self._copyable(readings):
+            readings = array(self.values.typecode, readings)
+        # with the view exporting values, even an empty slice assignment
+        #   to values itself fails, so copies go through the view
+        target = self.view if self.view is not None else self.values
+        n = len(readings)
+        if n > capacity:
+            readings = readings[n - capacity:]
+            n = capacity
+        slot = self.messages % len(self.ts)
+        self.ts[slot] = ts
+        self.counts[slot] = count
+        self.starts[slot] = self.written
+        self.lengths[slot] = n
+        pos = self.written % capacity
+        if pos + n <= capacity:
+            target[pos:pos+n] = readings
+        else:
+            head = capacity - pos
+            target[pos:] = readings[:head]
+            target[:n-head] = readings[head:]
+        self.written += n
+        self.messages += 1
+        self.last = ts
+
+
+    def read(self, since, limit):
+        '''
+        Yields the held messages, newest first, as (ts, count, readings)
+        tuples.
+        '''
+        capacity = len(self.values)
+        oldest = self.written - capacity
+        for i in range(self.messages - 1, max(self.messages - len(self.ts), 0) - 1, -1):
+            if limit <= 0:
+                return
+            slot = i % len(self.ts)
+            ts = self.ts[slot]
+            if ts < since or self.starts[slot] < oldest:
+                return
+            pos = self.starts[slot] % capacity
+            n = self.lengths[slot]
+            values = self.values[pos:pos+n]
+            if len(values) < n:
+                values += self.values[:n-len(values)]
+            limit -= 1
+            yield ts, self.counts[slot], values
+
+
+class RecentReadings:
+    '''
+    Defines an in-memory cache of the most recent readings of every
+    mote, for local queries that need not go through the server.
+
+    Each mote heard on each device gets a ring of the last messages
+    messages it sent and of their last values readings, whichever runs
+    out first, kept in typed arrays that are allocated once: no Python
+    object is kept per reading and the memory used is fixed by the
+    configuration. When more than motes motes have been heard, the
+    one heard from least recently is evicted, and messages older than
+    max_age seconds are never returned.
+    '''
+
+    def __init__(self, messages=128, values=2048, motes=256, max_age=None):
+        '''
+        Returns a new RecentReadings cache.
+        Arguments:
+            messages: The number of messages held per mote.
+            values: The number of readings held per mote.
+            motes: The maximum number of motes held.
+            max_age: The age in seconds past which messages are
+            expired, None keeps them until they are overwritten.
+        Raises a ValueError if a limit is not positive.
+        '''
+        if messages <= 0 or values <= 0 or motes <= 0 or (max_age is not None and max_age <= 0):
+            raise ValueError('The limits of the recent readings cache must be positive!')
+        self._messages = int(messages)
+        self._values = int(values)
+        self._motes = int(motes)
+        self._max_age = float(max_age) if max_age is not None else None
+        # the rings in the order their motes were last heard from
+        self._rings = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def add(self, device, event, ts=None):
+        '''
+        Caches the readings of a message. Messages without an id and
+        readings are ignored.
+        Arguments:
+            device: The device the message came in on.
+            event: The decoded message.
+            ts: The time the message was received, defaults to now.
+        '''
+        try:
+            key, count, readings = (device, event.id), getattr(event, 'count', 0), event.readings
+        except AttributeError:
+            return
+        ts = ts if ts is not None else time.time()
+        with self._lock:
+            ring = self._rings.get(key)
+            if ring is None:
+                if len(self._rings) >= self._motes:
+                    self._rings.popitem(last=False)
+                ring = self._rings[key] = _Ring(self._messages, self._values)
+            else:
+                self._rings.move_to_end(key)
+            try:
+                ring.append(ts, count, readings)
+            except (OverflowError, TypeError):
+                pass
+
+
+    def query(self, device=None, mote=None, last=None, since=None):
+        '''
+        Gets the cached messages of the motes that match.
+        Arguments:
+            device: Only the messages received on this device.
+            mote: Only the messages of the mote with this id.
+            last: At most this many of the newest messages.
+            since: Only the messages received in the last since
+            seconds.
+        Returns the messages as dicts with the device, id, ts, count
+        and readings of each, oldest first.
+        '''
+        now = time.time()
+        cutoff = now - since if since is not None else 0.0
+        if self._max_age is not None:
+            cutoff = max(cutoff, now - self._max_age)
+        limit = int(last) if last is not None else self._messages
+        results = []
+        with self._lock:
+            for (name, ident), ring in self._rings.items():
+                if (device is not None and name != device) or (mote is not None and ident != mote):
+                    continue
+                for ts, count, values in ring.read(cutoff, limit):
+                    results.append({'device': name, 'id': ident, 'ts': ts, 'count': count,
+                        'readings': values.tolist()})
+        results.sort(key=lambda reading: reading['ts'])
+        return results[-limit:] if last is not None else results
+
+
+    def motes(self):
+        '''
+        Gets the (device, mote id) pairs held, with the time each was
+        last heard from.
+        '''
+        with self._lock:
+            return {key: ring.last for key, ring in self._rings.items()}
+
+
+    def memory(self):
+        '''
+        Gets the number of bytes the cache takes up once every mote's
+        ring is allocated.
+        '''
+        return self._motes * (self._messages * 24 + self._values * 4)
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class RecentServer:
+    '''
+    Defines a small HTTP server answering queries on the recent readings
+    cache at /recent, over TCP or a Unix socket. The query string takes
+    the device, mote, last and since arguments of RecentReadings.query().
+    It runs in its own thread, like the MetricsServer.
+    '''
+
+    def __init__(self, cache, host='127.0.0.1', port=None, socket=None):
+        '''
+        Starts serving the cache.
+        Arguments:
+            cache: The RecentReadings to serve.
+            host: The address to bind to.
+            port: The port to listen on.
+            socket: The path of a Unix socket to listen on instead of a
+            port.
+        '''
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if url.path != '/recent':
+                    self.send_error(404)
+                    return
+                args = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                try:
+                    readings = cache.query(args.get('device'),
+                        int(args['mote'], 0) if 'mote' in args else None,
+                        int(args['last']) if 'last' in args else None,
+                        float(args['since']) if 'since' in args else None)
+                except ValueError:
+                    self.send_error(400, 'Invalid query')
+                    return
+                body = simplejson.dumps({'readings': readings}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def address_string(self):
+                return self.client_address[0] if self.client_address else 'local'
+
+            def log_message(self, format, *args):
+                pass
+
+        self._socket = socket
+        if socket is not None:
+            if os.path.exists(socket):
+                os.unlink(socket)
+            self._server = _UnixHTTPServer(socket, Handler)
+        else:
+            self._server = ThreadingHTTPServer((host, int(port)), Handler)
+            self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever,
+            name='sensclient-recent', daemon=True)
+        self._thread.start()
+
+
+    def address(self):
+        '''
+        Gets the URL the server answers at.
+        '''
+        if self._socket is not None:
+            return 'unix:{}'.format(self._socket)
+        return 'http://{}:{}'.format(*self._server.server_address[:2])
+
+
+    def close(self):
+        '''
+        Stops the server.
+        '''
+        self._server.shutdown()
+        self._server.server_close()
+        if self._socket is not None and os.path.exists(self._socket):
+            os.unlink(self._socket)
@@ -0,0 +1,160 @@
+import array
+
+
+class SequenceTracker:
+    '''
+    Defines a tracker of the sequence numbers (the count field) of the
+    messages received from each mote on one device, from which radio
+    and serial losses can be told apart from drops inside the client.
+
+    Every mote gets a slot in a set of parallel arrays, so updates are
+    O(1) and cost no Python objects per mote. Next to the highest count
+    seen, a slot keeps a bitmap of which of the window counts below it
+    were received, which is enough to classify every message:
+        in order: the count is the next one expected.
+        gap: counts were skipped, they are counted as lost.
+        reordered: a count that had been skipped arrives late, it is
+        no longer counted as lost.
+        duplicate: a count that was already received.
+        reset: the count went back by more than the window, as when a
+        mote reboots; tracking starts over from it.
+    Counts from before the first one seen from a mote, or before a
+    reset, cannot be told apart from duplicates and are counted as such.
+    Counts wrap around at 2^bits, a count wrapping back to 0 is just
+    the next one expected.
+    '''
+
+    # The outcomes of observe()
+    IN_ORDER = 0
+    GAP = 1
+    REORDERED = 2
+    DUPLICATE = 3
+    RESET = 4
+    FIRST = 5
+
+    # The counters kept per mote, in the order of their arrays
+    COUNTERS = ('received', 'lost', 'duplicates', 'reordered', 'resets', 'wraps')
+
+
+    def __init__(self, bits=16, window=64):
+        '''
+        Returns a new SequenceTracker.
+        Arguments:
+            bits: The width of the count field.
+            window: How far back, in counts, late messages are still
+            recognized as reordered or duplicate, at most 64.
+        Raises a ValueError if the window is out of range.
+        '''
+        if not 1 <= window <= 64:
+            raise ValueError('Invalid sequence window {}, expected 1-64!'.format(window))
+        self._modulus = 1 << int(bits)
+        self._half = self._modulus >> 1
+        self._window = int(window)
+        self._mask = (1 << self._window) - 1
+        # maps a mote id to its slot in the arrays
+        self._slots = dict()
+        self._last = array.array('L')
+        self._seen = array.array('Q')
+        self._counters = [array.array('Q') for _ in SequenceTracker.COUNTERS]
+        (self._received, self._lost, self._duplicates,
+            self._reordered, self._resets, self._wraps) = self._counters
+
+
+    def observe(self, mote, count):
+        '''
+        Records a message.
+        Arguments:
+            mote: The id of the mote that sent the message.
+            count: The message's sequence number.
+        Returns one of the outcomes above.
+        '''
+        slot = self._slots.get(mote)
+        if slot is None:
+            slot = self._slots[mote] = len(self._last)
+            self._last.append(count % self._modulus)
+            self._seen.append(self._mask)
+            for counter in self._counters:
+                counter.append(0)
+            self._received[slot] = 1
+            return SequenceTracker.FIRST
+        last = self._last[slot]
+        delta = (count - last) % self._modulus
+        if delta == 0:
+            self._duplicates[slot] += 1
+            return SequenceTracker.DUPLICATE
+        if delta < self._half:
+            # ahead of the highest count seen
+            self._received[slot] += 1
+            self._last[slot] = count % self._modulus
+            if count % self._modulus < last:
+                self._wraps[slot] += 1
+            self._seen[slot] = ((self._seen[slot] << delta) | 1) & self._mask if delta < 64 else 1
+            if delta == 1:
+                return SequenceTracker.IN_ORDER
+            self._lost[slot] += delta - 1
+            return SequenceTracker.GAP
+        behind = self._modulus - delta
+        if behind < self._window:
+            bit = 1 << behind
+            if self._seen[slot] & bit:
+                self._duplicates[slot] += 1
+                return SequenceTracker.DUPLICATE
+            self._seen[slot] |= bit
+            self._received[slot] += 1
+            self._reordered[slot] += 1
+            self._lost[slot] -= 1
+            return SequenceTracker.REORDERED
+        # too far back to be late, the mote started over
+        self._received[slot] += 1
+        self._resets[slot] += 1
+        self._last[slot] = count % self._modulus
+        self._seen[slot] = self._mask
+        return SequenceTracker.RESET
+
+
+    #
+    # ACCESSOR METHODS
+    #
+
+    def motes(self):
+        '''
+        Gets the ids of the motes seen, in the order they were first
+        seen.
+        '''
+        return list(self._slots)
+
+
+    def mote(self, mote):
+        '''
+        Gets the counters of one mote as a dict, or None if the mote
+        has not been seen.
+        Arguments:
+            mote: The id of the mote.
+        '''
+        slot = self._slots.get(mote)
+        if slot is None:
+            return None
+        stats = {name: counter[slot] for name, counter in zip(SequenceTracker.COUNTERS, self._counters)}
+        stats['last'] = self._last[slot]
+        return stats
+
+
+    def totals(self):
+        '''
+        Gets the counters summed over every mote, plus the number of
+        motes seen.
+        '''
+        stats = {name: sum(counter) for name, counter in zip(SequenceTracker.COUNTERS, self._counters)}
+        stats['motes'] = len(self._slots)
+        return stats
+
+
+def loss_rate(stats):
+    '''
+    Computes the fraction of the messages sent that never arrived.
+    Arguments:
+        stats: The counters of a mote or a device.
+    Returns None if no message was expected yet.
+    '''
+    expected = stats['received'] + stats['lost']
+    return stats['lost'] / expected if expected else None
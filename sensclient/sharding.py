@@ -0,0 +1,455 @@
+import functools, multiprocessing, struct, threading, zlib
+
+from sensclient.decoding import DECODERS, DecoderRegistry, MessageLayout
+from sensclient.listener import Listener
+
+
+# Every block of packed columns sent back from a worker is prefixed by
+#   the slot of its device, the AM type of its messages and its length
+_RECORD = struct.Struct('<HBI')
+
+# The number of slots devices are numbered with in batches
+SLOTS = 0x10000
+
+
+#
+# WORKER PROCESS
+#
+
+class _Batcher:
+    '''
+    Collects the messages decoded by a worker's Listeners as packed
+    columns, one ColumnWriter per device and AM type, and ships them
+    to the parent with a single send_bytes() call, rather than pickling
+    every message. Messages keep their order within a device and AM
+    type.
+    '''
+
+    def __init__(self, conn, engine, batch_bytes, flush_interval):
+        self._conn = conn
+        self._engine = engine
+        self._batch_bytes = batch_bytes
+        self._flush_interval = flush_interval
+        self._writers = dict()
+        self._bytes = 0
+        self._timer = None
+        # the layout of every AM type of every slot
+        self.layouts = dict()
+
+
+    def add(self, slot, amtype, msg):
+        writer = self._writers.get((slot, amtype))
+        if writer is None:
+            writer = self._writers[(slot, amtype)] = self.layouts[slot][amtype].writer()
+        self._bytes += writer.append(msg)
+        if self._bytes >= self._batch_bytes:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self._engine.loop().call_later(self._flush_interval, self.flush)
+
+
+    def drop(self, slot):
+        # a stopped device's slot may be handed out again
+        self.layouts.pop(slot, None)
+        for key in [key for key in self._writers if key[0] == slot]:
+            del self._writers[key]
+
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._writers:
+            buffer = bytearray()
+            for (slot, amtype), writer in self._writers.items():
+                columns = writer.pack()
+                buffer += _RECORD.pack(slot, amtype, len(columns))
+                buffer += columns
+            self._writers = dict()
+            self._bytes = 0
+            try:
+                self._conn.send_bytes(buffer)
+            except (OSError, EOFError):
+                pass
+
+
+def _tag(amtype, decode, payload):
+    return amtype, decode(payload)
+
+
+def _worker_main(control, data, batch_bytes, flush_interval):
+    '''
+    Defines the body of a worker process. Runs its own Engine with the
+    Listeners of the devices assigned to it, and serves control
+    requests from the parent until told to exit.
+    '''
+    from sensclient.engine import Engine
+
+    engine = Engine()
+    batcher = _Batcher(data, engine, batch_bytes, flush_interval)
+    listeners = dict()
+    slots = dict()
+
+    def make_callback(slot):
+        return lambda device, tagged: batcher.add(slot, *tagged)
+
+    def make_registry(layouts):
+        # messages are decoded here and tagged with their AM type, so
+        #   the batcher knows which columns they go in
+        registry = DecoderRegistry()
+        for amtype, layout in layouts.items():
+            registry.register(amtype, layout.name, functools.partial(_tag, amtype, layout.decode))
+        return registry
+
+    while True:
+        try:
+            request = control.recv()
+        except (EOFError, OSError):
+            break
+        op, device = request[0], request[1] if len(request) > 1 else None
+        try:
+            if op == 'exit':
+                break
+            elif op == 'add':
+                _, device, slot, baudrate, decoders = request
+                layouts = {amtype: MessageLayout(name, fields) for amtype, name, fields in decoders}
+                batcher.layouts[slot] = layouts
+                listener = Listener(make_callback(slot), device, baudrate, sorted(layouts),
+                    engine=engine, registry=make_registry(layouts))
+                listener.start()
+                listeners[device] = listener
+                slots[device] = slot
+            elif op == 'resume':
+                listeners[device].resume()
+            elif op == 'pause':
+                listeners[device].pause()
+            elif op == 'stop':
+                listeners.pop(device).stop()
+                engine.call_soon(batcher.drop, slots.pop(device))
+            elif op == 'stats':
+                control.send(('ok', listeners[device].stats()))
+                continue
+            else:
+                raise ValueError('Unknown request {}!'.format(op))
+            state = listeners[device].state() if device in listeners else Listener.STOPPED
+            control.send(('ok', state))
+        except Exception as e:
+            control.send(('error', '{}: {}'.format(type(e).__name__, e)))
+
+    for listener in listeners.values():
+        listener.stop()
+    engine.call_soon(batcher.flush)
+    engine.close()
+    control.close()
+    data.close()
+
+
+#
+# PARENT PROCESS
+#
+
+class _Worker:
+    '''
+    Defines the parent's handle on one worker process.
+    '''
+
+    def __init__(self, index, context, callback, batch_bytes, flush_interval):
+        self.index = index
+        self.devices = dict()
+        # the layout of every AM type of every slot
+        self.layouts = dict()
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._control, child_control = context.Pipe()
+        data, child_data = context.Pipe(duplex=False)
+        self._process = context.Process(
+            target=_worker_main,
+            args=(child_control, child_data, batch_bytes, flush_interval),
+            name='sensclient-shard-{}'.format(index),
+            daemon=True
+        )
+        self._process.start()
+        child_control.close()
+        child_data.close()
+        self._receiver = threading.Thread(
+            target=self._receive, args=(data,),
+            name='sensclient-shard-{}-receiver'.format(index), daemon=True)
+        self._receiver.start()
+
+
+    def request(self, *request):
+        '''
+        Sends a control request to the worker and waits for its reply.
+        Raises a RuntimeError if the worker reports a failure.
+        '''
+        with self._lock:
+            self._control.send(request)
+            status, result = self._control.recv()
+        if status != 'ok':
+            raise RuntimeError(result)
+        return result
+
+
+    def _receive(self, data):
+        while True:
+            try:
+                buf = data.recv_bytes()
+            except (EOFError, OSError):
+                break
+            view = memoryview(buf)
+            pos = 0
+            while pos < len(buf):
+                slot, amtype, length = _RECORD.unpack_from(buf, pos)
+                pos += _RECORD.size
+                device = self.devices.get(slot)
+                layout = self.layouts.get(slot, dict()).get(amtype)
+                columns = view[pos:pos+length]
+                pos += length
+                if device is None or layout is None:
+                    continue
+                for msg in layout.read_columns(columns):
+                    self._callback(device, msg)
+
+
+    def close(self, timeout=5):
+        try:
+            with self._lock:
+                self._control.send(('exit',))
+        except (OSError, EOFError):
+            pass
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._receiver.join(timeout)
+
+
+class ShardedListener:
+    '''
+    Defines the parent side stand-in for a Listener that runs in one of
+    a ShardPool's worker processes. Offers the same accessor and
+    control methods as a Listener, so the shell can manage it the same
+    way.
+    '''
+
+    def __init__(self, worker, slot, device, baudrate, amrate, layouts):
+        self._worker = worker
+        self._layouts = layouts
+        self._slot = slot
+        self._device = device
+        self._baudrate = baudrate
+        self._amrate = amrate
+        self._state = Listener.PAUSED
+        # claim the slot now so least-loaded assignment sees the device
+        worker.devices[slot] = device
+        worker.layouts[slot] = layouts
+
+
+    def amrate(self):
+        '''
+        Gets the AM rate the Listener reports messages for.
+        '''
+        return self._amrate
+
+
+    def baudrate(self):
+        '''
+        Gets the physical sampling rate of the device.
+        '''
+        return self._baudrate
+
+
+    def device(self):
+        '''
+        Gets the physical address of the device being listened to.
+        '''
+        return self._device
+
+
+    def samplerate(self):
+        '''
+        Gets the software sampling rate of the device, same as the AM rate.
+        '''
+        return self._amrate
+
+
+    def state(self):
+        '''
+        Gets the state that the Listener is in.
+        '''
+        return self._state
+
+
+    def state_as_str(self):
+        return {Listener.RUNNING: 'RUNNING', Listener.PAUSED: 'PAUSED',
+            Listener.STOPPED: 'STOPPED'}.get(self._state, 'NULL')
+
+
+    def is_alive(self):
+        '''
+        Gets whether the Listener has not yet been stopped.
+        '''
+        return self._state != Listener.STOPPED
+
+
+    def shard(self):
+        '''
+        Gets the index of the worker process running the Listener.
+        '''
+        return self._worker.index
+
+
+    def stats(self):
+        '''
+        Gets the framing counters of the Listener's serial link.
+        '''
+        return self._worker.request('stats', self._device)
+
+
+    def start(self):
+        '''
+        Opens the device in the worker. The Listener remains PAUSED until
+        resumed.
+        '''
+        decoders = [(amtype, layout.name, layout.fields) for amtype, layout in self._layouts.items()]
+        try:
+            self._state = self._worker.request(
+                'add', self._device, self._slot, self._baudrate, decoders)
+        except RuntimeError:
+            self._release()
+            raise
+
+
+    def _release(self):
+        self._worker.devices.pop(self._slot, None)
+        self._worker.layouts.pop(self._slot, None)
+
+
+    def resume(self):
+        '''
+        Resumes data collection in the worker.
+        '''
+        if self._state == Listener.PAUSED:
+            self._state = self._worker.request('resume', self._device)
+
+
+    def pause(self):
+        '''
+        Pauses data collection in the worker.
+        '''
+        if self._state == Listener.RUNNING:
+            self._state = self._worker.request('pause', self._device)
+
+
+    def stop(self):
+        '''
+        Stops the Listener in the worker, closing the device.
+        '''
+        if self._state != Listener.STOPPED:
+            try:
+                self._worker.request('stop', self._device)
+            finally:
+                self._state = Listener.STOPPED
+                self._release()
+
+
+class ShardPool:
+    '''
+    Defines a pool of worker processes that share out the client's
+    Listeners, so that reading and framing for many devices is spread
+    over several cores instead of contending for one GIL.
+
+    Each worker runs its own Engine and decodes its messages itself.
+    The decoded messages flow back to the parent in batches of packed
+    columns, one send_bytes() per batch, where they are rebuilt and
+    handed to the callback on a receiver thread per worker. Only
+    decoders compiled from a MessageLayout can run in a worker. The shell keeps managing every device through the
+    ShardedListener handles returned by listener().
+
+    Devices are assigned to workers either by hashing the device's
+    address (stable across restarts) or to the worker with the fewest
+    devices.
+    '''
+
+    # Define the assignment policies
+    HASH = 'hash'
+    LEAST_LOADED = 'least-loaded'
+
+    POLICIES = (HASH, LEAST_LOADED)
+
+
+    def __init__(self, callback, workers=2, policy=HASH, batch_bytes=64*1024, flush_interval=0.05,
+            registry=None):
+        '''
+        Starts a new pool of worker processes.
+        Arguments:
+            callback: The callback to execute when an event is
+            received, called with the device and the message from a
+            receiver thread.
+            workers: The number of worker processes.
+            policy: One of POLICIES, how devices are assigned.
+            batch_bytes: The size at which a worker sends its batch.
+            flush_interval: The maximum time in seconds a message waits
+            in a worker before its batch is sent.
+            registry: The DecoderRegistry to look the decoders of AM
+            types up in, defaults to DECODERS.
+        Raises a ValueError if the policy is not known.
+        '''
+        if policy not in ShardPool.POLICIES:
+            raise ValueError('Unknown sharding policy {}, expected one of {}!'.format(
+                policy, ', '.join(ShardPool.POLICIES)))
+        self._policy = policy
+        self._registry = registry if registry is not None else DECODERS
+        self._next_slot = 0
+        # listeners may be created from several threads at once
+        self._lock = threading.Lock()
+        context = multiprocessing.get_context('spawn')
+        self._workers = [
+            _Worker(i, context, callback, int(batch_bytes), float(flush_interval))
+            for i in range(max(1, int(workers)))
+        ]
+
+
+    def _assign(self, device):
+        if self._policy == ShardPool.HASH:
+            return self._workers[zlib.crc32(device.encode('utf-8')) % len(self._workers)]
+        return min(self._workers, key=lambda worker: len(worker.devices))
+
+
+    def listener(self, device, baudrate, amrate='OSCILLOSCOPE'):
+        '''
+        Creates a Listener for a device in one of the workers.
+        Arguments:
+            device: The physical address of the device.
+            baudrate: The sampling rate of the physical device.
+            amrate: The AM rate of the messages to report.
+        Returns the ShardedListener standing in for it; call start()
+        on it to open the device. Raises a ValueError if an AM type has
+        no decoder or one that cannot run in a worker, and a
+        RuntimeError if every slot is taken.
+        '''
+        amtypes = self._registry.select(amrate)
+        # fail now, rather than in the worker, if a type has no decoder
+        table = self._registry.table(amtypes)
+        layouts = dict()
+        for amtype in amtypes:
+            layout = getattr(table[amtype], '__self__', None)
+            if not isinstance(layout, MessageLayout):
+                raise ValueError('The decoder of AM type {:#04x} is not a message layout and cannot '
+                    'run in a worker process!'.format(amtype))
+            layouts[amtype] = layout
+        with self._lock:
+            worker = self._assign(device)
+            # skip the slots of devices that are still running
+            for _ in range(SLOTS):
+                self._next_slot = (self._next_slot + 1) % SLOTS
+                if self._next_slot not in worker.devices:
+                    return ShardedListener(worker, self._next_slot, device, baudrate, amrate, layouts)
+        raise RuntimeError('Cannot add device {}, its worker has no free slot!'.format(device))
+
+
+    def close(self):
+        '''
+        Stops every worker process.
+        '''
+        for worker in self._workers:
+            worker.close()
@@ -0,0 +1,341 @@
+import os, struct, threading, time, zlib
+
+from sensclient.configuration import DEFAULT_SPOOL_PATH
+
+
+# Every record is prefixed by its length and the CRC32 of its payload
+_HEADER = struct.Struct('<II')
+
+# Segment files are named after the spool offset of their first byte
+_SEGMENT_SUFFIX = '.seg'
+_CURSOR_FILE = 'cursor'
+
+
+class Spool:
+    '''
+    Defines a crash-safe, disk-backed store-and-forward queue that sits
+    between the Listeners and the Uploader.
+
+    The spool is an append-only log split over segment files kept in a
+    single directory. Each segment is named after the offset of its
+    first byte in the logical spool, so the spool as a whole is one
+    ever growing byte stream. Records are length and CRC32 prefixed.
+    A separate cursor file records the offset up to which records have
+    been delivered; it is replaced atomically on every commit.
+
+    Writes are buffered and only fsync'd once fsync_records records
+    have been appended or fsync_interval seconds have passed, so
+    durability is paid for once per group of records rather than once
+    per packet. On open, a torn record at the tail of the last segment
+    (from a crash mid-write) is truncated away.
+
+    When the spool grows beyond max_bytes, whole segments are dropped
+    from the front, oldest first, so the spool never fills the disk.
+
+    All methods are thread-safe.
+    '''
+
+    def __init__(self, path=DEFAULT_SPOOL_PATH, max_bytes=64*1024*1024,
+            segment_bytes=4*1024*1024, fsync_records=256, fsync_interval=1.0):
+        '''
+        Opens (creating if needed) the spool in the given directory.
+        Arguments:
+            path: The directory holding the spool's files.
+            max_bytes: The maximum size of the spool on disk.
+            segment_bytes: The size at which a segment is sealed and a
+            new one started.
+            fsync_records: The number of appended records after which
+            the spool is fsync'd.
+            fsync_interval: The maximum time in seconds appended
+            records may go without being fsync'd.
+        '''
+        self._path = path
+        self._max_bytes = int(max_bytes)
+        self._segment_bytes = min(int(segment_bytes), self._max_bytes)
+        self._fsync_records = int(fsync_records)
+        self._fsync_interval = float(fsync_interval)
+
+        self._lock = threading.Lock()
+        self._writer = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._dropped = 0
+
+        os.makedirs(path, exist_ok=True)
+        self._segments = sorted(
+            int(name[:-len(_SEGMENT_SUFFIX)])
+            for name in os.listdir(path) if name.endswith(_SEGMENT_SUFFIX)
+        )
+        self._cursor = self._read_cursor()
+        if self._segments:
+            self._recover()
+        else:
+            self._segments.append(self._cursor)
+        last = self._segment_path(self._segments[-1])
+        self._end = self._segments[-1] + (os.path.getsize(last) if os.path.exists(last) else 0)
+        if self._cursor < self._segments[0] or self._cursor > self._end:
+            self._cursor = self._segments[0]
+        self._backlog = self._count(self._cursor, self._end)
+        self._writer = open(self._segment_path(self._segments[-1]), 'ab')
+
+
+    def _segment_path(self, base):
+        return os.path.join(self._path, '{:020d}{}'.format(base, _SEGMENT_SUFFIX))
+
+
+    def _read_cursor(self):
+        try:
+            with open(os.path.join(self._path, _CURSOR_FILE), 'r') as fp:
+                return int(fp.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+
+    def _write_cursor(self):
+        tmp = os.path.join(self._path, _CURSOR_FILE + '.tmp')
+        with open(tmp, 'w') as fp:
+            fp.write(str(self._cursor))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, os.path.join(self._path, _CURSOR_FILE))
+
+
+    def _scan(self, data):
+        '''
+        Walks the records in a buffer. Returns the list of payloads
+        (as memoryviews into data) and the number of bytes they used.
+        Stops at the first incomplete or corrupt record.
+        '''
+        view = memoryview(data)
+        records = []
+        pos = 0
+        while pos + _HEADER.size <= len(data):
+            length, crc = _HEADER.unpack_from(data, pos)
+            end = pos + _HEADER.size + length
+            if end > len(data):
+                break
+            payload = view[pos+_HEADER.size:end]
+            if zlib.crc32(payload) != crc:
+                break
+            records.append(payload)
+            pos = end
+        return records, pos
+
+
+    def _recover(self):
+        # truncate a torn write at the tail of the newest segment
+        last = self._segment_path(self._segments[-1])
+        with open(last, 'rb') as fp:
+            data = fp.read()
+        _, good = self._scan(data)
+        if good < len(data):
+            with open(last, 'r+b') as fp:
+                fp.truncate(good)
+                os.fsync(fp.fileno())
+
+
+    def _count(self, start, end, chunk=1024*1024):
+        count = 0
+        while start < end:
+            records, used = self._read_at(start, chunk)
+            if used == 0:
+                break
+            count += len(records)
+            start += used
+        return count
+
+
+    def _locate(self, offset):
+        for i in range(len(self._segments) - 1, -1, -1):
+            if self._segments[i] <= offset:
+                return i
+        return 0
+
+
+    def _read_at(self, offset, max_bytes):
+        '''
+        Reads whole records starting at an offset, never crossing a
+        segment boundary. Returns the records and the bytes consumed,
+        where the bytes consumed skip to the next segment when the
+        current one is exhausted.
+        '''
+        i = self._locate(offset)
+        base = self._segments[i]
+        with open(self._segment_path(base), 'rb') as fp:
+            fp.seek(offset - base)
+            data = fp.read(max_bytes)
+        records, used = self._scan(data)
+        if used == 0 and len(data) < max_bytes and i + 1 < len(self._segments):
+            # nothing left in a sealed segment, move on to the next
+            return [], self._segments[i+1] - offset
+        if used == 0 and len(data) >= _HEADER.size:
+            length, _ = _HEADER.unpack_from(data, 0)
+            if _HEADER.size + length > max_bytes:
+                return self._read_at(offset, _HEADER.size + length)
+        return records, used
+
+
+    def _roll(self):
+        self._sync()
+        self._writer.close()
+        self._segments.append(self._end)
+        self._writer = open(self._segment_path(self._end), 'ab')
+
+
+    def _enforce_cap(self):
+        while len(self._segments) > 1 and self._end - self._segments[0] > self._max_bytes:
+            base, following = self._segments[0], self._segments[1]
+            if self._cursor < following:
+                # undelivered records are about to go, account for them
+                lost = self._count(self._cursor, following)
+                self._dropped += lost
+                self._backlog = max(0, self._backlog - lost)
+                self._cursor = following
+                self._write_cursor()
+            self._segments.pop(0)
+            os.remove(self._segment_path(base))
+
+
+    def _sync(self):
+        if self._unsynced:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+            self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+
+    #
+    # ACCESSOR METHODS
+    #
+
+    def backlog(self):
+        '''
+        Gets the number of records appended but not yet committed.
+        '''
+        return self._backlog
+
+
+    def cursor(self):
+        '''
+        Gets the offset of the oldest record not yet committed, which
+        read() reads from by default.
+        '''
+        return self._cursor
+
+
+    def size(self):
+        '''
+        Gets the number of bytes the spool holds on disk.
+        '''
+        return self._end - self._segments[0]
+
+
+    def stats(self):
+        '''
+        Gets a dict of counters describing the spool.
+        '''
+        return {
+            'backlog': self._backlog,
+            'bytes': self._end - self._cursor,
+            'segments': len(self._segments),
+            'dropped': self._dropped
+        }
+
+
+    def sync_due(self):
+        '''
+        Gets whether appended records are waiting to be fsync'd and the
+        fsync interval has elapsed.
+        '''
+        return self._unsynced > 0 and \
+            time.monotonic() - self._last_sync >= self._fsync_interval
+
+
+    #
+    # CONTROL METHODS
+    #
+
+    def append(self, payload):
+        '''
+        Appends a record to the spool.
+        Arguments:
+            payload: The record, as bytes.
+        '''
+        with self._lock:
+            self._writer.write(_HEADER.pack(len(payload), zlib.crc32(payload)))
+            self._writer.write(payload)
+            self._end += _HEADER.size + len(payload)
+            self._backlog += 1
+            self._unsynced += 1
+            if self._unsynced >= self._fsync_records:
+                self._sync()
+            if self._end - self._segments[-1] >= self._segment_bytes:
+                self._roll()
+                self._enforce_cap()
+
+
+    def sync(self):
+        '''
+        Forces every appended record to disk.
+        '''
+        with self._lock:
+            self._sync()
+
+
+    def read(self, max_records, max_bytes=1024*1024, offset=None):
+        '''
+        Reads the oldest uncommitted records in large sequential reads.
+        Reading does not consume records, call commit() with the
+        returned offset once they have been delivered.
+        Arguments:
+            max_records: The maximum number of records to return.
+            max_bytes: The read size used against the segment files.
+            offset: The offset to read from, an offset returned by an
+            earlier read() to read ahead of the records not committed
+            yet. Defaults to the oldest uncommitted record.
+        Returns a list of payloads and the offset to commit.
+        '''
+        with self._lock:
+            self._writer.flush()
+            offset = self._cursor if offset is None else max(offset, self._cursor)
+            end = self._end
+            payloads = []
+            while offset < end and len(payloads) < max_records:
+                records, used = self._read_at(offset, max_bytes)
+                if used == 0:
+                    break
+                if len(payloads) + len(records) > max_records:
+                    records = records[:max_records - len(payloads)]
+                    used = sum(_HEADER.size + len(r) for r in records)
+                payloads.extend(bytes(r) for r in records)
+                offset += used
+            return payloads, offset
+
+
+    def commit(self, offset, count):
+        '''
+        Marks every record before an offset as delivered and deletes
+        segments that no longer hold undelivered records.
+        Arguments:
+            offset: The offset returned by read().
+            count: The number of records being committed.
+        '''
+        with self._lock:
+            if offset <= self._cursor:
+                return
+            self._cursor = offset
+            self._backlog = max(0, self._backlog - count)
+            self._write_cursor()
+            while len(self._segments) > 1 and self._segments[1] <= self._cursor:
+                os.remove(self._segment_path(self._segments.pop(0)))
+
+
+    def close(self):
+        '''
+        Syncs and closes the spool.
+        '''
+        with self._lock:
+            if self._writer is not None:
+                self._sync()
+                self._writer.close()
+                self._writer = None
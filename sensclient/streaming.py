@@ -0,0 +1,315 @@
+import asyncio, struct, uuid
+
+import click
+import simplejson
+
+
+# Every binary frame starts with its sequence number and the number of
+#   readings it holds
+FRAME_HEADER = struct.Struct('<QI')
+
+# Each reading follows as its length and its JSON encoding
+RECORD_LENGTH = struct.Struct('<I')
+
+# The default number of frames that may await acknowledgement at once
+DEFAULT_WINDOW = 256
+
+# The bounds in seconds on the delay between reconnection attempts
+RECONNECT_MIN = 0.1
+RECONNECT_MAX = 10.0
+
+
+def is_stream(server):
+    '''
+    Gets whether readings are streamed to a server, which is the case
+    for servers listed with a ws:// or wss:// URL.
+    Arguments:
+        server: A server as listed in the configuration.
+    '''
+    return server.startswith(('ws://', 'wss://'))
+
+
+def encode_frame(seq, records):
+    '''
+    Builds a binary frame.
+    Arguments:
+        seq: The sequence number of the frame.
+        records: The JSON encoded readings, as bytes.
+    '''
+    parts = [FRAME_HEADER.pack(seq, len(records))]
+    for record in records:
+        parts.append(RECORD_LENGTH.pack(len(record)))
+        parts.append(record)
+    return b''.join(parts)
+
+
+def decode_frame(data):
+    '''
+    The reference decoder of binary frames.
+    Arguments:
+        data: A frame, any bytes-like object.
+    Returns the sequence number and the list of readings. Raises a
+    ValueError if the frame is malformed.
+    '''
+    data = memoryview(data)
+    try:
+        seq, count = FRAME_HEADER.unpack_from(data, 0)
+        pos = FRAME_HEADER.size
+        readings = []
+        for _ in range(count):
+            length, = RECORD_LENGTH.unpack_from(data, pos)
+            pos += RECORD_LENGTH.size
+            if pos + length > len(data):
+                raise ValueError('Truncated frame!')
+            readings.append(simplejson.loads(bytes(data[pos:pos+length])))
+            pos += length
+    except struct.error:
+        raise ValueError('Truncated frame!') from None
+    return seq, readings
+
+
+class StreamUnsupported(Exception):
+    '''
+    Raised when a server refuses to open a stream.
+    '''
+    pass
+
+
+class Stream:
+    '''
+    Defines a persistent WebSocket to a server readings are streamed
+    over, in place of one HTTP request per batch.
+
+    Each batch is sent as a binary frame holding a sequence number and
+    its readings, every reading prefixed by its length. The server
+    acknowledges frames with text messages of the form {"ack": N},
+    meaning every frame up to N was received, and a batch counts as
+    delivered only once acknowledged. When the connection opens, the
+    client names its stream and the last frame it saw acknowledged,
+    {"stream": ID, "resume": N}, and the server answers with the last
+    frame it actually holds, {"acked": N}. Frames that were not
+    acknowledged when a connection dropped are sent again on the new
+    one, from after that frame, so delivery is at-least-once and a
+    server that remembers the last frame of each stream can discard
+    repeats. At most window frames await acknowledgement at once; past
+    that the oldest ones are given up on and count as failed, so a
+    server that stops acknowledging cannot grow the client's memory
+    without bound.
+
+    Streams run on the Uploader's event loop.
+    '''
+
+    def __init__(self, session, url, timeout=10.0, compress=False, heartbeat=30.0,
+            window=DEFAULT_WINDOW):
+        '''
+        Returns a new Stream, connected when first used.
+        Arguments:
+            session: The aiohttp ClientSession to connect with.
+            url: The ws:// or wss:// URL of the server.
+            timeout: The time in seconds to wait for a frame to be
+            acknowledged.
+            compress: Whether to ask the server to deflate messages.
+            heartbeat: The time in seconds between WebSocket pings.
+            window: The maximum number of frames awaiting
+            acknowledgement.
+        Raises a ValueError if the window is not positive.
+        '''
+        if int(window) < 1:
+            raise ValueError('The stream window must be positive!')
+        self._session = session
+        self._url = url
+        self._timeout = float(timeout)
+        self._compress = bool(compress)
+        self._heartbeat = float(heartbeat)
+        self._window = int(window)
+        self._id = uuid.uuid4().hex
+        self._ws = None
+        self._lock = asyncio.Lock()
+        self._reader = None
+        self._reconnecting = None
+        self._next = 1
+        self._acked = 0
+        # maps the sequence number of every unacknowledged frame, oldest
+        #   first, to the frame, the future resolved when it is
+        #   acknowledged or given up on and the key it was sent with
+        self._unacked = dict()
+        # maps the key of every unacknowledged frame sent with one to
+        #   its sequence number, so that a batch sent again waits on
+        #   that frame
+        self._pending = dict()
+        # maps the sequence number of every frame send() stopped
+        #   waiting on to its number of readings and the function told
+        #   how it ends
+        self._late = dict()
+        self._connects = 0
+        self._evicted = 0
+
+
+    def stats(self):
+        '''
+        Gets a dict of counters describing the stream.
+        '''
+        return {
+            'connected': self._ws is not None and not self._ws.closed,
+            'acked': self._acked,
+            'unacked': len(self._unacked),
+            'evicted': self._evicted,
+            'connects': self._connects
+        }
+
+
+    def _resolve(self, seq, ok):
+        _, future, key = self._unacked.pop(seq)
+        if key is not None:
+            self._pending.pop(key, None)
+        if not future.done():
+            future.set_result(ok)
+        late = self._late.pop(seq, None)
+        if late is not None:
+            count, function = late
+            function(count, ok)
+
+
+    def _ack(self, seq):
+        if seq <= self._acked:
+            return
+        self._acked = seq
+        for pending in [s for s in self._unacked if s <= seq]:
+            self._resolve(pending, True)
+
+
+    async def _connect(self):
+        import aiohttp
+
+        async with self._lock:
+            if self._ws is not None and not self._ws.closed:
+                return
+            try:
+                ws = await self._session.ws_connect(self._url, heartbeat=self._heartbeat,
+                    compress=15 if self._compress else 0)
+            except aiohttp.WSServerHandshakeError as e:
+                if e.status in (400, 404, 405, 426, 501):
+                    raise StreamUnsupported('{} does not accept streams (HTTP {})'.format(self._url, e.status))
+                raise
+            try:
+                await ws.send_str(simplejson.dumps({'stream': self._id, 'resume': self._acked}))
+                msg = await ws.receive(timeout=self._timeout)
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    raise aiohttp.ClientError('No reply to the stream hello from {}'.format(self._url))
+                self._ack(int(simplejson.loads(msg.data).get('acked', 0)))
+                # resume where the server left off
+                for seq in sorted(self._unacked):
+                    await ws.send_bytes(self._unacked[seq][0])
+            except BaseException:
+                await ws.close()
+                raise
+            self._ws = ws
+            self._connects += 1
+            self._reader = asyncio.get_running_loop().create_task(self._read(ws))
+
+
+    async def _read(self, ws):
+        import aiohttp
+
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                try:
+                    self._ack(int(simplejson.loads(msg.data)['ack']))
+                except (ValueError, KeyError, TypeError):
+                    pass
+            elif msg.type in (aiohttp.WSMsgType.ERROR, aiohttp.WSMsgType.CLOSE):
+                break
+        if self._ws is ws:
+            self._ws = None
+        if self._unacked and self._reconnecting is None:
+            self._reconnecting = asyncio.get_running_loop().create_task(self._reconnect())
+
+
+    async def _reconnect(self):
+        import aiohttp
+
+        delay = RECONNECT_MIN
+        try:
+            while self._unacked:
+                try:
+                    await self._connect()
+                    return
+                except (aiohttp.ClientError, asyncio.TimeoutError, OSError, StreamUnsupported) as e:
+                    click.secho('Reconnecting to {} failed: {}'.format(self._url, e), fg='red', err=True)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX)
+        finally:
+            self._reconnecting = None
+
+
+    async def send(self, records, key=None, late=None):
+        '''
+        Sends a batch of readings and waits for it to be acknowledged.
+        Arguments:
+            records: The JSON encoded readings, as bytes.
+            key: An optional key that stays the same for the same
+            readings however they are batched, such as where they are
+            in the spool.
+            late: An optional function called with the number of
+            readings and whether they were acknowledged, if the batch
+            is acknowledged or given up on after this stopped waiting.
+        Returns whether the server acknowledged the batch in time. A
+        batch that was not stays unacknowledged, is sent again after a
+        reconnection and can still be acknowledged late: sending a
+        batch with the same key again waits on its frame rather than
+        sending a new one. Raises StreamUnsupported if the server does
+        not accept streams.
+        '''
+        import aiohttp
+
+        try:
+            await self._connect()
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            click.secho('Streaming to {} failed: {}'.format(self._url, e), fg='red', err=True)
+            return False
+        seq = self._pending.get(key) if key is not None else None
+        if seq is None:
+            while len(self._unacked) >= self._window:
+                # give up on the oldest frame, which the caller may send
+                #   again as a new one
+                self._evicted += 1
+                self._resolve(next(iter(self._unacked)), False)
+            seq = self._next
+            self._next += 1
+            frame = encode_frame(seq, records)
+            future = asyncio.get_running_loop().create_future()
+            self._unacked[seq] = (frame, future, key)
+            if key is not None:
+                self._pending[key] = seq
+            ws = self._ws
+            if ws is not None:
+                try:
+                    await ws.send_bytes(frame)
+                except (aiohttp.ClientError, ConnectionError):
+                    # resent once the connection is back
+                    pass
+        else:
+            # already on the wire, or resent once the connection is back
+            future = self._unacked[seq][1]
+            self._late.pop(seq, None)
+        try:
+            # the frame outlives a timeout, as does its future
+            return await asyncio.wait_for(asyncio.shield(future), self._timeout)
+        except asyncio.TimeoutError:
+            if late is not None and seq in self._unacked:
+                self._late[seq] = (len(records), late)
+            return False
+
+
+    async def close(self):
+        '''
+        Closes the connection.
+        '''
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
+        if self._ws is not None:
+            await self._ws.close()
+            self._ws = None
+        if self._reader is not None:
+            await asyncio.gather(self._reader, return_exceptions=True)
+            self._reader = None
@@ -0,0 +1,567 @@
+import asyncio, gzip, time
+from urllib.parse import urlsplit
+import click
+import simplejson
+
+from sensclient import columnar
+from sensclient.adaptive import AdaptiveController, InflightLimit
+from sensclient.decoding import Oscilloscope
+from sensclient.engine import Engine
+from sensclient.streaming import Stream, StreamUnsupported, is_stream
+
+
+def make_reading(device, msg, ts=None):
+    '''
+    Converts a decoded message into the plain dict that is uploaded to
+    the server. Besides the device and the time, the reading holds
+    every field of the message; typed arrays and blobs are turned into
+    lists of integers.
+    Arguments:
+        device: The physical address of the device the message came in
+        on.
+        msg: The decoded message, a namedtuple such as Oscilloscope.
+        ts: The time the message was received, defaults to now.
+    '''
+    if type(msg) is not Oscilloscope:
+        reading = {'device': device, 'ts': ts if ts is not None else time.time()}
+        for name, value in zip(msg._fields, msg):
+            if isinstance(value, (bytes, bytearray)):
+                value = list(value)
+            elif hasattr(value, 'tolist'):
+                value = value.tolist()
+            reading[name] = value
+        return reading
+    return {
+        'device': device,
+        'ts': ts if ts is not None else time.time(),
+        'version': msg.version,
+        'interval': msg.interval,
+        'id': msg.id,
+        'count': msg.count,
+        'readings': msg.readings.tolist()
+    }
+
+
+def server_url(server, path):
+    '''
+    Builds the upload URL for a server entry from the configuration.
+    Arguments:
+        server: A server as listed in the configuration, either
+        'host:port' or a full URL. The HTTP URL of a server readings
+        are streamed to is its host.
+        path: The path on the server that accepts uploads.
+    '''
+    if '://' not in server:
+        server = 'http://' + server
+    elif is_stream(server):
+        parts = urlsplit(server)
+        server = '{}://{}'.format('https' if parts.scheme == 'wss' else 'http', parts.netloc)
+    return server.rstrip('/') + '/' + path.lstrip('/')
+
+
+class Uploader:
+    '''
+    Defines the subsystem that forwards readings to a Senslify server.
+
+    Readings are collected into batches which are flushed either when
+    they reach batch_size readings or when flush_interval seconds have
+    passed since the first reading of the batch arrived, whichever
+    comes first. Batches are POSTed as JSON, optionally gzipped, over a
+    single keep-alive aiohttp session so that connections to the
+    server are pooled and reused between flushes.
+
+    When given a Spool, the Uploader works in store-and-forward mode:
+    every reading is appended to the spool as it is submitted and is
+    only removed from it once the server has accepted it. While the
+    server is unreachable readings accumulate on disk, and once it
+    comes back the backlog is replayed in large sequential reads, with
+    connections requests in flight at once. Delivery is at-least-once.
+
+    Batches can also be sent in the compact columnar encoding of
+    sensclient.columnar, depending on the upload format:
+        json: Always send JSON.
+        columnar: Send columnar batches unless the server rejects one
+        with HTTP 415, after which that server is sent JSON.
+        auto: Send JSON until the server advertises the columnar media
+        type in an Accept-Post header on any response.
+    Batches holding readings that cannot be encoded in columns are
+    always sent as JSON.
+
+    With adaptive uploads, the batch size, the flush interval and the
+    number of requests in flight are not fixed but tuned by an
+    AdaptiveController from the server's response times and errors;
+    the configured values are only where it starts from.
+
+    Servers listed with a ws:// or wss:// URL are streamed to instead:
+    batches go out as frames over one persistent WebSocket, a
+    sensclient.streaming.Stream, and count as delivered once the server
+    acknowledges them. A server that refuses the WebSocket handshake is
+    sent HTTP batches at the upload path on the same host.
+
+    The Uploader runs on the client's Engine. submit() may be called
+    from any thread.
+    '''
+
+    # The path on the server that accepts uploads
+    DEFAULT_PATH = '/upload'
+
+
+    # Define the upload formats
+    JSON = 'json'
+    COLUMNAR = 'columnar'
+    AUTO = 'auto'
+
+    FORMATS = (JSON, COLUMNAR, AUTO)
+
+
+    # The bounds in seconds on the delay before retrying a failed
+    #   replay from the spool
+    RETRY_MIN = 1.0
+    RETRY_MAX = 60.0
+
+
+    def __init__(self, server, engine=None, batch_size=500, flush_interval=1.0,
+            compress=False, path=DEFAULT_PATH, connections=4, timeout=10.0, spool=None,
+            observer=None, format=JSON, adaptive=None):
+        '''
+        Returns a new Uploader. Call start() before submitting readings.
+        Arguments:
+            server: The server to upload to, as listed in the
+            configuration.
+            engine: The Engine to run on, defaults to the process-wide
+            Engine.
+            batch_size: The maximum number of readings per request.
+            flush_interval: The maximum time in seconds a reading waits
+            before its batch is sent.
+            compress: Whether to gzip request bodies.
+            path: The path on the server that accepts uploads.
+            connections: The maximum number of pooled connections, and
+            therefore of requests in flight at once.
+            timeout: The total timeout in seconds for a single request.
+            spool: An optional Spool to store readings in until they
+            are delivered.
+            observer: An optional function called after every request
+            with the server, the request's latency in seconds and
+            whether the server accepted it.
+            format: One of FORMATS, how batches are encoded.
+            adaptive: The settings of the AdaptiveController as a dict,
+            None or an 'enabled' setting of false keeps the batch size,
+            flush interval and connections fixed.
+        Raises a ValueError if the format or the adaptive settings are
+        not valid.
+        '''
+        if format not in Uploader.FORMATS:
+            raise ValueError('Unknown upload format {}, expected one of {}!'.format(
+                format, ', '.join(Uploader.FORMATS)))
+        self._engine = engine if engine else Engine.default()
+        self._path = path
+        self._url = server_url(server, path)
+        self._server = server
+        self._batch_size = int(batch_size)
+        self._flush_interval = float(flush_interval)
+        self._compress = bool(compress)
+        self._connections = int(connections)
+        self._timeout = float(timeout)
+        self._spool = spool
+        self._observer = observer
+        self._format = format
+        self._columnar = dict()
+        self._streams = dict()
+        self._streaming = dict()
+        self._controller = None
+        adaptive = dict(adaptive) if adaptive else dict(enabled=False)
+        if adaptive.pop('enabled', True):
+            try:
+                self._controller = AdaptiveController(self._batch_size, self._flush_interval,
+                    self._connections, **adaptive)
+            except TypeError as e:
+                raise ValueError('Invalid adaptive upload settings: {}'.format(e)) from None
+            self._batch_size = self._controller.batch_size()
+            self._flush_interval = self._controller.flush_interval()
+
+        self._session = None
+        self._inflight = None
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+        self._wake = None
+        self._drainer = None
+
+        self._sent = 0
+        self._failed = 0
+        self._requests = 0
+        self._bytes = 0
+
+
+    #
+    # ACCESSOR METHODS
+    #
+
+    def server(self):
+        '''
+        Gets the server currently being uploaded to.
+        '''
+        return self._server
+
+
+    def stats(self):
+        '''
+        Gets a dict of counters describing the Uploader's activity.
+        '''
+        return {
+            'server': self._server,
+            'format': Uploader.COLUMNAR if self._wants_columnar(self._server) else Uploader.JSON,
+            'transport': 'websocket' if self._wants_stream(self._server) else 'http',
+            'pending': self._spool.backlog() if self._spool else len(self._pending),
+            'inflight': len(self._tasks),
+            'adaptive': self._controller is not None,
+            'batch_size': self._batch_size,
+            'flush_interval': self._flush_interval,
+            'inflight_limit': self._inflight.limit() if self._inflight else self._connections,
+            'latency': self._controller.latency() if self._controller else None,
+            'target_latency': self._controller.target() if self._controller else None,
+            'requests': self._requests,
+            'sent': self._sent,
+            'failed': self._failed,
+            'bytes': self._bytes
+        }
+
+
+    #
+    # EVENT LOOP METHODS
+    #
+
+    async def _start(self):
+        import aiohttp
+
+        limit = self._connections
+        if self._controller is not None:
+            limit = max(limit, self._controller.inflight())
+        connector = aiohttp.TCPConnector(limit=limit, keepalive_timeout=60)
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self._timeout)
+        )
+        self._inflight = InflightLimit(self._controller.inflight() if self._controller else self._connections)
+        if self._spool is not None:
+            self._wake = asyncio.Event()
+            self._drainer = asyncio.get_running_loop().create_task(self._drain())
+        elif self._pending:
+            self._flush()
+
+
+    def _append(self, reading):
+        self._pending.append(reading)
+        if len(self._pending) >= self._batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self._flush_interval, self._flush)
+
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending or self._session is None:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.get_running_loop().create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+    def _wants_stream(self, server):
+        return is_stream(server) and self._streaming.get(server, True)
+
+
+    def _wants_columnar(self, server):
+        if self._format == Uploader.JSON or self._wants_stream(server):
+            return False
+        return self._columnar.get(server, self._format == Uploader.COLUMNAR)
+
+
+    def _encode(self, batch, columns=False):
+        '''
+        Builds a request body from a batch of JSON encoded readings,
+        in the columnar encoding if asked to and if every reading can
+        be encoded in columns.
+        '''
+        body = None
+        if columns:
+            try:
+                body = columnar.encode(simplejson.loads(b'[' + b','.join(batch) + b']'))
+                headers = {'Content-Type': columnar.MEDIA_TYPE}
+            except ValueError:
+                pass
+        if body is None:
+            body = b'{"readings":[' + b','.join(batch) + b']}'
+            headers = {'Content-Type': 'application/json'}
+        if self._compress:
+            body = gzip.compress(body, compresslevel=5)
+            headers['Content-Encoding'] = 'gzip'
+        return body, headers
+
+
+    async def _request(self, server, url, body, headers, size, negotiating=False):
+        '''
+        Sends one request body, holding size readings, to a server.
+        Returns the HTTP status of the response, None if the request
+        failed.
+        '''
+        import aiohttp
+
+        self._requests += 1
+        start = time.monotonic()
+        status = retry_after = None
+        try:
+            async with self._session.post(url, data=body, headers=headers) as resp:
+                await resp.read()
+                status = resp.status
+                retry_after = resp.headers.get('Retry-After')
+                if self._format != Uploader.JSON and \
+                        columnar.MEDIA_TYPE in resp.headers.get('Accept-Post', ''):
+                    self._columnar[server] = True
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            click.secho('Upload to {} failed: {}'.format(server, e), fg='red', err=True)
+        if negotiating and status == 415:
+            return status
+        if status is not None:
+            if status < 300:
+                self._bytes += len(body)
+            else:
+                click.secho('Upload to {} rejected with HTTP {}.'.format(server, status), fg='red', err=True)
+        latency = time.monotonic() - start
+        if self._controller is not None:
+            self._adapt(latency, status, retry_after, size)
+        if self._observer is not None:
+            self._observer(server, latency, status is not None and status < 300)
+        return status
+
+
+    def _adapt(self, latency, status, retry_after, size):
+        self._controller.observe(latency, status, retry_after, size)
+        self._batch_size = self._controller.batch_size()
+        self._flush_interval = self._controller.flush_interval()
+        self._inflight.set_limit(self._controller.inflight())
+
+
+    async def _stream(self, server, batch, key=None, late=None):
+        '''
+        Sends one batch over the server's stream, see Stream.send() for
+        the key and late arguments. Returns whether the server
+        acknowledged it, None if the server does not accept streams.
+        '''
+        stream = self._streams.get(server)
+        if stream is None:
+            stream = self._streams[server] = Stream(self._session, server, self._timeout,
+                compress=self._compress)
+        self._requests += 1
+        start = time.monotonic()
+        try:
+            ok = await stream.send(batch, key, late)
+        except StreamUnsupported as e:
+            if self._streams.get(server) is stream:
+                click.secho('{}, sending HTTP batches.'.format(e), fg='yellow', err=True)
+                self._streaming[server] = False
+                del self._streams[server]
+                await stream.close()
+            return None
+        latency = time.monotonic() - start
+        if ok:
+            self._bytes += sum(len(record) for record in batch)
+        if self._controller is not None:
+            self._adapt(latency, 200 if ok else None, None, len(batch))
+        if self._observer is not None:
+            self._observer(server, latency, ok)
+        return ok
+
+
+    async def _post(self, batch, key=None, late=None):
+        '''
+        Sends one batch to the server, over its stream if it has one,
+        falling back to JSON if the server does not accept columnar
+        batches. Returns True if the server accepted it.
+        '''
+        if self._controller is not None and self._controller.delay() > 0:
+            # the server asked for a break
+            await asyncio.sleep(self._controller.delay())
+        async with self._inflight:
+            server, url = self._server, self._url
+            if self._wants_stream(server):
+                ok = await self._stream(server, batch, key, late)
+                if ok is not None:
+                    return ok
+            body, headers = self._encode(batch, self._wants_columnar(server))
+            negotiating = headers['Content-Type'] == columnar.MEDIA_TYPE
+            status = await self._request(server, url, body, headers, len(batch), negotiating)
+            if negotiating and status == 415:
+                click.secho('{} does not accept columnar uploads, sending JSON.'.format(server), fg='yellow', err=True)
+                self._columnar[server] = False
+                body, headers = self._encode(batch)
+                status = await self._request(server, url, body, headers, len(batch))
+            return status is not None and status < 300
+
+
+    async def _send(self, batch):
+        await self.send(batch)
+
+
+    def _late(self, count, ok):
+        # a streamed batch counted as failed was acknowledged after all
+        if ok:
+            self._sent += count
+            self._failed -= count
+
+
+    async def _drain(self):
+        '''
+        Replays the spool to the server for as long as the Uploader
+        runs, backing off while the server is unreachable.
+        '''
+        loop = asyncio.get_running_loop()
+        backoff = Uploader.RETRY_MIN
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if self._spool.sync_due():
+                await loop.run_in_executor(None, self._spool.sync)
+            while self._spool.backlog() > 0:
+                start = self._spool.cursor()
+                records, offset = await loop.run_in_executor(
+                    None, self._spool.read, self._batch_size * self._inflight.limit())
+                if not records:
+                    break
+                # where the records start in the spool identifies them
+                #   when they are sent again, unless the spool dropped
+                #   some while they were read
+                keyed = self._spool.cursor() == start
+                batches = [(i, records[i:i+self._batch_size])
+                    for i in range(0, len(records), self._batch_size)]
+                results = await asyncio.gather(
+                    *(self._post(batch, (start, i, len(batch)) if keyed else None)
+                        for i, batch in batches))
+                if all(results):
+                    await loop.run_in_executor(None, self._spool.commit, offset, len(records))
+                    self._sent += len(records)
+                    backoff = Uploader.RETRY_MIN
+                else:
+                    # leave the records in the spool and try again later
+                    self._failed += len(records)
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, Uploader.RETRY_MAX)
+                    break
+
+
+    async def _close(self):
+        if self._drainer is not None:
+            self._drainer.cancel()
+            await asyncio.gather(self._drainer, return_exceptions=True)
+            self._drainer = None
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        for stream in self._streams.values():
+            await stream.close()
+        self._streams.clear()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._spool is not None:
+            self._spool.close()
+
+
+    #
+    # CONTROL METHODS
+    #
+
+    def start(self):
+        '''
+        Opens the pooled session to the server. Readings submitted
+        before the Uploader is started are held until it is.
+        '''
+        # aiohttp is slow to import, keep that off of the event loop
+        import aiohttp
+
+        self._engine.call(self._start())
+
+
+    def submit(self, reading):
+        '''
+        Queues a reading for upload. Safe to call from any thread.
+        Arguments:
+            reading: The reading to upload, see make_reading().
+        '''
+        record = simplejson.dumps(reading).encode('utf-8')
+        if self._spool is not None:
+            self._spool.append(record)
+            if self._wake is not None and self._spool.backlog() >= self._batch_size \
+                    and not self._wake.is_set():
+                self._engine.call_soon(self._wake.set)
+        elif self._engine.in_loop():
+            self._append(record)
+        else:
+            self._engine.call_soon(self._append, record)
+
+
+    def flush(self):
+        '''
+        Sends whatever readings are pending without waiting for the
+        batch to fill up.
+        '''
+        if self._spool is not None:
+            if self._wake is not None:
+                self._engine.call_soon(self._wake.set)
+        else:
+            self._engine.call_soon(self._flush)
+
+
+    async def send(self, records):
+        '''
+        Sends one batch right away, outside of the batching of submitted
+        readings. This is a coroutine that must run on the engine's
+        loop, after start().
+        Arguments:
+            records: The JSON encoded readings, as bytes.
+        Returns whether the server accepted the batch. A streamed batch
+        that is acknowledged after this returned counts as sent rather
+        than failed from then on.
+        '''
+        ok = await self._post(records, late=self._late)
+        if ok:
+            self._sent += len(records)
+        else:
+            self._failed += len(records)
+        return ok
+
+
+    def set_server(self, server):
+        '''
+        Switches the server readings are uploaded to. Batches already
+        in flight still go to the previous server.
+        Arguments:
+            server: The server to upload to, as listed in the
+            configuration.
+        '''
+        def _switch():
+            self._flush()
+            self._server = server
+            self._url = server_url(server, self._path)
+        if self._engine.in_loop():
+            _switch()
+        else:
+            self._engine.call_soon(_switch)
+
+
+    def close(self, timeout=None):
+        '''
+        Flushes any pending readings and closes the session.
+        Arguments:
+            timeout: The maximum time in seconds to wait for the final
+            flush.
+        '''
+        if not self._engine.closed():
+            self._engine.call(self._close(), timeout)
@@ -32,7 +32,7 @@ REQUIRED = [
 
 # What packages are optional?
 EXTRAS = {
-    # 'fancy feature': ['django'],
+    'fast': ['numpy'],  # Zero-copy and batch decoding of readings
 }
 
 # What testing suite and requires are necessary?
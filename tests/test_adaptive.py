@@ -0,0 +1,147 @@
+import asyncio, unittest
+from unittest import mock
+
+from sensclient.adaptive import AdaptiveController, InflightLimit
+
+
+class Clock:
+    '''
+    Stands in for time.monotonic(), moving only when told to.
+    '''
+
+    def __init__(self):
+        self.now = 1000.0
+
+
+    def __call__(self):
+        return self.now
+
+
+class AdaptiveControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('sensclient.adaptive.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def controller(self, **settings):
+        return AdaptiveController(100, 1.0, 4, **dict(dict(target_latency=0.5, min_batch=10,
+            max_batch=200, batch_step=50, min_interval=0.1, max_interval=2.0, recovery=0.5,
+            max_inflight=8, decrease=0.5, alpha=1.0), **settings))
+
+
+    def observe(self, controller, latency, status, size=None, after=1.0, retry_after=None):
+        self.clock.now += after
+        controller.observe(latency, status, retry_after, size)
+
+
+    def test_additive_increase(self):
+        controller = self.controller()
+        for _ in range(5):
+            self.observe(controller, 0.1, 200)
+        # about one more request in flight per round of responses in time
+        self.assertEqual(controller.inflight(), 5)
+        self.assertEqual(controller.flush_interval(), 0.1)
+        self.assertEqual(controller.batch_size(), 100)
+        self.observe(controller, 0.1, 200, size=100)
+        self.assertEqual(controller.batch_size(), 150)
+        for _ in range(40):
+            self.observe(controller, 0.1, 200, size=200)
+        self.assertEqual((controller.inflight(), controller.batch_size()), (8, 200))
+
+
+    def test_multiplicative_decrease(self):
+        controller = self.controller()
+        self.observe(controller, 0.1, 503)
+        self.assertEqual((controller.inflight(), controller.flush_interval()), (2, 2.0))
+        # congestion alone leaves the batch size alone
+        self.assertEqual((controller.batch_size(), controller.decreases()), (100, 1))
+        self.observe(controller, 0.1, 429)
+        self.observe(controller, 0.1, 500)
+        self.assertEqual((controller.inflight(), controller.decreases()), (1, 3))
+
+
+    def test_decrease_once_per_round_trip(self):
+        controller = self.controller()
+        self.observe(controller, 0.1, 500)
+        self.observe(controller, 0.1, 500, after=0.01)
+        self.observe(controller, 0.1, 500, after=0.01)
+        self.assertEqual((controller.inflight(), controller.decreases()), (2, 1))
+
+
+    def test_latency_over_the_target(self):
+        controller = self.controller()
+        self.observe(controller, 0.8, 200)
+        self.assertEqual((controller.latency(), controller.inflight()), (0.8, 2))
+        # back under the target, the window grows again
+        self.observe(controller, 0.25, 200)
+        self.assertEqual((controller.latency(), controller.inflight()), (0.25, 2))
+        self.observe(controller, 0.25, 200)
+        self.assertEqual(controller.inflight(), 2)
+        self.observe(controller, 0.25, 200)
+        self.assertEqual(controller.inflight(), 3)
+
+
+    def test_failures_cut_the_batch(self):
+        controller = self.controller()
+        self.observe(controller, 10.0, None)
+        self.assertEqual(controller.batch_size(), 50)
+        self.observe(controller, 0.1, 413)
+        self.observe(controller, 0.1, None)
+        self.observe(controller, 0.1, None)
+        self.assertEqual(controller.batch_size(), 10)
+        # failures do not count towards the latency
+        self.assertIsNone(controller.latency())
+
+
+    def test_retry_after(self):
+        controller = self.controller()
+        self.observe(controller, 0.1, 429, retry_after='5')
+        self.assertEqual(controller.delay(), 5.0)
+        self.clock.now += 2.0
+        self.assertEqual(controller.delay(), 3.0)
+        # unreadable or unasked for, the header is ignored
+        self.observe(controller, 0.1, 503, retry_after='soon')
+        self.observe(controller, 0.1, 200, retry_after='60')
+        self.assertEqual(controller.delay(), 1.0)
+
+
+    def test_starts_within_bounds(self):
+        controller = AdaptiveController(10000, 0.0, 100, max_batch=500, max_inflight=8)
+        self.assertEqual((controller.batch_size(), controller.flush_interval(), controller.inflight()),
+            (500, 0.05, 8))
+
+
+    def test_invalid_settings(self):
+        for settings in ({'min_batch': 0}, {'min_batch': 10, 'max_batch': 5}, {'decrease': 1.0},
+                {'recovery': 0}, {'target_latency': 0}, {'min_interval': 3.0}):
+            with self.assertRaises(ValueError):
+                AdaptiveController(100, 1.0, 4, **settings)
+
+
+class InflightLimitTest(unittest.TestCase):
+
+    def test_limit_changes_wake_waiters(self):
+        async def run():
+            limit = InflightLimit(1)
+            entered = []
+
+            async def request(num):
+                async with limit:
+                    entered.append(num)
+                    await asyncio.sleep(1)
+
+            tasks = [asyncio.create_task(request(num)) for num in range(3)]
+            await asyncio.sleep(0.01)
+            self.assertEqual(entered, [0])
+            limit.set_limit(3)
+            await asyncio.sleep(0.01)
+            self.assertEqual(entered, [0, 1, 2])
+            limit.set_limit(0)
+            self.assertEqual(limit.limit(), 1)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        asyncio.run(run())
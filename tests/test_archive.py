@@ -0,0 +1,143 @@
+import calendar, os, shutil, tempfile, time, unittest
+
+from sensclient.archive import Archive
+from sensclient.decoding import Oscilloscope
+
+
+# Midnight UTC on two consecutive days long past
+DAY1 = calendar.timegm((2024, 1, 1, 0, 0, 0))
+DAY2 = DAY1 + 86400
+
+
+def message(ident=1, count=0, readings=(1,)):
+    return Oscilloscope(1, 256, ident, count, list(readings))
+
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.archive = None
+
+
+    def tearDown(self):
+        if self.archive is not None:
+            self.archive.close()
+        shutil.rmtree(self.path)
+
+
+    def open(self, **settings):
+        if self.archive is not None:
+            self.archive.close()
+        self.archive = Archive(self.path, **dict(dict(block_rows=8, flush_interval=3600), **settings))
+        return self.archive
+
+
+    def fill(self, archive, start, messages=20, device='a'):
+        for i in range(messages):
+            archive.add(device, message(ident=i % 3, count=i, readings=(i, i + 1)), start + i)
+
+
+    def test_query_filters(self):
+        archive = self.open()
+        for i in range(20):
+            archive.add('a', message(ident=i % 3, count=i, readings=(i, i + 1)), DAY1 + 100 + i)
+            archive.add('b', message(ident=i % 3, count=i, readings=(i, i + 1)), DAY1 + 100.5 + i)
+        rows = list(archive.query())
+        self.assertEqual(len(rows), 80)
+        self.assertEqual(rows, sorted(rows, key=lambda row: row[0]))
+        self.assertEqual(rows[0], (DAY1 + 100, 'a', 0, 0, 0))
+        rows = list(archive.query(start=DAY1 + 105, end=DAY1 + 109, device='b', mote=1))
+        self.assertEqual([(row[0], row[3]) for row in rows], [(DAY1 + 107.5, 7)] * 2)
+        self.assertEqual(list(archive.query(device='c')), [])
+        self.assertEqual(list(archive.query(start=DAY1 + 1000)), [])
+
+
+    def test_blocks_are_indexed(self):
+        archive = self.open()
+        self.fill(archive, DAY1 + 100)
+        archive.close()
+        archive = self.open()
+        blocks = archive.blocks()
+        self.assertEqual(len(blocks), 5)
+        self.assertEqual(archive.blocks(start=DAY1 + 112, end=DAY1 + 113), [('20240101', 3)])
+        rows = archive.read_block('20240101', 3)
+        self.assertEqual([row[3] for row in rows], [12, 12, 13, 13, 14, 14, 15, 15])
+        self.assertEqual(archive.read_block('20240101', 3, start=DAY1 + 113, mote=1), [
+            (DAY1 + 113, 'a', 1, 13, 13), (DAY1 + 113, 'a', 1, 13, 14)])
+        self.assertEqual(archive.read_block('20240101', 99), [])
+
+
+    def test_times_never_go_backwards(self):
+        archive = self.open()
+        archive.add('a', message(count=1), DAY1 + 10)
+        archive.add('a', message(count=2), DAY1 + 5)
+        self.assertEqual([row[0] for row in list(archive.query())], [DAY1 + 10] * 2)
+
+
+    def test_unfit_messages_are_ignored(self):
+        archive = self.open()
+        for event in (object(), message(readings=()), message(readings=(-1,)), message(ident=-1)):
+            archive.add('a', event, DAY1)
+        self.assertEqual(list(archive.query()), [])
+        self.assertEqual(archive.rows(), 0)
+
+
+    def test_days_are_sealed(self):
+        archive = self.open()
+        self.fill(archive, DAY1 + 100)
+        self.fill(archive, DAY2 + 100)
+        expected = list(archive.query())
+        archive.close()
+        # the earlier day was sealed when the later one started, the
+        #   later one is sealed when the archive is opened again
+        self.assertTrue(archive.day_stats('20240101')['sealed'])
+        self.open().close()
+        archive = self.open()
+        self.assertEqual(archive.days(), ['20240101', '20240102'])
+        self.assertTrue(archive.day_stats('20240102')['sealed'])
+        self.assertEqual(list(archive.query()), expected)
+        self.assertEqual(list(archive.query(start=DAY2)), expected[40:])
+        self.assertEqual(len(archive.blocks()), 10)
+
+
+    def test_retention(self):
+        archive = self.open(retention_days=2)
+        self.fill(archive, DAY1 + 100)
+        self.fill(archive, DAY2 + 100)
+        archive.add('a', message(), DAY2 + 86400)
+        archive.close()
+        # expired once the later days are sealed
+        self.assertEqual(self.open().days(), ['20240102', '20240103'])
+
+
+    def test_torn_block_is_dropped(self):
+        now = time.time()
+        archive = self.open()
+        self.fill(archive, now, messages=4)
+        archive.close()
+        segment = [name for name in os.listdir(self.path) if name.endswith('.seg')][0]
+        with open(os.path.join(self.path, segment), 'ab') as f:
+            f.write(b'half a block')
+        archive = self.open()
+        self.fill(archive, now + 10, messages=4)
+        archive.close()
+        archive = self.open()
+        self.assertEqual(len(list(archive.query())), 16)
+
+
+    def test_idle_rows_are_flushed(self):
+        archive = self.open(flush_interval=0.1)
+        archive.add('a', message(count=1), DAY1 + 10)
+        self.assertEqual(archive.blocks(), [])
+        deadline = time.monotonic() + 5
+        while not archive.blocks() and time.monotonic() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(archive.blocks(), [('20240101', 0)])
+        self.assertEqual(archive.read_block('20240101', 0), [(DAY1 + 10, 'a', 1, 1, 1)])
+
+
+    def test_invalid_settings(self):
+        for settings in ({'block_rows': 0}, {'flush_interval': 0}, {'retention_days': 0}):
+            with self.assertRaises(ValueError):
+                Archive(self.path, **settings)
@@ -0,0 +1,152 @@
+import calendar, os, shutil, tempfile, unittest
+
+import simplejson
+
+from sensclient.archive import Archive
+from sensclient.backfill import ArchiveSource, Backfill, SpoolSource
+from sensclient.decoding import Oscilloscope
+from sensclient.engine import Engine
+from sensclient.spool import Spool
+
+
+DAY = calendar.timegm((2024, 1, 1, 0, 0, 0))
+
+
+class FakeUploader:
+    '''
+    Stands in for an Uploader, failing the sends it is told to.
+    '''
+
+    def __init__(self, failures=()):
+        self.failures = list(failures)
+        self.sent = []
+
+
+    def start(self):
+        pass
+
+
+    async def _close(self):
+        pass
+
+
+    async def send(self, records):
+        failure = self.failures.pop(0) if self.failures else None
+        if isinstance(failure, Exception):
+            raise failure
+        if failure is False:
+            return False
+        self.sent.append(records)
+        return True
+
+
+class BackfillTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.engine = Engine()
+        self._retry = Backfill.RETRY_MIN
+        Backfill.RETRY_MIN = 0.01
+
+
+    def tearDown(self):
+        Backfill.RETRY_MIN = self._retry
+        self.engine.close()
+        shutil.rmtree(self.path)
+
+
+    def archive(self, messages=12):
+        archive = Archive(os.path.join(self.path, 'archive'), block_rows=4, flush_interval=3600)
+        for i in range(messages):
+            archive.add('a', Oscilloscope(1, 256, i % 2, i, [i, i + 1]), DAY + i)
+        archive.close()
+        return Archive(os.path.join(self.path, 'archive'))
+
+
+    def run_backfill(self, source, uploader, **settings):
+        backfill = Backfill(source, uploader, engine=self.engine, **settings)
+        backfill.start()
+        backfill.wait(10)
+        return backfill.stats()
+
+
+    def test_archive_chunks(self):
+        archive = self.archive()
+        source = ArchiveSource(archive, os.path.join(self.path, 'backfill.json'), 'http://server')
+        self.assertEqual(source.total(), 6)
+        uploader = FakeUploader()
+        stats = self.run_backfill(source, uploader)
+        self.assertEqual((stats['chunks'], stats['sent']), (6, 12))
+        readings = [simplejson.loads(record) for chunk in uploader.sent for record in chunk]
+        self.assertEqual(sorted(r['count'] for r in readings), list(range(12)))
+        self.assertEqual(readings[0]['readings'], [readings[0]['count'], readings[0]['count'] + 1])
+        archive.close()
+
+
+    def test_archive_checkpoint_resumes(self):
+        archive = self.archive()
+        checkpoint = os.path.join(self.path, 'backfill.json')
+        source = ArchiveSource(archive, checkpoint, 'http://server')
+        chunks = list(source.chunks())
+        for key in (chunks[0][0], chunks[1][0], chunks[3][0]):
+            source.complete(key)
+        resumed = ArchiveSource(archive, checkpoint, 'http://server')
+        self.assertEqual(resumed.total(), 3)
+        self.assertEqual([key for key, _ in resumed.chunks()], [chunks[2][0], chunks[4][0], chunks[5][0]])
+        # another range or server starts over
+        self.assertEqual(ArchiveSource(archive, checkpoint, 'http://other').total(), 6)
+        self.assertEqual(ArchiveSource(archive, checkpoint, 'http://server', start=DAY).total(), 6)
+        archive.close()
+
+
+    def test_corrupt_checkpoint_starts_over(self):
+        archive = self.archive()
+        checkpoint = os.path.join(self.path, 'backfill.json')
+        with open(checkpoint, 'w') as f:
+            f.write('{"source": ')
+        self.assertEqual(ArchiveSource(archive, checkpoint, 'http://server').total(), 6)
+        archive.close()
+
+
+    def test_spool_commits_in_order(self):
+        spool = Spool(os.path.join(self.path, 'spool'))
+        for i in range(10):
+            spool.append(b'%d' % i)
+        source = SpoolSource(spool, chunk_size=3)
+        self.assertEqual(source.total(), 4)
+        chunks = source.chunks()
+        first, second = next(chunks), next(chunks)
+        # a later chunk delivered first commits nothing
+        source.complete(second[0])
+        self.assertEqual(spool.backlog(), 10)
+        source.complete(first[0])
+        self.assertEqual(spool.backlog(), 4)
+        source.close()
+
+
+    def test_failures_are_retried(self):
+        archive = self.archive()
+        source = ArchiveSource(archive, os.path.join(self.path, 'backfill.json'), 'http://server')
+        uploader = FakeUploader([False, RuntimeError('boom'), None, False])
+        stats = self.run_backfill(source, uploader, concurrency=1)
+        self.assertEqual((stats['chunks'], stats['retries']), (6, 3))
+        self.assertEqual(len(uploader.sent), 6)
+        self.assertEqual(ArchiveSource(archive, os.path.join(self.path, 'backfill.json'),
+            'http://server').total(), 0)
+        archive.close()
+
+
+    def test_checkpoint_failure_stops(self):
+        archive = self.archive()
+        source = ArchiveSource(archive, os.path.join(self.path, 'missing', 'backfill.json'), 'http://server')
+        uploader = FakeUploader()
+        stats = self.run_backfill(source, uploader, concurrency=1)
+        self.assertFalse(stats['running'])
+        self.assertEqual((stats['chunks'], len(uploader.sent)), (0, 1))
+        archive.close()
+
+
+    def test_rate_and_concurrency_must_be_positive(self):
+        for settings in ({'concurrency': 0}, {'rate': 0}):
+            with self.assertRaises(ValueError):
+                Backfill(None, FakeUploader(), engine=self.engine, **settings)
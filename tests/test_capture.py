@@ -0,0 +1,143 @@
+import os, shutil, struct, tempfile, time, unittest
+
+from sensclient.capture import FILE_HEADER, RECORD, CaptureReader, CaptureWriter, ReplayListener
+from sensclient.engine import Engine
+from sensclient.framing import DISPATCH_AM, PROTO_PACKET_NOACK, frame
+from sensclient.listener import AM_HEADER, Listener
+
+
+def message(count, readings=(1, 2, 3)):
+    payload = struct.pack('>HHHH{}H'.format(len(readings)), 1, 256, 7, count, *readings)
+    am = AM_HEADER.pack(0xffff, 7, len(payload), 0x22, Listener.AM_RATES['OSCILLOSCOPE'])
+    return frame(bytes((PROTO_PACKET_NOACK, DISPATCH_AM)) + am + payload)
+
+
+class CaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, 'capture.scap')
+        self.readers = []
+
+
+    def tearDown(self):
+        for reader in self.readers:
+            reader.close()
+        shutil.rmtree(self.path)
+
+
+    def write(self, chunks, index_interval=1024*1024, close=True):
+        '''
+        Writes a capture of chunks, the i-th read i tenths of a second
+        after the capture started.
+        '''
+        writer = CaptureWriter(self.filename, index_interval)
+        start = writer._start
+        for i, chunk in enumerate(chunks):
+            writer.write(chunk, start + i * 100000000)
+        if close:
+            writer.close()
+        else:
+            writer._fp.flush()
+        return writer
+
+
+    def read(self):
+        reader = CaptureReader(self.filename)
+        self.readers.append(reader)
+        return reader
+
+
+    def test_round_trip(self):
+        chunks = [b'first', b'', b'third chunk']
+        writer = self.write(chunks)
+        self.assertEqual((writer.records(), writer.size()),
+            (3, FILE_HEADER.size + 3 * RECORD.size + 16))
+        reader = self.read()
+        self.assertGreater(reader.started(), time.time() - 60)
+        self.assertEqual(reader.size(), 3 * RECORD.size + 16)
+        # a capture this small indexes its first record, the length runs to its last
+        self.assertEqual(reader.duration(), 0.2)
+        records = list(reader.records())
+        self.assertEqual([(ts, bytes(data)) for ts, data, _ in records],
+            [(0, b'first'), (100000000, b''), (200000000, b'third chunk')])
+        self.assertEqual(records[-1][2], FILE_HEADER.size + reader.size())
+
+
+    def test_unclosed_capture_with_a_torn_record(self):
+        self.write([b'one', b'two', b'three'], close=False)
+        with open(self.filename, 'ab') as f:
+            f.write(RECORD.pack(300000000, 100) + b'torn')
+        reader = self.read()
+        self.assertEqual([bytes(data) for _, data, _ in reader.records()], [b'one', b'two', b'three'])
+        self.assertEqual(reader.duration(), 0.2)
+        self.assertEqual(reader.size(), 3 * RECORD.size + 11)
+
+
+    def test_seek_and_start(self):
+        chunks = [b'%02d' % i for i in range(20)]
+        self.write(chunks, index_interval=3 * (RECORD.size + 2))
+        reader = self.read()
+        self.assertEqual(reader.duration(), 1.9)
+        # the index holds every third record
+        self.assertEqual(reader.seek(0), FILE_HEADER.size)
+        self.assertEqual(reader.seek(0.75), FILE_HEADER.size + 6 * (RECORD.size + 2))
+        self.assertEqual(reader.seek(-1), FILE_HEADER.size)
+        self.assertEqual([bytes(data) for _, data, _ in reader.records(start=0.75)],
+            chunks[8:])
+        # starting from an offset reads on from there
+        _, _, offset = next(reader.records(start=1.5))
+        self.assertEqual([bytes(data) for _, data, _ in reader.records(offset)], chunks[16:])
+
+
+    def test_not_a_capture(self):
+        for data in (b'', b'SCAP', b'PCAP' + bytes(FILE_HEADER.size)):
+            with open(self.filename, 'wb') as f:
+                f.write(data)
+            with self.assertRaises(ValueError):
+                CaptureReader(self.filename)
+
+
+class ReplayListenerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, 'capture.scap')
+        self.engine = Engine()
+
+
+    def tearDown(self):
+        self.engine.close()
+        shutil.rmtree(self.path)
+
+
+    def test_replay_as_fast_as_possible(self):
+        writer = CaptureWriter(self.filename)
+        data = b''.join(message(count) for count in range(200))
+        # chunks that split frames, read an hour apart
+        for i in range(0, len(data), 50):
+            writer.write(data[i:i+50], writer._start + i * 72000000000)
+        writer.close()
+        events = []
+        listener = ReplayListener(lambda device, msg: events.append((device, msg)), self.filename,
+            speed=0, engine=self.engine)
+        self.assertEqual(listener.baudrate(), 'max')
+        listener.start()
+        listener.resume()
+        deadline = time.monotonic() + 10
+        while listener.is_alive() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(listener.is_alive())
+        self.assertEqual([msg.count for _, msg in events], list(range(200)))
+        self.assertEqual(events[0][0], self.filename)
+        self.assertEqual(list(events[0][1].readings), [1, 2, 3])
+        reader = CaptureReader(self.filename)
+        self.assertEqual(listener.position(), FILE_HEADER.size + reader.size())
+        reader.close()
+
+
+    def test_invalid_replays(self):
+        with self.assertRaises(ValueError):
+            ReplayListener(None, self.filename, speed=-1, engine=self.engine)
+        with self.assertRaises(ValueError):
+            ReplayListener(None, self.filename, engine=self.engine).record(None)
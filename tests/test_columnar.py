@@ -0,0 +1,77 @@
+import unittest
+
+from sensclient import columnar
+
+
+def reading(device='/dev/ttyUSB0', ts=1700000000.0, ident=1, count=0, readings=(), version=1, interval=256):
+    return {'device': device, 'ts': ts, 'version': version, 'interval': interval, 'id': ident,
+        'count': count, 'readings': list(readings)}
+
+
+class ColumnarTest(unittest.TestCase):
+
+    def assertRoundTrip(self, readings):
+        decoded = columnar.decode(columnar.encode(readings))
+        self.assertEqual(len(decoded), len(readings))
+        for expected, actual in zip(readings, decoded):
+            self.assertAlmostEqual(actual.pop('ts'), expected['ts'], places=6)
+            self.assertEqual(actual, {k: v for k, v in expected.items() if k != 'ts'})
+
+
+    def test_empty(self):
+        self.assertEqual(columnar.decode(columnar.encode([])), [])
+
+
+    def test_series(self):
+        self.assertRoundTrip([reading(count=i, ts=1700000000.0 + i / 4, readings=range(i, i + 10))
+            for i in range(20)])
+
+
+    def test_series_are_grouped(self):
+        readings = [reading(ident=i % 2, count=i, readings=[i]) for i in range(6)]
+        decoded = columnar.decode(columnar.encode(readings))
+        self.assertEqual([r['count'] for r in decoded], [0, 2, 4, 1, 3, 5])
+
+
+    def test_devices(self):
+        self.assertRoundTrip([reading(device=name, readings=[1]) for name in ('a', 'b', 'capteur-é')])
+
+
+    def test_count_wraparound(self):
+        self.assertRoundTrip([reading(count=count) for count in (0xfffe, 0xffff, 0, 1, 0x8000, 3)])
+
+
+    def test_varint_boundaries(self):
+        values = [0, 63, 64, 0x7f, 0x80, 0x3fff, 0x4000, 0xffff, 2 ** 32 - 1, 0, 2 ** 40]
+        self.assertRoundTrip([reading(readings=values), reading(readings=list(reversed(values)))])
+
+
+    def test_timestamps_go_backwards(self):
+        self.assertRoundTrip([reading(ts=ts) for ts in (100.0, 99.5, 0.000001, 1e9)])
+
+
+    def test_varints(self):
+        out = bytearray()
+        for value in (0, 0x7f, 0x80, 300):
+            columnar._put(out, value)
+        self.assertEqual(bytes(out), b'\x00\x7f\x80\x01\xac\x02')
+
+
+    def test_zigzag(self):
+        self.assertEqual([columnar._zigzag(v) for v in (0, -1, 1, -2, 2)], [0, 1, 2, 3, 4])
+        for value in (0, 1, -1, 2 ** 40, -2 ** 40):
+            self.assertEqual(columnar._unzigzag(columnar._zigzag(value)), value)
+
+
+    def test_other_readings_raise(self):
+        with self.assertRaises(ValueError):
+            columnar.encode([dict(reading(), extra=1)])
+        with self.assertRaises(ValueError):
+            columnar.encode([{'device': 'd', 'ts': 0.0, 'payload': 'ff'}])
+
+
+    def test_invalid_bodies_raise(self):
+        body = columnar.encode([reading(readings=range(100))])
+        for invalid in (b'', b'JSON', body[:-1], body[:len(columnar.MAGIC) + 1]):
+            with self.assertRaises(ValueError):
+                columnar.decode(invalid)
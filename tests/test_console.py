@@ -0,0 +1,115 @@
+import unittest
+from unittest import mock
+
+import numpy
+
+from sensclient.console import Sampler, Summary, SummaryRow, render
+from sensclient.decoding import Oscilloscope
+
+
+def message(ident=1, readings=(1,)):
+    return Oscilloscope(1, 256, ident, 0, readings)
+
+
+class Clock:
+    '''
+    Stands in for time.monotonic(), moving only when told to.
+    '''
+
+    def __init__(self):
+        self.now = 1000.0
+
+
+    def __call__(self):
+        return self.now
+
+
+class SummaryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('sensclient.console.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def test_aggregation(self):
+        summary = Summary()
+        summary.add('a', message(1, [4, 2, 9]))
+        summary.add('a', message(1, numpy.array([1, 3], dtype=numpy.uint16)))
+        summary.add('a', message(2, [10]))
+        summary.add('b', object())
+        self.clock.now += 2.0
+        self.assertEqual(summary.snapshot(), [
+            SummaryRow('a', None, 1.5, None, 1, 10, 29 / 6),
+            SummaryRow('a', 1, 1.0, 3, 1, 9, 19 / 5),
+            SummaryRow('a', 2, 0.5, 10, 10, 10, 10.0),
+            SummaryRow('b', None, 0.5, None, None, None, None),
+            SummaryRow('b', None, 0.5, None, None, None, None)])
+
+
+    def test_windows(self):
+        summary = Summary()
+        summary.add('a', message(1, [4]))
+        summary.add('a', message(2, []))
+        self.clock.now += 1.0
+        summary.snapshot()
+        summary.add('a', message(2, [7]))
+        self.clock.now += 4.0
+        # a quiet mote keeps its last value, at a rate of 0
+        self.assertEqual(summary.snapshot(), [
+            SummaryRow('a', None, 0.25, None, 7, 7, 7.0),
+            SummaryRow('a', 1, 0.0, 4, None, None, None),
+            SummaryRow('a', 2, 0.25, 7, 7, 7, 7.0)])
+
+
+    def test_render(self):
+        rows = [SummaryRow('a', None, 1.5, None, 1, 10, 29 / 6), SummaryRow('a', 1, 1.0, 3, 1, 9, None)]
+        lines = render(rows, loss=lambda device, mote: 0.125 if mote == 1 else None)
+        self.assertEqual(lines[0].split(), ['DEVICE', 'MOTE', 'MSG/S', 'LAST', 'MIN', 'MAX', 'MEAN', 'LOSS'])
+        self.assertEqual(lines[1].split(), ['a', 'all', '1.5', '-', '1', '10', '4.8', '-'])
+        self.assertEqual(lines[2].split(), ['1', '1.0', '3', '1', '9', '-', '12.50%'])
+
+
+class SamplerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('sensclient.console.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def test_filters_and_every(self):
+        sampler = Sampler(rate=100, every=2, device='a', mote=1)
+        for i in range(6):
+            sampler.offer('a', message(1, [i]))
+            sampler.offer('a', message(2, [i]))
+            sampler.offer('b', message(1, [i]))
+        self.assertEqual([event.readings[0] for _, event in sampler.drain()], [1, 3, 5])
+        self.assertEqual(sampler.drain(), [])
+
+
+    def test_rate_limit(self):
+        sampler = Sampler(rate=2)
+        for i in range(5):
+            sampler.offer('a', message(1, [i]))
+        self.assertEqual((len(sampler.drain()), sampler.skipped()), (2, 3))
+        # the bucket refills over time
+        self.clock.now += 0.5
+        sampler.offer('a', message())
+        sampler.offer('a', message())
+        self.assertEqual((len(sampler.drain()), sampler.skipped()), (1, 4))
+
+
+    def test_oldest_events_are_dropped(self):
+        sampler = Sampler(rate=100, maxlen=2)
+        for i in range(3):
+            sampler.offer('a', message(1, [i]))
+        self.assertEqual([event.readings[0] for _, event in sampler.drain()], [1, 2])
+
+
+    def test_invalid_settings(self):
+        for settings in ({'rate': 0}, {'every': 0}):
+            with self.assertRaises(ValueError):
+                Sampler(**settings)
@@ -0,0 +1,221 @@
+import struct, unittest
+
+from sensclient import decoding
+from sensclient.decoding import HEADER, OSCILLOSCOPE, DecoderRegistry, MessageLayout, Oscilloscope, \
+    decode_batch, decode_header, decode_message, integers_view
+
+
+def oscilloscope(ident, count, readings, version=1, interval=256):
+    return struct.pack('>HHHH{}H'.format(len(readings)), version, interval, ident, count, *readings)
+
+
+class WithoutNumpy:
+    '''
+    Runs a test with the decoders behaving as if NumPy were not
+    installed.
+    '''
+
+    def setUp(self):
+        self._numpy = decoding.numpy, decoding._numpy_loaded
+        decoding.numpy, decoding._numpy_loaded = None, True
+
+
+    def tearDown(self):
+        decoding.numpy, decoding._numpy_loaded = self._numpy
+
+
+class DecodeMessageTest(unittest.TestCase):
+
+    def test_header(self):
+        payload = oscilloscope(7, 300, [1, 2])
+        self.assertEqual(decode_header(payload), (1, 256, 7, 300))
+        self.assertEqual(decode_header(b'\0' * 3 + payload, 3), (1, 256, 7, 300))
+
+
+    def test_message(self):
+        msg = decode_message(oscilloscope(7, 300, [0, 1, 0x1234, 0xffff]))
+        self.assertEqual((msg.version, msg.interval, msg.id, msg.count), (1, 256, 7, 300))
+        self.assertEqual(list(msg.readings), [0, 1, 0x1234, 0xffff])
+
+
+    def test_message_without_readings(self):
+        msg = decode_message(oscilloscope(7, 300, []))
+        self.assertEqual(len(msg.readings), 0)
+
+
+    def test_odd_trailing_byte_is_ignored(self):
+        msg = decode_message(oscilloscope(7, 300, [5, 6]) + b'\x01')
+        self.assertEqual(list(msg.readings), [5, 6])
+
+
+    def test_short_message_raises(self):
+        with self.assertRaises(struct.error):
+            decode_message(b'\0' * (HEADER.size - 1))
+
+
+    def test_integers_view_sizes(self):
+        payload = b'\x00' + struct.pack('>IIQ', 1, 0xdeadbeef, 0)
+        self.assertEqual(list(integers_view(payload, 1, 4)), [1, 0xdeadbeef, 0, 0])
+        self.assertEqual(list(integers_view(payload, 1, 8)), [0x1deadbeef, 0])
+        self.assertEqual(list(integers_view(payload, 0, 1))[:2], [0, 0])
+
+
+    def test_batch(self):
+        payloads = [oscilloscope(i, i * 10, [i, i + 1, i + 2]) for i in range(4)]
+        columns = decode_batch(payloads)
+        self.assertEqual(list(columns['id']), [0, 1, 2, 3])
+        self.assertEqual(list(columns['count']), [0, 10, 20, 30])
+        self.assertEqual([list(row) for row in columns['readings']],
+            [[i, i + 1, i + 2] for i in range(4)])
+
+
+    def test_empty_batch(self):
+        self.assertEqual(decode_batch([])['readings'], [])
+
+
+    def test_batch_of_mixed_sizes_raises(self):
+        with self.assertRaises(ValueError):
+            decode_batch([oscilloscope(1, 1, [1]), oscilloscope(1, 2, [1, 2])])
+        with self.assertRaises(ValueError):
+            decode_batch([oscilloscope(1, 1, [1]) + b'\x01'])
+
+
+class DecodeMessageWithoutNumpyTest(WithoutNumpy, DecodeMessageTest):
+    pass
+
+
+SENSE = [('id', 'int', 2), ('delta', 'sint', 2), ('flags', 'int', 1), ('tag', 'blob', 3),
+    ('readings', 'array', 4)]
+
+
+class MessageLayoutTest(unittest.TestCase):
+
+    def test_decode(self):
+        layout = MessageLayout('Sense', SENSE)
+        msg = layout.decode(struct.pack('>Hhb3sII', 9, -2, 1, b'abc', 7, 0xffffffff))
+        self.assertEqual(msg[:4], (9, -2, 1, b'abc'))
+        self.assertEqual(list(msg.readings), [7, 0xffffffff])
+        self.assertEqual(layout.size(), 8)
+
+
+    def test_blob_tail(self):
+        layout = MessageLayout('Raw', [('kind', 'int', 1), ('data', 'blob', None)])
+        self.assertEqual(layout.decode(b'\x01rest'), (1, b'rest'))
+
+
+    def test_fixed_only(self):
+        layout = MessageLayout('Fixed', [('a', 'int', 8), ('b', 'sint', 1)])
+        self.assertEqual(layout.decode(b'\0' * 7 + b'\x05\xff'), (5, -1))
+
+
+    def test_invalid_layouts(self):
+        for fields in ([('a', 'int', 3)], [('a', 'float', 4)], [('a', 'blob', None), ('b', 'int', 1)],
+                [('a', 'array', 2), ('b', 'int', 1)]):
+            with self.assertRaises(ValueError):
+                MessageLayout('Bad', fields)
+        with self.assertRaises(ValueError):
+            MessageLayout('Bad', [('a', 'int', 1)], Oscilloscope)
+
+
+    def test_short_message_raises(self):
+        with self.assertRaises(struct.error):
+            MessageLayout('Sense', SENSE).decode(b'\0' * 7)
+
+
+class DecoderRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = DecoderRegistry()
+        self.registry.register(0x93, 'oscilloscope', OSCILLOSCOPE)
+        self.registry.register_layout('0x20', 'Sense', SENSE)
+
+
+    def test_lookup(self):
+        self.assertEqual(self.registry.lookup(0x93), OSCILLOSCOPE.decode)
+        self.assertIsNotNone(self.registry.lookup(0x20))
+        self.assertIsNone(self.registry.lookup(0x21))
+
+
+    def test_resolve(self):
+        self.assertEqual(self.registry.resolve('OSCILLOSCOPE'), 0x93)
+        self.assertEqual(self.registry.resolve('sense'), 0x20)
+        self.assertEqual(self.registry.resolve('0x21'), 0x21)
+        self.assertEqual(self.registry.resolve(33), 33)
+        for amrate in ('unknown', 256, -1):
+            with self.assertRaises(ValueError):
+                self.registry.resolve(amrate)
+
+
+    def test_select(self):
+        self.assertEqual(self.registry.select('ALL'), [0x20, 0x93])
+        self.assertEqual(self.registry.select('sense, 0x93'), [0x20, 0x93])
+        self.assertEqual(self.registry.select(['0x93', 0x93]), [0x93])
+
+
+    def test_register_replaces(self):
+        self.registry.register(0x20, 'other', OSCILLOSCOPE)
+        self.assertEqual(self.registry.names(), {'OSCILLOSCOPE': 0x93, 'OTHER': 0x20})
+        self.registry.unregister(0x20)
+        self.assertIsNone(self.registry.lookup(0x20))
+        self.assertEqual(self.registry.names(), {'OSCILLOSCOPE': 0x93})
+
+
+    def test_table(self):
+        table = self.registry.table([0x93])
+        self.assertEqual(len(table), 256)
+        self.assertEqual(table[0x93], OSCILLOSCOPE.decode)
+        self.assertIsNone(table[0x20])
+        with self.assertRaises(ValueError):
+            self.registry.table([0x21])
+
+
+class ColumnsTest(unittest.TestCase):
+
+    def _round_trip(self, layout, payloads):
+        writer = layout.writer()
+        messages = [layout.decode(payload) for payload in payloads]
+        size = sum(writer.append(msg) for msg in messages)
+        packed = writer.pack()
+        self.assertEqual(len(writer), len(messages))
+        self.assertEqual(len(packed), size + 4)
+        return messages, layout.read_columns(packed)
+
+
+    def _assertSameMessages(self, expected, actual):
+        self.assertEqual(len(expected), len(actual))
+        for a, b in zip(expected, actual):
+            self.assertEqual(type(a), type(b))
+            self.assertEqual(a[:-1], b[:-1])
+            self.assertEqual(list(a[-1]), list(b[-1]))
+
+
+    def test_oscilloscope(self):
+        payloads = [oscilloscope(i, i, list(range(i))) for i in range(5)]
+        self._assertSameMessages(*self._round_trip(OSCILLOSCOPE, payloads))
+
+
+    def test_signed_and_blob_fields(self):
+        layout = MessageLayout('Sense', SENSE)
+        payloads = [struct.pack('>Hhb3s{}I'.format(i), i, -i, 1, b'x%02d' % i, *range(i, 2 * i))
+            for i in range(4)]
+        self._assertSameMessages(*self._round_trip(layout, payloads))
+
+
+    def test_blob_tail(self):
+        layout = MessageLayout('Raw', [('kind', 'int', 1), ('data', 'blob', None)])
+        messages, rebuilt = self._round_trip(layout, [b'\x01', b'\x02ab', b'\x03\x7e\x00'])
+        self.assertEqual(messages, rebuilt)
+
+
+    def test_fixed_only(self):
+        layout = MessageLayout('Fixed', [('a', 'int', 8), ('b', 'sint', 1)])
+        messages, rebuilt = self._round_trip(layout, [b'\0' * 7 + bytes([i, 256 - i]) for i in range(1, 4)])
+        self.assertEqual(messages, rebuilt)
+
+
+    def test_empty(self):
+        self.assertEqual(OSCILLOSCOPE.read_columns(OSCILLOSCOPE.writer().pack()), [])
+
+
+class ColumnsWithoutNumpyTest(WithoutNumpy, ColumnsTest):
+    pass
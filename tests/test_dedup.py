@@ -0,0 +1,68 @@
+import time, unittest
+
+from sensclient.decoding import Oscilloscope
+from sensclient.dedup import DuplicateFilter
+
+
+def message(ident=1, count=0, version=1):
+    return Oscilloscope(version, 256, ident, count, [])
+
+
+class DuplicateFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.filter = DuplicateFilter(window=2.0, maxsize=4)
+        self.now = time.monotonic()
+
+
+    def admit(self, event, device='a', after=0.0):
+        return self.filter.admit(device, event, self.now + after)
+
+
+    def test_copies_are_suppressed(self):
+        self.assertTrue(self.admit(message(), 'a'))
+        self.assertFalse(self.admit(message(), 'b'))
+        self.assertTrue(self.admit(message(count=1), 'b'))
+        self.assertEqual(self.filter.stats(), {'admitted': {'a': 1, 'b': 1}, 'suppressed': {'b': 1}})
+
+
+    def test_key_fields(self):
+        self.assertTrue(self.admit(message()))
+        self.assertTrue(self.admit(message(ident=2)))
+        self.assertTrue(self.admit(message(version=2)))
+        # another message type with the same fields is another message
+        Other = type('Other', (), {'id': 1, 'count': 0, 'version': 1})
+        self.assertTrue(self.admit(Other()))
+
+
+    def test_messages_without_the_fields_pass(self):
+        self.assertTrue(self.admit(object()))
+        self.assertTrue(self.admit(object()))
+        self.assertEqual(self.filter.size(), 0)
+
+
+    def test_keys_outlive_one_generation(self):
+        self.admit(message(), after=0.0)
+        # the first rotation keeps the key in the previous generation
+        self.assertFalse(self.admit(message(), after=2.5))
+        self.assertTrue(self.admit(message(count=9), after=2.5))
+        # the second forgets it
+        self.assertTrue(self.admit(message(), after=5.0))
+
+
+    def test_full_generation_rotates(self):
+        for count in range(4):
+            self.assertTrue(self.admit(message(count=count)))
+        self.assertEqual(self.filter.size(), 4)
+        self.assertTrue(self.admit(message(count=4)))
+        self.assertFalse(self.admit(message(count=0)))
+        for count in range(5, 8):
+            self.admit(message(count=count))
+        self.assertTrue(self.admit(message(count=0)))
+        self.assertLessEqual(self.filter.size(), 8)
+
+
+    def test_invalid_limits(self):
+        for window, maxsize in ((0, 1), (1, 0), (-1, 1)):
+            with self.assertRaises(ValueError):
+                DuplicateFilter(window, maxsize)
@@ -0,0 +1,68 @@
+import asyncio, threading, unittest
+
+from sensclient.engine import Engine
+
+
+class EngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = Engine()
+
+
+    def tearDown(self):
+        self.engine.close()
+
+
+    def test_call_returns_the_result(self):
+        async def add(a, b):
+            return a + b
+        self.assertEqual(self.engine.call(add(1, 2)), 3)
+
+
+    def test_call_raises_the_exception(self):
+        async def fail():
+            raise KeyError('missing')
+        with self.assertRaises(KeyError):
+            self.engine.call(fail())
+
+
+    def test_coroutines_run_on_the_engine_thread(self):
+        async def where():
+            return self.engine.in_loop(), threading.current_thread().name
+        self.assertEqual(self.engine.call(where()), (True, 'sensclient-engine'))
+        self.assertFalse(self.engine.in_loop())
+
+
+    def test_call_from_the_engine_thread_is_refused(self):
+        async def nested():
+            async def inner():
+                pass
+            self.engine.call(inner())
+        with self.assertRaises(RuntimeError):
+            self.engine.call(nested())
+
+
+    def test_call_soon_runs_the_function(self):
+        done = threading.Event()
+        self.engine.call_soon(done.set)
+        self.assertTrue(done.wait(2))
+
+
+    def test_close_cancels_outstanding_tasks(self):
+        started, cancelled = threading.Event(), threading.Event()
+        async def forever():
+            started.set()
+            try:
+                await asyncio.sleep(3600)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+        self.engine.submit(forever())
+        self.assertTrue(started.wait(2))
+        self.engine.close()
+        self.assertTrue(cancelled.is_set())
+        self.assertTrue(self.engine.closed())
+
+
+    def test_default_is_shared(self):
+        self.assertIs(Engine.default(), Engine.default())
@@ -0,0 +1,109 @@
+import threading, time, unittest
+
+from sensclient.eventqueue import EventQueue
+
+
+class EventQueueTest(unittest.TestCase):
+
+    def fill(self, queue, count, device='a', start=0):
+        return [queue.put(device, i) for i in range(start, start + count)]
+
+
+    def events(self, queue):
+        return [(device, event) for device, event, _ in queue.get(max_items=100, timeout=0)]
+
+
+    def test_fifo(self):
+        queue = EventQueue(maxsize=4)
+        self.fill(queue, 3)
+        self.assertEqual(queue.depth(), 3)
+        items = queue.get(max_items=2)
+        self.assertEqual([event for _, event, _ in items], [0, 1])
+        self.assertLessEqual(items[0][2], time.monotonic())
+        self.assertEqual(self.events(queue), [('a', 2)])
+        self.assertEqual(queue.get(timeout=0.01), [])
+
+
+    def test_drop_oldest(self):
+        queue = EventQueue(maxsize=3, policy=EventQueue.DROP_OLDEST)
+        self.fill(queue, 2, device='a')
+        self.assertEqual(self.fill(queue, 3, device='b'), [True] * 3)
+        # the drops count against the devices whose events were lost
+        self.assertEqual((queue.dropped('a'), queue.dropped('b'), queue.dropped()), (2, 0, 2))
+        self.assertEqual(self.events(queue), [('b', 0), ('b', 1), ('b', 2)])
+
+
+    def test_drop_newest(self):
+        queue = EventQueue(maxsize=3, policy=EventQueue.DROP_NEWEST)
+        self.assertEqual(self.fill(queue, 5), [True] * 3 + [False] * 2)
+        self.assertEqual(queue.dropped('a'), 2)
+        self.assertEqual([event for _, event in self.events(queue)], [0, 1, 2])
+
+
+    def test_sample(self):
+        queue = EventQueue(maxsize=2, policy=EventQueue.SAMPLE, sample_every=3)
+        self.assertEqual(self.fill(queue, 8), [True, True, False, False, True, False, False, True])
+        self.assertEqual([event for _, event in self.events(queue)], [4, 7])
+        # 4 overflowing events were turned away, 2 queued ones displaced
+        self.assertEqual(queue.dropped('a'), 6)
+        # sampling starts over once there is room again
+        self.fill(queue, 2, start=10)
+        self.assertEqual(self.fill(queue, 3, start=20), [False, False, True])
+
+
+    def test_sample_is_per_device(self):
+        queue = EventQueue(maxsize=1, policy=EventQueue.SAMPLE, sample_every=2)
+        queue.put('a', 0)
+        self.assertEqual([queue.put('a', 1), queue.put('b', 1), queue.put('b', 2), queue.put('a', 2)],
+            [False, False, True, True])
+        self.assertEqual(self.events(queue), [('a', 2)])
+        self.assertEqual(queue.stats()['dropped'], {'a': 2, 'b': 2})
+
+
+    def test_block_waits_for_room(self):
+        queue = EventQueue(maxsize=1, policy=EventQueue.BLOCK)
+        queue.put('a', 0)
+        results = []
+        producer = threading.Thread(target=lambda: results.append(queue.put('a', 1)))
+        producer.start()
+        time.sleep(0.05)
+        self.assertEqual(results, [])
+        self.assertEqual([event for _, event in self.events(queue)], [0])
+        producer.join(5)
+        self.assertEqual(results, [True])
+        self.assertEqual([event for _, event in self.events(queue)], [1])
+        self.assertEqual(queue.dropped(), 0)
+
+
+    def test_block_timeout(self):
+        queue = EventQueue(maxsize=1, policy=EventQueue.BLOCK, block_timeout=0.01)
+        self.assertEqual(self.fill(queue, 2), [True, False])
+        self.assertEqual(queue.dropped('a'), 1)
+
+
+    def test_close_wakes_producers_and_consumers(self):
+        queue = EventQueue(maxsize=1, policy=EventQueue.BLOCK)
+        queue.put('a', 0)
+        results = []
+        producer = threading.Thread(target=lambda: results.append(queue.put('a', 1)))
+        producer.start()
+        time.sleep(0.05)
+        queue.close()
+        producer.join(5)
+        self.assertEqual(results, [False])
+        self.assertFalse(queue.put('a', 2))
+        # what was queued can still be drained
+        self.assertEqual([event for _, event in self.events(queue)], [0])
+        self.assertEqual(queue.get(timeout=5), [])
+
+
+    def test_stats(self):
+        queue = EventQueue(maxsize=2, policy=EventQueue.DROP_NEWEST)
+        self.fill(queue, 3)
+        self.assertEqual(queue.stats(), {'depth': 2, 'maxsize': 2, 'policy': EventQueue.DROP_NEWEST,
+            'accepted': 2, 'dropped': {'a': 1}})
+
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            EventQueue(policy='drop-random')
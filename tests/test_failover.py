@@ -0,0 +1,117 @@
+import time, unittest
+
+from sensclient.engine import Engine
+from sensclient.failover import FailoverMonitor, ServerHealth
+
+
+async def settle():
+    # runs after whatever was scheduled on the engine before it
+    pass
+
+
+class ServerHealthTest(unittest.TestCase):
+
+    def test_moving_averages(self):
+        health = ServerHealth('a', 0.5)
+        self.assertEqual(health.score(10.0), float('inf'))
+        health.record(1.0, True)
+        health.record(0.5, True)
+        self.assertEqual((health.latency, health.error_rate), (0.75, 0.0))
+        health.record(5.0, False)
+        # failures do not count towards the latency
+        self.assertEqual((health.latency, health.error_rate), (0.75, 0.5))
+        self.assertEqual(health.score(2.0), 1.5)
+        self.assertEqual((health.samples, health.errors), (3, 1))
+
+
+class FailoverMonitorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = Engine()
+        self.switches = []
+
+
+    def tearDown(self):
+        self.engine.close()
+
+
+    def monitor(self, **settings):
+        monitor = FailoverMonitor({0: 'primary', 1: 'secondary'}, self.switches.append, 0,
+            engine=self.engine, **dict(dict(alpha=1.0, min_dwell=0.0, switch_after=3), **settings))
+        monitor.enable()
+        return monitor
+
+
+    def evaluate(self, monitor, primary, secondary, rounds=1):
+        for _ in range(rounds):
+            monitor.observe('primary', primary, True)
+            monitor.observe('secondary', secondary, True)
+            monitor._evaluate()
+
+
+    def test_switches_after_consecutive_wins(self):
+        monitor = self.monitor()
+        self.evaluate(monitor, 1.0, 0.5, rounds=2)
+        self.assertEqual((self.switches, monitor.current()), ([], 0))
+        self.evaluate(monitor, 1.0, 0.5)
+        self.assertEqual((self.switches, monitor.current()), ([1], 1))
+
+
+    def test_margin(self):
+        monitor = self.monitor()
+        # better, but not by the margin
+        self.evaluate(monitor, 1.0, 0.8, rounds=5)
+        self.assertEqual(self.switches, [])
+
+
+    def test_a_lost_round_starts_over(self):
+        monitor = self.monitor()
+        self.evaluate(monitor, 1.0, 0.5, rounds=2)
+        self.evaluate(monitor, 1.0, 1.0)
+        self.evaluate(monitor, 1.0, 0.5, rounds=2)
+        self.assertEqual(self.switches, [])
+        self.evaluate(monitor, 1.0, 0.5)
+        self.assertEqual(self.switches, [1])
+
+
+    def test_min_dwell(self):
+        monitor = self.monitor(min_dwell=3600.0)
+        self.evaluate(monitor, 1.0, 0.5, rounds=5)
+        self.assertEqual(self.switches, [])
+        monitor._switched = time.monotonic() - 3600.0
+        self.evaluate(monitor, 1.0, 0.5)
+        self.assertEqual(self.switches, [1])
+
+
+    def test_failing_server_is_left_at_once(self):
+        monitor = self.monitor(min_dwell=3600.0)
+        self.evaluate(monitor, 1.0, 0.9)
+        monitor.observe('primary', 1.0, False)
+        monitor._evaluate()
+        self.assertEqual(self.switches, [1])
+
+
+    def test_servers_that_never_answered_are_not_picked(self):
+        monitor = self.monitor()
+        monitor.observe('primary', 1.0, True)
+        monitor.observe('secondary', 0.1, False)
+        for _ in range(5):
+            monitor._evaluate()
+        self.assertEqual(self.switches, [])
+
+
+    def test_disabled(self):
+        monitor = self.monitor()
+        monitor.disable(current=1)
+        self.assertEqual((monitor.enabled(), monitor.current()), (False, 1))
+
+
+    def test_set_servers_keeps_health(self):
+        monitor = self.monitor()
+        monitor.observe('secondary', 0.5, True)
+        monitor.set_servers({0: 'secondary', 1: 'tertiary'}, 0)
+        self.engine.call(settle())
+        self.assertEqual(monitor.health(0).latency, 0.5)
+        self.assertIsNone(monitor.health(1).latency)
+        monitor.observe('primary', 0.1, True)
+        self.assertIsNone(monitor.health(2))
@@ -0,0 +1,106 @@
+import io, unittest
+
+from sensclient.framing import FrameParser, crc16, escape, frame
+
+
+def bodies(parser):
+    return [bytes(body) for body in parser.frames()]
+
+
+class FramingTest(unittest.TestCase):
+
+    def test_crc16(self):
+        # the CRC-16/XMODEM check value
+        self.assertEqual(crc16(b'123456789'), 0x31c3)
+        self.assertEqual(crc16(b''), 0)
+
+
+    def test_escape(self):
+        self.assertEqual(escape(b'a\x7eb\x7dc'), b'a\x7d\x5eb\x7d\x5dc')
+        self.assertEqual(escape(b'\x7d\x5e'), b'\x7d\x5d\x5e')
+
+
+    def test_frame(self):
+        data = frame(b'\x45\x00\x01')
+        self.assertEqual(data[0], 0x7e)
+        self.assertEqual(data[-1], 0x7e)
+        self.assertNotIn(0x7e, data[1:-1])
+
+
+    def test_round_trip(self):
+        messages = [b'\x45plain', b'\x45\x7e\x7d\x7e\x7d', b'\x45' + bytes(range(256))]
+        parser = FrameParser()
+        parser.feed(b''.join(frame(body) for body in messages))
+        self.assertEqual(bodies(parser), messages)
+        self.assertEqual(parser.stats()['frames'], 3)
+
+
+    def test_escaped_crc(self):
+        # find a body whose CRC needs escaping
+        body = next(b for b in (b'\x45' + bytes([i, j]) for i in range(256) for j in range(256))
+            if 0x7e in crc16(b).to_bytes(2, 'little') or 0x7d in crc16(b).to_bytes(2, 'little'))
+        parser = FrameParser()
+        parser.feed(frame(body))
+        self.assertEqual(bodies(parser), [body])
+
+
+    def test_shared_flags(self):
+        # the closing flag of one frame may open the next
+        first, second = frame(b'\x45one'), frame(b'\x45two')
+        parser = FrameParser()
+        parser.feed(first + second[1:])
+        self.assertEqual(bodies(parser), [b'\x45one', b'\x45two'])
+
+
+    def test_split_across_reads(self):
+        data = frame(b'\x45split \x7e body')
+        parser = FrameParser()
+        parser.feed(data[:5])
+        self.assertEqual(bodies(parser), [])
+        parser.feed(data[5:])
+        self.assertEqual(bodies(parser), [b'\x45split \x7e body'])
+
+
+    def test_bad_crc(self):
+        data = bytearray(frame(b'\x45body'))
+        data[2] ^= 0x01
+        parser = FrameParser()
+        parser.feed(bytes(data) + frame(b'\x45next'))
+        self.assertEqual(bodies(parser), [b'\x45next'])
+        self.assertEqual(parser.stats()['crc_errors'], 1)
+
+
+    def test_garbage_is_discarded(self):
+        parser = FrameParser()
+        parser.feed(b'noise' + frame(b'\x45body'))
+        self.assertEqual(bodies(parser), [b'\x45body'])
+        stats = parser.stats()
+        self.assertEqual(stats['framing_errors'], 1)
+        self.assertEqual(stats['discarded'], 5)
+
+
+    def test_short_and_dangling_frames(self):
+        parser = FrameParser()
+        # too short to hold a CRC, then an escape with nothing after it
+        parser.feed(b'\x7e\x45\x7e' + b'\x7e\x45\x01\x7d\x7e' + frame(b'\x45ok'))
+        self.assertEqual(bodies(parser), [b'\x45ok'])
+        self.assertEqual(parser.stats()['framing_errors'], 2)
+
+
+    def test_runaway_frame_is_discarded(self):
+        parser = FrameParser(capacity=256, max_frame=64)
+        parser.feed(b'\x7e' + b'x' * 100)
+        self.assertEqual(bodies(parser), [])
+        self.assertEqual(parser.buffered(), 0)
+        parser.feed(frame(b'\x45after'))
+        self.assertEqual(bodies(parser), [b'\x45after'])
+
+
+    def test_fill_wraps_the_ring(self):
+        messages = [b'\x45message %d' % i for i in range(200)]
+        source = io.BytesIO(b''.join(frame(body) for body in messages))
+        parser = FrameParser(capacity=128, max_frame=64)
+        received = []
+        while parser.fill(source.readinto, 50):
+            received.extend(bodies(parser))
+        self.assertEqual(received, messages)
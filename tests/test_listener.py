@@ -0,0 +1,58 @@
+import struct, unittest
+from unittest import mock
+
+from sensclient.decoding import DecoderRegistry
+from sensclient.engine import Engine
+from sensclient.framing import DISPATCH_AM, PROTO_PACKET_NOACK
+from sensclient.listener import AM_HEADER, Listener
+
+
+def body(count, amtype=Listener.AM_RATES['OSCILLOSCOPE'], readings=(1, 2)):
+    payload = struct.pack('>HHHH{}H'.format(len(readings)), 1, 256, 7, count, *readings)
+    return bytes((PROTO_PACKET_NOACK, DISPATCH_AM)) + \
+        AM_HEADER.pack(0xffff, 7, len(payload), 0x22, amtype) + payload
+
+
+class DispatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = Engine()
+        self.events = []
+
+
+    def tearDown(self):
+        self.engine.close()
+
+
+    def listener(self, **settings):
+        return Listener(lambda device, msg: self.events.append((device, msg)), '/dev/null', 115200,
+            engine=self.engine, **settings)
+
+
+    def test_dispatch(self):
+        listener = self.listener()
+        listener._dispatch(memoryview(body(5)))
+        listener._dispatch(memoryview(body(6, amtype=0x20)))
+        self.assertEqual([(device, msg.count) for device, msg in self.events], [('/dev/null', 5)])
+        stats = listener.stats()
+        self.assertEqual((stats['packets'], stats['unhandled'], stats['decode_errors']), (1, 1, 0))
+
+
+    def test_decode_errors_are_counted_and_reported_once(self):
+        def decoder(payload):
+            if payload[7] == 3:
+                raise KeyError('not this one')
+            raise struct.error('too short')
+        registry = DecoderRegistry()
+        registry.register(0x93, 'OSCILLOSCOPE', decoder)
+        registry.register(0x20, 'OTHER', decoder)
+        listener = self.listener(amrate='ALL', registry=registry)
+        with mock.patch('sensclient.listener.click.secho') as secho:
+            for count in (1, 3, 1, 3):
+                listener._dispatch(memoryview(body(count)))
+            listener._dispatch(memoryview(body(1, amtype=0x20)))
+        self.assertEqual(self.events, [])
+        self.assertEqual((listener.stats()['decode_errors'], listener.stats()['packets']), (5, 0))
+        # once for each AM type, whatever the error
+        self.assertEqual(secho.call_count, 2)
+        self.assertIn('AM type 147', secho.call_args_list[0][0][0])
@@ -0,0 +1,81 @@
+import threading, unittest, urllib.error, urllib.request
+
+from sensclient.metrics import Counter, Histogram, MetricsServer, Registry, quantile
+
+
+def record_in_threads(record, threads=4):
+    workers = [threading.Thread(target=record, args=(num,)) for num in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_counter_slots_are_merged(self):
+        counter = Counter('events', 'Events.')
+        record_in_threads(lambda num: [counter.inc(('a',)) for _ in range(1000)])
+        counter.inc(('b',), amount=5)
+        self.assertEqual(len(counter._slots), 5)
+        self.assertEqual(counter.values(), {('a',): 4000, ('b',): 5})
+        self.assertEqual((counter.value(('a',)), counter.value(('c',))), (4000, 0))
+
+
+    def test_histogram_slots_are_merged(self):
+        histogram = Histogram('latency', 'Latency.', (1.0, 0.1))
+        self.assertEqual(histogram.buckets, (0.1, 1.0))
+        record_in_threads(lambda num: [histogram.observe(value) for value in (0.05, 0.1, 0.5, 2.0)])
+        snapshot = histogram.snapshot()
+        # a bucket holds the values up to and including its bound
+        self.assertEqual(snapshot['buckets'], [(0.1, 8), (1.0, 12), (float('inf'), 16)])
+        self.assertEqual((snapshot['count'], round(snapshot['sum'], 6)), (16, 10.6))
+        self.assertEqual(histogram.snapshot(('other',))['count'], 0)
+
+
+    def test_quantile(self):
+        histogram = Histogram('latency', 'Latency.', (0.1, 1.0))
+        self.assertIsNone(quantile(histogram.snapshot(), 0.5))
+        for value in (0.05, 0.05, 0.5, 5.0):
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual([quantile(snapshot, q) for q in (0.5, 0.75, 0.99)], [0.1, 1.0, float('inf')])
+
+
+    def test_render(self):
+        registry = Registry(prefix='test_')
+        errors = registry.counter('errors_total', 'Errors.', ('server',))
+        latency = registry.histogram('seconds', 'Latency.', ('server',), buckets=(0.5,))
+        registry.add_collector(lambda prefix: '# TYPE {}extra gauge\n{}extra 1\n'.format(prefix, prefix))
+        errors.inc(('b"\\',))
+        errors.inc(('a',), amount=2)
+        latency.observe(0.25, ('a',))
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP test_errors_total Errors.',
+            '# TYPE test_errors_total counter',
+            'test_errors_total{server="a"} 2',
+            'test_errors_total{server="b\\"\\\\"} 1',
+            '# HELP test_seconds Latency.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{server="a",le="0.5"} 1',
+            'test_seconds_bucket{server="a",le="+Inf"} 1',
+            'test_seconds_sum{server="a"} 0.25',
+            'test_seconds_count{server="a"} 1',
+            '# TYPE test_extra gauge',
+            'test_extra 1',
+            '']))
+
+
+    def test_server(self):
+        registry = Registry(prefix='test_')
+        registry.counter('events_total', 'Events.').inc()
+        server = MetricsServer(registry, port=0)
+        try:
+            url = 'http://{}:{}'.format(*server.address())
+            with urllib.request.urlopen(url + '/metrics', timeout=5) as resp:
+                self.assertTrue(resp.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+                self.assertIn('test_events_total 1\n', resp.read().decode('utf-8'))
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(url + '/other', timeout=5)
+        finally:
+            server.close()
@@ -0,0 +1,105 @@
+import threading, time, unittest
+from unittest import mock
+
+from benchmarks.fakemote import FakeMote
+from sensclient import client
+from sensclient.engine import Engine
+from sensclient.eventqueue import EventQueue
+from sensclient.listener import Listener
+from sensclient.probe import candidate_rates, probe
+
+
+class ProbeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = Engine()
+        self.motes = []
+
+
+    def tearDown(self):
+        for mote, sender in self.motes:
+            sender.join()
+            mote.close()
+        self.engine.close()
+
+
+    def mote(self, rate=200.0, duration=2.0, **settings):
+        '''
+        Opens a fake mote sending for a while in the background, a rate
+        of 0 sends nothing.
+        '''
+        mote = FakeMote(rate or 1.0, **settings)
+        sender = threading.Thread(target=mote.run, args=(duration if rate else 0,), daemon=True)
+        sender.start()
+        self.motes.append((mote, sender))
+        return mote
+
+
+    def test_candidate_rates(self):
+        rates = candidate_rates()
+        self.assertEqual(rates, sorted(set(Listener.RATES.values()), reverse=True))
+        self.assertEqual(rates[0], 115200)
+
+
+    def test_devices_are_probed_in_parallel(self):
+        talking, corrupt, silent = self.mote(), self.mote(corrupt=1.0), self.mote(rate=0)
+        devices = [talking.device, corrupt.device, silent.device, '/dev/does-not-exist']
+        start = time.monotonic()
+        results = probe(devices, rates=[115200, 57600], window=0.5, engine=self.engine)
+        elapsed = time.monotonic() - start
+        # a pty takes any rate, so the first one tried is picked
+        self.assertEqual(results[talking.device].baudrate, 115200)
+        self.assertEqual(list(results[talking.device].rates), [115200])
+        self.assertGreaterEqual(results[talking.device].rates[115200][0], 2)
+        # bad frames settle nothing
+        self.assertIsNone(results[corrupt.device].baudrate)
+        self.assertEqual(results[corrupt.device].rates[115200][0], 0)
+        self.assertGreater(results[corrupt.device].rates[115200][1], 0)
+        self.assertEqual(results[silent.device].rates, {115200: (0, 0), 57600: (0, 0)})
+        self.assertIsInstance(results['/dev/does-not-exist'], Exception)
+        # one device after the other would have taken 2s
+        self.assertLess(elapsed, 1.5)
+
+
+class StartDevicesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.motes = []
+        self.queue = EventQueue()
+        for name, value in (('_listeners', dict()), ('_queue', self.queue), ('_pool', None),
+                ('_sequence_options', None), ('_recent', None)):
+            patcher = mock.patch.object(client, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+    def tearDown(self):
+        for listener in client._listeners.values():
+            listener.stop()
+        for mote, sender in self.motes:
+            sender.join()
+            mote.close()
+
+
+    def mote(self):
+        mote = FakeMote(200.0, motes=2)
+        sender = threading.Thread(target=mote.run, args=(2.0,), daemon=True)
+        sender.start()
+        self.motes.append((mote, sender))
+        return mote
+
+
+    def test_bring_up(self):
+        first, second = self.mote(), self.mote()
+        with mock.patch.object(client, '_config', {'devices': [
+                {'device': first.device, 'baudrate': 'AUTO', 'amrate': 'OSCILLOSCOPE'},
+                {'device': second.device, 'baudrate': 'TELOSB', 'amrate': 'OSCILLOSCOPE'},
+                {'device': '/dev/does-not-exist', 'baudrate': 'AUTO', 'amrate': 'OSCILLOSCOPE'}]}):
+            client.start_devices(resume=True)
+        self.assertEqual(sorted(client._listeners), sorted([first.device, second.device]))
+        self.assertEqual(client._listeners[first.device].baudrate(), 115200)
+        devices = set()
+        deadline = time.monotonic() + 5
+        while devices != {first.device, second.device} and time.monotonic() < deadline:
+            devices.update(device for device, _, _ in self.queue.get(max_items=100, timeout=0.1))
+        self.assertEqual(devices, {first.device, second.device})
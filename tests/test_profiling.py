@@ -0,0 +1,132 @@
+import cProfile, os, pstats, shutil, tempfile, threading, unittest
+
+from sensclient.engine import Engine
+from sensclient.profiling import Profiler, StageTimer, collapse_profile
+
+
+def inner(n):
+    return sum(i * i for i in range(n))
+
+
+def outer():
+    return inner(20000) + inner(20000)
+
+
+class StageTimerTest(unittest.TestCase):
+
+    def test_one_in_every_pass_is_timed(self):
+        timer = StageTimer()
+        timer.start(every=3)
+        marks = [timer.begin('consumer') for _ in range(7)]
+        self.assertEqual([mark is not None for mark in marks],
+            [True, False, False, True, False, False, True])
+        # keys are sampled separately
+        self.assertIsNotNone(timer.begin('listener'))
+        for mark in marks:
+            if mark is not None:
+                mark = timer.lap(mark, ('consumer', 'decode'))
+                timer.lap(mark, ('consumer', 'upload'))
+        timings = timer.timings()
+        self.assertEqual(sorted(timings), [('consumer', 'decode'), ('consumer', 'upload')])
+        self.assertEqual(timings[('consumer', 'decode')][0], 3)
+        self.assertGreaterEqual(timings[('consumer', 'decode')][1], 0.0)
+
+
+    def test_threads_are_merged(self):
+        timer = StageTimer()
+        timer.start(every=1)
+
+        def work():
+            for _ in range(5):
+                timer.lap(timer.begin('listener'), ('listener',))
+        workers = [threading.Thread(target=work) for _ in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(timer.timings()[('listener',)][0], 15)
+        # starting again clears the timings
+        timer.start(every=1)
+        self.assertEqual(timer.timings(), {})
+        with self.assertRaises(ValueError):
+            timer.start(every=0)
+
+
+class CollapseProfileTest(unittest.TestCase):
+
+    def test_stacks(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        outer()
+        profile.disable()
+        stacks = collapse_profile(pstats.Stats(profile), root='main', threshold=0.0)
+        self.assertTrue(all(stack[0] == 'main' for stack in stacks))
+        under = [stack for stack in stacks if any(frame.startswith('inner (') for frame in stack)]
+        self.assertTrue(under)
+        # inner is only ever reached through outer
+        for stack in under:
+            frames = [frame.split(' ')[0] for frame in stack]
+            self.assertLess(frames.index('outer'), frames.index('inner'))
+        self.assertTrue(all(';' not in frame for stack in stacks for frame in stack))
+        self.assertLessEqual(sum(stacks.values()), pstats.Stats(profile).total_tt * 1.01)
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.engine = Engine()
+        self.profiler = Profiler(StageTimer())
+
+
+    def tearDown(self):
+        self.profiler.stop()
+        self.engine.close()
+        shutil.rmtree(self.path)
+
+
+    def test_stages_dump(self):
+        self.profiler.start(Profiler.STAGES, every=2, engine=self.engine)
+        timer = self.profiler._stages
+        for _ in range(4):
+            mark = timer.begin('consumer')
+            if mark is not None:
+                timer.lap((mark[0] - 0.001, mark[1]), ('consumer', 'up;load'))
+        self.profiler.stop()
+        self.assertFalse(self.profiler.running())
+        filename = os.path.join(self.path, 'stages.txt')
+        self.assertEqual(self.profiler.dump(filename), 1)
+        with open(filename) as f:
+            stack, weight = f.read().split()
+        # two sampled passes of at least a millisecond, scaled up by 2
+        self.assertEqual(stack, 'consumer;up:load')
+        self.assertGreaterEqual(int(weight), 4000)
+        self.assertEqual(os.listdir(self.path), ['stages.txt'])
+
+
+    def test_cpu(self):
+        self.profiler.start(Profiler.CPU, engine=self.engine)
+
+        async def work():
+            outer()
+        self.engine.call(work())
+        self.profiler.stop()
+        stacks = self.profiler.stacks()
+        self.assertEqual(set(stack[0] for stack in stacks), {'sensclient-engine'})
+        self.assertTrue(any(frame.startswith('inner (') for stack in stacks for frame in stack))
+        self.assertEqual(self.profiler.mode(), Profiler.CPU)
+
+
+    def test_memory(self):
+        self.profiler.start(Profiler.MEMORY, engine=self.engine)
+        held = [bytearray(1024) for _ in range(100)]
+        self.profiler.stop()
+        self.assertGreaterEqual(sum(self.profiler.stacks().values()), len(held) * 1024)
+
+
+    def test_invalid_runs(self):
+        with self.assertRaises(ValueError):
+            self.profiler.start('gpu', engine=self.engine)
+        self.profiler.start(Profiler.STAGES, engine=self.engine)
+        with self.assertRaises(RuntimeError):
+            self.profiler.start(Profiler.STAGES, engine=self.engine)
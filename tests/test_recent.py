@@ -0,0 +1,88 @@
+import time, unittest
+from array import array
+
+from sensclient import decoding
+from sensclient.decoding import Oscilloscope, integers_view
+from sensclient.recent import RecentReadings
+
+
+def message(ident=1, count=0, readings=()):
+    return Oscilloscope(1, 256, ident, count, readings)
+
+
+class RecentReadingsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = RecentReadings(messages=4, values=10, motes=2)
+        self.now = time.time()
+
+
+    def add(self, event, device='a', after=0.0):
+        self.cache.add(device, event, self.now + after)
+
+
+    def readings(self, **filters):
+        return [(r['count'], r['readings']) for r in self.cache.query(**filters)]
+
+
+    def test_decoder_readings_are_copied(self):
+        payload = b'\x00\x01\x12\x34\xff\xff'
+        self.add(message(count=1, readings=integers_view(payload, 0, 2)))
+        self.add(message(count=2, readings=integers_view(payload, 2, 4)), after=1)
+        self.add(message(count=3, readings=array('I', [7, 2 ** 32 - 1])), after=2)
+        self.add(message(count=4, readings=[8, 9]), after=3)
+        self.assertEqual(self.readings(), [(1, [1, 0x1234, 0xffff]), (2, [0x1234ffff]),
+            (3, [7, 2 ** 32 - 1]), (4, [8, 9])])
+
+
+    def test_invalid_readings_are_skipped(self):
+        self.add(message(count=1, readings=[-1]))
+        self.add(message(count=2, readings=[2 ** 32]))
+        self.add(message(count=3, readings=['x']))
+        self.assertEqual(self.readings(), [])
+
+
+    def test_readings_wrap_around_the_ring(self):
+        for count in range(5):
+            self.add(message(count=count, readings=range(count * 3, count * 3 + 3)), after=count)
+        # only the last three messages' readings still fit in the ring
+        self.assertEqual(self.readings(), [(2, [6, 7, 8]), (3, [9, 10, 11]), (4, [12, 13, 14])])
+
+
+    def test_long_message_keeps_its_last_readings(self):
+        self.add(message(readings=range(25)))
+        self.assertEqual(self.readings(), [(0, list(range(15, 25)))])
+
+
+    def test_filters(self):
+        self.add(message(ident=1, count=1, readings=[1]), 'a', after=-60)
+        self.add(message(ident=2, count=2, readings=[2]), 'b')
+        self.assertEqual(self.readings(mote=1), [(1, [1])])
+        self.assertEqual(self.readings(device='b'), [(2, [2])])
+        self.assertEqual(self.readings(since=30), [(2, [2])])
+        self.assertEqual(self.readings(last=1), [(2, [2])])
+
+
+    def test_least_recently_heard_mote_is_evicted(self):
+        self.add(message(ident=1))
+        self.add(message(ident=2))
+        self.add(message(ident=1, count=1))
+        self.add(message(ident=3))
+        self.assertEqual(sorted(self.cache.motes()), [('a', 1), ('a', 3)])
+
+
+    def test_messages_without_readings_are_ignored(self):
+        self.cache.add('a', object())
+        self.assertEqual(self.cache.motes(), {})
+
+
+class RecentReadingsWithoutNumpyTest(RecentReadingsTest):
+
+    def setUp(self):
+        self._numpy = decoding.numpy, decoding._numpy_loaded
+        decoding.numpy, decoding._numpy_loaded = None, True
+        RecentReadingsTest.setUp(self)
+
+
+    def tearDown(self):
+        decoding.numpy, decoding._numpy_loaded = self._numpy
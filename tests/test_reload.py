@@ -0,0 +1,236 @@
+import os, shutil, tempfile, time, unittest
+from unittest import mock
+
+from sensclient import client
+from sensclient.configuration import ConfigWatcher, write_config
+from sensclient.listener import Listener
+
+
+def config(devices=(), primary='http://primary', secondary=()):
+    return {
+        'servers': {'primary': primary, 'secondary': list(secondary)},
+        'devices': [{'device': device, 'baudrate': baudrate, 'amrate': amrate}
+            for device, baudrate, amrate in devices]
+    }
+
+
+class FakeListener:
+    '''
+    Stands in for a Listener, recording what is done with it.
+    '''
+
+    def __init__(self, device, baudrate, amrate):
+        self._device = device
+        self._baudrate = client.get_baudrate(baudrate)
+        self._amrate = amrate
+        self._state = Listener.PAUSED
+
+
+    def baudrate(self):
+        return self._baudrate
+
+
+    def amrate(self):
+        return self._amrate
+
+
+    def state(self):
+        return self._state
+
+
+    def is_alive(self):
+        return self._state != Listener.STOPPED
+
+
+    def resume(self):
+        self._state = Listener.RUNNING
+
+
+    def stop(self):
+        self._state = Listener.STOPPED
+
+
+class FakeUploader:
+
+    def __init__(self, server):
+        self._server = server
+
+
+    def server(self):
+        return self._server
+
+
+    def set_server(self, server):
+        self._server = server
+
+
+class ReconcileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.created = []
+        for name, value in (('_listeners', dict()), ('_config', None), ('_server', client.PRIMARY),
+                ('_uploader', None), ('_failover', None), ('_watcher', None), ('_headless', False),
+                ('create_listener', self.create_listener)):
+            patcher = mock.patch.object(client, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+    def create_listener(self, device, baudrate, amrate):
+        self.created.append(device)
+        return FakeListener(device, baudrate, amrate)
+
+
+    def start(self, devices):
+        client._config = config(devices)
+        for device, baudrate, amrate in devices:
+            client._listeners[device] = FakeListener(device, str(baudrate), amrate)
+            client._listeners[device].resume()
+        return dict(client._listeners)
+
+
+    def test_only_changed_devices_are_restarted(self):
+        old = [('a', 115200, 'OSCILLOSCOPE'), ('b', 57600, 'OSCILLOSCOPE'), ('c', 'TELOSB', 'OSCILLOSCOPE'),
+            ('d', 57600, 'OSCILLOSCOPE')]
+        listeners = self.start(old)
+        client.reconcile_devices(config(old)['devices'], config([
+            ('a', 115200, 'OSCILLOSCOPE'),
+            # the same rate written another way
+            ('b', 'MICAZ', 'OSCILLOSCOPE'),
+            ('c', 19200, 'OSCILLOSCOPE'),
+            ('e', 57600, 'OSCILLOSCOPE')])['devices'])
+        self.assertEqual(self.created, ['c', 'e'])
+        self.assertEqual(sorted(client._listeners), ['a', 'b', 'c', 'e'])
+        self.assertIs(client._listeners['a'], listeners['a'])
+        self.assertIs(client._listeners['b'], listeners['b'])
+        self.assertFalse(listeners['c'].is_alive())
+        self.assertFalse(listeners['d'].is_alive())
+        # a restarted device keeps running, a new one waits to be resumed
+        self.assertEqual(client._listeners['c'].state(), Listener.RUNNING)
+        self.assertEqual(client._listeners['e'].state(), Listener.PAUSED)
+
+
+    def test_amrate_changes_restart(self):
+        old = [('a', 115200, 'OSCILLOSCOPE')]
+        listeners = self.start(old)
+        client.reconcile_devices(config(old)['devices'], config([('a', 115200, 'ALL')])['devices'])
+        self.assertEqual(self.created, ['a'])
+        self.assertFalse(listeners['a'].is_alive())
+        self.assertEqual(client._listeners['a'].amrate(), 'ALL')
+
+
+    def test_invalid_baudrates_are_skipped(self):
+        old = [('a', 115200, 'OSCILLOSCOPE')]
+        listeners = self.start(old)
+        client.reconcile_devices(config(old)['devices'], config([('a', 'fast', 'OSCILLOSCOPE')])['devices'])
+        self.assertEqual(self.created, [])
+        self.assertTrue(listeners['a'].is_alive())
+
+
+    def test_current_server_is_kept(self):
+        old = config(secondary=['http://b', 'http://c'])
+        client._server = 1
+        client._uploader = FakeUploader('http://c')
+        client._config = config(secondary=['http://c'])
+        client.reconcile_servers(old['servers'])
+        # renumbered, but still in use
+        self.assertEqual((client._server, client._uploader.server()), (0, 'http://c'))
+
+
+    def test_removed_server_is_dropped(self):
+        old = config(secondary=['http://b'])
+        client._server = 0
+        client._uploader = FakeUploader('http://b')
+        client._failover = mock.Mock()
+        client._config = config(primary='http://other')
+        client.reconcile_servers(old['servers'])
+        self.assertEqual((client._server, client._uploader.server()), (client.PRIMARY, 'http://other'))
+        client._failover.set_servers.assert_called_once_with({client.PRIMARY: 'http://other'}, client.PRIMARY)
+
+
+    def test_apply_config(self):
+        old = [('a', 115200, 'OSCILLOSCOPE'), ('b', 57600, 'OSCILLOSCOPE')]
+        listeners = self.start(old)
+        client._config['servers']['secondary'] = ['http://b']
+        client._server = 0
+        client._uploader = FakeUploader('http://b')
+        client.apply_config(config([('a', 115200, 'OSCILLOSCOPE')]))
+        self.assertEqual(self.created, [])
+        self.assertEqual(list(client._listeners), ['a'])
+        self.assertFalse(listeners['b'].is_alive())
+        self.assertEqual((client._server, client._uploader.server()), (client.PRIMARY, 'http://primary'))
+
+
+class ConfigWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, 'sensclient.json')
+        write_config(config(), self.filename, confirm=False)
+        self.changes = []
+        self.errors = []
+        self.watcher = ConfigWatcher(self.filename, self.changes.append, self.errors.append, interval=0.01)
+
+
+    def tearDown(self):
+        self.watcher.stop()
+        shutil.rmtree(self.path)
+
+
+    def rewrite(self, data):
+        # the change must show in the modification time or the size
+        stamp = os.stat(self.filename).st_mtime_ns
+        if isinstance(data, dict):
+            write_config(data, self.filename, confirm=False)
+        else:
+            with open(self.filename, 'w') as f:
+                f.write(data)
+        os.utime(self.filename, ns=(stamp + 1000000000, stamp + 1000000000))
+
+
+    def test_poll(self):
+        self.assertFalse(self.watcher.poll())
+        self.rewrite(config([('a', 115200, 'OSCILLOSCOPE')]))
+        self.assertTrue(self.watcher.poll())
+        self.assertEqual(self.changes, [config([('a', 115200, 'OSCILLOSCOPE')])])
+        # reported once
+        self.assertFalse(self.watcher.poll())
+
+
+    def test_invalid_files_are_reported_once(self):
+        self.rewrite('{"servers": ')
+        self.assertFalse(self.watcher.poll())
+        self.assertFalse(self.watcher.poll())
+        self.rewrite({'devices': []})
+        self.assertFalse(self.watcher.poll())
+        self.assertEqual([type(error) for error in self.errors], [ValueError, ValueError])
+        self.assertEqual(self.changes, [])
+
+
+    def test_missing_file_is_ignored(self):
+        os.remove(self.filename)
+        self.assertFalse(self.watcher.poll())
+        self.assertEqual(self.errors, [])
+
+
+    def test_watch_another_file(self):
+        other = os.path.join(self.path, 'other.json')
+        write_config(config(primary='http://other'), other, confirm=False)
+        self.watcher.watch(other)
+        self.assertEqual(self.watcher.filename(), other)
+        # taken as already loaded
+        self.assertFalse(self.watcher.poll())
+
+
+    def test_background_thread(self):
+        self.watcher.start()
+        self.rewrite(config(primary='http://other'))
+        deadline = time.monotonic() + 5
+        while not self.changes and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.changes[0]['servers']['primary'], 'http://other')
+
+
+    def test_invalid_interval(self):
+        with self.assertRaises(ValueError):
+            ConfigWatcher(self.filename, print, interval=0)
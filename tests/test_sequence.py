@@ -0,0 +1,94 @@
+import unittest
+
+from sensclient.sequence import SequenceTracker, loss_rate
+
+
+class SequenceTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = SequenceTracker()
+
+
+    def observe(self, *counts, mote=1):
+        return [self.tracker.observe(mote, count) for count in counts]
+
+
+    def test_in_order(self):
+        self.assertEqual(self.observe(5, 6, 7),
+            [SequenceTracker.FIRST, SequenceTracker.IN_ORDER, SequenceTracker.IN_ORDER])
+        stats = self.tracker.mote(1)
+        self.assertEqual((stats['received'], stats['lost'], stats['last']), (3, 0, 7))
+
+
+    def test_gap_then_reordered(self):
+        self.assertEqual(self.observe(1, 4, 2, 3),
+            [SequenceTracker.FIRST, SequenceTracker.GAP, SequenceTracker.REORDERED, SequenceTracker.REORDERED])
+        stats = self.tracker.mote(1)
+        self.assertEqual((stats['received'], stats['lost'], stats['reordered']), (4, 0, 2))
+
+
+    def test_duplicates(self):
+        self.assertEqual(self.observe(1, 2, 2, 1, 3, 1)[2:],
+            [SequenceTracker.DUPLICATE, SequenceTracker.DUPLICATE, SequenceTracker.IN_ORDER,
+                SequenceTracker.DUPLICATE])
+        self.assertEqual(self.tracker.mote(1)['duplicates'], 3)
+        # counts from before the first one seen cannot be told apart
+        self.assertEqual(self.observe(0), [SequenceTracker.DUPLICATE])
+
+
+    def test_wraparound(self):
+        self.assertEqual(self.observe(0xfffe, 0xffff, 0, 1),
+            [SequenceTracker.FIRST] + [SequenceTracker.IN_ORDER] * 3)
+        stats = self.tracker.mote(1)
+        self.assertEqual((stats['wraps'], stats['lost'], stats['last']), (1, 0, 1))
+
+
+    def test_gap_and_reordered_across_the_wrap(self):
+        self.assertEqual(self.observe(0xfffe, 2, 0xffff, 0),
+            [SequenceTracker.FIRST, SequenceTracker.GAP, SequenceTracker.REORDERED, SequenceTracker.REORDERED])
+        stats = self.tracker.mote(1)
+        self.assertEqual((stats['lost'], stats['reordered'], stats['wraps']), (1, 2, 1))
+        self.assertEqual(self.observe(1), [SequenceTracker.REORDERED])
+        self.assertEqual(self.tracker.mote(1)['lost'], 0)
+
+
+    def test_gap_wider_than_the_window(self):
+        self.observe(0, 100)
+        self.assertEqual(self.tracker.mote(1)['lost'], 99)
+        self.assertEqual(self.observe(99, 50), [SequenceTracker.REORDERED, SequenceTracker.REORDERED])
+        self.assertEqual(self.observe(30), [SequenceTracker.RESET])
+
+
+    def test_reset(self):
+        self.assertEqual(self.observe(1000, 1001, 3, 4),
+            [SequenceTracker.FIRST, SequenceTracker.IN_ORDER, SequenceTracker.RESET, SequenceTracker.IN_ORDER])
+        stats = self.tracker.mote(1)
+        self.assertEqual((stats['resets'], stats['received'], stats['lost']), (1, 4, 0))
+
+
+    def test_narrow_counts(self):
+        tracker = SequenceTracker(bits=8, window=8)
+        outcomes = [tracker.observe(1, count % 256) for count in range(250, 262)]
+        self.assertEqual(outcomes[1:], [SequenceTracker.IN_ORDER] * 11)
+        self.assertEqual(tracker.mote(1)['wraps'], 1)
+
+
+    def test_motes_are_separate(self):
+        self.observe(1, 3, mote=1)
+        self.observe(7, 8, mote=2)
+        self.assertEqual(self.tracker.motes(), [1, 2])
+        self.assertIsNone(self.tracker.mote(3))
+        totals = self.tracker.totals()
+        self.assertEqual((totals['motes'], totals['received'], totals['lost']), (2, 4, 1))
+
+
+    def test_invalid_window(self):
+        for window in (0, 65):
+            with self.assertRaises(ValueError):
+                SequenceTracker(window=window)
+
+
+    def test_loss_rate(self):
+        self.assertIsNone(loss_rate({'received': 0, 'lost': 0}))
+        self.observe(0, 4)
+        self.assertEqual(loss_rate(self.tracker.mote(1)), 0.6)
@@ -0,0 +1,125 @@
+import os, shutil, tempfile, unittest
+
+from sensclient.spool import Spool
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+
+    def _segments(self):
+        return sorted(name for name in os.listdir(self.path) if name.endswith('.seg'))
+
+
+    def test_read_does_not_consume(self):
+        spool = Spool(self.path)
+        for i in range(5):
+            spool.append(b'record %d' % i)
+        records, offset = spool.read(3)
+        self.assertEqual(records, [b'record 0', b'record 1', b'record 2'])
+        self.assertEqual(spool.read(3)[0], records)
+        self.assertEqual(spool.backlog(), 5)
+        spool.commit(offset, len(records))
+        self.assertEqual(spool.backlog(), 2)
+        self.assertEqual(spool.read(10)[0], [b'record 3', b'record 4'])
+        spool.close()
+
+
+    def test_read_ahead_of_the_cursor(self):
+        spool = Spool(self.path)
+        for i in range(4):
+            spool.append(b'%d' % i)
+        first, offset = spool.read(2)
+        second, end = spool.read(2, offset=offset)
+        self.assertEqual(first + second, [b'0', b'1', b'2', b'3'])
+        # an offset behind the cursor reads from the cursor
+        spool.commit(end, 4)
+        self.assertEqual(spool.read(10, offset=0)[0], [])
+        spool.close()
+
+
+    def test_reopen_resumes_at_the_cursor(self):
+        spool = Spool(self.path)
+        for i in range(5):
+            spool.append(b'%d' % i)
+        records, offset = spool.read(2)
+        spool.commit(offset, 2)
+        spool.close()
+        spool = Spool(self.path)
+        self.assertEqual(spool.backlog(), 3)
+        self.assertEqual(spool.read(10)[0], [b'2', b'3', b'4'])
+        spool.close()
+
+
+    def test_torn_tail_is_truncated(self):
+        spool = Spool(self.path)
+        spool.append(b'whole')
+        spool.append(b'torn record')
+        spool.close()
+        segment = os.path.join(self.path, self._segments()[-1])
+        with open(segment, 'r+b') as f:
+            f.truncate(os.path.getsize(segment) - 3)
+        spool = Spool(self.path)
+        self.assertEqual(spool.backlog(), 1)
+        spool.append(b'after')
+        self.assertEqual(spool.read(10)[0], [b'whole', b'after'])
+        spool.close()
+
+
+    def test_corrupt_tail_is_truncated(self):
+        spool = Spool(self.path)
+        spool.append(b'whole')
+        spool.append(b'corrupt')
+        spool.close()
+        segment = os.path.join(self.path, self._segments()[-1])
+        with open(segment, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b'!')
+        spool = Spool(self.path)
+        self.assertEqual(spool.read(10)[0], [b'whole'])
+        spool.close()
+
+
+    def test_records_span_segments(self):
+        spool = Spool(self.path, segment_bytes=64)
+        records = [b'%02d' % i * 8 for i in range(20)]
+        for record in records:
+            spool.append(record)
+        self.assertGreater(len(self._segments()), 1)
+        read, offset = spool.read(100, max_bytes=32)
+        self.assertEqual(read, records)
+        spool.commit(offset, len(read))
+        # delivered segments are deleted
+        self.assertEqual(len(self._segments()), 1)
+        spool.close()
+
+
+    def test_cap_drops_the_oldest_segments(self):
+        spool = Spool(self.path, max_bytes=256, segment_bytes=64)
+        for i in range(100):
+            spool.append(b'%03d' % i * 4)
+        self.assertLessEqual(spool.size(), 256 + 64)
+        stats = spool.stats()
+        self.assertGreater(stats['dropped'], 0)
+        self.assertEqual(stats['dropped'] + spool.backlog(), 100)
+        records = spool.read(100)[0]
+        self.assertEqual(records[-1], b'099' * 4)
+        self.assertEqual(len(records), spool.backlog())
+        spool.close()
+
+
+    def test_bad_cursor_restarts_at_the_oldest_segment(self):
+        spool = Spool(self.path)
+        spool.append(b'a')
+        spool.close()
+        with open(os.path.join(self.path, 'cursor'), 'w') as f:
+            f.write('not a number')
+        spool = Spool(self.path)
+        self.assertEqual(spool.read(10)[0], [b'a'])
+        spool.close()
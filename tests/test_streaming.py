@@ -0,0 +1,106 @@
+import asyncio, unittest
+
+import aiohttp
+from aiohttp import web
+
+from sensclient.streaming import Stream, decode_frame, encode_frame
+
+
+class StreamServer:
+    '''
+    Accepts one stream and acknowledges its frames once told to.
+    '''
+
+    def __init__(self):
+        self.frames = []
+        self.acking = False
+
+
+    async def handle(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                await ws.send_json({'acked': 0})
+            elif msg.type == aiohttp.WSMsgType.BINARY:
+                seq, readings = decode_frame(msg.data)
+                self.frames.append((seq, readings))
+                if self.acking:
+                    await ws.send_json({'ack': seq})
+        return ws
+
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/stream', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        return 'ws://127.0.0.1:{}/stream'.format(site._server.sockets[0].getsockname()[1])
+
+
+class StreamTest(unittest.TestCase):
+
+    def run_stream(self, test, **settings):
+        async def run():
+            server = StreamServer()
+            url = await server.start()
+            try:
+                async with aiohttp.ClientSession() as session:
+                    stream = Stream(session, url, **dict(dict(timeout=0.1), **settings))
+                    try:
+                        await test(server, stream)
+                    finally:
+                        await stream.close()
+            finally:
+                await server.runner.cleanup()
+        asyncio.run(run())
+
+
+    def test_frames(self):
+        frame = encode_frame(7, [b'{"a": 1}', b'[2]'])
+        self.assertEqual(decode_frame(frame), (7, [{'a': 1}, [2]]))
+        with self.assertRaises(ValueError):
+            decode_frame(frame[:-1])
+
+
+    def test_acknowledged(self):
+        async def test(server, stream):
+            server.acking = True
+            self.assertTrue(await stream.send([b'1', b'2']))
+            self.assertEqual(server.frames, [(1, [1, 2])])
+            self.assertEqual((stream.stats()['acked'], stream.stats()['unacked']), (1, 0))
+        self.run_stream(test)
+
+
+    def test_keyed_batches_wait_on_their_frame(self):
+        async def test(server, stream):
+            self.assertFalse(await stream.send([b'1'], key='a'))
+            self.assertFalse(await stream.send([b'1'], key='a'))
+            server.acking = True
+            self.assertTrue(await stream.send([b'2']))
+            # the second send of the keyed batch was no new frame
+            self.assertEqual([seq for seq, _ in server.frames], [1, 2])
+        self.run_stream(test)
+
+
+    def test_window_evicts_the_oldest_frames(self):
+        async def test(server, stream):
+            late = []
+            self.assertFalse(await stream.send([b'1'], late=lambda *outcome: late.append(outcome)))
+            self.assertFalse(await stream.send([b'2']))
+            self.assertFalse(await stream.send([b'3'], late=lambda *outcome: late.append(outcome)))
+            self.assertEqual((stream.stats()['unacked'], stream.stats()['evicted']), (2, 1))
+            self.assertEqual(late, [(1, False)])
+            # acknowledging a later frame acknowledges the late one
+            server.acking = True
+            self.assertTrue(await stream.send([b'4', b'5']))
+            self.assertEqual(late, [(1, False), (1, True)])
+            self.assertEqual(stream.stats()['unacked'], 0)
+        self.run_stream(test, window=2)
+
+
+    def test_invalid_window(self):
+        with self.assertRaises(ValueError):
+            Stream(None, 'ws://server', window=0)
@@ -0,0 +1,171 @@
+import os, shutil, tempfile, time, unittest
+
+import simplejson
+from aiohttp import web
+
+from sensclient import columnar
+from sensclient.engine import Engine
+from sensclient.spool import Spool
+from sensclient.uploader import Uploader
+
+
+class UploadServer:
+    '''
+    Accepts uploads, answering with the statuses it is told to and HTTP
+    200 after those.
+    '''
+
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.requests = []
+
+
+    async def handle(self, request):
+        # aiohttp decompresses gzipped bodies itself
+        body = await request.read()
+        status = self.statuses.pop(0) if self.statuses else 200
+        self.requests.append((request.headers.get('Content-Type'),
+            request.headers.get('Content-Encoding'), body, status))
+        return web.Response(status=status)
+
+
+    def readings(self):
+        readings = []
+        for content_type, _, body, status in self.requests:
+            if status < 300:
+                if content_type == columnar.MEDIA_TYPE:
+                    readings.extend(columnar.decode(body))
+                else:
+                    readings.extend(simplejson.loads(body)['readings'])
+        return readings
+
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/upload', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        return '127.0.0.1:{}'.format(site._server.sockets[0].getsockname()[1])
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class UploaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.engine = Engine()
+        self._retry = Uploader.RETRY_MIN
+        Uploader.RETRY_MIN = 0.01
+        self.uploader = None
+
+
+    def tearDown(self):
+        Uploader.RETRY_MIN = self._retry
+        if self.uploader is not None:
+            self.uploader.close(5)
+        self.engine.close()
+        shutil.rmtree(self.path)
+
+
+    def start(self, server, **settings):
+        address = self.engine.call(server.start())
+        self.uploader = Uploader(address, engine=self.engine,
+            **dict(dict(batch_size=3, flush_interval=3600), **settings))
+        self.uploader.start()
+        return self.uploader
+
+
+    def submit(self, uploader, readings=7):
+        for i in range(readings):
+            uploader.submit({'device': 'a', 'ts': 1.0 + i, 'version': 1, 'interval': 256, 'id': 1,
+                'count': i, 'readings': [i, i + 1]})
+
+
+    def test_batches(self):
+        server = UploadServer()
+        uploader = self.start(server)
+        self.submit(uploader)
+        self.assertTrue(wait_until(lambda: len(server.requests) == 2))
+        # the last reading waits for its batch to fill up
+        time.sleep(0.05)
+        self.assertEqual(len(server.requests), 2)
+        uploader.close(5)
+        self.assertEqual(sorted(len(simplejson.loads(r[2])['readings']) for r in server.requests), [1, 3, 3])
+        self.assertEqual(sorted(r['count'] for r in server.readings()), list(range(7)))
+        stats = uploader.stats()
+        self.assertEqual((stats['requests'], stats['sent'], stats['failed']), (3, 7, 0))
+
+
+    def test_flush_interval(self):
+        server = UploadServer()
+        uploader = self.start(server, batch_size=100, flush_interval=0.05)
+        self.submit(uploader, 2)
+        self.assertTrue(wait_until(lambda: len(server.requests) == 1))
+        self.assertEqual(len(server.readings()), 2)
+
+
+    def test_gzip(self):
+        server = UploadServer()
+        uploader = self.start(server, compress=True)
+        self.submit(uploader, 3)
+        self.assertTrue(wait_until(lambda: uploader.stats()['sent'] == 3))
+        self.assertEqual(server.requests[0][:2], ('application/json', 'gzip'))
+        self.assertEqual([r['count'] for r in server.readings()], [0, 1, 2])
+        self.assertLess(uploader.stats()['bytes'], len(server.requests[0][2]))
+
+
+    def test_columnar_falls_back_to_json(self):
+        server = UploadServer([415])
+        uploader = self.start(server, format=Uploader.COLUMNAR)
+        self.submit(uploader, 3)
+        self.assertTrue(wait_until(lambda: uploader.stats()['sent'] == 3))
+        self.assertEqual([r[0] for r in server.requests], [columnar.MEDIA_TYPE, 'application/json'])
+        self.assertEqual(uploader.stats()['format'], Uploader.JSON)
+
+
+    def test_failures(self):
+        server = UploadServer([500])
+        uploader = self.start(server)
+        self.submit(uploader, 6)
+        self.assertTrue(wait_until(lambda: uploader.stats()['sent'] + uploader.stats()['failed'] == 6))
+        # without a spool a rejected batch is lost
+        stats = uploader.stats()
+        self.assertEqual((stats['sent'], stats['failed']), (3, 3))
+        self.assertEqual(len(server.readings()), 3)
+
+
+    def test_unreachable_server(self):
+        uploader = Uploader('127.0.0.1:1', engine=self.engine, timeout=2)
+        uploader.start()
+        self.assertFalse(self.engine.call(uploader.send([b'{"count": 0}'])))
+        self.assertEqual(uploader.stats()['failed'], 1)
+        uploader.close(5)
+
+
+    def test_spool_hand_off(self):
+        server = UploadServer([500, 503])
+        spool = Spool(os.path.join(self.path, 'spool'))
+        uploader = self.start(server, spool=spool, flush_interval=0.05)
+        self.submit(uploader)
+        # rejected readings stay in the spool until they are delivered
+        self.assertTrue(wait_until(lambda: spool.backlog() == 0))
+        # batches accepted in a round that failed are sent again
+        self.assertEqual(set(r['count'] for r in server.readings()), set(range(7)))
+        stats = uploader.stats()
+        self.assertEqual((stats['sent'], stats['pending']), (7, 0))
+        self.assertGreater(stats['failed'], 0)
+        uploader.close(5)
+        self.assertEqual(Spool(os.path.join(self.path, 'spool')).backlog(), 0)
+
+
+    def test_invalid_format(self):
+        with self.assertRaises(ValueError):
+            Uploader('server', engine=self.engine, format='xml')